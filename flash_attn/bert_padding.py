@@ -1,5 +1,8 @@
 # Adapted from https://github.com/mlcommons/training_results_v1.1/blob/main/NVIDIA/benchmarks/bert/implementations/pytorch/padding.py
 
+from dataclasses import dataclass, fields, replace
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
 from einops import rearrange, repeat
@@ -216,3 +219,83 @@ def pad_input(hidden_states, indices, batch, seqlen):
     # output[indices] = hidden_states
     output = index_put_first_axis(hidden_states, indices, batch * seqlen)
     return rearrange(output, "(b s) ... -> b s ...", b=batch)
+
+
+@dataclass
+class PackedBatch:
+    """Unpadding metadata of a batch: which tokens are kept, and where each sequence starts.
+
+    Built once per batch by from_mask, then passed to every layer (e.g. as mixer_kwargs of Block,
+    for MHA) instead of recomputing it. Building it needs a device sync (nonzero and the max
+    sequence length). Build it on the host, e.g. in the collator, then move it with .to(device)
+    so that the forward pass doesn't sync at all.
+    Attributes:
+        indices: (total_nnz,), the indices of the kept tokens in the flattened (batch * seqlen).
+        cu_seqlens: (batch + 1,), int32, the cumulative sequence lengths.
+        max_seqlen: int.
+        subset_idx: (total_subset,), optional. Indices into the kept tokens of a subset of them
+            (e.g. the tokens the last layer needs to compute).
+        subset_cu_seqlens: (batch + 1,), int32, the cumulative sequence lengths of the subset.
+    """
+
+    batch_size: int
+    seqlen: int
+    indices: torch.Tensor
+    cu_seqlens: torch.Tensor
+    max_seqlen: int
+    subset_idx: Optional[torch.Tensor] = None
+    subset_cu_seqlens: Optional[torch.Tensor] = None
+
+    @classmethod
+    def from_mask(cls, attention_mask, subset_mask=None, **kwargs):
+        """
+        Arguments:
+            attention_mask: (batch, seqlen), bool, True means valid.
+            subset_mask: (batch, seqlen), bool, optional.
+            kwargs: extra fields of subclasses.
+        """
+        batch_size, seqlen = attention_mask.shape
+        seqlens = attention_mask.sum(dim=-1, dtype=torch.int32)
+        indices = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
+        cu_seqlens = F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+        subset_idx, subset_cu_seqlens = None, None
+        if subset_mask is not None:
+            subset_idx = torch.nonzero(subset_mask.flatten()[indices], as_tuple=False).flatten()
+            subset_seqlens = (subset_mask & attention_mask).sum(dim=-1, dtype=torch.int32)
+            subset_cu_seqlens = F.pad(
+                torch.cumsum(subset_seqlens, dim=0, dtype=torch.int32), (1, 0)
+            )
+        return cls(
+            batch_size=batch_size,
+            seqlen=seqlen,
+            indices=indices,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=seqlens.max().item(),
+            subset_idx=subset_idx,
+            subset_cu_seqlens=subset_cu_seqlens,
+            **kwargs,
+        )
+
+    def to(self, device, non_blocking=False):
+        return replace(
+            self,
+            **{
+                f.name: getattr(self, f.name).to(device, non_blocking=non_blocking)
+                for f in fields(self)
+                if isinstance(getattr(self, f.name), torch.Tensor)
+            },
+        )
+
+    def subset_rows(self, mask):
+        """Indices of the rows of the subset (ordered as subset_idx) where @mask (batch, seqlen)
+        is True."""
+        positions = self.indices[self.subset_idx]
+        return torch.nonzero(mask.flatten()[positions], as_tuple=False).flatten()
+
+    def unpad(self, hidden_states):
+        """(batch, seqlen, ...) -> (total_nnz, ...)"""
+        return index_first_axis(rearrange(hidden_states, "b s ... -> (b s) ..."), self.indices)
+
+    def pad(self, hidden_states):
+        """(total_nnz, ...) -> (batch, seqlen, ...)"""
+        return pad_input(hidden_states, self.indices, self.batch_size, self.seqlen)
@@ -1,6 +1,6 @@
 import torch
 import math
-from .utils import DEBUG
+from .utils import DEBUG, get_varlen_bucket_mask, get_varlen_buckets
 
 def attention_backward_core_ref_impl(
     do, q, k, v, o, softmax_lse, sm_scale, causal, use_exp2
@@ -138,13 +138,13 @@ def attention_varlen_backward_pytorch_ref_impl(
     if layout != 'thd':
         raise ValueError(f"Unsupported layout {layout}. Expected 'thd'.")
 
-    batch_size = cu_seqlens_q.shape[0] - 1
     num_heads = q.shape[1]
+    num_heads_k = k.shape[1]
     head_dim = q.shape[2]
+    group_size = num_heads // num_heads_k
 
     # Pre-allocate outputs
     total_L_q = q.shape[0]
-    total_L_k = k.shape[0]
 
     dq = torch.zeros_like(q)
     dk = torch.zeros_like(k)
@@ -152,56 +152,51 @@ def attention_varlen_backward_pytorch_ref_impl(
     # delta has the same shape as softmax_lse: [total_L_q, num_heads]
     delta = torch.zeros((total_L_q, num_heads), dtype=torch.float32, device=o.device)
 
-    for i in range(batch_size):
-        # Get the start and end indices for the current sequence
-        start_q = cu_seqlens_q[i].item()
-        end_q = cu_seqlens_q[i + 1].item()
-        start_k = cu_seqlens_k[i].item()
-        end_k = cu_seqlens_k[i + 1].item()
-
-        # Extract q_i, k_i, v_i, do_i, o_i, softmax_lse_i
-        q_i = q[start_q:end_q, :, :]      # [L_q_i, num_heads, head_dim]
-        k_i = k[start_k:end_k, :, :]      # [L_k_i, num_heads, head_dim]
-        v_i = v[start_k:end_k, :, :]      # [L_k_i, num_heads, head_dim]
-        do_i = do[start_q:end_q, :, :]    # [L_q_i, num_heads, head_dim]
-        o_i = o[start_q:end_q, :, :]      # [L_q_i, num_heads, head_dim]
-        # softmax_lse has shape [total_L_q, num_heads]
-        softmax_lse_i = softmax_lse[start_q:end_q, :]  # [L_q_i, num_heads]
-        softmax_lse_i = softmax_lse_i.transpose(0, 1)  # [num_heads, L_q_i]
-
-        # Permute to [num_heads, L_q_i, head_dim]
-        q_i = q_i.permute(1, 0, 2)
-        k_i = k_i.permute(1, 0, 2)
-        v_i = v_i.permute(1, 0, 2)
-        do_i = do_i.permute(1, 0, 2)
-        o_i = o_i.permute(1, 0, 2)
-        # softmax_lse_i is already in [num_heads, L_q_i]
-
-        # Call the core backward function for this sequence
-        dq_i, dk_i, dv_i, delta_i = attention_backward_core_ref_impl(
-            do_i,
-            q_i,
-            k_i,
-            v_i,
-            o_i,
-            softmax_lse_i,
-            sm_scale,
-            causal,
-            use_exp2
-        )
-
-        # Convert back to 'thd' layout
-        dq_i = dq_i.permute(1, 0, 2)  # [L_q_i, num_heads, head_dim]
-        dk_i = dk_i.permute(1, 0, 2)  # [L_k_i, num_heads, head_dim]
-        dv_i = dv_i.permute(1, 0, 2)  # [L_k_i, num_heads, head_dim]
-
-        # Place outputs in pre-allocated tensors
-        dq[start_q:end_q, :, :] = dq_i
-        dk[start_k:end_k, :, :] += dk_i  # Accumulate gradients for shared keys
-        dv[start_k:end_k, :, :] += dv_i  # Accumulate gradients for shared values
-        # delta_i has shape [num_heads, L_q_i]
-        delta_i = delta_i.transpose(1, 0)  # [L_q_i, num_heads]
-        delta[start_q:end_q, :] = delta_i
+    # Sequences of similar length are padded together and processed as one batched matmul
+    for q_idx, q_valid, k_idx, k_valid, seqlens_q, seqlens_k in get_varlen_buckets(
+        cu_seqlens_q, cu_seqlens_k, q.device
+    ):
+        # Gather to [n, L, num_heads, head_dim] and permute to [n, num_heads, L, head_dim]
+        do_b = do[q_idx].permute(0, 2, 1, 3).to(torch.float32)
+        q_b = q[q_idx].permute(0, 2, 1, 3).to(torch.float32)
+        o_b = o[q_idx].permute(0, 2, 1, 3).to(torch.float32)
+        k_b = k[k_idx].permute(0, 2, 1, 3).to(torch.float32)
+        v_b = v[k_idx].permute(0, 2, 1, 3).to(torch.float32)
+        if group_size > 1:
+            k_b = k_b.repeat_interleave(group_size, dim=1)
+            v_b = v_b.repeat_interleave(group_size, dim=1)
+        # softmax_lse: [total_L_q, num_heads] -> [n, num_heads, L_q]
+        softmax_lse_b = softmax_lse[q_idx].permute(0, 2, 1).to(torch.float32)
+        mask = get_varlen_bucket_mask(q_valid, k_valid, seqlens_q, seqlens_k, causal)
+
+        # recompute probabilities using softmax_lse. Padded rows and columns get p == 0.
+        attention_scaled_scores = sm_scale * torch.matmul(q_b, k_b.transpose(-2, -1))
+        attention_scaled_scores = attention_scaled_scores.masked_fill(torch.logical_not(mask), float('-inf'))
+        if use_exp2:
+            RCP_LN = 1 / math.log(2)
+            p = torch.exp2(RCP_LN * (attention_scaled_scores - softmax_lse_b.unsqueeze(-1)))
+        else:
+            p = torch.exp(attention_scaled_scores - softmax_lse_b.unsqueeze(-1))
+
+        dv_b = torch.matmul(p.transpose(-2, -1), do_b)
+        dp = torch.matmul(do_b, v_b.transpose(-2, -1))
+        delta_b = torch.sum(o_b * do_b, axis=-1)  # what OAI kernel uses
+        ds = (p * (dp - delta_b.unsqueeze(-1))) * sm_scale
+        dk_b = torch.matmul(ds.transpose(-2, -1), q_b)
+        dq_b = torch.matmul(ds, k_b)
+        if group_size > 1:
+            # Sum the gradients of the query heads that share a kv head
+            n, _, L_k, _ = dk_b.shape
+            dk_b = dk_b.view(n, num_heads_k, group_size, L_k, head_dim).sum(dim=2)
+            dv_b = dv_b.view(n, num_heads_k, group_size, L_k, head_dim).sum(dim=2)
+
+        # Scatter the valid rows back to the 'thd' layout, cast like attention_backward_core_ref_impl
+        rows_q = q_idx[q_valid]
+        rows_k = k_idx[k_valid]
+        dq[rows_q] = dq_b.to(torch.float16).permute(0, 2, 1, 3)[q_valid].to(dq.dtype)
+        dk[rows_k] = dk_b.to(torch.float16).permute(0, 2, 1, 3)[k_valid].to(dk.dtype)
+        dv[rows_k] = dv_b.to(torch.float16).permute(0, 2, 1, 3)[k_valid].to(dv.dtype)
+        delta[rows_q] = delta_b.permute(0, 2, 1)[q_valid]
 
     return dq, dk, dv, delta
 
@@ -0,0 +1,135 @@
+import torch
+from .fwd_tiled import BLOCK_M, BLOCK_N, compute_tile_scores, exp_tile, expand_kv_heads
+from .utils import DEBUG
+
+
+def attention_backward_tiled_core(
+    do, q, k, v, o, softmax_lse, sm_scale, causal, alibi_slopes, use_exp2,
+    block_m=BLOCK_M, block_n=BLOCK_N,
+):
+    """Blockwise backward over (batch, nheads, seqlen, head_dim) tensors.
+
+    Probabilities are recomputed per tile from softmax_lse (the FlashAttention-2 backward), with
+    K/V tiles in the outer loop so dk/dv of a tile are accumulated locally and dq is accumulated
+    across K/V tiles. GQA gradients are summed over the query heads that share a KV head.
+    Returns fp32 dq, dk, dv and delta = rowsum(o * do) of shape (batch, nheads_q, seqlen_q).
+    """
+    batch, nheads_q, seqlen_q, _ = q.shape
+    nheads_k, seqlen_k = k.shape[1], k.shape[2]
+    assert nheads_q % nheads_k == 0
+    group_size = nheads_q // nheads_k
+
+    delta = torch.sum(o.to(torch.float32) * do.to(torch.float32), dim=-1)
+    softmax_lse = softmax_lse.to(torch.float32)
+    dq = torch.zeros(q.shape, dtype=torch.float32, device=q.device)
+    dk = torch.zeros(k.shape, dtype=torch.float32, device=k.device)
+    dv = torch.zeros(v.shape, dtype=torch.float32, device=v.device)
+
+    for n_start in range(0, seqlen_k, block_n):
+        n_end = min(n_start + block_n, seqlen_k)
+        k_tile = expand_kv_heads(k[:, :, n_start:n_end].to(torch.float32), group_size)
+        v_tile = expand_kv_heads(v[:, :, n_start:n_end].to(torch.float32), group_size)
+        dk_tile = torch.zeros_like(k_tile)
+        dv_tile = torch.zeros_like(v_tile)
+        # With causal masking, queries before this row cannot see any key of the tile.
+        m_begin = max(0, n_start - (seqlen_k - seqlen_q)) if causal else 0
+        for m_start in range(m_begin, seqlen_q, block_m):
+            m_end = min(m_start + block_m, seqlen_q)
+            q_tile = q[:, :, m_start:m_end].to(torch.float32)
+            do_tile = do[:, :, m_start:m_end].to(torch.float32)
+            scores = compute_tile_scores(
+                q_tile, k_tile, sm_scale, causal, alibi_slopes, m_start, n_start, seqlen_q, seqlen_k
+            )
+            p = exp_tile(scores - softmax_lse[:, :, m_start:m_end, None], use_exp2)
+            dv_tile += torch.matmul(p.transpose(-2, -1), do_tile)
+            dp = torch.matmul(do_tile, v_tile.transpose(-2, -1))
+            ds = p * (dp - delta[:, :, m_start:m_end, None]) * sm_scale
+            dk_tile += torch.matmul(ds.transpose(-2, -1), q_tile)
+            dq[:, :, m_start:m_end] += torch.matmul(ds, k_tile)
+
+        n = n_end - n_start
+        dk[:, :, n_start:n_end] = dk_tile.view(batch, nheads_k, group_size, n, -1).sum(dim=2)
+        dv[:, :, n_start:n_end] = dv_tile.view(batch, nheads_k, group_size, n, -1).sum(dim=2)
+
+    return dq, dk, dv, delta
+
+
+def attention_backward_tiled_impl(
+    do,
+    q,
+    k,
+    v,
+    o,
+    softmax_lse,
+    sm_scale,
+    causal,
+    layout,
+    cu_seqlens_q,
+    cu_seqlens_k,
+    max_seqlen_q,
+    max_seqlen_k,
+    alibi_slopes,
+    use_exp2,
+    block_m=BLOCK_M,
+    block_n=BLOCK_N,
+):
+    """Blockwise counterpart of attention_backward_pytorch_ref_impl, returning (dq, dk, dv, delta)."""
+    if DEBUG:
+        print()
+        print("attention_backward_tiled_impl")
+        print("do:", do.shape)
+        print("q:", q.shape)
+        print("k:", k.shape)
+        print("v:", v.shape)
+        print("softmax_lse:", softmax_lse.shape)
+        print("sm_scale:", sm_scale)
+        print("causal:", causal)
+        print("layout:", layout)
+        print("alibi_slopes:", alibi_slopes)
+        print("use_exp2:", use_exp2)
+
+    if layout == "thd":
+        dq = torch.empty_like(q)
+        dk = torch.empty_like(k)
+        dv = torch.empty_like(v)
+        delta = torch.empty((q.shape[0], q.shape[1]), dtype=torch.float32, device=q.device)
+        cu_seqlens_q_host = cu_seqlens_q.tolist()
+        cu_seqlens_k_host = cu_seqlens_k.tolist()
+        for i in range(len(cu_seqlens_q_host) - 1):
+            start_q, end_q = cu_seqlens_q_host[i], cu_seqlens_q_host[i + 1]
+            start_k, end_k = cu_seqlens_k_host[i], cu_seqlens_k_host[i + 1]
+            # [L_i, num_heads, head_dim] -> [1, num_heads, L_i, head_dim]
+            dq_i, dk_i, dv_i, delta_i = attention_backward_tiled_core(
+                do[start_q:end_q].transpose(0, 1).unsqueeze(0),
+                q[start_q:end_q].transpose(0, 1).unsqueeze(0),
+                k[start_k:end_k].transpose(0, 1).unsqueeze(0),
+                v[start_k:end_k].transpose(0, 1).unsqueeze(0),
+                o[start_q:end_q].transpose(0, 1).unsqueeze(0),
+                softmax_lse[start_q:end_q].transpose(0, 1).unsqueeze(0),
+                sm_scale,
+                causal,
+                alibi_slopes[i : i + 1] if alibi_slopes is not None else None,
+                use_exp2,
+                block_m=block_m,
+                block_n=block_n,
+            )
+            dq[start_q:end_q] = dq_i[0].transpose(0, 1)
+            dk[start_k:end_k] = dk_i[0].transpose(0, 1)
+            dv[start_k:end_k] = dv_i[0].transpose(0, 1)
+            delta[start_q:end_q] = delta_i[0].transpose(0, 1)
+        return dq, dk, dv, delta
+
+    if layout == "bshd":
+        do, q, k, v, o = [x.transpose(1, 2) for x in (do, q, k, v, o)]
+    elif layout != "bhsd":
+        raise ValueError(f"Unknown layout {layout}")
+
+    dq, dk, dv, delta = attention_backward_tiled_core(
+        do, q, k, v, o, softmax_lse, sm_scale, causal, alibi_slopes, use_exp2,
+        block_m=block_m, block_n=block_n,
+    )
+    dq, dk, dv = dq.to(q.dtype), dk.to(k.dtype), dv.to(v.dtype)
+    if layout == "bshd":
+        dq, dk, dv = dq.transpose(1, 2), dk.transpose(1, 2), dv.transpose(1, 2)
+
+    return dq, dk, dv, delta
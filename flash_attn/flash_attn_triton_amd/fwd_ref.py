@@ -1,6 +1,6 @@
 import torch
 import math
-from .utils import DEBUG
+from .utils import DEBUG, get_varlen_bucket_mask, get_varlen_buckets
 
 def attention_forward_core_ref_impl(q, k, v, sm_scale, causal, use_exp2):
     if DEBUG:
@@ -166,59 +166,52 @@ def attention_varlen_forward_pytorch_ref_impl(
     if layout != 'thd':
         raise ValueError(f"Unsupported layout {layout}. Expected 'thd'.")
 
-    batch_size = cu_seqlens_q.shape[0] - 1
     num_heads = q.shape[1]
     head_dim = q.shape[2]
+    group_size = num_heads // k.shape[1]
 
     # Pre-allocate outputs
     total_L_q = q.shape[0]
-    total_L_k = k.shape[0]
 
     o = torch.empty((total_L_q, num_heads, head_dim), dtype=q.dtype, device=q.device)
     softmax_lse = torch.empty((total_L_q, num_heads), dtype=torch.float32, device=q.device)
 
-    for i in range(batch_size):
-        # Get the start and end indices for the current sequence
-        start_q = cu_seqlens_q[i].item()
-        end_q = cu_seqlens_q[i + 1].item()
-        start_k = cu_seqlens_k[i].item()
-        end_k = cu_seqlens_k[i + 1].item()
-
-        # Extract q_i, k_i, v_i
-        q_i = q[start_q:end_q, :, :]  # [L_q_i, num_heads, head_dim]
-        k_i = k[start_k:end_k, :, :]  # [L_k_i, num_heads, head_dim]
-        v_i = v[start_k:end_k, :, :]  # [L_k_i, num_heads, head_dim]
-
-        # Permute to [num_heads, L_q_i, head_dim]
-        q_i = q_i.permute(1, 0, 2)
-        k_i = k_i.permute(1, 0, 2)
-        v_i = v_i.permute(1, 0, 2)
-
-        # Call the core attention function for this sequence
-        (
-            o_i,
-            softmax_lse_i,
-            exp_scores_i,
-            softmax_i,
-            attention_shifted_scaled_scores_i,
-            attention_scaled_scores_i,
-            attention_scores_i,
-        ) = attention_forward_core_ref_impl(q_i, k_i, v_i, sm_scale, causal, use_exp2)
-
-        # Convert back to 'thd' layout and float16
-        o_i = o_i.permute(1, 0, 2).to(torch.float16)  # [L_q_i, num_heads, head_dim]
-
-        # Place outputs in pre-allocated tensors
-        o[start_q:end_q, :, :] = o_i
-        softmax_lse[start_q:end_q, :] = softmax_lse_i.transpose(0, 1)  # Transpose to [L_q_i, num_heads]
-
-        # For variable-sized outputs, map them into the preallocated tensors
-        # exp_scores_i: [num_heads, L_q_i, L_k_i] -> [L_q_i, num_heads, L_k_i]
-        exp_scores_i = exp_scores_i.permute(1, 0, 2)
-        softmax_i = softmax_i.permute(1, 0, 2)
-        attention_shifted_scaled_scores_i = attention_shifted_scaled_scores_i.permute(1, 0, 2)
-        attention_scaled_scores_i = attention_scaled_scores_i.permute(1, 0, 2)
-        attention_scores_i = attention_scores_i.permute(1, 0, 2)
+    # Sequences of similar length are padded together and processed as one batched matmul
+    for q_idx, q_valid, k_idx, k_valid, seqlens_q, seqlens_k in get_varlen_buckets(
+        cu_seqlens_q, cu_seqlens_k, q.device
+    ):
+        # Gather to [n, L, num_heads, head_dim] and permute to [n, num_heads, L, head_dim]
+        q_b = q[q_idx].permute(0, 2, 1, 3).to(torch.float32)
+        k_b = k[k_idx].permute(0, 2, 1, 3).to(torch.float32)
+        v_b = v[k_idx].permute(0, 2, 1, 3).to(torch.float32)
+        if group_size > 1:
+            k_b = k_b.repeat_interleave(group_size, dim=1)
+            v_b = v_b.repeat_interleave(group_size, dim=1)
+        mask = get_varlen_bucket_mask(q_valid, k_valid, seqlens_q, seqlens_k, causal)
+
+        attention_scaled_scores = sm_scale * torch.matmul(q_b, k_b.transpose(-2, -1))
+        attention_scaled_scores = attention_scaled_scores.masked_fill(torch.logical_not(mask), float('-inf'))
+
+        # Same conventions as attention_forward_core_ref_impl for rows that are fully masked
+        max_scores = torch.max(attention_scaled_scores, dim=-1, keepdim=True)[0]
+        max_scores = torch.where(torch.isinf(max_scores), torch.zeros_like(max_scores), max_scores)
+        attention_shifted_scaled_scores = attention_scaled_scores - max_scores
+        if use_exp2:
+            RCP_LN = 1 / math.log(2)
+            exp_scores = torch.exp2(RCP_LN * attention_shifted_scaled_scores)
+        else:
+            exp_scores = torch.exp(attention_shifted_scaled_scores)
+        sum_exp_scores = torch.sum(exp_scores, dim=-1, keepdim=True)
+        sum_exp_scores = torch.where(sum_exp_scores == 0, torch.ones_like(sum_exp_scores), sum_exp_scores)
+        softmax = exp_scores / sum_exp_scores
+        softmax_lse_b = (max_scores + torch.log(sum_exp_scores)).squeeze(-1)
+
+        o_b = torch.matmul(softmax, v_b).to(torch.float16)
+
+        # Scatter the valid rows back to the 'thd' layout
+        rows = q_idx[q_valid]
+        o[rows] = o_b.permute(0, 2, 1, 3)[q_valid].to(o.dtype)
+        softmax_lse[rows] = softmax_lse_b.permute(0, 2, 1)[q_valid]
 
     return (
         o,
@@ -0,0 +1,188 @@
+import torch
+import math
+from .utils import DEBUG
+
+# Tile sizes of the blockwise reference. Peak extra memory is
+# O(batch * nheads * BLOCK_M * BLOCK_N) on top of the O(seqlen * head_dim) inputs/outputs.
+BLOCK_M = 128
+BLOCK_N = 128
+
+RCP_LN2 = 1 / math.log(2)
+
+
+def exp_tile(x, use_exp2):
+    if use_exp2:
+        return torch.exp2(RCP_LN2 * x)
+    return torch.exp(x)
+
+
+def expand_kv_heads(x, group_size):
+    """(batch, nheads_k, seqlen, head_dim) -> (batch, nheads_k * group_size, seqlen, head_dim)"""
+    if group_size == 1:
+        return x
+    batch, nheads_k, seqlen, head_dim = x.shape
+    return (
+        x.unsqueeze(2)
+        .expand(batch, nheads_k, group_size, seqlen, head_dim)
+        .reshape(batch, nheads_k * group_size, seqlen, head_dim)
+    )
+
+
+def compute_tile_scores(
+    q_tile, k_tile, sm_scale, causal, alibi_slopes, m_start, n_start, seqlen_q, seqlen_k
+):
+    """Scaled (and masked / biased) scores of one (BLOCK_M, BLOCK_N) tile.
+
+    q_tile: (batch, nheads, block_m, head_dim), fp32
+    k_tile: (batch, nheads, block_n, head_dim), fp32, already expanded to nheads_q
+    alibi_slopes: (batch, nheads) or None
+    The causal mask is aligned to the bottom right corner of the attention matrix, as in the kernels.
+    """
+    scores = torch.matmul(q_tile, k_tile.transpose(-2, -1)) * sm_scale
+    if causal or alibi_slopes is not None:
+        row_idx = torch.arange(
+            m_start, m_start + q_tile.shape[2], device=q_tile.device
+        ).unsqueeze(1)
+        col_idx = torch.arange(
+            n_start, n_start + k_tile.shape[2], device=q_tile.device
+        ).unsqueeze(0)
+        relative_pos = row_idx + seqlen_k - seqlen_q - col_idx  # (block_m, block_n)
+        if alibi_slopes is not None:
+            scores = scores - alibi_slopes.to(torch.float32)[:, :, None, None] * relative_pos.abs()
+        if causal:
+            scores = scores.masked_fill(relative_pos < 0, float("-inf"))
+    return scores
+
+
+def attention_forward_tiled_core(
+    q, k, v, sm_scale, causal, alibi_slopes, use_exp2, block_m=BLOCK_M, block_n=BLOCK_N
+):
+    """Online-softmax forward over (batch, nheads, seqlen, head_dim) tensors.
+
+    K/V are streamed in tiles of block_n keys for every tile of block_m queries while a running
+    row max and row sum are kept, so the full seqlen_q x seqlen_k matrix is never materialized.
+    Returns the fp32 output and softmax_lse of shape (batch, nheads_q, seqlen_q). Rows that are
+    fully masked get a zero output and a softmax_lse of 0, matching the Triton kernel.
+    """
+    batch, nheads_q, seqlen_q, _ = q.shape
+    nheads_k, seqlen_k = k.shape[1], k.shape[2]
+    assert nheads_q % nheads_k == 0
+    group_size = nheads_q // nheads_k
+    head_dim_v = v.shape[-1]
+
+    o = torch.zeros((batch, nheads_q, seqlen_q, head_dim_v), dtype=torch.float32, device=q.device)
+    softmax_lse = torch.zeros((batch, nheads_q, seqlen_q), dtype=torch.float32, device=q.device)
+
+    for m_start in range(0, seqlen_q, block_m):
+        m_end = min(m_start + block_m, seqlen_q)
+        q_tile = q[:, :, m_start:m_end].to(torch.float32)
+        m_i = torch.full(
+            (batch, nheads_q, m_end - m_start, 1), float("-inf"), dtype=torch.float32, device=q.device
+        )
+        l_i = torch.zeros_like(m_i)
+        acc = torch.zeros(
+            (batch, nheads_q, m_end - m_start, head_dim_v), dtype=torch.float32, device=q.device
+        )
+        # With causal masking, keys past the last query row of this tile are never visible.
+        n_stop = min(seqlen_k, max(0, m_end + seqlen_k - seqlen_q)) if causal else seqlen_k
+        for n_start in range(0, n_stop, block_n):
+            n_end = min(n_start + block_n, n_stop)
+            k_tile = expand_kv_heads(k[:, :, n_start:n_end].to(torch.float32), group_size)
+            v_tile = expand_kv_heads(v[:, :, n_start:n_end].to(torch.float32), group_size)
+            scores = compute_tile_scores(
+                q_tile, k_tile, sm_scale, causal, alibi_slopes, m_start, n_start, seqlen_q, seqlen_k
+            )
+            m_new = torch.maximum(m_i, scores.amax(dim=-1, keepdim=True))
+            # Replace -inf with zeros to avoid NaN in subtraction for rows that are still fully masked
+            m_shift = torch.where(torch.isinf(m_new), torch.zeros_like(m_new), m_new)
+            p = exp_tile(scores - m_shift, use_exp2)
+            alpha = exp_tile(m_i - m_shift, use_exp2)
+            l_i = l_i * alpha + p.sum(dim=-1, keepdim=True)
+            acc = acc * alpha + torch.matmul(p, v_tile)
+            m_i = m_new
+
+        m_i = torch.where(torch.isinf(m_i), torch.zeros_like(m_i), m_i)
+        l_i = torch.where(l_i == 0, torch.ones_like(l_i), l_i)
+        o[:, :, m_start:m_end] = acc / l_i
+        softmax_lse[:, :, m_start:m_end] = (m_i + torch.log(l_i)).squeeze(-1)
+
+    return o, softmax_lse
+
+
+def attention_forward_tiled_impl(
+    q,
+    k,
+    v,
+    sm_scale,
+    causal,
+    layout,
+    cu_seqlens_q,
+    cu_seqlens_k,
+    max_seqlen_q,
+    max_seqlen_k,
+    alibi_slopes,
+    use_exp2,
+    block_m=BLOCK_M,
+    block_n=BLOCK_N,
+):
+    """Blockwise counterpart of attention_forward_pytorch_ref_impl.
+
+    Only returns (o, softmax_lse): the intermediate score matrices that the reference returns are
+    exactly what this implementation avoids materializing. softmax_lse is (batch, nheads, seqlen_q)
+    for "bshd"/"bhsd" and (total_q, nheads) for "thd", like the Triton kernel.
+    """
+    if DEBUG:
+        print()
+        print("attention_forward_tiled_impl")
+        print("q:", q.shape)
+        print("k:", k.shape)
+        print("v:", v.shape)
+        print("sm_scale:", sm_scale)
+        print("causal:", causal)
+        print("layout:", layout)
+        print("alibi_slopes:", alibi_slopes)
+        print("use_exp2:", use_exp2)
+
+    if layout == "thd":
+        o = torch.empty_like(q)
+        softmax_lse = torch.empty((q.shape[0], q.shape[1]), dtype=torch.float32, device=q.device)
+        # A single host copy instead of an .item() sync per boundary
+        cu_seqlens_q_host = cu_seqlens_q.tolist()
+        cu_seqlens_k_host = cu_seqlens_k.tolist()
+        for i in range(len(cu_seqlens_q_host) - 1):
+            start_q, end_q = cu_seqlens_q_host[i], cu_seqlens_q_host[i + 1]
+            start_k, end_k = cu_seqlens_k_host[i], cu_seqlens_k_host[i + 1]
+            # [L_i, num_heads, head_dim] -> [1, num_heads, L_i, head_dim]
+            o_i, softmax_lse_i = attention_forward_tiled_core(
+                q[start_q:end_q].transpose(0, 1).unsqueeze(0),
+                k[start_k:end_k].transpose(0, 1).unsqueeze(0),
+                v[start_k:end_k].transpose(0, 1).unsqueeze(0),
+                sm_scale,
+                causal,
+                alibi_slopes[i : i + 1] if alibi_slopes is not None else None,
+                use_exp2,
+                block_m=block_m,
+                block_n=block_n,
+            )
+            o[start_q:end_q] = o_i[0].transpose(0, 1)
+            softmax_lse[start_q:end_q] = softmax_lse_i[0].transpose(0, 1)
+        return o, softmax_lse
+
+    if layout == "bshd":
+        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    elif layout != "bhsd":
+        raise ValueError(f"Unknown layout {layout}")
+
+    o, softmax_lse = attention_forward_tiled_core(
+        q, k, v, sm_scale, causal, alibi_slopes, use_exp2, block_m=block_m, block_n=block_n
+    )
+    o = o.to(q.dtype)
+    if layout == "bshd":
+        o = o.transpose(1, 2)
+
+    if DEBUG:
+        print("attention_forward_tiled_impl outputs")
+        print("o:", o.shape)
+        print("softmax_lse:", softmax_lse.shape)
+
+    return o, softmax_lse
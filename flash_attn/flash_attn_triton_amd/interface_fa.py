@@ -5,9 +5,13 @@ from .bwd_prefill import attention_prefill_backward_triton_impl
 from .fwd_decode import attention_decode_forward_triton_impl
 from .fwd_ref import attention_forward_pytorch_ref_impl
 from .bwd_ref import attention_backward_pytorch_ref_impl
+from .fwd_tiled import attention_forward_tiled_impl
+from .bwd_tiled import attention_backward_tiled_impl
 from .utils import MetaData, get_shape_from_layout, DEBUG
 
 USE_REF = os.environ.get('FLASH_ATTENTION_TRITON_AMD_REF', '0').lower() in ('1', 'true', 'yes')
+# blockwise (online-softmax) reference that never materializes the seqlen_q x seqlen_k matrices
+USE_TILED_REF = os.environ.get('FLASH_ATTENTION_TRITON_AMD_TILED_REF', '0').lower() in ('1', 'true', 'yes')
 
 def fwd(q,
         k,
@@ -44,6 +48,11 @@ def fwd(q,
     if dropout_p != 0.0:
         raise ValueError("dropout is not supported on AMD's Triton Backend yet")
 
+    if return_softmax and USE_TILED_REF:
+        # The tiled reference never materializes the seqlen_q x seqlen_k softmax
+        raise ValueError("return_softmax is not supported by the tiled reference implementation "
+                         "(FLASH_ATTENTION_TRITON_AMD_TILED_REF), unset it to get the softmax")
+
     if o is None:
         o = torch.empty_like(q)
 
@@ -68,7 +77,25 @@ def fwd(q,
     
     # Check arguments
     metadata.check_args(q, k, v, o)
-    if USE_REF:
+    if USE_TILED_REF:
+        if DEBUG:
+            print("Using tiled reference implementation")
+        output, softmax_lse = attention_forward_tiled_impl(
+                                                q,
+                                                k,
+                                                v,
+                                                metadata.sm_scale,
+                                                metadata.causal,
+                                                metadata.layout,
+                                                metadata.cu_seqlens_q,
+                                                metadata.cu_seqlens_k,
+                                                metadata.max_seqlens_q,
+                                                metadata.max_seqlens_k,
+                                                metadata.alibi_slopes,
+                                                metadata.use_exp2)
+        exp_scores = None
+        o.copy_(output)
+    elif USE_REF:
         if DEBUG:
             print("Using reference implementation")
         (output, 
@@ -174,7 +201,31 @@ def bwd(
     if dropout_p != 0.0:
         raise ValueError("dropout is not supported on AMD yet")
 
-    if USE_REF:
+    if USE_TILED_REF:
+        if DEBUG:
+            print("Using tiled reference implementation")
+        dq_ref, dk_ref, dv_ref, delta_ref = attention_backward_tiled_impl(
+            dout,
+            q,
+            k,
+            v,
+            out,
+            softmax_lse,
+            softmax_scale,
+            causal,
+            "bshd",
+            None,
+            None,
+            None,
+            None,
+            alibi_slopes,
+            False,
+        )
+        dq.copy_(dq_ref)
+        dk.copy_(dk_ref)
+        dv.copy_(dv_ref)
+        delta = delta_ref
+    elif USE_REF:
         if DEBUG:
             print("Using reference implementation")
         dq_ref, dk_ref, dv_ref, delta_ref = attention_backward_pytorch_ref_impl(
@@ -272,6 +323,11 @@ def varlen_fwd(
 
     if dropout_p != 0.0:
         raise ValueError("dropout is not supported on AMD's Triton Backend yet")
+
+    if return_softmax and USE_TILED_REF:
+        # The tiled reference never materializes the seqlen_q x seqlen_k softmax
+        raise ValueError("return_softmax is not supported by the tiled reference implementation "
+                         "(FLASH_ATTENTION_TRITON_AMD_TILED_REF), unset it to get the softmax")
     
     if o is None:
         o = torch.empty_like(q)
@@ -299,7 +355,25 @@ def varlen_fwd(
     if o is None:
         o = torch.empty_like(q, dtype=v.dtype)
 
-    if USE_REF:
+    if USE_TILED_REF:
+        if DEBUG:
+            print("Using tiled reference implementation")
+        output, softmax_lse = attention_forward_tiled_impl(
+                                                q,
+                                                k,
+                                                v,
+                                                metadata.sm_scale,
+                                                metadata.causal,
+                                                metadata.layout,
+                                                metadata.cu_seqlens_q,
+                                                metadata.cu_seqlens_k,
+                                                metadata.max_seqlens_q,
+                                                metadata.max_seqlens_k,
+                                                metadata.alibi_slopes,
+                                                metadata.use_exp2)
+        exp_scores = None
+        o.copy_(output)
+    elif USE_REF:
         if DEBUG:
             print("Using reference implementation")
         (output, 
@@ -413,7 +487,31 @@ def varlen_bwd(
     if dropout_p != 0.0:
         raise ValueError("dropout is not supported on AMD yet")
 
-    if USE_REF:
+    if USE_TILED_REF:
+        if DEBUG:
+            print("Using tiled reference implementation")
+        dq_ref, dk_ref, dv_ref, delta_ref = attention_backward_tiled_impl(
+            dout,
+            q,
+            k,
+            v,
+            out,
+            softmax_lse,
+            softmax_scale,
+            causal,
+            "thd",
+            cu_seqlens_q,
+            cu_seqlens_k,
+            max_seqlen_q,
+            max_seqlen_k,
+            alibi_slopes,
+            False,
+        )
+        dq.copy_(dq_ref)
+        dk.copy_(dk_ref)
+        dv.copy_(dv_ref)
+        delta = delta_ref
+    elif USE_REF:
         if DEBUG:
             print("Using reference implementation")
         dq_ref, dk_ref, dv_ref, delta_ref = attention_backward_pytorch_ref_impl(
@@ -3,11 +3,13 @@ import pytest
 
 from .utils import MetaData, get_input_shapes, input_helper, varlen_input_helper, DEBUG
 from .interface_torch import attention_prefill, attention_decode
-from .fwd_ref import attention_forward_pytorch_ref_impl, compute_alibi_tensor_ref
+from .fwd_ref import attention_forward_pytorch_ref_impl, attention_vanilla_forward_pytorch_ref_impl, compute_alibi_tensor_ref
 from .fwd_prefill import attention_prefill_forward_triton_impl
 from .bwd_prefill import attention_prefill_backward_triton_impl
-from .bwd_ref import attention_backward_pytorch_ref_impl
+from .bwd_ref import attention_backward_pytorch_ref_impl, attention_vanilla_backward_pytorch_ref_impl
 from .fwd_decode import dequantize_kv_fp16, quantize_kv_int4
+from .fwd_tiled import attention_forward_tiled_impl
+from .bwd_tiled import attention_backward_tiled_impl
 
 # defailt fp16 tolerance is ATOL, RTOL = 1e-5, 1e-3. See table https://pytorch.org/docs/stable/testing.html
 ATOL, RTOL = 1e-2, 1e-2 # old standard. maybe to lose. 
@@ -722,3 +724,173 @@ def test_op_fwd_decode_int4_kv(B, Mq, Mkv, Hq, Hkv, K, dtype=torch.float16):
     dq_attn = (q @ dqk.transpose(-1, -2) * scale).softmax(-1)
     dq_ref_out = dq_attn @ dqv
     torch.testing.assert_close(dq_ref_out, tri_out, atol=1e-3, rtol=0)
+
+
+def attention_autograd_ref(q, k, v, sm_scale, causal, alibi_slopes):
+    """Differentiable full-matrix reference in bhsd layout. Fully masked rows output zeros."""
+    seqlen_q, seqlen_k = q.shape[2], k.shape[2]
+    group_size = q.shape[1] // k.shape[1]
+    k = k.repeat_interleave(group_size, dim=1)
+    v = v.repeat_interleave(group_size, dim=1)
+    scores = torch.matmul(q, k.transpose(-2, -1)) * sm_scale
+    row_idx = torch.arange(seqlen_q, device=q.device).unsqueeze(1)
+    col_idx = torch.arange(seqlen_k, device=q.device).unsqueeze(0)
+    relative_pos = row_idx + seqlen_k - seqlen_q - col_idx
+    if alibi_slopes is not None:
+        scores = scores - alibi_slopes[:, :, None, None] * relative_pos.abs()
+    visible = relative_pos >= 0 if causal else torch.ones_like(relative_pos, dtype=torch.bool)
+    row_valid = visible.any(dim=-1, keepdim=True)
+    # keep fully masked rows finite so that autograd does not produce NaNs
+    scores = scores.masked_fill(~visible & row_valid, float("-inf")).masked_fill(~row_valid, 0.0)
+    lse = torch.logsumexp(scores, dim=-1).masked_fill(~row_valid.squeeze(-1), 0.0)
+    p = torch.softmax(scores, dim=-1) * row_valid
+    return torch.matmul(p, v), lse
+
+
+@pytest.mark.parametrize('Z, HQ, HK, N_CTX_Q, N_CTX_K, D_HEAD', [
+    (2, 4, 4, 128, 128, 32),
+    (2, 4, 2, 113, 203, 64),
+    (1, 6, 2, 257, 65, 16),
+    (2, 4, 1, 1, 77, 32),
+    (1, 2, 2, 64, 1, 8),
+])
+@pytest.mark.parametrize('causal', [True, False])
+@pytest.mark.parametrize('use_alibi', [True, False])
+@pytest.mark.parametrize('use_exp2', [True, False])
+@pytest.mark.parametrize('layout', ['bshd', 'bhsd'])
+def test_op_tiled_ref(Z, HQ, HK, N_CTX_Q, N_CTX_K, D_HEAD, causal, use_alibi, use_exp2, layout, dtype=torch.float32):
+    device = "cpu"
+    torch.manual_seed(20)
+    q = torch.randn((Z, HQ, N_CTX_Q, D_HEAD), dtype=dtype, device=device, requires_grad=True)
+    k = torch.randn((Z, HK, N_CTX_K, D_HEAD), dtype=dtype, device=device, requires_grad=True)
+    v = torch.randn((Z, HK, N_CTX_K, D_HEAD), dtype=dtype, device=device, requires_grad=True)
+    sm_scale = D_HEAD ** -0.5
+    if use_alibi:
+        alibi_slopes = torch.tensor([2**(-8 / HQ * i) for i in range(1, HQ + 1)], dtype=torch.float32,
+                                    device=device).repeat(Z, 1)
+    else:
+        alibi_slopes = None
+
+    o_ref, lse_ref = attention_autograd_ref(q, k, v, sm_scale, causal, alibi_slopes)
+    do = torch.randn_like(o_ref)
+    dq_ref, dk_ref, dv_ref = torch.autograd.grad(o_ref, (q, k, v), do)
+
+    # small tiles so that every code path sees several partial tiles
+    block_m, block_n = 32, 48
+    to_layout = (lambda x: x.transpose(1, 2)) if layout == 'bshd' else (lambda x: x)
+    from_layout = to_layout
+    with torch.no_grad():
+        o_tiled, lse_tiled = attention_forward_tiled_impl(
+            to_layout(q), to_layout(k), to_layout(v), sm_scale, causal, layout, None, None,
+            N_CTX_Q, N_CTX_K, alibi_slopes, use_exp2, block_m=block_m, block_n=block_n
+        )
+        dq_tiled, dk_tiled, dv_tiled, delta_tiled = attention_backward_tiled_impl(
+            to_layout(do), to_layout(q), to_layout(k), to_layout(v), o_tiled, lse_tiled, sm_scale, causal,
+            layout, None, None, N_CTX_Q, N_CTX_K, alibi_slopes, use_exp2, block_m=block_m, block_n=block_n
+        )
+
+    torch.testing.assert_close(from_layout(o_tiled), o_ref, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(lse_tiled, lse_ref, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(delta_tiled, (o_ref * do).sum(-1), atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(from_layout(dq_tiled), dq_ref, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(from_layout(dk_tiled), dk_ref, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(from_layout(dv_tiled), dv_ref, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize('Z, H, N_CTX, D_HEAD', [(4, 2, 512, 32), (8, 4, 1024, 64), (1, 1, 300, 16)])
+@pytest.mark.parametrize('causal', [True, False])
+def test_op_varlen_tiled_ref(Z, H, N_CTX, D_HEAD, causal, dtype=torch.float16):
+    device = "cpu"
+    q, k, v, input_metadata = varlen_input_helper(Z, H, H, N_CTX, N_CTX, D_HEAD, dtype, device=device)
+    cu_seqlens_q, cu_seqlens_k = input_metadata.cu_seqlens_q, input_metadata.cu_seqlens_k
+    max_seqlen_q, max_seqlen_k = input_metadata.max_seqlens_q, input_metadata.max_seqlens_k
+    sm_scale = input_metadata.sm_scale
+    q, k, v = q.detach().float(), k.detach().float(), v.detach().float()
+
+    o_ref, lse_ref, _, _, _, _, _ = attention_forward_pytorch_ref_impl(
+        q, k, v, sm_scale, causal, "thd", cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, False
+    )
+    o_tiled, lse_tiled = attention_forward_tiled_impl(
+        q, k, v, sm_scale, causal, "thd", cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+        None, False, block_m=16, block_n=16
+    )
+    torch.testing.assert_close(o_tiled, o_ref, atol=ATOL, rtol=RTOL)
+    torch.testing.assert_close(lse_tiled, lse_ref, atol=ATOL, rtol=RTOL)
+
+    do = torch.randn_like(q)
+    dq_ref, dk_ref, dv_ref, delta_ref = attention_backward_pytorch_ref_impl(
+        do, q, k, v, o_ref, lse_ref, sm_scale, causal, "thd", cu_seqlens_q, cu_seqlens_k,
+        max_seqlen_q, max_seqlen_k, False
+    )
+    dq_tiled, dk_tiled, dv_tiled, delta_tiled = attention_backward_tiled_impl(
+        do, q, k, v, o_tiled, lse_tiled, sm_scale, causal, "thd", cu_seqlens_q, cu_seqlens_k,
+        max_seqlen_q, max_seqlen_k, None, False, block_m=16, block_n=16
+    )
+    torch.testing.assert_close(delta_tiled, delta_ref, atol=ATOL, rtol=RTOL)
+    torch.testing.assert_close(dq_tiled, dq_ref.to(dq_tiled.dtype), atol=ATOL, rtol=RTOL)
+    torch.testing.assert_close(dk_tiled, dk_ref.to(dk_tiled.dtype), atol=ATOL, rtol=RTOL)
+    torch.testing.assert_close(dv_tiled, dv_ref.to(dv_tiled.dtype), atol=ATOL, rtol=RTOL)
+
+
+def test_tiled_ref_return_softmax(monkeypatch):
+    from . import interface_fa
+    monkeypatch.setattr(interface_fa, "USE_TILED_REF", True)
+    q = k = v = torch.randn(1, 16, 2, 32)
+    # The tiled reference has no softmax to return
+    with pytest.raises(ValueError, match="return_softmax"):
+        interface_fa.fwd(q, k, v, None, None, 0.0, 32 ** -0.5, False, -1, -1, 0.0, True, None)
+
+
+@pytest.mark.parametrize('Z, HQ, HK, N_CTX_Q, N_CTX_K, D_HEAD', [
+    (4, 2, 2, 512, 512, 32),
+    (64, 4, 2, 2048, 1024, 16),
+    (300, 2, 1, 4800, 6000, 8),
+    (1, 3, 3, 77, 77, 16),
+])
+@pytest.mark.parametrize('causal', [True, False])
+@pytest.mark.parametrize('use_exp2', [True, False])
+def test_op_varlen_bucketed_ref(Z, HQ, HK, N_CTX_Q, N_CTX_K, D_HEAD, causal, use_exp2, dtype=torch.float16):
+    """The bucketed varlen reference must match running the vanilla reference on every sequence."""
+    device = "cpu"
+    q, k, v, input_metadata = varlen_input_helper(Z, HQ, HK, N_CTX_Q, N_CTX_K, D_HEAD, dtype, device=device)
+    q, k, v = q.detach().float(), k.detach().float(), v.detach().float()
+    cu_seqlens_q, cu_seqlens_k = input_metadata.cu_seqlens_q, input_metadata.cu_seqlens_k
+    seqlens_q = (cu_seqlens_q[1:] - cu_seqlens_q[:-1]).tolist()
+    seqlens_k = (cu_seqlens_k[1:] - cu_seqlens_k[:-1]).tolist()
+    assert input_metadata.max_seqlens_q == max(seqlens_q)
+    assert input_metadata.max_seqlens_k == max(seqlens_k)
+    sm_scale = input_metadata.sm_scale
+    do = torch.randn_like(q)
+
+    o, softmax_lse, _, _, _, _, _ = attention_forward_pytorch_ref_impl(
+        q, k, v, sm_scale, causal, "thd", cu_seqlens_q, cu_seqlens_k,
+        input_metadata.max_seqlens_q, input_metadata.max_seqlens_k, use_exp2
+    )
+    dq, dk, dv, delta = attention_backward_pytorch_ref_impl(
+        do, q, k, v, o, softmax_lse, sm_scale, causal, "thd", cu_seqlens_q, cu_seqlens_k,
+        input_metadata.max_seqlens_q, input_metadata.max_seqlens_k, use_exp2
+    )
+
+    cu_q, cu_k = cu_seqlens_q.tolist(), cu_seqlens_k.tolist()
+    for i in range(Z):
+        # [L_i, num_heads, head_dim] -> [1, num_heads, L_i, head_dim], kv heads replicated for the vanilla path
+        to_bhsd = lambda x, start, end: x[start:end].transpose(0, 1).unsqueeze(0)
+        q_i = to_bhsd(q, cu_q[i], cu_q[i + 1])
+        k_i = to_bhsd(k, cu_k[i], cu_k[i + 1]).repeat_interleave(HQ // HK, dim=1)
+        v_i = to_bhsd(v, cu_k[i], cu_k[i + 1]).repeat_interleave(HQ // HK, dim=1)
+        do_i = to_bhsd(do, cu_q[i], cu_q[i + 1])
+        o_i, softmax_lse_i, _, _, _, _, _ = attention_vanilla_forward_pytorch_ref_impl(
+            q_i, k_i, v_i, sm_scale, causal, "bhsd", use_exp2
+        )
+        dq_i, dk_i, dv_i, delta_i = attention_vanilla_backward_pytorch_ref_impl(
+            do_i, q_i, k_i, v_i, o_i, softmax_lse_i, sm_scale, causal, "bhsd", use_exp2
+        )
+        dk_i = dk_i.view(1, HK, HQ // HK, -1, D_HEAD).float().sum(dim=2)
+        dv_i = dv_i.view(1, HK, HQ // HK, -1, D_HEAD).float().sum(dim=2)
+
+        torch.testing.assert_close(to_bhsd(o, cu_q[i], cu_q[i + 1]), o_i.float(), atol=ATOL, rtol=RTOL)
+        torch.testing.assert_close(to_bhsd(softmax_lse, cu_q[i], cu_q[i + 1]), softmax_lse_i, atol=ATOL, rtol=RTOL)
+        torch.testing.assert_close(to_bhsd(delta, cu_q[i], cu_q[i + 1]), delta_i, atol=ATOL, rtol=RTOL)
+        torch.testing.assert_close(to_bhsd(dq, cu_q[i], cu_q[i + 1]), dq_i.float(), atol=ATOL, rtol=RTOL)
+        torch.testing.assert_close(to_bhsd(dk, cu_k[i], cu_k[i + 1]), dk_i, atol=ATOL, rtol=RTOL)
+        torch.testing.assert_close(to_bhsd(dv, cu_k[i], cu_k[i + 1]), dv_i, atol=ATOL, rtol=RTOL)
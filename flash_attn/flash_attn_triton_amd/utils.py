@@ -64,9 +64,9 @@ class MetaData():
         assert len(cu_seqlens_q) >= 2
         assert len(cu_seqlens_q) == len(cu_seqlens_k)
         self.num_contexts = len(cu_seqlens_q) - 1
-        for i in range(0, self.num_contexts):
-            self.max_seqlens_q = max(cu_seqlens_q[i + 1].item() - cu_seqlens_q[i].item(), self.max_seqlens_q)
-            self.max_seqlens_k = max(cu_seqlens_k[i + 1].item() - cu_seqlens_k[i].item(), self.max_seqlens_k)
+        # One host copy of each cu_seqlens instead of an .item() sync per sequence
+        self.max_seqlens_q = max(int(cu_seqlens_q.cpu().diff().max()), self.max_seqlens_q)
+        self.max_seqlens_k = max(int(cu_seqlens_k.cpu().diff().max()), self.max_seqlens_k)
 
     def need_bias(self, bias, batch, nheads, seqlen_q, seqlen_k):
         assert bias.is_cuda
@@ -238,6 +238,61 @@ def get_strides_from_layout(q, k, v, o, layout):
         assert False, 'Got unsupported layout.'
     return q_strides, k_strides, v_strides, o_strides
 
+def get_varlen_buckets(cu_seqlens_q, cu_seqlens_k, device):
+    """Group the sequences of a varlen ("thd") batch into buckets of similar length.
+
+    Sequences are bucketed by the power-of-two ceiling of their (seqlen_q, seqlen_k), so every bucket
+    can be processed as one padded batched matmul wasting at most 2x in each dimension.
+    All the bookkeeping is done with tensor ops on a single host copy of cu_seqlens.
+
+    Yields for each bucket of n sequences, padded to (max_q, max_k):
+        q_idx: (n, max_q) row indices into the packed q, q_valid: (n, max_q) bool
+        k_idx: (n, max_k) row indices into the packed k/v, k_valid: (n, max_k) bool
+        seqlens_q, seqlens_k: (n,) lengths of the sequences
+    Padded positions of q_idx / k_idx point at row 0 and must be masked with q_valid / k_valid.
+    """
+    cu_seqlens_q = cu_seqlens_q.to(device="cpu", dtype=torch.int64)
+    cu_seqlens_k = cu_seqlens_k.to(device="cpu", dtype=torch.int64)
+    seqlens_q = cu_seqlens_q.diff()
+    seqlens_k = cu_seqlens_k.diff()
+    log2_q = torch.ceil(torch.log2(seqlens_q.clamp(min=1).double())).long()
+    log2_k = torch.ceil(torch.log2(seqlens_k.clamp(min=1).double())).long()
+    bucket_keys = log2_q * 64 + log2_k
+    for key in bucket_keys.unique().tolist():
+        seq_ids = (bucket_keys == key).nonzero().squeeze(1)
+        bucket_seqlens_q, bucket_seqlens_k = seqlens_q[seq_ids], seqlens_k[seq_ids]
+        max_q, max_k = int(bucket_seqlens_q.max()), int(bucket_seqlens_k.max())
+        q_pos = torch.arange(max_q).unsqueeze(0)
+        k_pos = torch.arange(max_k).unsqueeze(0)
+        q_valid = q_pos < bucket_seqlens_q.unsqueeze(1)
+        k_valid = k_pos < bucket_seqlens_k.unsqueeze(1)
+        q_idx = torch.where(q_valid, cu_seqlens_q[seq_ids].unsqueeze(1) + q_pos, 0)
+        k_idx = torch.where(k_valid, cu_seqlens_k[seq_ids].unsqueeze(1) + k_pos, 0)
+        yield (
+            q_idx.to(device),
+            q_valid.to(device),
+            k_idx.to(device),
+            k_valid.to(device),
+            bucket_seqlens_q.to(device),
+            bucket_seqlens_k.to(device),
+        )
+
+
+def get_varlen_bucket_mask(q_valid, k_valid, seqlens_q, seqlens_k, causal):
+    """(n, 1, max_q, max_k) bool mask of the scores of a padded bucket, True where attention is allowed.
+
+    Padded rows are fully masked. The causal mask of each sequence is aligned to the bottom right
+    corner of its own attention matrix.
+    """
+    mask = q_valid.unsqueeze(2) & k_valid.unsqueeze(1)
+    if causal:
+        row_idx = torch.arange(q_valid.shape[1], device=q_valid.device).view(1, -1, 1)
+        col_idx = torch.arange(k_valid.shape[1], device=k_valid.device).view(1, 1, -1)
+        col_offset = (seqlens_q - seqlens_k).view(-1, 1, 1)
+        mask = mask & (row_idx >= col_offset + col_idx)
+    return mask.unsqueeze(1)
+
+
 def get_padded_headsize(size):
     # Get closest power of 2 over or equal to 32.
     padded_d_model = 1 << (size - 1).bit_length()
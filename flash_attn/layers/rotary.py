@@ -338,6 +338,26 @@ def apply_rotary_emb_kv_(
     return ApplyRotaryEmbKV_.apply(kv, cos, sin, interleaved, seqlen_offsets)
 
 
+class _CosSinTable:
+    """cos / sin of the positions [0, seqlen), and cos_k / sin_k for XPos."""
+
+    def __init__(self, seqlen, cos, sin, cos_k=None, sin_k=None):
+        self.seqlen = seqlen
+        self.cos, self.sin = cos, sin
+        self.cos_k, self.sin_k = cos_k, sin_k
+
+
+# Tables of the RotaryEmbedding with share_cos_sin=True, keyed by the parameters that determine
+# them. All the layers of a model use the same table instead of each computing its own.
+_cos_sin_tables = {}
+
+
+def clear_cos_sin_tables():
+    """Release the shared cos / sin tables, e.g. after deleting a model. They are recomputed by
+    the RotaryEmbedding that need them."""
+    _cos_sin_tables.clear()
+
+
 class RotaryEmbedding(torch.nn.Module):
     """
     The rotary position embeddings from RoFormer_ (Su et. al).
@@ -364,6 +384,7 @@ class RotaryEmbedding(torch.nn.Module):
         scale_base=None,
         pos_idx_in_fp32=True,
         device=None,
+        share_cos_sin=True,
     ):
         """
         interleaved: if True, rotate pairs of even and odd dimensions (GPT-J style) instead
@@ -378,6 +399,10 @@ class RotaryEmbedding(torch.nn.Module):
             embeddings for some positions will coincide.
             To maintain compatibility with models previously trained in pure bf16,
             we add this option.
+        share_cos_sin: if True, the cos / sin tables are shared with all the other
+            RotaryEmbedding with the same dim, base, scale_base and pos_idx_in_fp32 (e.g. the
+            ones of the other layers), on the same device and dtype, instead of each module
+            keeping its own copy. See clear_cos_sin_tables to release them.
         """
         super().__init__()
         self.dim = dim
@@ -394,7 +419,9 @@ class RotaryEmbedding(torch.nn.Module):
             else None
         )
         self.register_buffer("scale", scale, persistent=False)
+        self.share_cos_sin = share_cos_sin
 
+        self._cos_sin_table = None
         self._seq_len_cached = 0
         self._cos_cached = None
         self._sin_cached = None
@@ -407,51 +434,86 @@ class RotaryEmbedding(torch.nn.Module):
             ** (torch.arange(0, self.dim, 2, device=device, dtype=torch.float32) / self.dim)
         )
 
+    def _compute_cos_sin(self, start, end, device=None, dtype=None):
+        """cos / sin of the positions [start, end), and cos_k / sin_k (None if not XPos).
+        For XPos, the scale depends on end, so start must be 0."""
+        # We want fp32 here, not self.inv_freq.dtype, since the model could be loaded in bf16
+        # And the output of arange can be quite large, so bf16 would lose a lot of precision.
+        # However, for compatibility reason, we add an option to use the dtype of self.inv_freq.
+        if self.pos_idx_in_fp32:
+            t = torch.arange(start, end, device=device, dtype=torch.float32)
+            # We want fp32 here as well since inv_freq will be multiplied with t, and the output
+            # will be large. Having it in bf16 will lose a lot of precision and cause the
+            # cos & sin output to change significantly.
+            # We want to recompute self.inv_freq if it was not loaded in fp32
+            if self.inv_freq.dtype != torch.float32:
+                inv_freq = self._compute_inv_freq(device=device)
+            else:
+                inv_freq = self.inv_freq
+        else:
+            t = torch.arange(start, end, device=device, dtype=self.inv_freq.dtype)
+            inv_freq = self.inv_freq
+        # Don't do einsum, it converts fp32 to fp16 under AMP
+        # freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        freqs = torch.outer(t, inv_freq)
+        if self.scale is None:
+            return torch.cos(freqs).to(dtype), torch.sin(freqs).to(dtype), None, None
+        assert start == 0
+        power = (
+            torch.arange(end, dtype=self.scale.dtype, device=self.scale.device) - end // 2
+        ) / self.scale_base
+        scale = self.scale.to(device=power.device) ** rearrange(power, "s -> s 1")
+        scale = scale.to(device=freqs.device)
+        # We want the multiplication by scale to happen in fp32
+        return (
+            (torch.cos(freqs) * scale).to(dtype),
+            (torch.sin(freqs) * scale).to(dtype),
+            (torch.cos(freqs) / scale).to(dtype),
+            (torch.sin(freqs) / scale).to(dtype),
+        )
+
     def _update_cos_sin_cache(self, seqlen, device=None, dtype=None):
-        # Reset the tables if the sequence length has changed,
-        # if we're on a new device (possibly due to tracing for instance),
+        if self.share_cos_sin:
+            key = (
+                type(self),
+                self.dim,
+                self.base,
+                self.scale_base,
+                None if self.pos_idx_in_fp32 else self.inv_freq.dtype,
+                torch.device(device) if device is not None else None,
+                dtype,
+            )
+            table = _cos_sin_tables.get(key)
+        else:
+            table = self._cos_sin_table
+        # Reset the tables if we're on a new device (possibly due to tracing for instance),
         # or if we're switching from inference mode to training
         if (
-            seqlen > self._seq_len_cached
-            or self._cos_cached is None
-            or self._cos_cached.device != device
-            or self._cos_cached.dtype != dtype
-            or (self.training and self._cos_cached.is_inference())
+            table is None
+            or table.cos.device != device
+            or table.cos.dtype != dtype
+            or (self.training and table.cos.is_inference())
         ):
-            self._seq_len_cached = seqlen
-            # We want fp32 here, not self.inv_freq.dtype, since the model could be loaded in bf16
-            # And the output of arange can be quite large, so bf16 would lose a lot of precision.
-            # However, for compatibility reason, we add an option to use the dtype of self.inv_freq.
-            if self.pos_idx_in_fp32:
-                t = torch.arange(seqlen, device=device, dtype=torch.float32)
-                # We want fp32 here as well since inv_freq will be multiplied with t, and the output
-                # will be large. Having it in bf16 will lose a lot of precision and cause the
-                # cos & sin output to change significantly.
-                # We want to recompute self.inv_freq if it was not loaded in fp32
-                if self.inv_freq.dtype != torch.float32:
-                    inv_freq = self._compute_inv_freq(device=device)
-                else:
-                    inv_freq = self.inv_freq
-            else:
-                t = torch.arange(seqlen, device=device, dtype=self.inv_freq.dtype)
-                inv_freq = self.inv_freq
-            # Don't do einsum, it converts fp32 to fp16 under AMP
-            # freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            freqs = torch.outer(t, inv_freq)
+            seqlen = max(seqlen, table.seqlen if table is not None else 0)
+            table = _CosSinTable(seqlen, *self._compute_cos_sin(0, seqlen, device, dtype))
+        elif seqlen > table.seqlen:
             if self.scale is None:
-                self._cos_cached = torch.cos(freqs).to(dtype)
-                self._sin_cached = torch.sin(freqs).to(dtype)
+                # Grow geometrically so that generating a long sequence only recomputes the
+                # tables O(log seqlen) times, and only compute the new positions
+                new_seqlen = max(seqlen, 2 * table.seqlen)
+                cos, sin, _, _ = self._compute_cos_sin(table.seqlen, new_seqlen, device, dtype)
+                table = _CosSinTable(
+                    new_seqlen, torch.cat([table.cos, cos]), torch.cat([table.sin, sin])
+                )
             else:
-                power = (
-                    torch.arange(seqlen, dtype=self.scale.dtype, device=self.scale.device)
-                    - seqlen // 2
-                ) / self.scale_base
-                scale = self.scale.to(device=power.device) ** rearrange(power, "s -> s 1")
-                # We want the multiplication by scale to happen in fp32
-                self._cos_cached = (torch.cos(freqs) * scale).to(dtype)
-                self._sin_cached = (torch.sin(freqs) * scale).to(dtype)
-                self._cos_k_cached = (torch.cos(freqs) / scale).to(dtype)
-                self._sin_k_cached = (torch.sin(freqs) / scale).to(dtype)
+                # The XPos scale is centered on the table, so all positions change
+                table = _CosSinTable(seqlen, *self._compute_cos_sin(0, seqlen, device, dtype))
+        if self.share_cos_sin:
+            _cos_sin_tables[key] = table
+        self._cos_sin_table = table
+        self._seq_len_cached = table.seqlen
+        self._cos_cached, self._sin_cached = table.cos, table.sin
+        self._cos_k_cached, self._sin_k_cached = table.cos_k, table.sin_k
 
     def forward(
         self,
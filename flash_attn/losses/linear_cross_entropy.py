@@ -0,0 +1,80 @@
+import torch.nn as nn
+
+from flash_attn.ops.linear_cross_entropy import linear_cross_entropy_loss
+
+
+class LinearCrossEntropyLoss(nn.Module):
+    def __init__(
+        self,
+        ignore_index=-100,
+        reduction="mean",
+        label_smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        chunk_size=1024,
+        process_group=None,
+        sequence_parallel=True,
+        return_z_loss=False,
+    ):
+        """Cross-entropy loss of the logits of a linear layer (e.g. the LM head), computed from
+        its input and weight without materializing the logits of all the tokens.
+        Arguments:
+            chunk_size: int. Number of tokens whose logits are computed at once.
+            process_group: if not None, we're doing Tensor Parallel: each process is responsible for
+                one part of the vocab. The loss will be aggregated across processes.
+            sequence_parallel: if True (and process_group is not None), each process has a shard
+                of the hidden states, and the target of all the tokens.
+            See CrossEntropyLoss for the other arguments.
+        """
+        super().__init__()
+        if reduction not in ["mean", "none", "sum"]:
+            raise NotImplementedError("Only support reduction = 'mean' or 'none' or 'sum'")
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+        self.label_smoothing = label_smoothing
+        self.logit_scale = logit_scale
+        self.lse_square_scale = lse_square_scale
+        self.chunk_size = chunk_size
+        self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
+        self.return_z_loss = return_z_loss
+
+    def forward(self, hidden_states, weight, target, bias=None):
+        """
+        Arguments:
+            hidden_states: (..., hidden_dim)
+            weight: (vocab_size, hidden_dim)
+            target: (...)
+            bias: (vocab_size,)
+        Returns:
+            losses: (batch,) if reduction is 'none', else (1,), dtype float
+            z_loss: (batch,) if reduction is 'none', else (1,), dtype float (if self.return_z_loss)
+        """
+        loss, z_loss = linear_cross_entropy_loss(
+            hidden_states.reshape(-1, hidden_states.shape[-1]),
+            weight,
+            target.reshape(-1),
+            bias=bias,
+            chunk_size=self.chunk_size,
+            label_smoothing=self.label_smoothing,
+            logit_scale=self.logit_scale,
+            lse_square_scale=self.lse_square_scale,
+            ignore_index=self.ignore_index,
+            process_group=self.process_group,
+            sequence_parallel=self.sequence_parallel,
+        )
+        target = target.reshape(-1)
+        if self.reduction == "mean":
+            loss = loss.sum() / (target != self.ignore_index).sum()
+        elif self.reduction == "sum":
+            loss = loss.sum()
+
+        if not self.return_z_loss:
+            return loss
+
+        if self.reduction == "mean":
+            z_loss = z_loss.sum() / (target != self.ignore_index).sum()
+        elif self.reduction == "sum":
+            z_loss = z_loss.sum()
+
+        return loss, z_loss
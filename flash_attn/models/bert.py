@@ -9,8 +9,9 @@ import logging
 import re
 from collections import OrderedDict
 from collections.abc import Sequence
+from dataclasses import dataclass
 from functools import partial
-from typing import Any, Mapping
+from typing import Any, Mapping, Optional
 
 import torch
 import torch.nn as nn
@@ -23,10 +24,9 @@ from transformers.models.bert.modeling_bert import (
 )
 
 from flash_attn.bert_padding import (
+    PackedBatch,
     index_first_axis,
     index_first_axis_residual,
-    pad_input,
-    unpad_input,
 )
 from flash_attn.modules.block import Block
 from flash_attn.modules.embedding import BertEmbeddings
@@ -149,6 +149,18 @@ def _init_weights(module, initializer_range=0.02):
             nn.init.zeros_(module.weight[module.padding_idx])
 
 
+@dataclass
+class BertPackedBatch(PackedBatch):
+    """PackedBatch where the subset is the CLS and the masked tokens, with the rows of the
+    encoder output (the subset) that go to the pooler and to the masked LM head, and the
+    positions of the masked tokens in the flattened (batch * seqlen).
+    """
+
+    pool_idx: Optional[torch.Tensor] = None
+    masked_idx: Optional[torch.Tensor] = None
+    masked_token_idx: Optional[torch.Tensor] = None
+
+
 class BertEncoder(nn.Module):
     def __init__(self, config: BertConfig):
         super().__init__()
@@ -157,12 +169,14 @@ class BertEncoder(nn.Module):
             [create_block(config, layer_idx=i) for i in range(config.num_hidden_layers)]
         )
 
-    def forward(self, hidden_states, key_padding_mask=None, subset_mask=None):
+    def forward(self, hidden_states, key_padding_mask=None, subset_mask=None, packed_batch=None):
         """If subset_mask is not None, we only want output for the subset of the sequence.
         This means that we only compute the last layer output for these tokens.
         subset_mask: (batch, seqlen), dtype=torch.bool
+        packed_batch: PackedBatch built from key_padding_mask and subset_mask, to avoid
+            computing it here. Only applicable when using FlashAttention.
         """
-        if key_padding_mask is None or not self.use_flash_attn:
+        if (key_padding_mask is None and packed_batch is None) or not self.use_flash_attn:
             mixer_kwargs = (
                 {"key_padding_mask": key_padding_mask} if key_padding_mask is not None else None
             )
@@ -171,43 +185,21 @@ class BertEncoder(nn.Module):
             if subset_mask is not None:
                 hidden_states = hidden_states[subset_mask]
         else:
-            batch, seqlen = hidden_states.shape[:2]
-            hidden_states, indices, cu_seqlens, max_seqlen_in_batch, _ = unpad_input(
-                hidden_states, key_padding_mask
-            )
-            mixer_kwargs = {"cu_seqlens": cu_seqlens, "max_seqlen": max_seqlen_in_batch}
-            if subset_mask is None:
+            if packed_batch is None:
+                packed_batch = PackedBatch.from_mask(key_padding_mask, subset_mask)
+            hidden_states = packed_batch.unpad(hidden_states)
+            mixer_kwargs = {"packed_batch": packed_batch}
+            if packed_batch.subset_idx is None:
                 for layer in self.layers:
                     hidden_states = layer(hidden_states, mixer_kwargs=mixer_kwargs)
-                hidden_states = pad_input(hidden_states, indices, batch, seqlen)
+                hidden_states = packed_batch.pad(hidden_states)
             else:
                 for layer in self.layers[:-1]:
                     hidden_states = layer(hidden_states, mixer_kwargs=mixer_kwargs)
-                if key_padding_mask is not None:
-                    subset_idx = torch.nonzero(
-                        subset_mask[key_padding_mask], as_tuple=False
-                    ).flatten()
-                    subset_seqlens = (subset_mask & key_padding_mask).sum(dim=-1, dtype=torch.int32)
-                    subset_cu_seqlens = F.pad(
-                        torch.cumsum(subset_seqlens, dim=0, dtype=torch.int32), (1, 0)
-                    )
-                else:
-                    subset_idx = torch.nonzero(subset_mask, as_tuple=False).flatten()
-                    subset_seqlens = subset_mask.sum(dim=-1, dtype=torch.int32)
-                    subset_cu_seqlens = F.pad(
-                        torch.cumsum(subset_seqlens, dim=0, dtype=torch.int32), (1, 0)
-                    )
                 hidden_states_subset, hidden_states = index_first_axis_residual(
-                    hidden_states, subset_idx
+                    hidden_states, packed_batch.subset_idx
                 )
-                # It's ok to set max_seqlen_q to be much larger
-                mixer_kwargs = {
-                    "x_kv": hidden_states,
-                    "cu_seqlens": subset_cu_seqlens,
-                    "max_seqlen": max_seqlen_in_batch,
-                    "cu_seqlens_k": cu_seqlens,
-                    "max_seqlen_k": max_seqlen_in_batch,
-                }
+                mixer_kwargs = {"x_kv": hidden_states, "packed_batch": packed_batch}
                 hidden_states = self.layers[-1](hidden_states_subset, mixer_kwargs=mixer_kwargs)
         return hidden_states
 
@@ -364,6 +356,25 @@ class BertModel(BertPreTrainedModel):
 
         self.apply(partial(_init_weights, initializer_range=config.initializer_range))
 
+    @staticmethod
+    def pack_batch(attention_mask, masked_tokens_mask=None):
+        """Build the BertPackedBatch for BertModel.forward, on the device of attention_mask.
+        attention_mask, masked_tokens_mask: (batch, seqlen), dtype=torch.bool
+        """
+        if masked_tokens_mask is None:
+            return BertPackedBatch.from_mask(attention_mask)
+        # We also need the first column for the CLS token
+        first_col_mask = torch.zeros_like(attention_mask)
+        first_col_mask[:, 0] = True
+        packed_batch = BertPackedBatch.from_mask(
+            attention_mask,
+            masked_tokens_mask | first_col_mask,
+            masked_token_idx=torch.nonzero(masked_tokens_mask.flatten(), as_tuple=False).flatten(),
+        )
+        packed_batch.pool_idx = packed_batch.subset_rows(first_col_mask)
+        packed_batch.masked_idx = packed_batch.subset_rows(masked_tokens_mask)
+        return packed_batch
+
     def forward(
         self,
         input_ids,
@@ -371,11 +382,15 @@ class BertModel(BertPreTrainedModel):
         token_type_ids=None,
         attention_mask=None,
         masked_tokens_mask=None,
+        packed_batch=None,
     ):
         """If masked_tokens_mask is not None (i.e. last_layer_subset == True in BertForPreTraining),
         we only want the output for the masked tokens. This means that we only compute the last
         layer output for these tokens.
         masked_tokens_mask: (batch, seqlen), dtype=torch.bool
+        packed_batch: BertPackedBatch from BertModel.pack_batch(attention_mask, masked_tokens_mask),
+            e.g. built on the host by the collator. Only used with FlashAttention, and computed
+            here if None.
         """
         hidden_states = self.embeddings(
             input_ids, position_ids=position_ids, token_type_ids=token_type_ids
@@ -401,15 +416,25 @@ class BertModel(BertPreTrainedModel):
         else:
             subset_mask = None
 
+        if packed_batch is None and attention_mask is not None and self.encoder.use_flash_attn:
+            packed_batch = self.pack_batch(attention_mask, masked_tokens_mask)
+        if not self.encoder.use_flash_attn:
+            packed_batch = None
         sequence_output = self.encoder(
-            hidden_states, key_padding_mask=attention_mask, subset_mask=subset_mask
+            hidden_states,
+            key_padding_mask=attention_mask,
+            subset_mask=subset_mask,
+            packed_batch=packed_batch,
         )
 
         if masked_tokens_mask is None:
             pooled_output = self.pooler(sequence_output) if self.pooler is not None else None
         else:
             # TD [2022-03-01]: the indexing here is very tricky.
-            if attention_mask is not None:
+            if packed_batch is not None:
+                pool_input = sequence_output[packed_batch.pool_idx]
+                sequence_output = sequence_output[packed_batch.masked_idx]
+            elif attention_mask is not None:
                 subset_idx = subset_mask[attention_mask]
                 pool_input = sequence_output[first_col_mask[attention_mask][subset_idx]]
                 sequence_output = sequence_output[masked_tokens_mask[attention_mask][subset_idx]]
@@ -464,10 +489,13 @@ class BertForPreTraining(BertPreTrainedModel):
         attention_mask=None,
         labels=None,
         next_sentence_label=None,
+        packed_batch=None,
     ):
         """
         If labels are provided, they must be 0 for masked out tokens (as specified in the attention
         mask).
+        packed_batch: BertPackedBatch from BertModel.pack_batch(attention_mask, labels > 0) if
+            last_layer_subset else BertModel.pack_batch(attention_mask), see BertModel.forward.
         Outputs:
             if `labels` and `next_sentence_label` are not `None`:
                 Outputs the total_loss which is the sum of the masked language modeling loss and the next
@@ -485,10 +513,14 @@ class BertForPreTraining(BertPreTrainedModel):
             token_type_ids=token_type_ids,
             attention_mask=attention_mask.bool() if attention_mask is not None else None,
             masked_tokens_mask=masked_tokens_mask,
+            packed_batch=packed_batch,
         )
         sequence_output, pooled_output = outputs.last_hidden_state, outputs.pooler_output
         if self.dense_seq_output and labels is not None:
-            masked_token_idx = torch.nonzero(labels.flatten() > 0, as_tuple=False).flatten()
+            if packed_batch is not None and packed_batch.masked_token_idx is not None:
+                masked_token_idx = packed_batch.masked_token_idx
+            else:
+                masked_token_idx = torch.nonzero(labels.flatten() > 0, as_tuple=False).flatten()
             if not self.last_layer_subset:
                 sequence_output = index_first_axis(
                     rearrange(sequence_output, "b s d -> (b s) d"), masked_token_idx
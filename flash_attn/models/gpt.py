@@ -14,6 +14,7 @@ import torch.nn.functional as F
 from einops import rearrange
 from transformers import GPT2Config
 
+from flash_attn.losses.linear_cross_entropy import LinearCrossEntropyLoss
 from flash_attn.models.bigcode import remap_state_dict_hf_bigcode
 from flash_attn.models.falcon import remap_state_dict_hf_falcon
 from flash_attn.models.gpt_neox import remap_state_dict_hf_gpt_neox
@@ -39,7 +40,7 @@ from flash_attn.utils.distributed import (
     sync_shared_params,
 )
 from flash_attn.utils.generation import GenerationMixin
-from flash_attn.utils.pretrained import state_dict_from_pretrained
+from flash_attn.utils.pretrained import load_pretrained_streaming, state_dict_from_pretrained
 
 try:
     from flash_attn.ops.fused_dense import ColumnParallelLinear
@@ -336,41 +337,60 @@ class GPTPreTrainedModel(nn.Module):
         dtype=None,
         world_size=1,
         rank=0,
+        streaming=False,
         **kwargs,
     ):
         """
         Instantiate a GPTPreTrainedModel from a pre-trained model file or a pytorch state dict.
         Download and cache the pre-trained model file if needed.
+        If streaming=True, the checkpoint is loaded one layer at a time (see
+        load_pretrained_streaming) instead of all at once, which bounds peak host memory.
         """
         # Instantiate model.
         model = cls(config, *args, device=device, dtype=dtype, **kwargs)
-        # Load state_dict in cpu because we already initialized the model in GPU, and we don't
-        # want extra stuff taking up more GPU memory
-        state_dict = state_dict_from_pretrained(model_name, device="cpu", dtype=dtype)
         if model_name.startswith("gpt2"):
-            state_dict = remap_state_dict_hf_gpt2(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_gpt2
         elif model_name.startswith("facebook/opt"):
-            state_dict = remap_state_dict_hf_opt(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_opt
         elif model_name.startswith("EleutherAI/gpt-j-") or model_name.startswith(
             "togethercomputer/GPT-JT-"
         ):
-            state_dict = remap_state_dict_hf_gptj(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_gptj
         elif (
             model_name.startswith("EleutherAI/gpt-neox-")
             or model_name.startswith("EleutherAI/pythia-")
             or model_name.startswith("togethercomputer/RedPajama-INCITE-")
         ):
-            state_dict = remap_state_dict_hf_gpt_neox(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_gpt_neox
         elif model_name.startswith("tiiuae/falcon-"):
-            state_dict = remap_state_dict_hf_falcon(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_falcon
         elif model_name.startswith("meta-llama/Llama-"):
-            state_dict = remap_state_dict_hf_llama(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_llama
         elif model_name.startswith("bigcode/") or model_name.startswith("WizardLM/"):
-            state_dict = remap_state_dict_hf_bigcode(state_dict, config)
+            remap_state_dict_hf = remap_state_dict_hf_bigcode
         else:
             raise NotImplementedError(f"Model {model_name} not supported")
-        if world_size > 1:
-            state_dict = shard_state_dict_tp(state_dict, config, world_size, rank)
+
+        def convert_state_dict(state_dict):
+            state_dict = remap_state_dict_hf(state_dict, config)
+            if world_size > 1:
+                state_dict = shard_state_dict_tp(state_dict, config, world_size, rank)
+            return state_dict
+
+        if streaming:
+            stats = load_pretrained_streaming(
+                model, model_name, convert_state_dict, dtype=dtype, strict=strict
+            )
+            logger.info(
+                f"Loaded {stats['num_tensors']} tensors ({stats['num_bytes'] / 1e9:.2f}GB) in "
+                f"{stats['seconds']:.1f}s, {stats['throughput']:.2f}GB/s"
+            )
+            return model
+        # Load state_dict in cpu because we already initialized the model in GPU, and we don't
+        # want extra stuff taking up more GPU memory
+        state_dict = convert_state_dict(
+            state_dict_from_pretrained(model_name, device="cpu", dtype=dtype)
+        )
         load_return = model.load_state_dict(state_dict, strict=strict)
         logger.info(load_return)
         return model
@@ -511,7 +531,21 @@ class GPTModel(GPTPreTrainedModel):
             for i, layer in enumerate(self.layers)
         }
 
-    def forward(self, input_ids, position_ids=None, inference_params=None):
+    def forward(
+        self, input_ids, position_ids=None, inference_params=None, cu_seqlens=None, max_seqlen=None
+    ):
+        """
+        cu_seqlens, max_seqlen: for packed sequences, input_ids is (1, total) and cu_seqlens is
+            the (num_seqs + 1,) int32 cumulative sequence lengths. Attention doesn't cross the
+            sequence boundaries. position_ids should then restart at 0 for each sequence.
+            Packed sequences currently need learned position embeddings: the rotary embedding
+            of MHA doesn't support cu_seqlens yet.
+        """
+        if cu_seqlens is not None:
+            assert getattr(self.layers[0].mixer, "rotary_emb_dim", 0) == 0, (
+                "Packed sequences (cu_seqlens) don't support rotary embeddings yet, "
+                "use learned position embeddings (rotary_emb_fraction=0.0)"
+            )
         # If using Tensor Parallel with sequence parallel, we combine the batch and the seqlen
         # dimensions so that we can split on it easily, in case of small batch size.
         # Only the attention layers need to know the seqlen.
@@ -533,6 +567,12 @@ class GPTModel(GPTPreTrainedModel):
         )
         if inference_params is not None:
             mixer_kwargs["inference_params"] = inference_params
+        if cu_seqlens is not None:
+            assert inference_params is None and max_seqlen is not None
+            assert self.process_group is None, "Packed sequences don't support Tensor Parallel"
+            batch_size = hidden_states.shape[0]
+            hidden_states = rearrange(hidden_states, "b s d -> (b s) d")
+            mixer_kwargs.update(cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
         for layer in self.layers:
             if self.prenorm:
                 if not self.parallel_block:
@@ -571,6 +611,8 @@ class GPTModel(GPTPreTrainedModel):
                     prenorm=False,
                     is_rms_norm=isinstance(self.ln_f, RMSNorm)
                 )
+        if cu_seqlens is not None:
+            hidden_states = rearrange(hidden_states, "(b s) d -> b s d", b=batch_size)
         return hidden_states
 
 
@@ -610,6 +652,11 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
                 **factory_kwargs,
             )
         self.norm_head = getattr(config, "norm_head", False)
+        self.lm_loss = LinearCrossEntropyLoss(
+            chunk_size=getattr(config, "lm_loss_chunk_size", 1024),
+            process_group=process_group,
+            sequence_parallel=getattr(config, "sequence_parallel", True),
+        )
         # Initialize weights and apply final processing
         self.apply(
             partial(
@@ -632,19 +679,36 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
             batch_size, max_seqlen, dtype=dtype, **kwargs
         )
 
-    def forward(self, input_ids, position_ids=None, inference_params=None, num_last_tokens=0):
+    def forward(
+        self,
+        input_ids,
+        position_ids=None,
+        inference_params=None,
+        num_last_tokens=0,
+        cu_seqlens=None,
+        max_seqlen=None,
+        labels=None,
+    ):
         """
         input_ids: (batch, seqlen) int tensor
         inference_params: for generation. Adapted from Megatron-LM (and Apex)
         https://github.com/NVIDIA/apex/blob/3ff1a10f72ec07067c4e44759442329804ac5162/apex/transformer/testing/standalone_transformer_lm.py#L470
         num_last_tokens: if > 0, only return the logits for the last n tokens
+        cu_seqlens, max_seqlen: for packed sequences, see GPTModel.forward
+        labels: (batch, seqlen) int tensor, the target of each position (-100 to ignore). If not
+            None, returns the mean cross-entropy loss instead of the logits (logits=None), computed
+            config.lm_loss_chunk_size tokens at a time without materializing all the logits.
         """
         assert (
             input_ids.ndim == 2
         ), f"Expected `input_ids` to have shape [b, slen], but got shape {input_ids.shape}"
         b, slen = input_ids.shape
         hidden_states = self.transformer(
-            input_ids, position_ids=position_ids, inference_params=inference_params
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
         if inference_params is not None:
             assert hidden_states.ndim == 3, "sequence_parallel is not supported in generation mode"
@@ -654,6 +718,14 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
             hidden_states = self.project_out(hidden_states)
         if self.output_scale != 1.0:
             hidden_states = hidden_states * self.output_scale
+        if labels is not None:
+            assert inference_params is None and num_last_tokens == 0
+            lm_head_weight = (
+                self.lm_head.weight if not self.norm_head else F.normalize(self.lm_head.weight)
+            )
+            loss = self.lm_loss(hidden_states, lm_head_weight, labels, bias=self.lm_head.bias)
+            CausalLMOutput = namedtuple("CausalLMOutput", ["logits", "loss"])
+            return CausalLMOutput(logits=None, loss=loss)
         if not self.norm_head:
             lm_logits = self.lm_head(hidden_states)
         else:
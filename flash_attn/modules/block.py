@@ -120,6 +120,8 @@ class Block(nn.Module):
             mixer_subset: for cross-attention only. If not None, will take a subset of x
                 before applying the query projection. Useful for e.g., ViT where we only care
                 about the CLS token in the last layer.
+            mixer_kwargs: passed to the mixer, e.g. packed_batch (a PackedBatch from
+                flash_attn.bert_padding) for MHA on unpadded hidden_states.
         """
         if self.prenorm:
             if not self.fused_dropout_add_ln:
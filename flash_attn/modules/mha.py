@@ -7,7 +7,7 @@ import torch
 import torch.nn as nn
 from einops import rearrange, repeat
 
-from flash_attn.utils.distributed import get_dim_for_local_rank
+from flash_attn.utils.distributed import all_to_all, get_dim_for_local_rank
 
 try:
     from flash_attn import (
@@ -32,6 +32,12 @@ try:
 except ImportError:
     RotaryEmbedding = None
 
+from flash_attn.utils.kv_cache import (
+    QuantizedKVCache,
+    paged_kv_cache_gather,
+    paged_kv_cache_update,
+)
+
 
 # From https://github.com/ofirpress/attention_with_linear_biases/blob/4b92f28a005ead2567abe2359f633e73e08f3833/fairseq/models/transformer.py#L742
 def get_alibi_slopes(nheads):
@@ -341,6 +347,123 @@ class CrossAttention(nn.Module):
         return output
 
 
+class UlyssesAttention(nn.Module):
+    """Sequence parallel attention with all-to-all communication, as in DeepSpeed-Ulysses
+    (https://arxiv.org/abs/2309.14509). Each rank of @process_group holds a contiguous shard of the
+    sequence (with all the heads): an all-to-all gives each rank the whole sequence for a subset
+    of the heads, @inner_attn computes the attention over it, and a second all-to-all brings the
+    output back to sequence shards.
+    Arguments
+    ---------
+        inner_attn: FlashSelfAttention / FlashCrossAttention (or SelfAttention / CrossAttention).
+        process_group: num_heads must be divisible by its size. If num_heads_kv is smaller than
+            the size, the KV heads are replicated so that each rank gets the one its query heads
+            use (the size must then be divisible by num_heads_kv).
+    """
+
+    def __init__(self, inner_attn, process_group):
+        super().__init__()
+        self.inner_attn = inner_attn
+        self.process_group = process_group
+        self.world_size = process_group.size()
+        self.local_rank = torch.distributed.get_rank(process_group)
+
+    def gather_seqlens(self, seqlen, seqlen_k=None, device=None):
+        """Sequence lengths of the shards of all the ranks. If @seqlen_k is not None, returns
+        the lengths of the query shards and of the key / value shards."""
+        local = torch.tensor([seqlen, seqlen if seqlen_k is None else seqlen_k], device=device)
+        seqlens = [torch.empty_like(local) for _ in range(self.world_size)]
+        torch.distributed.all_gather(seqlens, local, group=self.process_group)
+        seqlens = torch.stack(seqlens).tolist()
+        seqlens, seqlens_k = [s for s, _ in seqlens], [s for _, s in seqlens]
+        return seqlens if seqlen_k is None else (seqlens, seqlens_k)
+
+    def _scatter_heads(self, x, seqlens):
+        # (B, S_local, ..., H, D) -> (B, S, ..., H / world_size, D)
+        x = rearrange(x, "b s ... (w h) d -> (w s) b ... h d", w=self.world_size)
+        seqlen = x.shape[0] // self.world_size
+        x = all_to_all(x, self.process_group, seqlens, [seqlen] * self.world_size)
+        return rearrange(x, "s b ... h d -> b s ... h d")
+
+    def _gather_heads(self, x, seqlens):
+        # (B, S, H / world_size, D) -> (B, S_local, H, D)
+        x = rearrange(x, "b s h d -> s b h d")
+        seqlen = seqlens[self.local_rank]
+        x = all_to_all(x, self.process_group, [seqlen] * self.world_size, seqlens)
+        return rearrange(x, "(w s) b h d -> b s (w h) d", w=self.world_size)
+
+    def forward(self, qkv, kv=None, seqlens=None, seqlens_k=None, **kwargs):
+        """
+        Arguments:
+            qkv: (B, S_local, 3, H, D), or q: (B, S_local, H, D) if kv is not None.
+            kv: (B, S_local_k, 2, H_k, D)
+            seqlens: list of the sequence lengths of the shards of all the ranks (the shards can
+                be uneven). If None, they are gathered from all the ranks (see gather_seqlens).
+            seqlens_k: same for kv, defaults to seqlens.
+            kwargs: passed to inner_attn, e.g. causal. The varlen interface (cu_seqlens) is not
+                supported.
+        Return:
+            out: (B, S_local, H, D)
+        """
+        assert kwargs.pop("cu_seqlens", None) is None, "UlyssesAttention does not support varlen"
+        kwargs.pop("max_seqlen", None)
+        assert kwargs.get("key_padding_mask") is None
+        num_heads = qkv.shape[-2]
+        assert num_heads % self.world_size == 0, "num_heads must be divisible by world_size"
+        if seqlens is None:
+            if kv is None:
+                seqlens = self.gather_seqlens(qkv.shape[1], device=qkv.device)
+            else:
+                seqlens, seqlens_k = self.gather_seqlens(
+                    qkv.shape[1], kv.shape[1], device=qkv.device
+                )
+        seqlens_k = seqlens_k if seqlens_k is not None else seqlens
+        if kv is None:
+            context = self.inner_attn(self._scatter_heads(qkv, seqlens), **kwargs)
+        else:
+            num_heads_kv = kv.shape[-2]
+            if num_heads_kv < self.world_size:
+                assert (
+                    self.world_size % num_heads_kv == 0
+                ), "world_size must be divisible by num_heads_kv"
+                kv = repeat(kv, "... hkv d -> ... (hkv g) d", g=self.world_size // num_heads_kv)
+            else:
+                assert (
+                    num_heads_kv % self.world_size == 0
+                ), "num_heads_kv must be divisible by world_size"
+            context = self.inner_attn(
+                self._scatter_heads(qkv, seqlens), self._scatter_heads(kv, seqlens_k), **kwargs
+            )
+        return self._gather_heads(context, seqlens)
+
+
+def ulysses_comm_volume(
+    batch_size, seqlen, num_heads, num_heads_kv, head_dim, world_size, element_size=2
+):
+    """Bytes sent by each rank in the forward pass of one attention layer over a sequence of
+    @seqlen tokens, with sequence parallelism over @world_size ranks (the backward pass sends the
+    same amount again). Compares:
+        all_to_all: UlyssesAttention, O(seqlen / world_size).
+        tensor_parallel: the all-gather of the input and the reduce-scatter of the output of
+            ParallelMHA with sequence_parallel=True, O(seqlen), independent of world_size.
+        ring: ring attention (flash_attn.ops.ring_attention), where each rank sends its key /
+            value shard around the ring, O(seqlen).
+    """
+    tokens_per_rank = batch_size * seqlen / world_size
+    sent_fraction = (world_size - 1) / world_size
+    num_heads_kv_scattered = max(num_heads_kv, world_size)
+    all_to_all_elements = (
+        tokens_per_rank * (2 * num_heads + 2 * num_heads_kv_scattered) * head_dim * sent_fraction
+    )
+    tensor_parallel_elements = 2 * batch_size * seqlen * num_heads * head_dim * sent_fraction
+    ring_elements = (world_size - 1) * tokens_per_rank * 2 * num_heads_kv * head_dim
+    return {
+        "all_to_all": int(all_to_all_elements * element_size),
+        "tensor_parallel": int(tensor_parallel_elements * element_size),
+        "ring": int(ring_elements * element_size),
+    }
+
+
 class LinearResidual(nn.Linear):
     """Wrap nn.Linear to return the residual as well. For compatibility with FusedDense."""
 
@@ -403,6 +526,7 @@ class MHA(nn.Module):
         use_flash_attn=False,
         return_residual=False,
         checkpointing=False,
+        ulysses_process_group=None,
         device=None,
         dtype=None,
     ) -> None:
@@ -411,6 +535,9 @@ class MHA(nn.Module):
         return_residual: whether to return the input x along with the output. This is for
             performance reason: for post-norm architecture, returning the input allows us
             to fuse the backward of nn.Linear with the residual connection.
+        ulysses_process_group: if not None, x is a shard of the sequence on each rank of the
+            process group (the shards being contiguous and in rank order), and the attention is
+            computed with UlyssesAttention. Not supported for generation.
         """
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
@@ -492,11 +619,30 @@ class MHA(nn.Module):
         self.inner_cross_attn = inner_cross_attn_cls(
             causal=causal, softmax_scale=softmax_scale, attention_dropout=dropout
         )
+        self.ulysses_process_group = ulysses_process_group
+        if ulysses_process_group is not None:
+            self.inner_attn = UlyssesAttention(self.inner_attn, ulysses_process_group)
+            self.inner_cross_attn = UlyssesAttention(self.inner_cross_attn, ulysses_process_group)
         self.out_proj = linear_cls(embed_dim, embed_dim, bias=out_proj_bias, **factory_kwargs)
 
-    def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None):
+    def allocate_inference_cache(
+        self, batch_size, max_seqlen, dtype=None, kv_cache_bits=None, kv_cache_group_size=None
+    ):
+        """If kv_cache_bits is 8 or 4, allocate a QuantizedKVCache (dequantized to @dtype) with
+        groups of kv_cache_group_size channels (default: head_dim)."""
         dtype = self.out_proj.weight.dtype if dtype is None else dtype
         device = self.out_proj.weight.device
+        if kv_cache_bits is not None:
+            return QuantizedKVCache(
+                batch_size,
+                max_seqlen,
+                self.num_heads_kv,
+                self.head_dim,
+                num_bits=kv_cache_bits,
+                group_size=kv_cache_group_size,
+                dtype=dtype,
+                device=device,
+            )
         return torch.empty(
             batch_size,
             max_seqlen,
@@ -513,6 +659,34 @@ class MHA(nn.Module):
         assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
         return _update_kv_cache(kv, inference_params, self.layer_idx)
 
+    def _update_quantized_kvcache_attention(self, q, kv, inference_params):
+        """Quantize kv into the QuantizedKVCache of inference_params, then do attention over the
+        cache, dequantizing it one chunk at a time."""
+        assert not self.dwconv, "Generation does not support dwconv yet"
+        assert (
+            inference_params.block_table is None
+        ), "Quantized KV cache does not support paged KV cache yet"
+        assert (
+            getattr(self.inner_cross_attn, "alibi_slopes", None) is None
+        ), "Quantized KV cache does not support ALiBi yet"
+        assert (
+            inference_params.lengths_per_sample is None
+        ), "Quantized KV cache does not support lengths_per_sample yet"
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        batch_start = inference_params.batch_size_offset
+        seqlen_offset = inference_params.seqlen_offset
+        kv_cache.update(kv, batch_start, seqlen_offset)
+        if seqlen_offset == 0:
+            # Prompt: the keys / values that were just computed are exact, no need to read back
+            return self.inner_cross_attn(q, kv)
+        return kv_cache.attention(
+            q,
+            seqlen_offset + kv.shape[1],
+            batch_start=batch_start,
+            softmax_scale=self.inner_cross_attn.softmax_scale,
+            causal=self.inner_cross_attn.causal,
+        )
+
     def _apply_rotary_update_kvcache_attention(self, q, kv, inference_params):
         """
         Fast path that combine 3 steps: apply rotary to Q and K, update kv cache, and apply attention.
@@ -530,7 +704,12 @@ class MHA(nn.Module):
         else:
             rotary_cos, rotary_sin = None, None
         batch = q.shape[0]
-        kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        block_table = inference_params.block_table
+        if block_table is None:
+            kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        else:
+            kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+            block_table = block_table[:batch]
         cache_seqlens = (
             inference_params.lengths_per_sample[:batch]
             if inference_params.lengths_per_sample is not None
@@ -546,6 +725,7 @@ class MHA(nn.Module):
             rotary_cos=rotary_cos,
             rotary_sin=rotary_sin,
             cache_seqlens=cache_seqlens,
+            block_table=block_table,
             softmax_scale=self.inner_cross_attn.softmax_scale,
             causal=self.inner_cross_attn.causal,
             rotary_interleaved=self.rotary_emb.interleaved if self.rotary_emb_dim > 0 else False,
@@ -553,14 +733,75 @@ class MHA(nn.Module):
         )
         return context
 
+    def _update_paged_kvcache_attention(self, q, kv, inference_params):
+        """Write kv to the pages of inference_params, then do attention.
+        Without FlashAttention, the pages are written and gathered with pure torch ops.
+        """
+        assert not self.dwconv, "Generation does not support dwconv yet"
+        assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
+        batch, seqlen_q = q.shape[:2]
+        kv_pages = inference_params.key_value_memory_dict[self.layer_idx]
+        block_table = inference_params.block_table[:batch]
+        cache_seqlens = (
+            inference_params.lengths_per_sample[:batch]
+            if inference_params.lengths_per_sample is not None
+            else torch.full(
+                (batch,), inference_params.seqlen_offset, dtype=torch.int32, device=q.device
+            )
+        )
+        if self.use_flash_attn and flash_attn_with_kvcache is not None:
+            alibi_slopes = getattr(self.inner_cross_attn, "alibi_slopes", None)
+            return flash_attn_with_kvcache(
+                q,
+                kv_pages[:, :, 0],
+                kv_pages[:, :, 1],
+                kv[:, :, 0],
+                kv[:, :, 1],
+                cache_seqlens=cache_seqlens,
+                block_table=block_table,
+                softmax_scale=self.inner_cross_attn.softmax_scale,
+                causal=self.inner_cross_attn.causal,
+                alibi_slopes=alibi_slopes,
+            )
+        paged_kv_cache_update(kv_pages, block_table, kv, cache_seqlens)
+        seqlens_k = cache_seqlens + seqlen_q
+        kv = paged_kv_cache_gather(kv_pages, block_table, int(seqlens_k.max()))
+        key_padding_mask = torch.arange(kv.shape[1], device=q.device) < seqlens_k[:, None]
+        return self.inner_cross_attn(q, kv, key_padding_mask=key_padding_mask)
+
+    def _update_ragged_kvcache_attention(self, q, kv, inference_params):
+        """Write kv to the dense KV cache at lengths_per_sample, which can differ between the
+        sequences of the batch, then do attention. Pure torch version of flash_attn_with_kvcache.
+        """
+        assert not self.dwconv, "Generation does not support dwconv yet"
+        assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
+        batch, seqlen_q = q.shape[:2]
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        cache_seqlens = inference_params.lengths_per_sample[:batch]
+        positions = cache_seqlens[:, None] + torch.arange(seqlen_q, device=q.device)
+        kv_cache[torch.arange(batch, device=q.device)[:, None], positions] = kv
+        seqlens_k = cache_seqlens + seqlen_q
+        kv = kv_cache[:, : int(seqlens_k.max())]
+        key_padding_mask = torch.arange(kv.shape[1], device=q.device) < seqlens_k[:, None]
+        return self.inner_cross_attn(q, kv, key_padding_mask=key_padding_mask)
+
     def _update_kvcache_attention(self, q, kv, inference_params):
         """Write kv to inference_params, then do attention"""
+        if isinstance(inference_params.key_value_memory_dict.get(self.layer_idx), QuantizedKVCache):
+            return self._update_quantized_kvcache_attention(q, kv, inference_params)
+        if inference_params.block_table is not None:
+            return self._update_paged_kvcache_attention(q, kv, inference_params)
         if (
             inference_params.seqlen_offset == 0
             or flash_attn_with_kvcache is None
             or not self.use_flash_attn
         ):
-            # TODO: this only uses seqlen_offset and not lengths_per_sample.
+            if (
+                inference_params.seqlen_offset > 0
+                and inference_params.lengths_per_sample is not None
+            ):
+                # Sequences of the batch can have different lengths
+                return self._update_ragged_kvcache_attention(q, kv, inference_params)
             kv = self._update_kv_cache(kv, inference_params)
             return self.inner_cross_attn(q, kv)
         else:
@@ -593,6 +834,7 @@ class MHA(nn.Module):
         max_seqlen=None,
         mixer_subset=None,
         inference_params=None,
+        packed_batch=None,
         **kwargs,
     ):
         """
@@ -612,7 +854,19 @@ class MHA(nn.Module):
                 about the CLS token in the last layer.
             inference_params: for generation. Adapted from Megatron-LM (and Apex)
             https://github.com/NVIDIA/apex/blob/3ff1a10f72ec07067c4e44759442329804ac5162/apex/transformer/testing/standalone_transformer_lm.py#L470
+            packed_batch: PackedBatch (see flash_attn.bert_padding), in place of cu_seqlens and
+                max_seqlen. With x_kv, x are the tokens packed_batch.subset_idx of x_kv.
         """
+        if packed_batch is not None:
+            assert cu_seqlens is None and max_seqlen is None
+            max_seqlen = packed_batch.max_seqlen
+            if x_kv is None:
+                cu_seqlens = packed_batch.cu_seqlens
+            else:
+                # It's ok to set max_seqlen_q to be much larger
+                cu_seqlens = packed_batch.subset_cu_seqlens
+                kwargs["cu_seqlens_k"] = packed_batch.cu_seqlens
+                kwargs["max_seqlen_k"] = packed_batch.max_seqlen
         if cu_seqlens is not None:
             assert max_seqlen is not None
             assert key_padding_mask is None
@@ -642,7 +896,19 @@ class MHA(nn.Module):
                 else inference_params.seqlen_offset
             )
         )
+        if self.ulysses_process_group is not None:
+            assert inference_params is None, "Generation is not supported with sequence parallel"
+            assert cu_seqlens is None and key_padding_mask is None
+            if not self.cross_attn:
+                # The rotary embedding needs the position of the shard in the sequence
+                seqlens = self.inner_attn.gather_seqlens(x.shape[1], device=x.device)
+                seqlen_offset = sum(seqlens[: self.inner_attn.local_rank])
+                kwargs["seqlens"] = seqlens
         rotary_max_seqlen = inference_params.max_seqlen if inference_params is not None else None
+        # The fused rotary + cache update path of flash_attn_with_kvcache can't write to it
+        kv_cache_quantized = inference_params is not None and isinstance(
+            inference_params.key_value_memory_dict.get(self.layer_idx), QuantizedKVCache
+        )
         batch, seqlen = x.shape[:2]
         if not self.cross_attn and self.num_heads_kv == self.num_heads:
             assert x_kv is None and mixer_subset is None
@@ -660,6 +926,7 @@ class MHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or kv_cache_quantized
             ):
                 if self.rotary_emb_dim > 0:
                     qkv = self.rotary_emb(
@@ -711,6 +978,7 @@ class MHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or kv_cache_quantized
             ):
                 if self.rotary_emb_dim > 0:
                     q, kv = self.rotary_emb(
@@ -882,6 +1150,7 @@ class ParallelMHA(nn.Module):
             rotary_cos, rotary_sin = self.rotary_emb._cos_cached, self.rotary_emb._sin_cached
         else:
             rotary_cos, rotary_sin = None, None
+        assert inference_params.block_table is None, "ParallelMHA does not support paged KV cache yet"
         batch = q.shape[0]
         kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
         cache_seqlens = (
@@ -908,6 +1177,7 @@ class ParallelMHA(nn.Module):
 
     def _update_kvcache_attention(self, q, kv, inference_params):
         """Write kv to inference_params, then do attention"""
+        assert inference_params.block_table is None, "ParallelMHA does not support paged KV cache yet"
         if inference_params.seqlen_offset == 0 or not self.use_flash_attn:
             # TODO: this only uses seqlen_offset and not lengths_per_sample.
             kv = self._update_kv_cache(kv, inference_params)
@@ -0,0 +1,189 @@
+# Cross-entropy loss of a linear layer (e.g. the LM head), fused so that the logits are never
+# materialized for all the tokens: the tokens are processed chunk_size at a time, and the logits of
+# a chunk are recomputed in the backward pass. At 128k vocab and 8k tokens, the full logits take
+# 4GB in fp32, the logits of a chunk of 1024 tokens 512MB.
+# Pure torch, so it also runs on CPU. The statistics are the same as in ops/triton/cross_entropy.py,
+# including the vocab parallel (tensor parallel) reduction.
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from torch.distributed import ProcessGroup
+
+from flash_attn.utils.distributed import all_gather_raw, all_reduce_raw, reduce_scatter_raw
+
+
+def _chunk_logits(hidden_states, weight, bias, logit_scale):
+    return F.linear(hidden_states, weight, bias).float() * logit_scale
+
+
+class LinearCrossEntropyFunc(torch.autograd.Function):
+    @staticmethod
+    def forward(
+        ctx,
+        hidden_states,
+        weight,
+        bias,
+        labels,
+        chunk_size=1024,
+        smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        ignore_index=-100,
+        process_group=None,
+        sequence_parallel=True,
+    ):
+        assert logit_scale > 0.0
+        world_size = 1 if process_group is None else torch.distributed.get_world_size(process_group)
+        rank = 0 if process_group is None else torch.distributed.get_rank(process_group)
+        if world_size > 1 and sequence_parallel:
+            hidden_states_total, _ = all_gather_raw(hidden_states, process_group)
+        else:
+            hidden_states_total = hidden_states
+        n_rows, n_cols = hidden_states_total.shape[0], weight.shape[0]
+        assert labels.shape == (n_rows,)
+        total_classes = world_size * n_cols
+        class_start_idx = rank * n_cols
+        labels_local = labels - class_start_idx
+        in_partition = (labels_local >= 0) & (labels_local < n_cols)
+        labels_local = labels_local.clamp(0, n_cols - 1)
+        lse = torch.empty(n_rows, dtype=torch.float, device=hidden_states.device)
+        losses = torch.empty(n_rows, dtype=torch.float, device=hidden_states.device)
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            logits = _chunk_logits(hidden_states_total[start:end], weight, bias, logit_scale)
+            lse[start:end] = torch.logsumexp(logits, dim=-1)
+            # Everything but the lse, which is only known after the reduction across processes
+            predicted_logits = logits.gather(1, labels_local[start:end, None]).squeeze(1)
+            predicted_logits.masked_fill_(~in_partition[start:end], 0.0)
+            losses[start:end] = -(1.0 - smoothing) * predicted_logits
+            if smoothing > 0.0:
+                losses[start:end] -= smoothing * logits.sum(dim=-1) / total_classes
+        if world_size > 1:
+            lse_allgather = [torch.empty_like(lse) for _ in range(world_size)]
+            torch.distributed.all_gather(lse_allgather, lse, group=process_group)
+            _, handle_losses = all_reduce_raw(losses, process_group, async_op=True)
+            lse = torch.logsumexp(torch.stack(lse_allgather), dim=0)
+            handle_losses.wait()
+        losses += lse
+        if lse_square_scale != 0.0:
+            z_losses = lse_square_scale * lse.square()
+            z_losses.masked_fill_(labels == ignore_index, 0.0)
+            losses += z_losses
+        else:
+            z_losses = torch.zeros_like(losses)
+        losses.masked_fill_(labels == ignore_index, 0.0)
+
+        ctx.save_for_backward(
+            hidden_states, weight, bias, labels_local, in_partition, labels == ignore_index, lse
+        )
+        ctx.mark_non_differentiable(z_losses)
+        ctx.chunk_size = chunk_size
+        ctx.smoothing = smoothing
+        ctx.logit_scale = logit_scale
+        ctx.lse_square_scale = lse_square_scale
+        ctx.total_classes = total_classes
+        ctx.process_group = process_group
+        ctx.sequence_parallel = sequence_parallel
+        return losses, z_losses
+
+    @staticmethod
+    def backward(ctx, grad_losses, grad_z_losses):
+        del grad_z_losses  # z_losses are only for logging.
+
+        hidden_states, weight, bias, labels_local, in_partition, ignored, lse = ctx.saved_tensors
+        process_group = ctx.process_group
+        world_size = 1 if process_group is None else torch.distributed.get_world_size(process_group)
+        if world_size > 1 and ctx.sequence_parallel:
+            hidden_states, _ = all_gather_raw(hidden_states, process_group)
+        grad_losses = grad_losses.masked_fill(ignored, 0.0) * ctx.logit_scale
+        smoothing = ctx.smoothing
+        grad_hidden_states = torch.empty_like(hidden_states)
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+        grad_bias = torch.zeros_like(bias, dtype=torch.float32) if bias is not None else None
+        for start in range(0, hidden_states.shape[0], ctx.chunk_size):
+            end = min(start + ctx.chunk_size, hidden_states.shape[0])
+            logits = _chunk_logits(hidden_states[start:end], weight, bias, ctx.logit_scale)
+            lse_chunk = lse[start:end, None]
+            probs = torch.exp(logits - lse_chunk)
+            if ctx.lse_square_scale != 0.0:
+                probs *= 1.0 + 2.0 * ctx.lse_square_scale * lse_chunk
+            if smoothing > 0.0:
+                probs -= smoothing / ctx.total_classes
+            probs.scatter_add_(
+                1,
+                labels_local[start:end, None],
+                -(1.0 - smoothing) * in_partition[start:end, None].float(),
+            )
+            grad_logits = (probs * grad_losses[start:end, None]).to(hidden_states.dtype)
+            grad_hidden_states[start:end] = grad_logits @ weight
+            grad_weight += grad_logits.t() @ hidden_states[start:end]
+            if bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+        if world_size > 1:
+            # Each process only has the gradient from its part of the vocab
+            if ctx.sequence_parallel:
+                grad_hidden_states, _ = reduce_scatter_raw(grad_hidden_states, process_group)
+            else:
+                grad_hidden_states, _ = all_reduce_raw(grad_hidden_states, process_group)
+        return (
+            grad_hidden_states,
+            grad_weight.to(weight.dtype),
+            grad_bias.to(bias.dtype) if bias is not None else None,
+            None,
+            None,
+            None,
+            None,
+            None,
+            None,
+            None,
+            None,
+        )
+
+
+def linear_cross_entropy_loss(
+    hidden_states: Tensor,
+    weight: Tensor,
+    labels: Tensor,
+    bias: Optional[Tensor] = None,
+    chunk_size: int = 1024,
+    label_smoothing: float = 0.0,
+    logit_scale: float = 1.0,
+    lse_square_scale: float = 0.0,
+    ignore_index=-100,
+    process_group: Optional[ProcessGroup] = None,
+    sequence_parallel: bool = True,
+) -> Tuple[Tensor, Tensor]:
+    """Cross-entropy loss of F.linear(hidden_states, weight, bias), computed @chunk_size tokens at
+    a time, same as cross_entropy_loss (flash_attn.ops.triton.cross_entropy) of the logits.
+    Arguments:
+        hidden_states: (batch, hidden_dim)
+        weight: (vocab_size, hidden_dim), e.g. the weight of the LM head.
+        labels: (batch,)
+        chunk_size: int. Number of tokens whose logits are computed at once. The extra memory is
+            chunk_size * vocab_size floats, in the forward and in the backward pass.
+        label_smoothing, logit_scale, lse_square_scale, ignore_index: see cross_entropy_loss.
+        process_group: if not None, we're doing Tensor Parallel: each process has one part of the
+            vocab (weight is the local shard of ColumnParallelLinear). The loss will be aggregated
+            across processes.
+        sequence_parallel: if True (and process_group is not None), hidden_states are the local
+            shard of the tokens and are gathered, as in ColumnParallelLinear. labels are those of
+            all the tokens.
+    Returns:
+        losses: (batch,), float. With sequence_parallel, for the tokens of all the processes.
+        z_losses: (batch,), float
+    """
+    return LinearCrossEntropyFunc.apply(
+        hidden_states,
+        weight,
+        bias,
+        labels,
+        chunk_size,
+        label_smoothing,
+        logit_scale,
+        lse_square_scale,
+        ignore_index,
+        process_group,
+        sequence_parallel,
+    )
@@ -0,0 +1,290 @@
+# Ring attention (context parallelism): the sequence is sharded across the ranks of a process
+# group, and the key / value shards are passed around the ring, so that every rank computes the
+# attention of its queries over the whole sequence without gathering it. The partial outputs are
+# merged with their log-sum-exp as in split_kv.combine. See Liu et al., Ring Attention with
+# Blockwise Transformers for Near-Infinite Context (https://arxiv.org/abs/2310.01889).
+# On CUDA the blocks are computed with the FlashAttention kernels, otherwise in pure torch
+# (e.g. on CPU with the gloo backend).
+import math
+from typing import Optional, Sequence
+
+import torch
+from einops import rearrange, repeat
+from torch import Tensor
+from torch.distributed import ProcessGroup
+
+from flash_attn.flash_attn_interface import _flash_attn_backward, _flash_attn_forward
+from flash_attn.ops.split_kv import attention_partial, combine
+
+
+def zigzag_shard(x: Tensor, world_size: int, rank: int, dim: int = 1):
+    """Shard of @x along @dim for @rank, in the zig-zag layout expected by ring_attn_func with
+    causal=True: the sequence is split into 2 * world_size chunks, and rank i gets chunks i and
+    2 * world_size - 1 - i, so that every rank has the same amount of work under the causal mask.
+    Position ids (e.g. for rotary embeddings) must be sharded the same way:
+    zigzag_shard(torch.arange(seqlen), world_size, rank, dim=0).
+    """
+    assert x.shape[dim] % (2 * world_size) == 0, "seqlen must be divisible by 2 * world_size"
+    chunks = x.chunk(2 * world_size, dim=dim)
+    return torch.cat([chunks[rank], chunks[2 * world_size - 1 - rank]], dim=dim)
+
+
+def zigzag_unshard(shards: Sequence[Tensor], dim: int = 1):
+    """Inverse of zigzag_shard, @shards being the shards of all the ranks, in order."""
+    halves = [shard.chunk(2, dim=dim) for shard in shards]
+    return torch.cat([h[0] for h in halves] + [h[1] for h in reversed(halves)], dim=dim)
+
+
+class _RingComm:
+    """Sends tensors to the next rank of the ring and receives them from the previous one, with
+    async point-to-point ops so that the transfer overlaps with the compute."""
+
+    def __init__(self, process_group: ProcessGroup):
+        self.process_group = process_group
+        world_size = torch.distributed.get_world_size(process_group)
+        rank = torch.distributed.get_rank(process_group)
+        self.send_rank = torch.distributed.get_global_rank(process_group, (rank + 1) % world_size)
+        self.recv_rank = torch.distributed.get_global_rank(process_group, (rank - 1) % world_size)
+        self._ops = []
+        self._reqs = None
+        self._sent = []  # Keep the sent tensors alive until the ops complete
+
+    def send_recv(self, tensor: Tensor):
+        tensor = tensor.contiguous()
+        recv = torch.empty_like(tensor)
+        self._ops.append(
+            torch.distributed.P2POp(
+                torch.distributed.isend, tensor, self.send_rank, self.process_group
+            )
+        )
+        self._ops.append(
+            torch.distributed.P2POp(
+                torch.distributed.irecv, recv, self.recv_rank, self.process_group
+            )
+        )
+        self._sent.append(tensor)
+        return recv
+
+    def commit(self):
+        assert self._reqs is None, "wait() must be called before committing new ops"
+        self._reqs = torch.distributed.batch_isend_irecv(self._ops)
+        self._ops = []
+
+    def wait(self):
+        for req in self._reqs:
+            req.wait()
+        self._reqs = None
+        self._sent = []
+
+
+def _step_slices(src_rank: int, rank: int, seqlen: int, causal: bool):
+    """Queries and keys of the local shard and of the shard of @src_rank that attend to each other,
+    with the zig-zag layout: (q slice, kv slice, whether the block is causal)."""
+    everything = slice(None)
+    if not causal:
+        return everything, everything, False
+    half = seqlen // 2
+    if src_rank == rank:
+        return everything, everything, True
+    elif src_rank < rank:
+        # Only the first chunk of src_rank comes before the chunks of rank
+        return everything, slice(0, half), False
+    else:
+        # Only the second chunk of rank comes after the chunks of src_rank
+        return slice(half, None), everything, False
+
+
+def _block_forward(q, k, v, softmax_scale, causal):
+    if q.is_cuda:
+        out, lse, _, _ = _flash_attn_forward(
+            q, k, v, 0.0, softmax_scale, causal, -1, -1, 0.0, None, False
+        )
+        return out, lse.transpose(1, 2)
+    return attention_partial(q, k, v, softmax_scale, causal)
+
+
+def _block_backward(dout, q, k, v, out, lse, softmax_scale, causal, deterministic):
+    """Gradients of a block, given the output @out and @lse (batch_size, seqlen_q, nheads) of the
+    attention over the whole sequence."""
+    if q.is_cuda:
+        dq, dk, dv = torch.empty_like(q), torch.empty_like(k), torch.empty_like(v)
+        _flash_attn_backward(
+            dout,
+            q,
+            k,
+            v,
+            out,
+            lse.transpose(1, 2).contiguous(),
+            dq,
+            dk,
+            dv,
+            0.0,
+            softmax_scale,
+            causal,
+            -1,
+            -1,
+            0.0,
+            None,
+            deterministic,
+        )
+        return dq, dk, dv
+    seqlen_q, seqlen_k = q.shape[1], k.shape[1]
+    g = q.shape[2] // k.shape[2]
+    if g > 1:  # MQA/GQA
+        k = repeat(k, "... hk d -> ... (hk g) d", g=g)
+        v = repeat(v, "... hk d -> ... (hk g) d", g=g)
+    q, k, v, dout = q.float(), k.float(), v.float(), dout.float()
+    scores = torch.einsum("bthd,bshd->bhts", q, k) * softmax_scale
+    if causal:
+        row_idx = torch.arange(seqlen_q, device=q.device).unsqueeze(1)
+        col_idx = torch.arange(seqlen_k, device=q.device)
+        scores.masked_fill_(col_idx > row_idx + seqlen_k - seqlen_q, float("-inf"))
+    probs = torch.exp(scores - lse.transpose(1, 2).unsqueeze(-1))
+    dv = torch.einsum("bhts,bthd->bshd", probs, dout)
+    dprobs = torch.einsum("bthd,bshd->bhts", dout, v)
+    delta = (dout * out.float()).sum(dim=-1).transpose(1, 2)
+    dscores = probs * (dprobs - delta.unsqueeze(-1)) * softmax_scale
+    dq = torch.einsum("bhts,bshd->bthd", dscores, k)
+    dk = torch.einsum("bhts,bthd->bshd", dscores, q)
+    if g > 1:
+        dk = rearrange(dk, "b s (hk g) d -> b s hk g d", g=g).sum(dim=3)
+        dv = rearrange(dv, "b s (hk g) d -> b s hk g d", g=g).sum(dim=3)
+    return dq, dk, dv
+
+
+def _ring_attn_forward(q, k, v, softmax_scale, causal, process_group):
+    world_size = torch.distributed.get_world_size(process_group)
+    rank = torch.distributed.get_rank(process_group)
+    seqlen = q.shape[1]
+    comm = _RingComm(process_group) if world_size > 1 else None
+    out, lse = None, None
+    for step in range(world_size):
+        if step + 1 < world_size:
+            next_k, next_v = comm.send_recv(k), comm.send_recv(v)
+            comm.commit()
+        q_slice, kv_slice, block_causal = _step_slices(
+            (rank - step) % world_size, rank, seqlen, causal
+        )
+        block_out, block_lse = _block_forward(
+            q[:, q_slice], k[:, kv_slice], v[:, kv_slice], softmax_scale, block_causal
+        )
+        if out is None:  # Step 0, the local block covers all the queries
+            out, lse = block_out.float(), block_lse
+        else:
+            out[:, q_slice], lse[:, q_slice] = combine(
+                [out[:, q_slice], block_out], [lse[:, q_slice], block_lse], out_dtype=torch.float32
+            )
+        if step + 1 < world_size:
+            comm.wait()
+            k, v = next_k, next_v
+    return out.to(q.dtype), lse
+
+
+def _ring_attn_backward(dout, q, k, v, out, lse, softmax_scale, causal, process_group,
+                        deterministic):
+    world_size = torch.distributed.get_world_size(process_group)
+    rank = torch.distributed.get_rank(process_group)
+    seqlen = q.shape[1]
+    kv_comm = _RingComm(process_group) if world_size > 1 else None
+    # The gradients of a key / value shard travel with it around the ring, accumulating the
+    # contribution of every rank, and are back to their rank after a full turn.
+    dkv_comm = _RingComm(process_group) if world_size > 1 else None
+    dq = torch.zeros_like(q, dtype=torch.float32)
+    for step in range(world_size):
+        if step + 1 < world_size:
+            next_k, next_v = kv_comm.send_recv(k), kv_comm.send_recv(v)
+            kv_comm.commit()
+        if step == 0:
+            dk = torch.zeros_like(k, dtype=torch.float32)
+            dv = torch.zeros_like(v, dtype=torch.float32)
+        else:
+            dkv_comm.wait()
+            dk, dv = next_dk, next_dv
+        q_slice, kv_slice, block_causal = _step_slices(
+            (rank - step) % world_size, rank, seqlen, causal
+        )
+        block_dq, block_dk, block_dv = _block_backward(
+            dout[:, q_slice],
+            q[:, q_slice],
+            k[:, kv_slice],
+            v[:, kv_slice],
+            out[:, q_slice],
+            lse[:, q_slice],
+            softmax_scale,
+            block_causal,
+            deterministic,
+        )
+        dq[:, q_slice] += block_dq
+        dk[:, kv_slice] += block_dk
+        dv[:, kv_slice] += block_dv
+        if step + 1 < world_size:
+            kv_comm.wait()
+            k, v = next_k, next_v
+        if world_size > 1:
+            next_dk, next_dv = dkv_comm.send_recv(dk), dkv_comm.send_recv(dv)
+            dkv_comm.commit()
+    if world_size > 1:
+        dkv_comm.wait()
+        dk, dv = next_dk, next_dv
+    return dq.to(q.dtype), dk.to(k.dtype), dv.to(v.dtype)
+
+
+class RingAttnFunc(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, q, k, v, process_group, softmax_scale, causal, deterministic):
+        if softmax_scale is None:
+            softmax_scale = 1.0 / math.sqrt(q.shape[-1])
+        out, lse = _ring_attn_forward(q, k, v, softmax_scale, causal, process_group)
+        ctx.save_for_backward(q, k, v, out, lse)
+        ctx.process_group = process_group
+        ctx.softmax_scale = softmax_scale
+        ctx.causal = causal
+        ctx.deterministic = deterministic
+        return out
+
+    @staticmethod
+    def backward(ctx, dout):
+        q, k, v, out, lse = ctx.saved_tensors
+        dq, dk, dv = _ring_attn_backward(
+            dout,
+            q,
+            k,
+            v,
+            out,
+            lse,
+            ctx.softmax_scale,
+            ctx.causal,
+            ctx.process_group,
+            ctx.deterministic,
+        )
+        return dq, dk, dv, None, None, None, None
+
+
+def ring_attn_func(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    process_group: ProcessGroup,
+    softmax_scale: Optional[float] = None,
+    causal: bool = False,
+    deterministic: bool = False,
+):
+    """Attention over a sequence sharded across the ranks of @process_group (context parallelism).
+    Each rank passes the queries / keys / values of its shard and gets the output of its shard.
+    The key / value shards go around the ring, each rank sending its current shard to the next
+    rank while computing the attention over it, so the communication is hidden behind the compute
+    when the shards are long enough. The backward pass does a second turn, the gradients of every
+    key / value shard following it around the ring.
+    Arguments:
+        q: (batch_size, seqlen_local, nheads, headdim)
+        k, v: (batch_size, seqlen_local, nheads_k, headdim). nheads must be divisible by nheads_k.
+        causal: whether to apply the causal mask over the whole sequence. The shards must then be
+            in the zig-zag layout of zigzag_shard, which balances the work across the ranks
+            (with contiguous shards, the first rank would only attend to its own shard while the
+            last one attends to all of them). Without causal, any sharding works.
+        deterministic: whether to use the deterministic implementation of the backward pass of
+            the FlashAttention kernel (CUDA only).
+    Return:
+        out: (batch_size, seqlen_local, nheads, headdim)
+    """
+    return RingAttnFunc.apply(q, k, v, process_group, softmax_scale, causal, deterministic)
@@ -0,0 +1,131 @@
+# Split-KV attention in pure torch: attention over chunks of keys / values that are computed
+# independently and merged with their log-sum-exp, as done by the split-KV kernels and
+# flash_attn_combine (hopper/flash_fwd_combine_kernel.h).
+import math
+from typing import Optional, Sequence, Union
+
+import torch
+from einops import repeat
+from torch import Tensor
+
+
+def attention_partial(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    softmax_scale: Optional[float] = None,
+    causal: bool = False,
+    k_start: int = 0,
+    seqlen_k: Optional[int] = None,
+):
+    """Attention of q over one chunk of keys / values, in fp32.
+    Arguments:
+        q: (batch_size, seqlen_q, nheads, headdim)
+        k, v: (batch_size, chunk_size, nheads_k, headdim). nheads must be divisible by nheads_k.
+        k_start: position of the first key of the chunk in the full key sequence.
+        seqlen_k: length of the full key sequence, defaults to k_start + chunk_size. Only used for
+            the causal mask, which is aligned to the bottom right corner of the full attention
+            matrix, as in flash_attn_func.
+    Return:
+        out: (batch_size, seqlen_q, nheads, headdim), fp32
+        lse: (batch_size, seqlen_q, nheads), fp32. -inf for rows where no key of the chunk is
+            visible (their output is 0), so that they are ignored by combine.
+        Stacking the outputs of several chunks gives the layout of out_partial / lse_partial of
+        flash_attn_combine.
+    """
+    seqlen_q, nheads = q.shape[1], q.shape[2]
+    chunk_size, nheads_k = k.shape[1], k.shape[2]
+    assert nheads % nheads_k == 0
+    if seqlen_k is None:
+        seqlen_k = k_start + chunk_size
+    softmax_scale = softmax_scale if softmax_scale is not None else 1.0 / math.sqrt(q.shape[-1])
+    if nheads_k != nheads:  # MQA/GQA
+        k = repeat(k, "... hk d -> ... (hk g) d", g=nheads // nheads_k)
+        v = repeat(v, "... hk d -> ... (hk g) d", g=nheads // nheads_k)
+    scores = torch.einsum("bthd,bshd->bhts", q.float(), k.float()) * softmax_scale
+    if causal:
+        row_idx = torch.arange(seqlen_q, device=q.device).unsqueeze(1)
+        col_idx = torch.arange(k_start, k_start + chunk_size, device=q.device)
+        scores.masked_fill_(col_idx > row_idx + seqlen_k - seqlen_q, float("-inf"))
+    lse = torch.logsumexp(scores, dim=-1)
+    # Rows without any visible key have lse = -inf, exp(scores - lse) would be NaN
+    probs = torch.exp(scores - lse.masked_fill(lse == float("-inf"), 0.0).unsqueeze(-1))
+    out = torch.einsum("bhts,bshd->bthd", probs, v.float())
+    return out, lse.transpose(1, 2)
+
+
+def combine(
+    out_partials: Union[Tensor, Sequence[Tensor]],
+    lse_partials: Union[Tensor, Sequence[Tensor]],
+    out_dtype: Optional[torch.dtype] = None,
+):
+    """Merge partial attention outputs, computed over disjoint chunks of keys, into the output
+    over all the keys. Pure torch counterpart of flash_attn_combine, with the same layout.
+    Arguments:
+        out_partials: (num_splits, batch_size, seqlen, nheads, headdim), or a sequence of
+            num_splits tensors of shape (batch_size, seqlen, nheads, headdim).
+        lse_partials: (num_splits, batch_size, seqlen, nheads), or a sequence of tensors.
+        out_dtype: dtype of the output, defaults to the dtype of out_partials.
+    Return:
+        out: (batch_size, seqlen, nheads, headdim)
+        lse: (batch_size, seqlen, nheads), fp32. -inf (and out = 0) where all the partial lse
+            are -inf.
+    """
+    if not isinstance(out_partials, Tensor):
+        out_partials = torch.stack(list(out_partials))
+    if not isinstance(lse_partials, Tensor):
+        lse_partials = torch.stack(list(lse_partials))
+    out_dtype = out_dtype if out_dtype is not None else out_partials.dtype
+    lse_partials = lse_partials.float()
+    lse_max = lse_partials.amax(dim=0)
+    # In case all the partial lse are -inf
+    lse_max = lse_max.masked_fill(lse_max == float("-inf"), 0.0)
+    scales = torch.exp(lse_partials - lse_max)
+    scales_sum = scales.sum(dim=0)
+    lse = torch.log(scales_sum) + lse_max
+    scales = scales / scales_sum.masked_fill(scales_sum == 0.0, 1.0)
+    # Splits with lse = -inf don't contribute, even if their output is not finite
+    scales = scales.unsqueeze(-1)
+    out = (scales * out_partials.float().masked_fill(scales == 0.0, 0.0)).sum(dim=0)
+    return out.to(out_dtype), lse
+
+
+def attention_chunked(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    chunk_size: int = 4096,
+    softmax_scale: Optional[float] = None,
+    causal: bool = False,
+    return_lse: bool = False,
+):
+    """Attention over keys / values processed @chunk_size at a time.
+
+    Partial results are merged into a running (out, lse) after every chunk, so the extra memory is
+    O(batch_size * nheads * seqlen_q * chunk_size) regardless of seqlen_k. Chunks are moved to the
+    device of q as they are processed, so k and v can stay on CPU (e.g. memory-mapped) for
+    offloading.
+    Arguments:
+        q: (batch_size, seqlen_q, nheads, headdim)
+        k, v: (batch_size, seqlen_k, nheads_k, headdim)
+    Return:
+        out: (batch_size, seqlen_q, nheads, headdim), same dtype as q
+        lse [optional, if return_lse=True]: (batch_size, seqlen_q, nheads), fp32
+    """
+    seqlen_k = k.shape[1]
+    out, lse = None, None
+    for k_start in range(0, seqlen_k, chunk_size):
+        k_chunk = k[:, k_start : k_start + chunk_size].to(q.device, non_blocking=True)
+        v_chunk = v[:, k_start : k_start + chunk_size].to(q.device, non_blocking=True)
+        out_chunk, lse_chunk = attention_partial(
+            q, k_chunk, v_chunk, softmax_scale, causal, k_start=k_start, seqlen_k=seqlen_k
+        )
+        if out is None:
+            out, lse = out_chunk, lse_chunk
+        else:
+            out, lse = combine([out, out_chunk], [lse, lse_chunk])
+    if out is None:  # seqlen_k == 0
+        out = torch.zeros(*q.shape[:3], v.shape[-1], dtype=torch.float32, device=q.device)
+        lse = torch.full(q.shape[:3], float("-inf"), dtype=torch.float32, device=q.device)
+    out = out.to(q.dtype)
+    return (out, lse) if return_lse else out
@@ -0,0 +1,386 @@
+# Python mirror of the launch heuristics of the Hopper (FlashAttention-3) forward kernels:
+# num_splits_heuristic / should_pack_gqa in hopper/heuristics.h, tile_size_fwd_sm90 /
+# tile_size_fwd_sm8x in hopper/tile_size.h, and get_num_splits / get_pack_gqa in
+# hopper/flash_api.cpp. These must be kept in sync with the C++ code.
+# This assumes a build with all features enabled (no FLASHATTENTION_DISABLE_* flags).
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import torch
+
+
+@dataclass(frozen=True)
+class LaunchPlan:
+    """Launch configuration of a forward call, as the C++ side would choose it.
+
+    kernel_args are the remaining values returned by the tile size function:
+    (Mma1_is_RS, IntraWGOverlap) for sm90, (kNWarps, kStages, Q_in_regs) for sm8x.
+    wave_efficiency is the fraction of the last wave of CTAs that is busy, averaged over waves,
+    i.e. num_ctas / (ceil(num_ctas / num_sm) * num_sm).
+    """
+
+    arch: int
+    num_sm: int
+    block_m: int
+    block_n: int
+    kernel_args: Tuple
+    num_splits: int
+    pack_gqa: bool
+    num_m_blocks: int
+    num_n_blocks: int
+    num_ctas: int
+    num_waves: float
+    wave_efficiency: float
+
+
+def round_up_headdim(head_size: int) -> int:
+    for headdim in (64, 96, 128, 192):
+        if head_size <= headdim:
+            return headdim
+    return 256
+
+
+def should_pack_gqa(varlen_q: bool, seqlen_q: int, qhead_per_khead: int, block_m: int) -> bool:
+    # If varlen, we don't actually know seqlen_q but only max_seqlen_q.
+    if varlen_q:
+        return True
+
+    # PackGQA is a bit slower but can help if seqlen_q is small or not near a multiple of kBlockM
+    def round_up(a, b):
+        return (a + b - 1) // b * b
+
+    nopack_gqa_efficiency = seqlen_q / round_up(seqlen_q, block_m)
+    pack_gqa_efficiency = seqlen_q * qhead_per_khead / round_up(seqlen_q * qhead_per_khead, block_m)
+    return nopack_gqa_efficiency < 0.9 * pack_gqa_efficiency
+
+
+def num_splits_heuristic(
+    batch_nheads_mblocks: int, num_sm: int, num_n_blocks: int, max_splits: int
+) -> int:
+    """Smallest number of splits that gets 85% of the best wave efficiency."""
+    # If we have enough to almost fill the SMs, then just use 1 split
+    if batch_nheads_mblocks >= 0.8 * num_sm:
+        return 1
+    # If num_n_blocks is too small, use 1 split. E.g. we never split for hdim 128 and seqlen_k 512.
+    if num_n_blocks <= 4:
+        return 1
+    max_splits = min(max_splits, num_sm, num_n_blocks)
+    efficiency = []
+    for num_splits in range(1, max_splits + 1):
+        n_waves = batch_nheads_mblocks * num_splits / num_sm
+        efficiency.append(n_waves / math.ceil(n_waves))
+    max_efficiency = max(efficiency, default=0.0)
+    for num_splits in range(1, max_splits + 1):
+        if efficiency[num_splits - 1] >= 0.85 * max_efficiency:
+            return num_splits
+    return 1
+
+
+def tile_size_fwd_sm90(
+    headdim,
+    headdim_v,
+    is_causal,
+    is_local,
+    element_size=2,
+    v_colmajor=False,
+    paged_kv=False,
+    softcap=False,
+):
+    """Return (kBlockM, kBlockN, Mma1_is_RS, IntraWGOverlap)"""
+    if element_size == 2:
+        if headdim <= 64:
+            return 192, 128, True, True
+        elif headdim <= 96:
+            return 192, 128 if is_local or paged_kv else 144, False, True
+        elif headdim <= 128:
+            return 128, 128 if is_causal or is_local or paged_kv else 176, True, True
+        elif headdim <= 192:
+            block_n = 96 if paged_kv or is_local else (128 if headdim_v <= 128 else 112)
+            return 128, block_n, True, True
+        else:
+            return 128, 64 if is_local else 80, True, True
+    else:
+        if headdim <= 64:
+            return 192, 160, True, True
+        elif headdim <= 96:
+            return 192, 128, True, True
+        elif headdim <= 128:
+            block_n = 160 if paged_kv else (192 if v_colmajor or (softcap and is_local) else 224)
+            return 128, block_n, True, True
+        elif headdim <= 192:
+            return 128, 128 if (paged_kv or softcap) and is_local else 160, True, True
+        else:
+            return 128, 64 if is_local else 128, True, not paged_kv
+
+
+def tile_size_fwd_sm8x(
+    sm86_or_89,
+    headdim,
+    headdim_v,
+    is_causal,
+    is_local,
+    element_size=2,
+    paged_kv=False,
+    varlen_and_split=False,
+    softcap=False,
+    append_kv=False,
+):
+    """Return (kBlockM, kBlockN, kNWarps, kStages, Q_in_regs)"""
+    if element_size == 2:
+        if headdim <= 64:
+            return 128, 80 if varlen_and_split else (96 if is_local else 112), 4, 1, False
+        elif headdim <= 96:
+            return 128, 48 if varlen_and_split or is_local else 64, 4, 1, False
+        elif headdim <= 128:
+            use_8_warps = sm86_or_89 or varlen_and_split
+            if use_8_warps and varlen_and_split:
+                block_n = 96 if is_local else 112
+            elif use_8_warps:
+                block_n = 96 if is_local else 128
+            else:
+                block_n = 48 if is_local else 64
+            return 128, block_n, 8 if use_8_warps else 4, 1, use_8_warps
+        elif headdim <= 192:
+            block_n_64 = append_kv or is_local or varlen_and_split or paged_kv
+            return 128, 64 if block_n_64 else 96, 8, 1 if sm86_or_89 else 2, not block_n_64
+        else:
+            if sm86_or_89:
+                block_n = 32 if append_kv else (48 if varlen_and_split or is_local else 64)
+            else:
+                block_n = 48 if append_kv else (64 if varlen_and_split or is_local else 96)
+            return 128, block_n, 8, 1, sm86_or_89 and not append_kv
+    else:
+        # Placeholder for now
+        return 128, 64, 8, 2, False
+
+
+def get_device_arch_and_num_sm(device=None) -> Tuple[int, int]:
+    props = torch.cuda.get_device_properties(device if device is not None else 0)
+    return props.major * 10 + props.minor, props.multi_processor_count
+
+
+@lru_cache(maxsize=None)
+def _plan_fwd(
+    arch,
+    num_sm,
+    batch_size,
+    seqlen_q,
+    seqlen_k,
+    num_heads,
+    num_heads_k,
+    headdim,
+    headdim_v,
+    element_size,
+    causal,
+    window_size,
+    softcap,
+    paged_kv,
+    varlen_q,
+    varlen_k,
+    append_kv,
+    num_splits,
+    pack_gqa,
+):
+    # Same normalization of the window as mha_fwd, then set_params_fprop
+    window_size_left, window_size_right = window_size
+    if window_size_left >= seqlen_k - 1:
+        window_size_left = -1
+    if window_size_right >= seqlen_q - 1:
+        window_size_right = -1
+    if causal:
+        window_size_right = 0
+    is_causal = window_size_left < 0 and window_size_right == 0
+    is_local = (window_size_left >= 0 or window_size_right >= 0) and not is_causal
+    if window_size_left < 0 and window_size_right >= 0:
+        window_size_left = seqlen_k - 1
+    if window_size_left >= 0 and window_size_right < 0:
+        window_size_right = seqlen_q - 1
+
+    d_rounded, dv_rounded = round_up_headdim(headdim), round_up_headdim(headdim_v)
+    has_softcap = softcap > 0.0
+    qhead_per_khead = num_heads // num_heads_k
+    tile_sm90 = tile_size_fwd_sm90(
+        d_rounded, dv_rounded, is_causal, is_local, element_size, False, paged_kv, has_softcap
+    )
+
+    def get_tile(varlen_and_split, append_kv):
+        if arch >= 90:
+            return tile_sm90
+        return tile_size_fwd_sm8x(
+            arch in (86, 89),
+            d_rounded,
+            dv_rounded,
+            is_causal,
+            is_local,
+            element_size,
+            paged_kv,
+            varlen_and_split,
+            has_softcap,
+            append_kv,
+        )
+
+    def get_num_m_blocks(pack_gqa, block_m):
+        seqlen = seqlen_q * qhead_per_khead if pack_gqa else seqlen_q
+        return (seqlen + block_m - 1) // block_m
+
+    # get_num_splits. This runs before pack_gqa and knew_ptr are set, and the C++ params are
+    # zero-initialized, so the heuristic counts all the query heads and ignores append_kv.
+    varlen = varlen_q or varlen_k
+    block_m, block_n = get_tile(varlen, False)[:2]
+    if is_local:
+        seqlen_k_loaded = max(0, min(seqlen_k, window_size_right + window_size_left + 1 + block_m))
+    else:
+        seqlen_k_loaded = seqlen_k
+    if num_splits <= 0:
+        num_n_blocks = (seqlen_k_loaded + block_n - 1) // block_n
+        num_m_blocks = get_num_m_blocks(True, block_m)
+        num_splits = num_splits_heuristic(
+            batch_size * num_heads * num_m_blocks, num_sm, num_n_blocks, 128
+        )
+
+    # get_pack_gqa
+    if pack_gqa is None:
+        if arch < 90 or paged_kv or num_splits > 1:
+            pack_gqa = True
+        elif num_heads == num_heads_k:
+            pack_gqa = False
+        else:
+            pack_gqa = should_pack_gqa(varlen_q, seqlen_q, qhead_per_khead, tile_sm90[0])
+
+    # The tile size of the kernel that is actually launched
+    tile = get_tile(varlen and num_splits > 1, append_kv)
+    block_m, block_n = tile[:2]
+    num_m_blocks = get_num_m_blocks(pack_gqa, block_m)
+    num_n_blocks = (seqlen_k_loaded + block_n - 1) // block_n
+    num_ctas = batch_size * (num_heads_k if pack_gqa else num_heads) * num_m_blocks * num_splits
+    num_waves = num_ctas / num_sm
+    wave_efficiency = num_waves / math.ceil(num_waves) if num_ctas > 0 else 0.0
+    return LaunchPlan(
+        arch=arch,
+        num_sm=num_sm,
+        block_m=block_m,
+        block_n=block_n,
+        kernel_args=tuple(tile[2:]),
+        num_splits=num_splits,
+        pack_gqa=pack_gqa,
+        num_m_blocks=num_m_blocks,
+        num_n_blocks=num_n_blocks,
+        num_ctas=num_ctas,
+        num_waves=num_waves,
+        wave_efficiency=wave_efficiency,
+    )
+
+
+def plan_fwd(
+    batch_size: int,
+    seqlen_q: int,
+    seqlen_k: int,
+    num_heads: int,
+    num_heads_k: int,
+    headdim: int,
+    headdim_v: Optional[int] = None,
+    dtype: torch.dtype = torch.bfloat16,
+    causal: bool = False,
+    window_size: Tuple[int, int] = (-1, -1),
+    softcap: float = 0.0,
+    paged_kv: bool = False,
+    varlen_q: bool = False,
+    varlen_k: bool = False,
+    append_kv: bool = False,
+    num_sm: Optional[int] = None,
+    arch: Optional[int] = None,
+    sm_margin: int = 0,
+    num_splits: int = 0,
+    pack_gqa: Optional[bool] = None,
+) -> LaunchPlan:
+    """Predict the launch configuration of the Hopper forward kernel.
+
+    Arguments:
+        seqlen_q, seqlen_k: max_seqlen_q / max_seqlen_k if varlen. For a paged KV cache, seqlen_k is
+            max_num_blocks_per_seq * page_block_size, as in the C++ code.
+        dtype: dtype of q. torch.float8_e4m3fn selects the fp8 tile sizes.
+        varlen_q: cu_seqlens_q or seqused_q is passed.
+        varlen_k: cu_seqlens_k, seqused_k (e.g. cache_seqlens) or leftpad_k is passed.
+        append_kv: new k / v are appended to the KV cache.
+        num_sm, arch: default to the properties of the current CUDA device. @sm_margin is
+            subtracted from num_sm, like the sm_margin argument of the interface.
+        num_splits, pack_gqa: same meaning as in flash_attn_with_kvcache. num_splits <= 0 and
+            pack_gqa=None let the heuristics decide.
+    Return:
+        LaunchPlan. Pass it as flash_attn_with_kvcache(..., plan=plan) to launch with its
+        num_splits and pack_gqa. Plans are cached, so this is cheap to call per step.
+    """
+    if arch is None or num_sm is None:
+        device_arch, device_num_sm = get_device_arch_and_num_sm()
+        arch = arch if arch is not None else device_arch
+        num_sm = num_sm if num_sm is not None else device_num_sm
+    assert num_heads % num_heads_k == 0, "num_heads must be divisible by num_heads_k"
+    return _plan_fwd(
+        arch,
+        num_sm - sm_margin,
+        batch_size,
+        seqlen_q,
+        seqlen_k,
+        num_heads,
+        num_heads_k,
+        headdim,
+        headdim_v if headdim_v is not None else headdim,
+        1 if dtype == torch.float8_e4m3fn else 2,
+        causal,
+        tuple(window_size),
+        softcap,
+        paged_kv,
+        varlen_q,
+        varlen_k,
+        append_kv,
+        num_splits,
+        pack_gqa,
+    )
+
+
+def plan_with_kvcache(
+    q,
+    k_cache,
+    v_cache,
+    k=None,
+    cache_seqlens=None,
+    cache_leftpad=None,
+    page_table=None,
+    cu_seqlens_q=None,
+    max_seqlen_q=None,
+    causal=False,
+    window_size=(-1, -1),
+    softcap=0.0,
+    num_sm=None,
+    arch=None,
+    sm_margin=0,
+) -> LaunchPlan:
+    """plan_fwd with the shapes read from the arguments of flash_attn_with_kvcache (Hopper)."""
+    batch_size = q.shape[0] if cu_seqlens_q is None else cu_seqlens_q.shape[0] - 1
+    seqlen_q = q.shape[1] if cu_seqlens_q is None else max_seqlen_q
+    if page_table is None:
+        seqlen_k = k_cache.shape[1]
+    else:
+        seqlen_k = page_table.shape[1] * k_cache.shape[1]
+    return plan_fwd(
+        batch_size,
+        seqlen_q,
+        seqlen_k,
+        q.shape[-2],
+        k_cache.shape[-2],
+        q.shape[-1],
+        v_cache.shape[-1],
+        dtype=q.dtype,
+        causal=causal,
+        window_size=window_size,
+        softcap=softcap,
+        paged_kv=page_table is not None,
+        varlen_q=cu_seqlens_q is not None,
+        varlen_k=cache_seqlens is not None or cache_leftpad is not None,
+        append_kv=k is not None,
+        num_sm=num_sm,
+        arch=arch,
+        sm_margin=sm_margin,
+    )
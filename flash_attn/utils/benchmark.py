@@ -5,15 +5,24 @@ import torch
 import torch.utils.benchmark as benchmark
 
 
+def get_device_type(*inputs, **kwinputs):
+    """Device type of the first tensor argument, used for autocast. Defaults to "cuda"."""
+    for x in (*inputs, *kwinputs.values()):
+        if isinstance(x, torch.Tensor):
+            return x.device.type
+    return "cuda"
+
+
 def benchmark_forward(
     fn, *inputs, repeats=10, desc="", verbose=True, amp=False, amp_dtype=torch.float16, **kwinputs
 ):
     """Use Pytorch Benchmark on the forward pass of an arbitrary function."""
     if verbose:
         print(desc, "- Forward pass")
+    device_type = get_device_type(*inputs, **kwinputs)
 
     def amp_wrapper(*inputs, **kwinputs):
-        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
             fn(*inputs, **kwinputs)
 
     t = benchmark.Timer(
@@ -41,7 +50,8 @@ def benchmark_backward(
     """Use Pytorch Benchmark on the backward pass of an arbitrary function."""
     if verbose:
         print(desc, "- Backward pass")
-    with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+    device_type = get_device_type(*inputs, **kwinputs)
+    with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
         y = fn(*inputs, **kwinputs)
         if type(y) is tuple:
             y = y[0]
@@ -83,7 +93,8 @@ def benchmark_combined(
     """Use Pytorch Benchmark on the forward+backward pass of an arbitrary function."""
     if verbose:
         print(desc, "- Forward + Backward pass")
-    with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+    device_type = get_device_type(*inputs, **kwinputs)
+    with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
         y = fn(*inputs, **kwinputs)
         if type(y) is tuple:
             y = y[0]
@@ -97,7 +108,7 @@ def benchmark_combined(
         for x in inputs:
             if isinstance(x, torch.Tensor):
                 x.grad = None
-        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
             y = fn(*inputs, **kwinputs)
             if type(y) is tuple:
                 y = y[0]
@@ -211,8 +222,9 @@ def pytorch_profiler(
     **kwinputs,
 ):
     """Wrap benchmark functions in Pytorch profiler to see CUDA information."""
+    device_type = get_device_type(*inputs, **kwinputs)
     if backward:
-        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
             out = fn(*inputs, **kwinputs)
             if type(out) is tuple:
                 out = out[0]
@@ -222,16 +234,16 @@ def pytorch_profiler(
             for x in inputs:
                 if isinstance(x, torch.Tensor):
                     x.grad = None
-        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
             out = fn(*inputs, **kwinputs)
             if type(out) is tuple:
                 out = out[0]
         # Backward should be done outside autocast
         if backward:
             out.backward(g, retain_graph=True)
-    activities = ([torch.profiler.ProfilerActivity.CPU] if cpu else []) + [
-        torch.profiler.ProfilerActivity.CUDA
-    ]
+    activities = ([torch.profiler.ProfilerActivity.CPU] if cpu or device_type == "cpu" else []) + (
+        [torch.profiler.ProfilerActivity.CUDA] if device_type == "cuda" else []
+    )
     with torch.profiler.profile(
         activities=activities,
         record_shapes=True,
@@ -242,7 +254,7 @@ def pytorch_profiler(
             for x in inputs:
                 if isinstance(x, torch.Tensor):
                     x.grad = None
-        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp):
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp):
             out = fn(*inputs, **kwinputs)
             if type(out) is tuple:
                 out = out[0]
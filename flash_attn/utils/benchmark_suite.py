@@ -0,0 +1,360 @@
+""" Attention benchmark suite: sweep a grid of configurations, store the results as JSON / CSV,
+and compare a run against a saved baseline.
+
+    python -m flash_attn.utils.benchmark_suite --grid grid.json --output run.json \
+        --baseline baseline.json
+
+The grid is a JSON object mapping each field of BenchmarkConfig to a list of values, e.g.
+{"batch_size": [2, 8], "seqlen": [512, 2048], "headdim": [64, 128], "causal": [false, true]}.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional
+
+import torch
+from einops import rearrange
+
+from flash_attn.utils.benchmark import benchmark_backward, benchmark_combined, benchmark_forward
+
+
+@dataclass(frozen=True)
+class BenchmarkConfig:
+    backend: str = "flash"  # "flash" or "pytorch"
+    mode: str = "fwd"  # "fwd", "bwd" or "fwd_bwd"
+    batch_size: int = 2
+    seqlen: int = 1024
+    seqlen_k: Optional[int] = None  # Defaults to seqlen
+    nheads: int = 16
+    headdim: int = 64
+    gqa_ratio: int = 1  # nheads // nheads_k
+    causal: bool = False
+    varlen: bool = False  # Sequence lengths drawn in [seqlen // 2, seqlen]
+    dtype: str = "float16"
+
+    @property
+    def name(self) -> str:
+        return ",".join(f"{f.name}={getattr(self, f.name)}" for f in fields(self))
+
+
+def make_grid(**axes) -> List[BenchmarkConfig]:
+    """Cartesian product of the values of each axis, e.g. make_grid(seqlen=[512, 1024])."""
+    for name in axes:
+        if name not in {f.name for f in fields(BenchmarkConfig)}:
+            raise ValueError(f"Unknown benchmark axis {name}")
+    names = list(axes)
+    values = [v if isinstance(v, (list, tuple)) else [v] for v in axes.values()]
+    return [BenchmarkConfig(**dict(zip(names, combo))) for combo in itertools.product(*values)]
+
+
+def attention_flops(seqlens_q, seqlens_k, nheads, headdim, causal, mode="fwd"):
+    """FLOPs of the two matmuls, only counting the entries that are not masked out."""
+    assert mode in ["fwd", "bwd", "fwd_bwd"]
+    f = 0
+    for seqlen_q, seqlen_k in zip(seqlens_q, seqlens_k):
+        if causal:  # Mask aligned to the bottom right corner
+            num_entries = sum(
+                min(max(i + seqlen_k - seqlen_q + 1, 0), seqlen_k) for i in range(seqlen_q)
+            )
+        else:
+            num_entries = seqlen_q * seqlen_k
+        f += 4 * num_entries * nheads * headdim
+    return f if mode == "fwd" else (2.5 * f if mode == "bwd" else 3.5 * f)
+
+
+def attention_pytorch(q, k, v, causal=False, key_padding_mask=None):
+    """Standard attention in pytorch, as the baseline. q, k, v: (batch, seqlen, nheads, headdim)"""
+    seqlen_q, seqlen_k = q.shape[1], k.shape[1]
+    if k.shape[2] != q.shape[2]:  # MQA/GQA
+        g = q.shape[2] // k.shape[2]
+        k, v = k.repeat_interleave(g, dim=2), v.repeat_interleave(g, dim=2)
+    scores = torch.einsum("bthd,bshd->bhts", q, k / math.sqrt(q.shape[-1]))
+    if key_padding_mask is not None:
+        scores = scores.masked_fill(~rearrange(key_padding_mask, "b s -> b 1 1 s"), float("-inf"))
+    if causal:
+        row_idx = torch.arange(seqlen_q, device=q.device).unsqueeze(1)
+        col_idx = torch.arange(seqlen_k, device=q.device)
+        scores = scores.masked_fill(col_idx > row_idx + seqlen_k - seqlen_q, float("-inf"))
+    attention = torch.softmax(scores, dim=-1).nan_to_num(0.0)
+    return torch.einsum("bhts,bshd->bthd", attention, v)
+
+
+def make_inputs(config: BenchmarkConfig, device):
+    """Return (fn, inputs, kwinputs, seqlens_q, seqlens_k) for one configuration."""
+    dtype = getattr(torch, config.dtype)
+    seqlen_q = config.seqlen
+    seqlen_k = config.seqlen_k if config.seqlen_k is not None else config.seqlen
+    nheads_k = config.nheads // config.gqa_ratio
+    if config.varlen:
+        seqlens_q = torch.randint(seqlen_q // 2, seqlen_q + 1, (config.batch_size,)).tolist()
+        if seqlen_k == seqlen_q:
+            seqlens_k = seqlens_q
+        else:
+            seqlens_k = torch.randint(seqlen_k // 2, seqlen_k + 1, (config.batch_size,)).tolist()
+    else:
+        seqlens_q, seqlens_k = [seqlen_q] * config.batch_size, [seqlen_k] * config.batch_size
+    requires_grad = config.mode != "fwd"
+
+    def randn(seqlens, nheads):
+        if config.varlen:  # (total, nheads, headdim)
+            shape = (sum(seqlens), nheads, config.headdim)
+        else:
+            shape = (config.batch_size, seqlens[0], nheads, config.headdim)
+        return torch.randn(shape, device=device, dtype=dtype, requires_grad=requires_grad)
+
+    q = randn(seqlens_q, config.nheads)
+    k, v = randn(seqlens_k, nheads_k), randn(seqlens_k, nheads_k)
+    if config.backend == "flash":
+        from flash_attn import flash_attn_func, flash_attn_varlen_func
+
+        if not config.varlen:
+            return flash_attn_func, (q, k, v), {"causal": config.causal}, seqlens_q, seqlens_k
+
+        def cu_seqlens(seqlens):
+            return torch.tensor([0] + list(itertools.accumulate(seqlens)), device=device).int()
+
+        kwinputs = {
+            "cu_seqlens_q": cu_seqlens(seqlens_q),
+            "cu_seqlens_k": cu_seqlens(seqlens_k),
+            "max_seqlen_q": max(seqlens_q),
+            "max_seqlen_k": max(seqlens_k),
+            "causal": config.causal,
+        }
+        return flash_attn_varlen_func, (q, k, v), kwinputs, seqlens_q, seqlens_k
+    elif config.backend == "pytorch":
+        if not config.varlen:
+            kwinputs = {"causal": config.causal}
+            return attention_pytorch, (q, k, v), kwinputs, seqlens_q, seqlens_k
+        from flash_attn.bert_padding import pad_input
+
+        # The baseline runs on padded tensors, as it would without varlen support
+        def padding_mask(seqlens):
+            return torch.arange(max(seqlens), device=device) < torch.tensor(
+                seqlens, device=device
+            ).unsqueeze(1)
+
+        def pad(x, seqlens):
+            mask = padding_mask(seqlens)
+            indices = torch.nonzero(mask.flatten(), as_tuple=False).flatten()
+            return pad_input(x, indices, config.batch_size, max(seqlens))
+
+        def fn(q, k, v, causal):
+            return attention_pytorch(
+                pad(q, seqlens_q),
+                pad(k, seqlens_k),
+                pad(v, seqlens_k),
+                causal=causal,
+                key_padding_mask=padding_mask(seqlens_k),
+            )
+
+        return fn, (q, k, v), {"causal": config.causal}, seqlens_q, seqlens_k
+    raise ValueError(f"Unknown backend {config.backend}")
+
+
+def run_config(config: BenchmarkConfig, device="cuda", repeats=10, num_samples=5) -> Dict:
+    """Time one configuration. Each of the @num_samples timing samples is the mean over
+    @repeats runs; the median and the interquartile range of the samples are reported."""
+    torch.manual_seed(0)
+    fn, inputs, kwinputs, seqlens_q, seqlens_k = make_inputs(config, device)
+    benchmark_fn = {
+        "fwd": benchmark_forward,
+        "bwd": benchmark_backward,
+        "fwd_bwd": benchmark_combined,
+    }[config.mode]
+    is_cuda = torch.device(device).type == "cuda"
+    if is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    # This also warms up
+    timer, _ = benchmark_fn(fn, *inputs, repeats=1, verbose=False, **kwinputs)
+    peak_memory_mb = torch.cuda.max_memory_allocated() / 2**20 if is_cuda else None
+    times = sorted(timer.timeit(repeats).mean for _ in range(num_samples))
+    median = statistics.median(times)
+    flops = attention_flops(
+        seqlens_q, seqlens_k, config.nheads, config.headdim, config.causal, config.mode
+    )
+    return {
+        "name": config.name,
+        **asdict(config),
+        "time_ms": median * 1e3,
+        "iqr_ms": (times[(3 * len(times)) // 4] - times[len(times) // 4]) * 1e3,
+        "tflops": flops / median / 1e12,
+        "peak_memory_mb": peak_memory_mb,
+        "samples_ms": [t * 1e3 for t in times],
+    }
+
+
+def get_metadata(device) -> Dict:
+    import flash_attn
+
+    metadata = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "flash_attn": flash_attn.__version__,
+        "torch": torch.__version__,
+        "device": str(device),
+        "platform": platform.platform(),
+    }
+    if torch.device(device).type == "cuda":
+        metadata["device_name"] = torch.cuda.get_device_name(device)
+    else:
+        metadata["device_name"] = platform.processor()
+        metadata["num_threads"] = torch.get_num_threads()
+    return metadata
+
+
+def run_suite(configs, device="cuda", repeats=10, num_samples=5, verbose=True) -> Dict:
+    results = []
+    for config in configs:
+        try:
+            result = run_config(config, device=device, repeats=repeats, num_samples=num_samples)
+        except (RuntimeError, ImportError) as e:  # OOM, unsupported config or missing backend
+            if verbose:
+                print(f"Skipping {config.name}: {e}")
+            continue
+        if verbose:
+            print(
+                f"{config.name}: {result['time_ms']:.3f}ms, {result['tflops']:.2f} TFLOPs/s"
+                + (
+                    f", {result['peak_memory_mb']:.0f}MB"
+                    if result["peak_memory_mb"] is not None
+                    else ""
+                )
+            )
+        results.append(result)
+    return {"metadata": get_metadata(device), "results": results}
+
+
+def save_json(run: Dict, path):
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+
+
+def load_json(path) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_csv(run: Dict, path):
+    """One row per configuration, without the individual samples."""
+    rows = [{k: v for k, v in r.items() if k != "samples_ms"} for r in run["results"]]
+    if not rows:
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def mann_whitney_u_pvalue(x, y) -> float:
+    """One-sided p-value that samples @y tend to be larger than samples @x (normal approximation
+    of the Mann-Whitney U test, with tie correction)."""
+    n1, n2 = len(x), len(y)
+    ranked = sorted([(v, 0) for v in x] + [(v, 1) for v in y])
+    ranks = [0.0] * len(ranked)
+    tie_term, i = 0.0, 0
+    while i < len(ranked):
+        j = i
+        while j + 1 < len(ranked) and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        for idx in range(i, j + 1):
+            ranks[idx] = (i + j) / 2 + 1
+        tie_term += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    rank_sum_y = sum(r for r, (_, group) in zip(ranks, ranked) if group == 1)
+    u = rank_sum_y - n2 * (n2 + 1) / 2
+    n = n1 + n2
+    var = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if var <= 0:
+        return 0.5
+    z = (u - n1 * n2 / 2) / math.sqrt(var)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare(run: Dict, baseline: Dict, threshold=0.05, alpha=0.05) -> List[Dict]:
+    """Compare the times of @run against @baseline, configuration by configuration.
+
+    A configuration regresses (improves) if its median time is more than @threshold slower
+    (faster) than the baseline, and the difference is significant at level @alpha according to
+    a Mann-Whitney U test on the timing samples. Returns one entry per common configuration with
+    the time ratio and a status in {"regression", "improvement", "unchanged"}.
+    """
+    baseline_results = {r["name"]: r for r in baseline["results"]}
+    comparisons = []
+    for result in run["results"]:
+        base = baseline_results.get(result["name"])
+        if base is None:
+            continue
+        ratio = result["time_ms"] / base["time_ms"]
+        p_slower = mann_whitney_u_pvalue(base["samples_ms"], result["samples_ms"])
+        p_faster = mann_whitney_u_pvalue(result["samples_ms"], base["samples_ms"])
+        if ratio > 1 + threshold and p_slower < alpha:
+            status = "regression"
+        elif ratio < 1 - threshold and p_faster < alpha:
+            status = "improvement"
+        else:
+            status = "unchanged"
+        comparisons.append(
+            {
+                "name": result["name"],
+                "baseline_ms": base["time_ms"],
+                "time_ms": result["time_ms"],
+                "ratio": ratio,
+                "p_value": p_slower if ratio >= 1 else p_faster,
+                "status": status,
+            }
+        )
+    return comparisons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Attention benchmark suite")
+    parser.add_argument("--grid", help="JSON file mapping BenchmarkConfig fields to lists")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--num-samples", type=int, default=5)
+    parser.add_argument("--output", help="Where to save the results as JSON")
+    parser.add_argument("--csv", help="Where to save the results as CSV")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.05)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    if args.grid is not None:
+        with open(args.grid) as f:
+            axes = json.load(f)
+    else:
+        axes = {
+            "backend": ["flash" if torch.device(args.device).type == "cuda" else "pytorch"],
+            "seqlen": [512, 2048],
+            "headdim": [64, 128],
+            "causal": [False, True],
+        }
+    run = run_suite(
+        make_grid(**axes), device=args.device, repeats=args.repeats, num_samples=args.num_samples
+    )
+    if args.output is not None:
+        save_json(run, args.output)
+    if args.csv is not None:
+        save_csv(run, args.csv)
+    if args.baseline is not None:
+        comparisons = compare(run, load_json(args.baseline), args.threshold, args.alpha)
+        for c in comparisons:
+            print(
+                f"{c['status']:>11} {c['ratio']:6.3f}x ({c['baseline_ms']:.3f}ms -> "
+                f"{c['time_ms']:.3f}ms, p={c['p_value']:.3f}) {c['name']}"
+            )
+        if any(c["status"] == "regression" for c in comparisons):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
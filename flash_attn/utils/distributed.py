@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import torch
 from torch import Tensor
@@ -46,6 +46,36 @@ def all_reduce_raw(input_: Tensor, process_group: ProcessGroup, async_op: bool =
     return input_, handle
 
 
+# Raw operation, does not support autograd, but does support async
+def all_to_all_raw(
+    input_: Tensor,
+    process_group: ProcessGroup,
+    output_split_sizes: Optional[List[int]] = None,
+    input_split_sizes: Optional[List[int]] = None,
+    async_op: bool = False,
+):
+    """Rank i sends the i-th chunk of the input (along dim 0) to every rank, and the output is the
+    concatenation of the chunks received from all the ranks, in rank order. The chunks are of equal
+    size if the split sizes are None.
+    """
+    if output_split_sizes is None:
+        world_size = torch.distributed.get_world_size(process_group)
+        assert input_.shape[0] % world_size == 0
+        output_rows = input_.shape[0]
+    else:
+        output_rows = sum(output_split_sizes)
+    output = torch.empty(output_rows, *input_.shape[1:], dtype=input_.dtype, device=input_.device)
+    handle = torch.distributed.all_to_all_single(
+        output,
+        input_.contiguous(),
+        output_split_sizes=output_split_sizes,
+        input_split_sizes=input_split_sizes,
+        group=process_group,
+        async_op=async_op,
+    )
+    return output, handle
+
+
 class AllGatherFunc(torch.autograd.Function):
     """Gather the input from sequence parallel region and concatenate."""
 
@@ -102,6 +132,35 @@ class AllReduceFunc(torch.autograd.Function):
 all_reduce = AllReduceFunc.apply
 
 
+class AllToAllFunc(torch.autograd.Function):
+    """Exchange chunks of the input between all the ranks, see all_to_all_raw."""
+
+    @staticmethod
+    def forward(
+        ctx,
+        input_: Tensor,
+        process_group: ProcessGroup,
+        output_split_sizes: Optional[List[int]] = None,
+        input_split_sizes: Optional[List[int]] = None,
+    ) -> Tensor:
+        ctx.process_group = process_group
+        ctx.output_split_sizes = output_split_sizes
+        ctx.input_split_sizes = input_split_sizes
+        output, _ = all_to_all_raw(input_, process_group, output_split_sizes, input_split_sizes)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor):
+        grad_input, _ = all_to_all_raw(
+            grad_output, ctx.process_group, ctx.input_split_sizes, ctx.output_split_sizes
+        )
+        return grad_input, None, None, None
+
+
+# Supports autograd, but does not support async
+all_to_all = AllToAllFunc.apply
+
+
 def sync_shared_params(model: torch.nn.Module, process_group: ProcessGroup):
     # We want to iterate over parameters with _shared_params=True in the same order,
     # as different ranks might have different number of parameters (e.g., only rank 0 has bias).
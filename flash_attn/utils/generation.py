@@ -3,9 +3,10 @@
 import gc
 import time
 from collections import namedtuple
-from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from functools import partial
-from typing import Callable, Optional, Sequence, Union
+from typing import Callable, List, Optional, Sequence, Union
 
 import torch
 import torch.nn.functional as F
@@ -13,6 +14,8 @@ from einops import rearrange, repeat
 from torch import Tensor
 from torch.profiler import ProfilerActivity, profile, record_function
 
+from flash_attn.utils.kv_cache import QuantizedKVCache
+
 try:
     from transformers.generation import GreedySearchDecoderOnlyOutput, SampleDecoderOnlyOutput
 except ImportError:
@@ -31,6 +34,9 @@ class InferenceParams:
     batch_size_offset: int = 0
     key_value_memory_dict: dict = field(default_factory=dict)
     lengths_per_sample: Optional[Tensor] = None
+    # If not None, key_value_memory_dict holds pages of a PagedKVCache and this maps each sequence
+    # of the batch to its pages, (batch_size, max_blocks_per_seq), int32.
+    block_table: Optional[Tensor] = None
 
     def reset(self, max_seqlen, max_batch_size):
         self.max_seqlen = max_seqlen
@@ -95,8 +101,203 @@ def sample(logits, top_k=1, top_p=0.0, temperature=1.0):
             )
 
 
+@dataclass
+class SamplingParams:
+    """Sampling parameters of one sequence, see sample_batched.
+    top_k = 0 means no top-k filtering, top_p = 0.0 or 1.0 means no top-p filtering,
+    temperature = 0.0 or top_k = 1 means greedy decoding.
+    If seed is not None, the sequence samples from its own generator, so its tokens don't
+    depend on the other sequences of the batch. The generator is created at the first use and
+    kept on this object, so decode and ContinuousBatchingScheduler copy the params of each
+    sequence, which then starts at the seed.
+    """
+
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 0.0
+    repetition_penalty: float = 1.0
+    seed: Optional[int] = None
+    _generator: Optional[torch.Generator] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @property
+    def greedy(self):
+        return self.top_k == 1 or self.temperature <= 0.0
+
+    def get_generator(self, device):
+        if self.seed is None:
+            return None
+        if self._generator is None:
+            self._generator = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generator
+
+
+@dataclass
+class BatchSamplingParams:
+    """SamplingParams of a batch as (batch_size,) tensors, along with the host-side summaries
+    sample_batched needs to pick its code path without a device sync."""
+
+    temperature: Tensor
+    top_k: Tensor  # 0 replaced by vocab_size in sample_batched
+    top_p: Tensor
+    repetition_penalty: Optional[Tensor]  # None if all the penalties are 1.0
+    generators: Optional[List[Optional[torch.Generator]]]  # None if no sequence has a seed
+    all_greedy: bool
+    all_top_k: bool  # Whether every sequence has top-k filtering
+    max_top_k: int  # Largest top_k > 0, 0 if there is none
+
+    def select(self, rows: List[int]):
+        """The parameters of @rows of the batch. Summaries are kept as is, as they still hold
+        (or are upper bounds) for any subset of the rows."""
+        idx = torch.tensor(rows, device=self.temperature.device)
+        return BatchSamplingParams(
+            temperature=self.temperature[idx],
+            top_k=self.top_k[idx],
+            top_p=self.top_p[idx],
+            repetition_penalty=(
+                self.repetition_penalty[idx] if self.repetition_penalty is not None else None
+            ),
+            generators=[self.generators[i] for i in rows] if self.generators is not None else None,
+            all_greedy=self.all_greedy,
+            all_top_k=self.all_top_k,
+            max_top_k=self.max_top_k,
+        )
+
+    @classmethod
+    def from_list(cls, params: Sequence[SamplingParams], device=None):
+        penalties = [p.repetition_penalty for p in params]
+        generators = [p.get_generator(device) for p in params]
+        return cls(
+            temperature=torch.tensor([p.temperature for p in params], device=device),
+            top_k=torch.tensor([p.top_k for p in params], dtype=torch.long, device=device),
+            top_p=torch.tensor([p.top_p for p in params], device=device),
+            repetition_penalty=(
+                torch.tensor(penalties, device=device)
+                if any(penalty != 1.0 for penalty in penalties)
+                else None
+            ),
+            generators=generators if any(g is not None for g in generators) else None,
+            all_greedy=all(p.greedy for p in params),
+            all_top_k=all(p.top_k > 0 for p in params),
+            max_top_k=max([p.top_k for p in params if p.top_k > 0], default=0),
+        )
+
+
+def _top_p_threshold(probs, top_p, num_iters=32):
+    """Largest t (up to bisection precision) such that the tokens with probability >= t have a
+    total probability >= top_p, for each row of @probs. Keeping these tokens is the same as
+    modify_logits_for_top_p_filtering, but with num_iters passes over the vocab instead of a sort.
+    """
+    lo = torch.zeros_like(probs[:, 0])
+    hi = probs.amax(dim=-1)
+    for _ in range(num_iters):
+        mid = (lo + hi) / 2
+        enough = (probs * (probs >= mid[:, None])).sum(dim=-1) >= top_p
+        lo = torch.where(enough, mid, lo)
+        hi = torch.where(enough, hi, mid)
+    return lo
+
+
+def sample_batched(logits, params: BatchSamplingParams, input_ids=None):
+    """Sample one token per row of @logits, each with its own temperature, top-k, top-p,
+    repetition penalty and generator.
+
+    If every row has top-k filtering, only the top max(top_k) logits are selected (a partial sort)
+    and top-p is applied on those. Otherwise the top-p threshold is found by bisection over the
+    full vocab, and sampling is an inverse CDF lookup, so the vocab is never sorted.
+    Arguments:
+        logits: (batch_size, vocab_size)
+        input_ids: (batch_size, seqlen), the tokens so far, for the repetition penalty (as in
+            https://arxiv.org/abs/1909.05858: positive logits are divided by the penalty,
+            negative ones multiplied).
+    Return:
+        tokens: (batch_size,), int64
+    """
+    batch_size, vocab_size = logits.shape
+    logits = logits.float()
+    if params.repetition_penalty is not None and input_ids is not None:
+        logits = logits.clone()
+        penalty = params.repetition_penalty[:, None].to(logits.dtype)
+        prev_logits = logits.gather(1, input_ids)
+        logits.scatter_(
+            1, input_ids, torch.where(prev_logits > 0, prev_logits / penalty, prev_logits * penalty)
+        )
+    tokens_greedy = logits.argmax(dim=-1)
+    if params.all_greedy:
+        return tokens_greedy
+    greedy = (params.top_k == 1) | (params.temperature <= 0.0)
+    logits = logits / params.temperature.clamp(min=1e-5)[:, None]
+    top_k = torch.where(params.top_k > 0, params.top_k.clamp(max=vocab_size), vocab_size)
+    top_p = torch.where((params.top_p > 0.0) & (params.top_p < 1.0), params.top_p, 1.0)
+    if params.all_top_k:
+        logits, indices = torch.topk(logits, min(params.max_top_k, vocab_size), dim=-1)
+        positions = torch.arange(logits.shape[-1], device=logits.device)
+        logits.masked_fill_(positions >= top_k[:, None], float("-inf"))
+        probs = torch.softmax(logits, dim=-1)
+        # Sorted in decreasing order: remove the tokens after the mass reaches top_p
+        probs.masked_fill_(probs.cumsum(dim=-1) - probs >= top_p[:, None], 0.0)
+    else:
+        indices = None
+        if params.max_top_k > 0:
+            max_top_k = min(params.max_top_k, vocab_size)
+            kth_logits = torch.topk(logits, max_top_k, dim=-1)[0].gather(
+                1, top_k.clamp(max=max_top_k)[:, None] - 1
+            )
+            logits = logits.masked_fill(
+                (logits < kth_logits) & (params.top_k[:, None] > 0), float("-inf")
+            )
+        probs = torch.softmax(logits, dim=-1)
+        threshold = _top_p_threshold(probs, top_p)
+        probs.masked_fill_(probs < threshold[:, None], 0.0)
+    if params.generators is None:
+        uniform = torch.rand(batch_size, device=logits.device)
+    else:
+        uniform = torch.stack(
+            [torch.rand((), generator=g, device=logits.device) for g in params.generators]
+        )
+    cdf = probs.cumsum(dim=-1)
+    idx = torch.searchsorted(cdf, (uniform * cdf[:, -1])[:, None], right=True)
+    idx = idx.clamp(max=cdf.shape[-1] - 1).squeeze(-1)
+    tokens = indices.gather(1, idx[:, None]).squeeze(-1) if indices is not None else idx
+    return torch.where(greedy, tokens_greedy, tokens)
+
+
+def prefill_chunked(model, input_ids, inference_params, chunk_size):
+    """Process the prompt @input_ids (batch, seqlen) @chunk_size tokens at a time, writing its keys
+    and values to the KV cache of @inference_params. Each chunk attends causally to the tokens
+    before it, which are in the cache, so the logits are those of processing the prompt at once,
+    but the activation memory only grows with @chunk_size.
+    As with a forward pass of @model, the caller advances inference_params.seqlen_offset (and
+    lengths_per_sample) afterwards.
+    Return: logits of the last token, (batch, vocab_size).
+    """
+    batch_size, seqlen = input_ids.shape
+    seqlen_offset = inference_params.seqlen_offset
+    for start in range(0, seqlen, chunk_size):
+        chunk = input_ids[:, start : start + chunk_size]
+        arange = torch.arange(chunk.shape[1], dtype=torch.long, device=input_ids.device)
+        if inference_params.lengths_per_sample is not None:
+            position_ids = inference_params.lengths_per_sample[:, None] + arange
+        else:
+            position_ids = (inference_params.seqlen_offset + arange).expand(batch_size, -1)
+        logits = model(
+            chunk,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            num_last_tokens=1,
+        ).logits.squeeze(dim=1)
+        inference_params.seqlen_offset += chunk.shape[1]
+        if inference_params.lengths_per_sample is not None:
+            inference_params.lengths_per_sample += chunk.shape[1]
+    inference_params.seqlen_offset = seqlen_offset
+    if inference_params.lengths_per_sample is not None:
+        inference_params.lengths_per_sample -= seqlen
+    return logits
+
+
 @torch.inference_mode()
-def decode(
+def _decode_steps(
     input_ids,
     model,
     max_length,
@@ -109,25 +310,39 @@ def decode(
     tensor_parallel=1,
     cg=False,
     enable_timing=False,
+    paged_kv_cache=None,
+    prefix_cache=None,
+    kv_cache_bits=None,
+    sampling_params=None,
+    compact_finished=False,
+    prefill_chunk_size=None,
 ):
-    """Decoding, either greedy or with top-k or top-p sampling.
-    If top-k = 0, don't limit the number of candidates (pure sampling).
-    Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
-    then top-p.
-    We assume that all sequences in the same batch have the same length.
-
-    Arguments:
-        input_ids: (batch, seq_len)
-        max_length: int
-        teacher_outputs (optional): (batch, seq_len). If provided, instead of sampling from the
-            logits, the next token is taken from the teacher_outputs. Useful for testing.
-    Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
-        sequences: (batch, max_length)
-        scores: tuples of (batch, vocab_size)
-    """
+    """Generator behind decode and generate_stream. Yields, for each step, the sampled tokens
+    (batch, 1) and the logits (batch, vocab_size). Arguments are those of decode."""
     batch_size, seqlen_og = input_ids.shape
     teacher_output_len = teacher_outputs.shape[1] if teacher_outputs is not None else 0
-    if cg:
+    if paged_kv_cache is not None:
+        assert not cg, "CUDA graph does not support paged KV cache yet"
+        assert batch_size <= paged_kv_cache.max_batch_size
+        inference_params = InferenceParams(
+            max_seqlen=max_length,
+            max_batch_size=batch_size,
+            key_value_memory_dict=paged_kv_cache.kv_pages,
+            lengths_per_sample=torch.zeros(batch_size, dtype=torch.int32, device=input_ids.device),
+            block_table=paged_kv_cache.block_table[:batch_size],
+        )
+        if prefix_cache is not None:
+            assert prefix_cache.kv_cache is paged_kv_cache
+            matches = [prefix_cache.match(ids) for ids in input_ids.tolist()]
+            # All the sequences start at the same offset, so only the prefix that is cached for
+            # every one of them is reused.
+            prefix_len = min(num_tokens for num_tokens, _ in matches)
+            num_prefix_blocks = prefix_len // paged_kv_cache.page_block_size
+            for i, (_, blocks) in enumerate(matches):
+                paged_kv_cache.assign(i, blocks[:num_prefix_blocks])
+            inference_params.seqlen_offset = prefix_len
+            inference_params.lengths_per_sample.fill_(prefix_len)
+    elif cg:
         if not hasattr(model, "_decoding_cache"):
             model._decoding_cache = None
         model._decoding_cache = update_graph_cache(
@@ -142,16 +357,39 @@ def decode(
         inference_params.reset(max_length, batch_size)
     else:
         inference_params = InferenceParams(max_seqlen=max_length, max_batch_size=batch_size)
+        if kv_cache_bits is not None:
+            inference_params.key_value_memory_dict = model.allocate_inference_cache(
+                batch_size, max_length, kv_cache_bits=kv_cache_bits
+            )
+    assert kv_cache_bits is None or (
+        paged_kv_cache is None and not cg
+    ), "Quantized KV cache does not support paged KV cache or CUDA graph yet"
+    assert prefix_cache is None or paged_kv_cache is not None, "prefix_cache needs paged_kv_cache"
+    assert not (compact_finished and cg), "CUDA graph does not support compact_finished yet"
+    prefix_len = inference_params.seqlen_offset
+    # With compact_finished, the rows of the batch that are still running, once some finished
+    rows, active_rows = list(range(batch_size)), None
+    # Number of tokens in the KV cache of each finished sequence
+    num_cached_tokens = [None] * batch_size
+    if sampling_params is not None:
+        if isinstance(sampling_params, SamplingParams):
+            sampling_params = [sampling_params] * batch_size
+        assert len(sampling_params) == batch_size
+        # Copies, so that the sequences don't share the generators of the caller's params
+        sampling_params = BatchSamplingParams.from_list(
+            [replace(params) for params in sampling_params], device=input_ids.device
+        )
 
     def get_logits(input_ids, inference_params):
+        if prefill_chunk_size is not None and input_ids.shape[1] > prefill_chunk_size:
+            logits = prefill_chunked(model, input_ids, inference_params, prefill_chunk_size)
+            return logits[..., :vocab_size] if vocab_size is not None else logits
         decoding = inference_params.seqlen_offset > 0
         if decoding:
-            position_ids = torch.full(
-                (batch_size, 1),
-                inference_params.seqlen_offset,
-                dtype=torch.long,
-                device=input_ids.device,
-            )
+            # More than 1 token when prefill starts from a cached prefix
+            position_ids = inference_params.seqlen_offset + torch.arange(
+                input_ids.shape[1], dtype=torch.long, device=input_ids.device
+            ).expand(input_ids.shape[0], -1)
         else:
             position_ids = None
         if not cg or not decoding:
@@ -169,14 +407,27 @@ def decode(
 
     def sample_tokens(logits, inference_params):
         if teacher_outputs is None or teacher_output_len <= inference_params.seqlen_offset:
-            token = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature)
+            if sampling_params is None:
+                token = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature)
+            else:
+                prev_ids = (
+                    torch.cat(sequences, dim=1)
+                    if sampling_params.repetition_penalty is not None
+                    else None
+                )
+                if prev_ids is not None and active_rows is not None:
+                    prev_ids = prev_ids[active_rows]
+                token = sample_batched(logits, sampling_params, input_ids=prev_ids)
         else:
-            token = teacher_outputs[:, inference_params.seqlen_offset]
+            token = teacher_outputs[
+                active_rows if active_rows is not None else slice(None),
+                inference_params.seqlen_offset,
+            ]
         # return rearrange(token, "b -> b 1")
         return token.unsqueeze(1)
 
     def should_stop(current_token, inference_params):
-        if inference_params.seqlen_offset == 0:
+        if inference_params.seqlen_offset < seqlen_og:
             return False
         if eos_token_id is not None and (current_token == eos_token_id).all():
             return True
@@ -184,26 +435,290 @@ def decode(
             return True
         return False
 
-    start = torch.cuda.Event(enable_timing=enable_timing)
-    end = torch.cuda.Event(enable_timing=enable_timing)
-
     if enable_timing:
+        start = torch.cuda.Event(enable_timing=enable_timing)
+        end = torch.cuda.Event(enable_timing=enable_timing)
         if tensor_parallel > 1:
             torch.distributed.barrier()
         start.record()
-    scores, sequences = [], [input_ids]
-    while not should_stop(sequences[-1], inference_params):
-        scores.append(get_logits(sequences[-1], inference_params))
-        inference_params.seqlen_offset += sequences[-1].shape[1]
-        sequences.append(sample_tokens(scores[-1], inference_params))
+    sequences = [input_ids]
+    if prefix_len > 0:
+        sequences = [input_ids[:, :prefix_len], input_ids[:, prefix_len:]]
+    next_ids = sequences[-1]  # Tokens of the running rows to process at the next step
+    num_steps, num_tokens_skipped = 0, 0
+    completed = False
+    try:
+        while not should_stop(next_ids, inference_params):
+            num_steps += 1
+            num_tokens_skipped += batch_size - len(rows)
+            if paged_kv_cache is not None:
+                for i in rows:
+                    paged_kv_cache.reserve(i, inference_params.seqlen_offset + next_ids.shape[1])
+                if active_rows is not None:
+                    # Indexing copies the rows, so this picks up the pages just reserved
+                    inference_params.block_table = paged_kv_cache.block_table[active_rows]
+            logits = get_logits(next_ids, inference_params)
+            inference_params.seqlen_offset += next_ids.shape[1]
+            if paged_kv_cache is not None:
+                inference_params.lengths_per_sample += next_ids.shape[1]
+            next_ids = sample_tokens(logits, inference_params)
+            if active_rows is None:
+                sequences.append(next_ids)
+            else:
+                # Scatter back into the whole batch
+                logits = logits.new_zeros(batch_size, logits.shape[-1]).index_copy_(
+                    0, active_rows, logits
+                )
+                sequences.append(
+                    torch.full_like(sequences[0][:, :1], eos_token_id).index_copy_(
+                        0, active_rows, next_ids
+                    )
+                )
+            yield sequences[-1], logits
+            if compact_finished and eos_token_id is not None:
+                finished = (next_ids.squeeze(1) == eos_token_id).tolist()
+                # If they all finished, should_stop ends the loop
+                if any(finished) and not all(finished):
+                    for i, done in enumerate(finished):
+                        if done:
+                            num_cached_tokens[rows[i]] = inference_params.seqlen_offset
+                    rows = [row for row, done in zip(rows, finished) if not done]
+                    active_rows = torch.tensor(rows, device=input_ids.device)
+                    keep_list = [i for i, done in enumerate(finished) if not done]
+                    keep = torch.tensor(keep_list, device=input_ids.device)
+                    next_ids = next_ids[keep]
+                    if sampling_params is not None:
+                        sampling_params = sampling_params.select(keep_list)
+                    if paged_kv_cache is not None:
+                        # Pages are not moved, the block table of the running sequences is
+                        # gathered from paged_kv_cache at every step
+                        inference_params.lengths_per_sample = (
+                            inference_params.lengths_per_sample[keep]
+                        )
+                    else:
+                        _compact_kv_cache(
+                            inference_params.key_value_memory_dict,
+                            keep,
+                            inference_params.seqlen_offset,
+                        )
+        completed = True
+    finally:
+        # Also release the slots if the caller stops iterating early
+        if paged_kv_cache is not None:
+            if prefix_cache is not None and completed:
+                cached_ids = torch.cat(sequences, dim=1).tolist()
+                for i in range(batch_size):
+                    num_cached = num_cached_tokens[i] or inference_params.seqlen_offset
+                    prefix_cache.insert(cached_ids[i][:num_cached], paged_kv_cache.block_tables[i])
+            for i in range(batch_size):
+                paged_kv_cache.free(i)
     if enable_timing:
         end.record()
         if tensor_parallel > 1:
             torch.distributed.barrier()
         torch.cuda.synchronize()
         print(f"Prompt processing + decoding time: {(start.elapsed_time(end)):.0f}ms")
-    output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
-    return output_cls(sequences=torch.cat(sequences, dim=1), scores=tuple(scores))
+        if compact_finished:
+            num_tokens = batch_size * num_steps
+            print(
+                f"Tokens of finished sequences skipped: {num_tokens_skipped} / {num_tokens} "
+                f"({num_tokens_skipped / num_tokens * 100:.1f}%), "
+                f"{num_tokens_skipped / start.elapsed_time(end) * 1000:.0f} tokens/s saved"
+            )
+
+
+@torch.inference_mode()
+def decode(
+    input_ids,
+    model,
+    max_length,
+    top_k=1,
+    top_p=0.0,
+    temperature=1.0,
+    eos_token_id=None,
+    teacher_outputs=None,
+    vocab_size=None,
+    tensor_parallel=1,
+    cg=False,
+    enable_timing=False,
+    paged_kv_cache=None,
+    prefix_cache=None,
+    kv_cache_bits=None,
+    sampling_params=None,
+    compact_finished=False,
+    prefill_chunk_size=None,
+):
+    """Decoding, either greedy or with top-k or top-p sampling.
+    If top-k = 0, don't limit the number of candidates (pure sampling).
+    Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
+    then top-p.
+    We assume that all sequences in the same batch have the same length.
+
+    Arguments:
+        input_ids: (batch, seq_len)
+        max_length: int
+        teacher_outputs (optional): (batch, seq_len). If provided, instead of sampling from the
+            logits, the next token is taken from the teacher_outputs. Useful for testing.
+        paged_kv_cache (optional): PagedKVCache. If provided, the KV cache is stored in its pages,
+            with blocks allocated as the sequences grow, instead of in a dense
+            (batch, max_length) cache. Slots [0, batch) are freed when decoding ends.
+        prefix_cache (optional): RadixPrefixCache of @paged_kv_cache. If provided, prefill starts
+            from the longest prefix that is cached for all the sequences, and the KV cache of the
+            sequences is added to the prefix cache when decoding ends.
+        kv_cache_bits (optional): 8 or 4. If provided, the KV cache is quantized to that many bits
+            (see QuantizedKVCache), allocated with model.allocate_inference_cache.
+        sampling_params (optional): SamplingParams, or a sequence of batch SamplingParams (one per
+            sequence). If provided, tokens are sampled with sample_batched and these parameters
+            instead of top_k, top_p and temperature.
+        compact_finished: if True (and eos_token_id is not None), sequences that sampled
+            eos_token_id are removed from the batch that runs the next steps, along with their
+            KV cache. Their remaining tokens are eos_token_id and their remaining scores are 0.
+        prefill_chunk_size (optional): if provided, the prompt is processed this many tokens at a
+            time (see prefill_chunked), which bounds the activation memory of long prompts.
+    Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
+        sequences: (batch, max_length)
+        scores: tuples of (batch, vocab_size)
+    """
+    steps = _decode_steps(
+        input_ids,
+        model,
+        max_length,
+        top_k=top_k,
+        top_p=top_p,
+        temperature=temperature,
+        eos_token_id=eos_token_id,
+        teacher_outputs=teacher_outputs,
+        vocab_size=vocab_size,
+        tensor_parallel=tensor_parallel,
+        cg=cg,
+        enable_timing=enable_timing,
+        paged_kv_cache=paged_kv_cache,
+        prefix_cache=prefix_cache,
+        kv_cache_bits=kv_cache_bits,
+        sampling_params=sampling_params,
+        compact_finished=compact_finished,
+        prefill_chunk_size=prefill_chunk_size,
+    )
+    tokens, scores = [], []
+    for token, logits in steps:
+        tokens.append(token)
+        scores.append(logits)
+    if sampling_params is None:
+        greedy = top_k == 1
+    elif isinstance(sampling_params, SamplingParams):
+        greedy = sampling_params.greedy
+    else:
+        greedy = all(params.greedy for params in sampling_params)
+    output_cls = GreedySearchDecoderOnlyOutput if greedy else SampleDecoderOnlyOutput
+    return output_cls(sequences=torch.cat([input_ids] + tokens, dim=1), scores=tuple(scores))
+
+
+@dataclass
+class StreamStep:
+    """Output of one step of generate_stream, for the whole batch."""
+
+    tokens: Tensor  # (batch,)
+    logprobs: Optional[Tensor] = None  # (batch,), log-probabilities of tokens under the model
+    scores: Optional[Tensor] = None  # (batch, vocab_size)
+    text: Optional[List[str]] = None  # Text added to each sequence by tokens
+
+
+class _IncrementalDetokenizer:
+    """Detokenize the generated tokens of a batch one step at a time. Only a window of recent
+    tokens is decoded at each step, and text is held back while it ends with an incomplete
+    character (e.g. a multi-byte character split over several tokens)."""
+
+    def __init__(self, detokenize, batch_size, eos_token_id=None):
+        self.detokenize = detokenize
+        self.eos_token_id = eos_token_id
+        self.ids = [[] for _ in range(batch_size)]
+        self.prefix_offsets = [0] * batch_size
+        self.read_offsets = [0] * batch_size
+        self.finished = [False] * batch_size
+
+    def step(self, tokens):
+        with torch.no_grad():
+            tokens = tokens.tolist()
+            text = []
+            for i, token in enumerate(tokens):
+                if self.finished[i]:
+                    text.append("")
+                    continue
+                if token == self.eos_token_id:
+                    self.finished[i] = True
+                    text.append("")
+                    continue
+                ids = self.ids[i]
+                ids.append(token)
+                prefix_offset, read_offset = self.prefix_offsets[i], self.read_offsets[i]
+                prefix_text = self.detokenize(ids[prefix_offset:read_offset])
+                new_text = self.detokenize(ids[prefix_offset:])
+                if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+                    text.append(new_text[len(prefix_text) :])
+                    self.prefix_offsets[i], self.read_offsets[i] = read_offset, len(ids)
+                else:
+                    text.append("")
+            return text
+
+
+def generate_stream(
+    input_ids,
+    model,
+    max_length,
+    output_scores=False,
+    output_logprobs=False,
+    detokenize=None,
+    **kwargs,
+):
+    """Same as decode, but yields a StreamStep as soon as each token is generated.
+    The logits of a step are only kept by the StreamStep that is yielded (if output_scores), so
+    memory doesn't grow with the number of steps.
+
+    Arguments:
+        output_logprobs: if True, StreamStep.logprobs has the log-probabilities of the tokens.
+        detokenize (optional): callable mapping a list of token ids to a string, e.g.
+            tokenizer.decode. If provided, StreamStep.text has the new text of each sequence
+            (empty once the sequence generated eos_token_id). Detokenization runs on a worker
+            thread while the next step is computed, so the steps after the first one are yielded
+            one step late.
+        kwargs: passed to decode.
+    """
+    steps = _decode_steps(input_ids, model, max_length, **kwargs)
+    executor, detokenizer, pending = None, None, None
+    if detokenize is not None:
+        executor = ThreadPoolExecutor(max_workers=1)
+        detokenizer = _IncrementalDetokenizer(
+            detokenize, input_ids.shape[0], eos_token_id=kwargs.get("eos_token_id")
+        )
+    try:
+        for i, (token, logits) in enumerate(steps):
+            token = token.squeeze(1)
+            step = StreamStep(tokens=token, scores=logits if output_scores else None)
+            if output_logprobs:
+                step.logprobs = torch.log_softmax(logits.float(), dim=-1).gather(
+                    -1, token[:, None]
+                ).squeeze(-1)
+            if detokenizer is None:
+                yield step
+                continue
+            future = executor.submit(detokenizer.step, token)
+            if pending is not None:
+                prev_step, prev_future = pending
+                prev_step.text = prev_future.result()
+                yield prev_step
+            if i == 0:  # Don't delay the first token
+                step.text = future.result()
+                yield step
+            else:
+                pending = (step, future)
+        if pending is not None:
+            prev_step, prev_future = pending
+            prev_step.text = prev_future.result()
+            yield prev_step
+    finally:
+        steps.close()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
 
 
 def sample_speculative(logits, logits_draft, tokens_draft, top_k=1, top_p=0.0, temperature=1.0):
@@ -261,10 +776,28 @@ def sample_speculative(logits, logits_draft, tokens_draft, top_k=1, top_p=0.0, t
     )
     resample = torch.multinomial(resample_probs, num_samples=1).squeeze(dim=-1)  # (batch,)
     tokens = F.pad(tokens_draft, (0, 1))
-    tokens[:, first_rejected_idx] = resample
+    tokens[torch.arange(batch, device=tokens.device), first_rejected_idx] = resample
     return tokens, first_rejected_idx + 1
 
 
+@dataclass
+class SpeculativeDecodingStats:
+    """Statistics of decode_speculative. Counts per sequence are (batch,) int64 tensors, and only
+    include the steps where the sequence was not finished yet."""
+
+    num_main_model_calls: int
+    num_draft_tokens: Tensor  # Draft tokens proposed
+    num_accepted_tokens: Tensor  # Draft tokens accepted by the main model
+
+    @property
+    def acceptance_rate(self):
+        return self.num_accepted_tokens.sum().item() / max(self.num_draft_tokens.sum().item(), 1)
+
+    @property
+    def acceptance_rate_per_sequence(self):
+        return self.num_accepted_tokens / self.num_draft_tokens.clamp(min=1)
+
+
 @torch.inference_mode()
 def decode_speculative(
     input_ids,
@@ -281,26 +814,29 @@ def decode_speculative(
     cg=False,
     enable_timing=False,
     debug=False,
+    return_stats=False,
 ):
     """
-    TD: WIP, for my own understanding, lightly tested. Only support batch_size == 1 for now.
-
     Speculative decoding, either greedy or with top-k or top-p sampling.
     If top-k = 0, don't limit the number of candidates (pure sampling).
     Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
     then top-p.
     We assume that all sequences in the same batch have the same length.
+    Each sequence of the batch accepts its own number of draft tokens at each step, so the
+    sequences then have different lengths: the KV caches keep track of them in
+    lengths_per_sample, and the rejected draft tokens are rolled back by resetting it.
+    Sequences that sampled eos_token_id (or reached max_length) stop, the others continue.
 
     Arguments:
         input_ids: (batch, seq_len)
         max_length: int
+        return_stats: if True, also return the SpeculativeDecodingStats.
     Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
-        sequences: (batch, max_length)
-        scores: tuples of (batch, vocab_size)
+        sequences: (batch, max_length). Tokens after eos_token_id are eos_token_id.
+        scores: (batch, max_length - seq_len, vocab_size). Scores after eos_token_id are 0.
     """
     batch_size, seqlen_og = input_ids.shape
-    assert batch_size == 1, "Speculative decoding implementation only supports batch_size=1"
-    assert eos_token_id is None, "Speculative decoding implementation doesn't support eos_token_id"
+    assert seqlen_og < max_length, "max_length must be larger than the prompt length"
     if cg:
         if not hasattr(model_draft, "_decoding_cache"):
             model_draft._decoding_cache = None
@@ -330,27 +866,23 @@ def decode_speculative(
         inference_params = model._decoding_cache.inference_params
         inference_params.reset(max_length, batch_size)
     else:
-        inference_params_draft = InferenceParams(max_seqlen=max_length, max_batch_size=batch_size)
-        inference_params = InferenceParams(max_seqlen=max_length, max_batch_size=batch_size)
+        inference_params_draft = InferenceParams(
+            max_seqlen=max_length,
+            max_batch_size=batch_size,
+            lengths_per_sample=torch.zeros(batch_size, dtype=torch.int32, device=input_ids.device),
+        )
+        inference_params = InferenceParams(
+            max_seqlen=max_length,
+            max_batch_size=batch_size,
+            lengths_per_sample=torch.zeros(batch_size, dtype=torch.int32, device=input_ids.device),
+        )
 
     def get_logits(input_ids, inference_params, model, num_last_tokens=1, cg=False):
         decoding = inference_params.seqlen_offset > 0
         if decoding:
-            seqlen = input_ids.shape[1]
-            # if inference_params.lengths_per_sample is None:
-            # TODO: in the case of batched decoding where each sequence has a different length,
-            # we need to compute the position_ids for each sequence using lengths_per_sample
-            if True:
-                cache_seqlens = torch.full(
-                    (input_ids.shape[0],),
-                    inference_params.seqlen_offset,
-                    dtype=torch.int32,
-                    device=input_ids.device,
-                )
-            else:
-                cache_seqlens = inference_params.lengths_per_sample
-            position_ids = cache_seqlens[:, None] + torch.arange(
-                seqlen, dtype=torch.long, device=input_ids.device
+            # Each sequence has its own number of cached tokens
+            position_ids = inference_params.lengths_per_sample[:, None] + torch.arange(
+                input_ids.shape[1], dtype=torch.long, device=input_ids.device
             )
         else:
             position_ids = None
@@ -366,7 +898,7 @@ def decode_speculative(
             # This might not be compatible the num_last_tokens used here.
             assert num_last_tokens <= input_ids.shape[1]
             logits = model._decoding_cache.run(
-                input_ids, position_ids, inference_params.seqlen_offset
+                input_ids, position_ids, inference_params.lengths_per_sample
             )[:, -num_last_tokens:]
         return logits[..., :vocab_size] if vocab_size is not None else logits
 
@@ -385,19 +917,19 @@ def decode_speculative(
         for i in range(num_tokens):
             scores.append(get_logits_fn(sequences[-1], inference_params)[:, -1])
             inference_params.seqlen_offset += sequences[-1].shape[1]
+            inference_params.lengths_per_sample += sequences[-1].shape[1]
             sequences.append(sample_fn(scores[-1]).unsqueeze(1))
         return torch.cat(sequences[1:], dim=1), torch.stack(scores, dim=1)
 
+    def set_cache_seqlens(inference_params, cache_seqlens):
+        inference_params.lengths_per_sample.copy_(torch.tensor(cache_seqlens, dtype=torch.int32))
+        # Only used to tell prompt processing (0) from decoding
+        inference_params.seqlen_offset = max(cache_seqlens)
+
     sampling_kwargs = dict(top_k=top_k, top_p=top_p, temperature=temperature)
     sample_fn = partial(sample, **sampling_kwargs)
     get_logits_main = partial(get_logits, model=model, cg=cg)
     get_logits_draft = partial(get_logits, model=model_draft, cg=cg)
-    sample_tokens_main = partial(
-        sample_tokens,
-        get_logits_fn=get_logits_main,
-        sample_fn=sample_fn,
-        inference_params=inference_params,
-    )
     sample_tokens_draft = partial(
         sample_tokens,
         get_logits_fn=get_logits_draft,
@@ -405,162 +937,112 @@ def decode_speculative(
         inference_params=inference_params_draft,
     )
 
-    if debug:
-        from transformers import AutoTokenizer
-
-        tokenizer = AutoTokenizer.from_pretrained("gpt2")
     if enable_timing:
         if tensor_parallel > 1:
             torch.distributed.barrier()
         torch.cuda.synchronize()
         start = time.time()
 
-    sequences, scores = [input_ids], []
-    num_main_model_calls = 0
-    num_draft_tokens = 0
-    num_accepted_tokens_history = []
-    if seqlen_og >= max_length - 1:
-        # Don't do speculative sampling, just sample 1 token from the model
-        tokens, scores_new = sample_tokens_main(input_ids, num_tokens=1)
-        sequences.append(tokens)
-        scores.append(scores_new)
-    else:
-        # Sample from draft model, which produces @n_spec_tokens, and @model
-        # will then use to produce between 1 and 1 + @n_spec_tokens tokens.
-        # We want seqlen_og + 1 + @n_spec_tokens to be <= @max_length.
-        n_spec_tokens = min(speculative_lookahead, max_length - seqlen_og - 1)
-        tokens_draft, scores_draft = sample_tokens_draft(input_ids, num_tokens=n_spec_tokens)
-        num_draft_tokens += n_spec_tokens
-        if debug:
-            scores_draft_ref = model_draft(
-                torch.cat([input_ids, tokens_draft], dim=1), num_last_tokens=n_spec_tokens + 1
-            ).logits
-            print((scores_draft - scores_draft_ref[:, :-1]).abs().max())
-
-        # Evaluate the draft tokens with the model
-        logits = get_logits_main(
-            torch.cat([input_ids, tokens_draft], dim=1),
-            inference_params,
-            num_last_tokens=n_spec_tokens + 1,
-        )
-        num_main_model_calls += 1
-        if debug:
-            logits_ref = model(
-                torch.cat([input_ids, tokens_draft], dim=1), num_last_tokens=n_spec_tokens + 1
-            ).logits
-            print((logits - logits_ref).abs().max())
-            # breakpoint()
-        tokens, num_generated_tokens = sample_speculative(
-            logits, scores_draft, tokens_draft, **sampling_kwargs
-        )
-        num_accepted_tokens_history.append(num_generated_tokens - 1)
-        if debug:
-            print(tokens)
-            print(num_generated_tokens)
-            # breakpoint()
-        # TODO: we're using the fact that batch_size == 1
-        # TODO: check eos_token_id
-        sequences.append(tokens[:1, : num_generated_tokens[0]])
-        scores.append(logits[:1, : num_generated_tokens[0]])
-        # Note that @model has not evaluated the last sampled token yet, so we'll need to pass
-        # that in the next time we call @model.
-        num_generated = num_generated_tokens[0].item()
-        inference_params.seqlen_offset = seqlen_og + num_generated - 1
-        inference_params_draft.seqlen_offset = (
-            inference_params.seqlen_offset - 1
-            if num_generated > 1
-            else inference_params.seqlen_offset
-        )
-        if debug:
-            cur_ids = torch.cat([input_ids, sequences[-1]], dim=1)
-            scores_ref = model(cur_ids, num_last_tokens=num_generated_tokens[0].item() + 1).logits
-            print((scores[-1] - scores_ref[:, :-1]).abs().max())
-            # breakpoint()
-
-    while True:
-        # seqlen_offset is total length generated - 1
-        if inference_params.seqlen_offset >= max_length - 1:
-            break
-        if inference_params.seqlen_offset >= max_length - 2:
+    sequences = torch.full(
+        (batch_size, max_length),
+        eos_token_id if eos_token_id is not None else 0,
+        dtype=input_ids.dtype,
+        device=input_ids.device,
+    )
+    sequences[:, :seqlen_og] = input_ids
+    scores = None
+    # Host-side state of each sequence: its length, and whether it's finished
+    lengths = [seqlen_og] * batch_size
+    finished = [False] * batch_size
+    stats = SpeculativeDecodingStats(
+        num_main_model_calls=0,
+        num_draft_tokens=torch.zeros(batch_size, dtype=torch.long),
+        num_accepted_tokens=torch.zeros(batch_size, dtype=torch.long),
+    )
+    # Tokens that the main model and the draft model haven't evaluated yet
+    input_ids_main, input_ids_draft = input_ids, input_ids
+    while not all(finished):
+        # Sample from the draft model, which produces @n_spec_tokens, and @model will then use
+        # them to produce between 1 and 1 + @n_spec_tokens tokens.
+        # We want length + 1 + @n_spec_tokens to be <= @max_length for every running sequence.
+        max_seqlen = max(length for length, done in zip(lengths, finished) if not done)
+        n_spec_tokens = min(speculative_lookahead, max_length - max_seqlen - 1)
+        if n_spec_tokens > 0:
+            tokens_draft, scores_draft = sample_tokens_draft(
+                input_ids_draft, num_tokens=n_spec_tokens
+            )
+            # Evaluate the draft tokens with the model
+            logits = get_logits_main(
+                torch.cat([input_ids_main, tokens_draft], dim=1),
+                inference_params,
+                num_last_tokens=n_spec_tokens + 1,
+            )  # (batch, n_spec_tokens + 1, vocab_size)
+            tokens, num_generated_tokens = sample_speculative(
+                logits, scores_draft, tokens_draft, **sampling_kwargs
+            )
+        else:
             # Don't do speculative sampling, just sample 1 token from the model
-            tokens, scores_new = sample_tokens_main(sequences[-1][:, -1:], num_tokens=1)
-            sequences.append(tokens)
-            scores.append(scores_new)
+            logits = get_logits_main(input_ids_main, inference_params)
+            tokens = sample_fn(logits[:, -1]).unsqueeze(1)
+            num_generated_tokens = torch.ones(batch_size, dtype=torch.long, device=tokens.device)
+        stats.num_main_model_calls += 1
+        if scores is None:
+            scores = logits.new_zeros(batch_size, max_length - seqlen_og, logits.shape[-1])
+        tokens_host = tokens.tolist()
+        for i, num_generated in enumerate(num_generated_tokens.tolist()):
+            if finished[i]:
+                continue
+            stats.num_draft_tokens[i] += n_spec_tokens
+            stats.num_accepted_tokens[i] += num_generated - 1
+            if eos_token_id is not None and eos_token_id in tokens_host[i][:num_generated]:
+                num_generated = tokens_host[i].index(eos_token_id) + 1
+                finished[i] = True
+            start_idx = lengths[i]
+            sequences[i, start_idx : start_idx + num_generated] = tokens[i, :num_generated]
+            scores[i, start_idx - seqlen_og : start_idx - seqlen_og + num_generated] = logits[
+                i, :num_generated
+            ]
+            lengths[i] += num_generated
+            finished[i] = finished[i] or lengths[i] >= max_length
+        if all(finished):
             break
-        # Sample from draft model
-        n_spec_tokens = min(
-            speculative_lookahead, max_length - inference_params_draft.seqlen_offset - 2
+        # Roll back the rejected draft tokens. The main model has evaluated all the tokens but the
+        # last one, which it'll get at the next step. The draft model hasn't evaluated the last
+        # draft token if all of them were accepted, so we always pass it the last 2 tokens.
+        # Finished sequences still go through the models, with their caches reset to empty.
+        set_cache_seqlens(
+            inference_params, [0 if done else l - 1 for l, done in zip(lengths, finished)]
         )
-        # If the main model accepts all the draft tokens, plus it samples one new token,
-        # then at the next iteration the draft model need to evaluate the logits of the last draft
-        # token and the logits of the newly sampled token. So here we pass in the last 2 tokens
-        # of sequences[-1].
-        # This exception is when the main model rejects all the draft tokens, in which case we
-        # will only have 1 token to pass in.
-        tokens_draft, scores_draft = sample_tokens_draft(
-            sequences[-1][:, -2:], num_tokens=n_spec_tokens
-        )
-        num_draft_tokens += n_spec_tokens
-        if debug:
-            scores_draft_ref = model_draft(
-                torch.cat([cur_ids, tokens_draft], dim=1), num_last_tokens=n_spec_tokens + 1
-            ).logits
-            print((scores_draft - scores_draft_ref[:, :-1]).abs().max())
-            # breakpoint()
-        # Evaluate the draft tokens with the model
-        logits = get_logits_main(
-            torch.cat([sequences[-1][:, -1:], tokens_draft], dim=1),
-            inference_params,
-            num_last_tokens=n_spec_tokens + 1,
-        )  # (batch, n_spec_tokens + 1, vocab_size)
-        num_main_model_calls += 1
-        if debug:
-            logits_ref = model(
-                torch.cat([cur_ids, tokens_draft], dim=1), num_last_tokens=n_spec_tokens + 1
-            ).logits
-            print((logits - logits_ref).abs().max())
-            # breakpoint()
-        tokens, num_generated_tokens = sample_speculative(
-            logits, scores_draft, tokens_draft, **sampling_kwargs
+        set_cache_seqlens(
+            inference_params_draft, [0 if done else l - 2 for l, done in zip(lengths, finished)]
         )
-        num_accepted_tokens_history.append(num_generated_tokens - 1)
-        if debug:
-            print(tokens)
-            print(num_generated_tokens)
-            # breakpoint()
-        sequences.append(tokens[:1, : num_generated_tokens[0]])
-        scores.append(logits[:1, : num_generated_tokens[0]])
-        # We've evaluated 1 token from sequences[-1][:, -1:] above, plus
-        # num_generated_tokens[0].item() - 1 tokens from the draft model.
-        num_generated = num_generated_tokens[0].item()
-        inference_params.seqlen_offset += num_generated
-        inference_params_draft.seqlen_offset = (
-            inference_params.seqlen_offset - 1
-            if num_generated > 1
-            else inference_params.seqlen_offset
+        last_idx = torch.tensor([l - 1 for l in lengths], device=sequences.device).clamp(
+            max=max_length - 1
         )
-        if debug:
-            cur_ids = torch.cat([cur_ids, sequences[-1]], dim=1)
-            scores_ref = model(cur_ids, num_last_tokens=num_generated_tokens[0].item() + 1).logits
-            print((scores[-1] - scores_ref[:, :-1]).abs().max())
-            # breakpoint()
+        input_ids_main = sequences.gather(1, last_idx[:, None])
+        input_ids_draft = sequences.gather(1, torch.stack([last_idx - 1, last_idx], dim=1))
 
     if enable_timing:
         if tensor_parallel > 1:
             torch.distributed.barrier()
         torch.cuda.synchronize()
         print(f"Prompt processing + decoding time: {(time.time() - start) * 1000:.0f}ms")
-        print(f"Number of calls to main model: {num_main_model_calls}")
-        print(
-            f"Acceptance rate: {torch.cat(num_accepted_tokens_history).sum().item() / num_draft_tokens * 100:.2f}%"
-        )
-    sequences = torch.cat(sequences, dim=1)
-    scores = torch.cat(scores, dim=1)
+        print(f"Number of calls to main model: {stats.num_main_model_calls}")
+        print(f"Acceptance rate: {stats.acceptance_rate * 100:.2f}%")
+        if batch_size > 1:
+            print(
+                "Acceptance rate per sequence: "
+                f"{[round(r * 100, 2) for r in stats.acceptance_rate_per_sequence.tolist()]}"
+            )
     if debug:
-        scores_ref = model(sequences).logits
-        print((scores - scores_ref[:, seqlen_og - 1 : -1]).abs().max())
+        scores_ref = model(sequences).logits[:, seqlen_og - 1 : -1]
+        valid = torch.arange(max_length - seqlen_og, device=sequences.device) < torch.tensor(
+            lengths, device=sequences.device
+        )[:, None] - seqlen_og
+        print((scores - scores_ref[..., : scores.shape[-1]])[valid].abs().max())
     output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
-    return output_cls(sequences=sequences, scores=scores)
+    output = output_cls(sequences=sequences, scores=scores)
+    return (output, stats) if return_stats else output
 
 
 class GenerationMixin:
@@ -585,6 +1067,12 @@ class GenerationMixin:
             output.scores = None
         return output if return_dict_in_generate else output.sequences
 
+    def generate_stream(self, input_ids, max_length, top_k=1, top_p=0.0, temperature=1.0, **kwargs):
+        """Iterator over the StreamStep of each generated token, see generate_stream."""
+        return generate_stream(
+            input_ids, self, max_length, top_k=top_k, top_p=top_p, temperature=temperature, **kwargs
+        )
+
 
 def allocate_inference_cache(
     max_batch_size,
@@ -594,14 +1082,43 @@ def allocate_inference_cache(
     layers: Union[int, Sequence],
     device,
     dtype=torch.float16,
+    kv_cache_bits=None,
+    kv_cache_group_size=None,
 ):
+    """If kv_cache_bits is 8 or 4, each layer gets a QuantizedKVCache, dequantized to @dtype."""
     assert dtype in [torch.float16, torch.bfloat16, torch.float32]
     kv_cache_shape = (max_batch_size, max_seqlen, 2, nheads, headdim)
     if isinstance(layers, int):
         layers = range(layers)
+    if kv_cache_bits is not None:
+        return {
+            i: QuantizedKVCache(
+                *kv_cache_shape[:2],
+                nheads,
+                headdim,
+                num_bits=kv_cache_bits,
+                group_size=kv_cache_group_size,
+                dtype=dtype,
+                device=device,
+            )
+            for i in layers
+        }
     return {i: torch.empty(kv_cache_shape, device=device, dtype=dtype) for i in layers}
 
 
+def _compact_kv_cache(key_value_memory_dict, keep, seqlen):
+    """Move the first @seqlen tokens of rows @keep of every dense KV cache to rows
+    [0, len(keep)), in order, so that the running sequences are at the front of the batch."""
+    num_rows = keep.shape[0]
+    for kv_cache in key_value_memory_dict.values():
+        if isinstance(kv_cache, QuantizedKVCache):
+            tensors = [kv_cache.data, kv_cache.scale, kv_cache.shift]
+        else:
+            tensors = [kv_cache]
+        for t in tensors:
+            t[:num_rows, :seqlen] = t[keep, :seqlen]
+
+
 @dataclass
 class DecodingCGCache:
     max_batch_size: int = 0
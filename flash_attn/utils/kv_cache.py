@@ -0,0 +1,337 @@
+# Paged KV cache in the spirit of vLLM's PagedAttention: https://arxiv.org/abs/2309.06180
+import math
+from typing import Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+from flash_attn.ops.split_kv import attention_partial, combine
+
+
+class BlockAllocator:
+    """Fixed pool of KV-cache blocks with a free list and per-block reference counts.
+
+    A block returns to the free list once its last reference is released, so blocks can be
+    shared between sequences (e.g. a common prompt prefix).
+    """
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        # Used as a stack, so that recently freed (and probably cache-hot) blocks are reused first
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.ref_counts = [0] * num_blocks
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            raise RuntimeError(f"Out of KV cache blocks (all {self.num_blocks} are in use)")
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def incref(self, block: int):
+        assert self.ref_counts[block] > 0, f"Block {block} is not allocated"
+        self.ref_counts[block] += 1
+
+    def free(self, block: int):
+        assert self.ref_counts[block] > 0, f"Block {block} is already free"
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+
+class PagedKVCache:
+    """Paged KV cache shared by all the layers of a model.
+
+    Each layer owns a pool of pages of shape (num_blocks, page_block_size, 2, nheads, headdim),
+    i.e. the layout of the dense cache with (batch, seqlen) replaced by
+    (num_blocks, page_block_size). Every batch slot has a list of blocks, mirrored on device in
+    @block_table with shape (max_batch_size, max_blocks_per_seq), as expected by
+    flash_attn_with_kvcache(block_table=...).
+    Blocks are only allocated when a sequence actually grows into them.
+
+    The cache itself only does host-side bookkeeping: callers reserve blocks for the tokens they
+    are about to write, then run the model with InferenceParams(block_table=self.block_table, ...).
+    If a RadixPrefixCache is attached (@prefix_cache), its unused blocks are evicted when the
+    cache runs out of free blocks.
+    """
+
+    def __init__(self, kv_pages: Dict[int, Tensor], max_batch_size: int, max_seqlen: int):
+        kv_pages_example = next(iter(kv_pages.values()))
+        self.kv_pages = kv_pages
+        self.num_blocks, self.page_block_size = kv_pages_example.shape[:2]
+        self.max_batch_size = max_batch_size
+        self.max_seqlen = max_seqlen
+        self.max_blocks_per_seq = math.ceil(max_seqlen / self.page_block_size)
+        self.allocator = BlockAllocator(self.num_blocks)
+        self.prefix_cache = None
+        self.block_tables: List[List[int]] = [[] for _ in range(max_batch_size)]
+        self.block_table = torch.zeros(
+            max_batch_size,
+            self.max_blocks_per_seq,
+            dtype=torch.int32,
+            device=kv_pages_example.device,
+        )
+
+    @classmethod
+    def from_model(
+        cls, model, max_batch_size, max_seqlen, num_blocks=None, page_block_size=256, dtype=None
+    ):
+        """Allocate the pages with model.allocate_inference_cache.
+        By default, allocate as many blocks as a dense cache of (max_batch_size, max_seqlen).
+        The CUDA kernel requires page_block_size to be a multiple of 256, the torch path does not.
+        """
+        if num_blocks is None:
+            num_blocks = max_batch_size * math.ceil(max_seqlen / page_block_size)
+        kv_pages = model.allocate_inference_cache(num_blocks, page_block_size, dtype=dtype)
+        return cls(kv_pages, max_batch_size, max_seqlen)
+
+    @property
+    def num_free_blocks(self) -> int:
+        return self.allocator.num_free_blocks
+
+    def num_blocks_needed(self, seqlen: int) -> int:
+        return math.ceil(seqlen / self.page_block_size)
+
+    def can_reserve(self, batch_idx: int, seqlen: int) -> bool:
+        num_new_blocks = self.num_blocks_needed(seqlen) - len(self.block_tables[batch_idx])
+        num_free_blocks = self.num_free_blocks
+        if self.prefix_cache is not None:
+            num_free_blocks += self.prefix_cache.num_evictable_blocks
+        return num_new_blocks <= num_free_blocks
+
+    def _ensure_free_blocks(self, num_blocks: int):
+        if num_blocks > self.num_free_blocks and self.prefix_cache is not None:
+            self.prefix_cache.evict(num_blocks - self.num_free_blocks)
+        if num_blocks > self.num_free_blocks:
+            raise RuntimeError(
+                f"Out of KV cache blocks: need {num_blocks}, {self.num_free_blocks} are free"
+            )
+
+    def _set_blocks(self, batch_idx: int, start: int, blocks: List[int]):
+        if blocks:
+            self.block_table[batch_idx, start : start + len(blocks)] = torch.tensor(
+                blocks, dtype=torch.int32
+            )
+
+    def reserve(self, batch_idx: int, seqlen: int):
+        """Make sure that slot @batch_idx has enough blocks to hold @seqlen tokens."""
+        if seqlen > self.max_seqlen:
+            raise ValueError(f"seqlen {seqlen} exceeds max_seqlen {self.max_seqlen}")
+        table = self.block_tables[batch_idx]
+        num_new_blocks = self.num_blocks_needed(seqlen) - len(table)
+        if num_new_blocks <= 0:
+            return
+        self._ensure_free_blocks(num_new_blocks)
+        new_blocks = [self.allocator.allocate() for _ in range(num_new_blocks)]
+        self._set_blocks(batch_idx, len(table), new_blocks)
+        table.extend(new_blocks)
+
+    def free(self, batch_idx: int):
+        """Release all the blocks of slot @batch_idx. Stale entries of the block table are left as
+        is: they are never read since the length of the slot is reset by the caller."""
+        for block in self.block_tables[batch_idx]:
+            self.allocator.free(block)
+        self.block_tables[batch_idx] = []
+
+    def assign(self, batch_idx: int, blocks: List[int]):
+        """Let slot @batch_idx start with already filled @blocks, e.g. a cached prefix.
+        The blocks are shared (reference counted), so they must be full: the slot only appends to
+        blocks after them.
+        """
+        self.free(batch_idx)
+        for block in blocks:
+            self.allocator.incref(block)
+        self._set_blocks(batch_idx, 0, blocks)
+        self.block_tables[batch_idx] = list(blocks)
+
+    def fork(self, src_idx: int, dst_idx: int, seqlen: int):
+        """Let slot @dst_idx start with the first @seqlen cached tokens of slot @src_idx.
+        Full blocks are shared (reference counted); a trailing partial block is copied, so that
+        both sequences can keep appending without overwriting each other.
+        """
+        assert src_idx != dst_idx
+        self.free(dst_idx)
+        src_table = self.block_tables[src_idx]
+        assert self.num_blocks_needed(seqlen) <= len(src_table)
+        num_full_blocks = seqlen // self.page_block_size
+        dst_table = list(src_table[:num_full_blocks])
+        for block in dst_table:
+            self.allocator.incref(block)
+        if seqlen % self.page_block_size != 0:
+            self._ensure_free_blocks(1)
+            block = self.allocator.allocate()
+            for kv_pages in self.kv_pages.values():
+                kv_pages[block].copy_(kv_pages[src_table[num_full_blocks]])
+            dst_table.append(block)
+        self._set_blocks(dst_idx, 0, dst_table)
+        self.block_tables[dst_idx] = dst_table
+
+
+def paged_kv_cache_update(kv_pages: Tensor, block_table: Tensor, kv: Tensor, cache_seqlens: Tensor):
+    """Pure torch counterpart of the cache update done by flash_attn_with_kvcache(block_table=...).
+    Arguments:
+        kv_pages: (num_blocks, page_block_size, 2, nheads, headdim)
+        block_table: (batch_size, max_blocks_per_seq), int32
+        kv: (batch_size, seqlen_new, 2, nheads, headdim), written at positions
+            [cache_seqlens[i], cache_seqlens[i] + seqlen_new) of sequence i.
+        cache_seqlens: (batch_size,), int32
+    """
+    page_block_size = kv_pages.shape[1]
+    positions = cache_seqlens.to(torch.long)[:, None] + torch.arange(
+        kv.shape[1], dtype=torch.long, device=kv.device
+    )
+    blocks = block_table.to(torch.long).gather(1, positions // page_block_size)
+    kv_pages[blocks, positions % page_block_size] = kv.to(kv_pages.dtype)
+
+
+def paged_kv_cache_gather(kv_pages: Tensor, block_table: Tensor, seqlen: int) -> Tensor:
+    """Gather the first @seqlen tokens of every sequence into a dense
+    (batch_size, seqlen, 2, nheads, headdim) tensor. Positions past the length of a sequence
+    contain garbage and must be masked out by the caller.
+    """
+    page_block_size = kv_pages.shape[1]
+    num_blocks = math.ceil(seqlen / page_block_size)
+    kv = kv_pages[block_table[:, :num_blocks].to(torch.long)]
+    return kv.flatten(1, 2)[:, :seqlen]
+
+
+def quantize_kv(kv: Tensor, num_bits: int = 8, group_size: Optional[int] = None, scale_dtype=None):
+    """Asymmetric quantization of the last dimension in groups of @group_size, as
+    quantize_kv_int4 of the Triton AMD backend: x ~= q * scale + shift, q in [0, 2**num_bits - 1].
+    Arguments:
+        kv: (..., headdim)
+        num_bits: 8, or 4 in which case 2 values are packed per byte (low bits first).
+        group_size: defaults to headdim.
+        scale_dtype: dtype of scale and shift, defaults to the dtype of kv.
+    Return:
+        data: (..., headdim * num_bits // 8), uint8
+        scale, shift: (..., headdim // group_size)
+    """
+    assert num_bits in [4, 8]
+    headdim = kv.shape[-1]
+    group_size = group_size if group_size is not None else headdim
+    assert headdim % group_size == 0 and group_size % (8 // num_bits) == 0
+    scale_dtype = scale_dtype if scale_dtype is not None else kv.dtype
+    max_q = 2**num_bits - 1
+    x = kv.float().unflatten(-1, (headdim // group_size, group_size))
+    # Quantize with the rounded scale and shift, since those are what dequantization uses
+    shift = x.amin(dim=-1, keepdim=True).to(scale_dtype)
+    scale = ((x.amax(dim=-1, keepdim=True) - shift.float()) / max_q).to(scale_dtype)
+    # Constant groups have scale 0, any q works
+    q = (x - shift.float()) / scale.float().masked_fill(scale == 0, 1.0)
+    q = q.round_().clamp_(0, max_q).to(torch.uint8).flatten(-2)
+    if num_bits == 4:
+        q = q[..., ::2] | (q[..., 1::2] << 4)
+    return q, scale.squeeze(-1), shift.squeeze(-1)
+
+
+def dequantize_kv(data: Tensor, scale: Tensor, shift: Tensor, num_bits: int = 8, dtype=None):
+    """Inverse of quantize_kv. Returns (..., headdim) in @dtype (defaults to scale.dtype)."""
+    if num_bits == 4:
+        data = torch.stack([data & 0xF, data >> 4], dim=-1).flatten(-2)
+    x = data.unflatten(-1, (scale.shape[-1], -1)).float()
+    x = x * scale.float().unsqueeze(-1) + shift.float().unsqueeze(-1)
+    return x.flatten(-2).to(dtype if dtype is not None else scale.dtype)
+
+
+class QuantizedKVCache:
+    """KV cache of one layer, stored as int8 or packed int4 values with a scale and a shift per
+    group of @group_size channels of each token and head (see quantize_kv).
+
+    Takes the place of the dense (batch_size, max_seqlen, 2, nheads, headdim) cache in
+    InferenceParams.key_value_memory_dict. With num_bits=8 (resp. 4) and group_size=headdim=128
+    it takes 52% (resp. 27%) of the memory of a fp16 cache. New keys / values are quantized when
+    they are written, and attention dequantizes the cache @chunk_size tokens at a time, merging
+    the partial results as the split-KV kernels do, so the dequantized cache is never
+    materialized.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_seqlen: int,
+        nheads: int,
+        headdim: int,
+        num_bits: int = 8,
+        group_size: Optional[int] = None,
+        dtype=torch.float16,
+        device=None,
+        chunk_size: int = 1024,
+    ):
+        group_size = group_size if group_size is not None else headdim
+        assert num_bits in [4, 8]
+        assert headdim % group_size == 0 and group_size % (8 // num_bits) == 0
+        self.num_bits = num_bits
+        self.group_size = group_size
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        shape = (max_batch_size, max_seqlen, 2, nheads)
+        self.data = torch.zeros(*shape, headdim * num_bits // 8, dtype=torch.uint8, device=device)
+        self.scale = torch.zeros(*shape, headdim // group_size, dtype=dtype, device=device)
+        self.shift = torch.zeros(*shape, headdim // group_size, dtype=dtype, device=device)
+
+    @property
+    def max_batch_size(self) -> int:
+        return self.data.shape[0]
+
+    @property
+    def max_seqlen(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in [self.data, self.scale, self.shift])
+
+    def update(self, kv: Tensor, batch_start: int = 0, seqlen_start: int = 0):
+        """Quantize and write kv (batch_size, seqlen, 2, nheads, headdim) at
+        [batch_start, batch_start + batch_size) x [seqlen_start, seqlen_start + seqlen)."""
+        batch_end, seqlen_end = batch_start + kv.shape[0], seqlen_start + kv.shape[1]
+        assert batch_end <= self.max_batch_size
+        assert seqlen_end <= self.max_seqlen
+        data, scale, shift = quantize_kv(kv, self.num_bits, self.group_size, self.dtype)
+        self.data[batch_start:batch_end, seqlen_start:seqlen_end] = data
+        self.scale[batch_start:batch_end, seqlen_start:seqlen_end] = scale
+        self.shift[batch_start:batch_end, seqlen_start:seqlen_end] = shift
+
+    def dequantize(self, batch_start: int, batch_end: int, seqlen_start: int, seqlen_end: int):
+        """Dense (batch_end - batch_start, seqlen_end - seqlen_start, 2, nheads, headdim)."""
+        idx = (slice(batch_start, batch_end), slice(seqlen_start, seqlen_end))
+        return dequantize_kv(
+            self.data[idx], self.scale[idx], self.shift[idx], self.num_bits, self.dtype
+        )
+
+    def attention(
+        self,
+        q: Tensor,
+        seqlen_k: int,
+        batch_start: int = 0,
+        softmax_scale: Optional[float] = None,
+        causal: bool = False,
+    ):
+        """Attention of q (batch_size, seqlen_q, nheads, headdim) over the first @seqlen_k tokens
+        of sequences [batch_start, batch_start + batch_size) of the cache.
+        Return: (batch_size, seqlen_q, nheads, headdim), same dtype as q.
+        """
+        batch_end = batch_start + q.shape[0]
+        out, lse = None, None
+        for k_start in range(0, seqlen_k, self.chunk_size):
+            k_end = min(k_start + self.chunk_size, seqlen_k)
+            kv = self.dequantize(batch_start, batch_end, k_start, k_end)
+            out_chunk, lse_chunk = attention_partial(
+                q,
+                kv[:, :, 0],
+                kv[:, :, 1],
+                softmax_scale,
+                causal,
+                k_start=k_start,
+                seqlen_k=seqlen_k,
+            )
+            if out is None:
+                out, lse = out_chunk, lse_chunk
+            else:
+                out, lse = combine([out, out_chunk], [lse, lse_chunk])
+        return out.to(q.dtype)
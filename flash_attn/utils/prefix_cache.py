@@ -0,0 +1,164 @@
+# Prefix sharing with a radix tree over cached blocks, as in SGLang's RadixAttention:
+# https://arxiv.org/abs/2312.07104
+import heapq
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from flash_attn.utils.kv_cache import PagedKVCache
+
+
+class RadixNode:
+    """One full block of cached tokens. Children are keyed by the token ids of their block."""
+
+    __slots__ = ("parent", "key", "block", "children", "last_access")
+
+    def __init__(self, parent: Optional["RadixNode"], key: Tuple[int, ...], block: int):
+        self.parent = parent
+        self.key = key
+        self.block = block
+        self.children: Dict[Tuple[int, ...], RadixNode] = {}
+        self.last_access = 0
+
+
+class RadixPrefixCache:
+    """Cache of the KV blocks of token-id prefixes, on top of a PagedKVCache.
+
+    Every edge of the tree is one full block of page_block_size tokens, so a cached prefix maps
+    directly to a list of blocks that a new sequence can point its block table to. The tree holds
+    a reference on each of its blocks; a block is evictable once no sequence uses it anymore.
+    Eviction is least recently used, leaves first, and happens either when more than @max_blocks
+    blocks are cached or when the PagedKVCache runs out of free blocks.
+
+    Counters: hits / misses count lookups that did / did not reuse a cached block,
+    num_hit_tokens / num_lookup_tokens count tokens, num_evicted_blocks counts evictions.
+    """
+
+    def __init__(self, paged_kv_cache: PagedKVCache, max_blocks: Optional[int] = None):
+        self.kv_cache = paged_kv_cache
+        self.page_block_size = paged_kv_cache.page_block_size
+        self.max_blocks = max_blocks if max_blocks is not None else paged_kv_cache.num_blocks
+        self.root = RadixNode(None, (), -1)
+        self.num_cached_blocks = 0
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.num_hit_tokens = 0
+        self.num_lookup_tokens = 0
+        self.num_evicted_blocks = 0
+        # Let the KV cache evict from us when it runs out of blocks
+        paged_kv_cache.prefix_cache = self
+
+    @classmethod
+    def from_memory_budget(cls, paged_kv_cache: PagedKVCache, max_bytes: int):
+        """Size the cache in bytes of KV cache (summed over all the layers) instead of blocks."""
+        block_nbytes = sum(
+            kv_pages[0].numel() * kv_pages.element_size()
+            for kv_pages in paged_kv_cache.kv_pages.values()
+        )
+        return cls(paged_kv_cache, max_blocks=max_bytes // block_nbytes)
+
+    @property
+    def hit_rate(self) -> float:
+        num_lookups = self.hits + self.misses
+        return self.hits / num_lookups if num_lookups > 0 else 0.0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "num_hit_tokens": self.num_hit_tokens,
+            "num_lookup_tokens": self.num_lookup_tokens,
+            "num_evicted_blocks": self.num_evicted_blocks,
+            "num_cached_blocks": self.num_cached_blocks,
+        }
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _block_keys(self, token_ids: Sequence[int], num_tokens: int):
+        for start in range(0, num_tokens - self.page_block_size + 1, self.page_block_size):
+            yield tuple(token_ids[start : start + self.page_block_size])
+
+    def match(self, token_ids: Sequence[int]) -> Tuple[int, List[int]]:
+        """Find the longest cached prefix of @token_ids.
+        At least the last token is left out of the match, so that there is always something to
+        prefill to get the logits of the next token.
+        Returns the number of cached tokens (a multiple of page_block_size) and their blocks.
+        """
+        token_ids = list(token_ids)
+        now = self._tick()
+        node, blocks = self.root, []
+        for key in self._block_keys(token_ids, len(token_ids) - 1):
+            node = node.children.get(key)
+            if node is None:
+                break
+            node.last_access = now
+            blocks.append(node.block)
+        num_tokens = len(blocks) * self.page_block_size
+        self.num_lookup_tokens += len(token_ids)
+        self.num_hit_tokens += num_tokens
+        if num_tokens > 0:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return num_tokens, blocks
+
+    def insert(self, token_ids: Sequence[int], blocks: Sequence[int]):
+        """Cache the full blocks of a sequence whose first len(@token_ids) tokens are in @blocks.
+        Blocks of prefixes that are already cached are not added again: the sequence keeps its
+        own copy of those.
+        """
+        token_ids = list(token_ids)
+        now = self._tick()
+        node = self.root
+        for i, key in enumerate(self._block_keys(token_ids, len(token_ids))):
+            child = node.children.get(key)
+            if child is None:
+                child = RadixNode(node, key, blocks[i])
+                node.children[key] = child
+                self.kv_cache.allocator.incref(blocks[i])
+                self.num_cached_blocks += 1
+            child.last_access = now
+            node = child
+        if self.num_cached_blocks > self.max_blocks:
+            self.evict(self.num_cached_blocks - self.max_blocks)
+
+    def _is_evictable(self, node: RadixNode) -> bool:
+        # Only referenced by the tree. Since a sequence that uses a block also uses the blocks of
+        # all its ancestors, the whole subtree of such a node is evictable too.
+        return self.kv_cache.allocator.ref_counts[node.block] == 1
+
+    def _nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
+
+    @property
+    def num_evictable_blocks(self) -> int:
+        return sum(self._is_evictable(node) for node in self._nodes())
+
+    def evict(self, num_blocks: int) -> int:
+        """Release up to @num_blocks least recently used blocks. Returns how many were released."""
+        leaves = [
+            (node.last_access, id(node), node)
+            for node in self._nodes()
+            if not node.children and self._is_evictable(node)
+        ]
+        heapq.heapify(leaves)
+        num_evicted = 0
+        while leaves and num_evicted < num_blocks:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.key]
+            self.kv_cache.allocator.free(node.block)
+            self.num_cached_blocks -= 1
+            num_evicted += 1
+            if parent is not self.root and not parent.children and self._is_evictable(parent):
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+        self.num_evicted_blocks += num_evicted
+        return num_evicted
+
+    def clear(self):
+        self.evict(self.num_cached_blocks)
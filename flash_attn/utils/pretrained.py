@@ -1,7 +1,11 @@
 import os
-from functools import partial
+import pickle
+import re
+import time
+from collections import defaultdict
 
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file as safe_load_file
 from transformers.utils import (
     SAFE_WEIGHTS_INDEX_NAME,
@@ -12,11 +16,11 @@ from transformers.utils import (
 from transformers.utils.hub import cached_file, get_checkpoint_shard_files
 
 
-def state_dict_from_pretrained(model_name, device=None, dtype=None):
-    # If not fp32, then we don't want to load directly to the GPU
-    mapped_device = "cpu" if dtype not in [torch.float32, None] else device
+def checkpoint_files_from_pretrained(model_name):
+    """Return the list of checkpoint files (one per shard) of @model_name, downloading them from
+    the HF hub if needed.
+    """
     is_sharded = False
-    load_safe = False
     resolved_archive_file = None
 
     weights_path = os.path.join(model_name, WEIGHTS_NAME)
@@ -37,13 +41,11 @@ def state_dict_from_pretrained(model_name, device=None, dtype=None):
         resolved_archive_file = cached_file(
             model_name, SAFE_WEIGHTS_NAME, _raise_exceptions_for_missing_entries=False
         )
-        load_safe = True
     elif os.path.isfile(safe_weights_index_path):
         resolved_archive_file = cached_file(
             model_name, SAFE_WEIGHTS_INDEX_NAME, _raise_exceptions_for_missing_entries=False
         )
         is_sharded = True
-        load_safe = True
     else:  # Try loading from HF hub instead of from local files
         resolved_archive_file = cached_file(model_name, WEIGHTS_NAME,
                                             _raise_exceptions_for_missing_entries=False)
@@ -56,24 +58,161 @@ def state_dict_from_pretrained(model_name, device=None, dtype=None):
     if resolved_archive_file is None:
         raise EnvironmentError(f"Model name {model_name} was not found.")
 
-    if load_safe:
-        loader = partial(safe_load_file, device=mapped_device)
-    else:
-        loader = partial(torch.load, map_location=mapped_device)
-
     if is_sharded:
         # resolved_archive_file becomes a list of files that point to the different
         # checkpoint shards in this case.
         resolved_archive_file, sharded_metadata = get_checkpoint_shard_files(
             model_name, resolved_archive_file
         )
-        state_dict = {}
-        for sharded_file in resolved_archive_file:
-            state_dict.update(loader(sharded_file))
-    else:
-        state_dict = loader(resolved_archive_file)
-    # Convert dtype before moving to GPU to save memory
-    if dtype is not None:
-        state_dict = {k: v.to(dtype=dtype) for k, v in state_dict.items()}
+        return resolved_archive_file
+    return [resolved_archive_file]
+
+
+def state_dict_from_pretrained(model_name, device=None, dtype=None):
+    # If not fp32, then we don't want to load directly to the GPU
+    mapped_device = "cpu" if dtype not in [torch.float32, None] else device
+    state_dict = {}
+    for archive_file in checkpoint_files_from_pretrained(model_name):
+        if archive_file.endswith(".safetensors"):
+            shard = safe_load_file(archive_file, device=mapped_device)
+        else:
+            shard = torch.load(archive_file, map_location=mapped_device)
+        # Convert dtype shard by shard, before moving to GPU, to save memory
+        if dtype is not None:
+            shard = {k: v.to(dtype=dtype) for k, v in shard.items()}
+        state_dict.update(shard)
     state_dict = {k: v.to(device=device) for k, v in state_dict.items()}
     return state_dict
+
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class LazyCheckpoint:
+    """Tensors of a (possibly sharded) checkpoint, only read from disk when requested.
+
+    Safetensors shards are memory-mapped. Pytorch shards are loaded with mmap=True when possible
+    (torch >= 2.1 and the zipfile format), otherwise the whole shard is loaded.
+    """
+
+    def __init__(self, files):
+        self.shards = {}  # key -> safe_open handle or state_dict of the shard containing it
+        for file in files:
+            if file.endswith(".safetensors"):
+                shard = safe_open(file, framework="pt", device="cpu")
+                keys = shard.keys()
+            else:
+                try:
+                    shard = torch.load(file, map_location="cpu", mmap=True, weights_only=True)
+                # torch < 2.1, legacy format or pickled objects other than tensors
+                except (TypeError, RuntimeError, pickle.UnpicklingError):
+                    shard = torch.load(file, map_location="cpu")
+                keys = shard.keys()
+            for key in keys:
+                self.shards[key] = shard
+
+    def keys(self):
+        return self.shards.keys()
+
+    def get_tensor(self, key):
+        shard = self.shards[key]
+        return shard[key] if isinstance(shard, dict) else shard.get_tensor(key)
+
+    def get_meta(self, key):
+        """Tensor on the meta device with the shape and dtype of @key, without reading it."""
+        shard = self.shards[key]
+        if isinstance(shard, dict):
+            return torch.empty_like(shard[key], device="meta")
+        tensor_slice = shard.get_slice(key)
+        return torch.empty(
+            tensor_slice.get_shape(),
+            dtype=_SAFETENSORS_DTYPES[tensor_slice.get_dtype()],
+            device="meta",
+        )
+
+
+def _layer_idx(key):
+    match = re.search(r"(?:^|\.)(\d+)\.", key)
+    return int(match.group(1)) if match is not None else -1
+
+
+def load_pretrained_streaming(model, model_name, convert_fn=None, dtype=None, strict=True):
+    """Load the checkpoint @model_name into the parameters of @model one layer at a time, so that
+    peak host memory is about one layer of the checkpoint instead of twice the whole checkpoint.
+
+    The tensors are grouped by layer index (the first integer in their name, tensors without
+    one, e.g. embeddings, form their own group). For each group, @convert_fn is applied to the
+    state_dict of the whole checkpoint where only the tensors of the group are read (and cast to
+    @dtype), the others being on the meta device. The converted tensors that are not on the meta
+    device are then copied into the model.
+    Arguments:
+        convert_fn: maps a state_dict of the checkpoint to a state_dict of @model, e.g. remapping
+            the keys then sharding for tensor parallel. Must not mix tensors of different layers.
+    Return:
+        stats: dict with missing_keys, unexpected_keys, num_tensors, num_bytes (read from the
+            checkpoint), seconds and throughput (GB/s).
+    """
+    start = time.perf_counter()
+    checkpoint = LazyCheckpoint(checkpoint_files_from_pretrained(model_name))
+    groups = defaultdict(list)
+    meta_state_dict = {}
+    for key in checkpoint.keys():
+        groups[_layer_idx(key)].append(key)
+        meta_state_dict[key] = checkpoint.get_meta(key)
+        if dtype is not None and meta_state_dict[key].is_floating_point():
+            meta_state_dict[key] = meta_state_dict[key].to(dtype=dtype)
+    model_state_dict = model.state_dict()
+    loaded_keys, unexpected_keys = set(), set()
+    num_bytes = 0
+    for group in sorted(groups):
+        state_dict = dict(meta_state_dict)
+        for key in groups[group]:
+            tensor = checkpoint.get_tensor(key)
+            num_bytes += tensor.numel() * tensor.element_size()
+            if dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(dtype=dtype)
+            state_dict[key] = tensor
+        if convert_fn is not None:
+            state_dict = convert_fn(state_dict)
+        with torch.no_grad():
+            for key, value in state_dict.items():
+                if value.is_meta or key in loaded_keys:
+                    continue
+                if key not in model_state_dict:
+                    unexpected_keys.add(key)
+                    continue
+                param = model_state_dict[key]
+                if param.shape != value.shape:
+                    raise RuntimeError(
+                        f"Size mismatch for {key}: copying a param with shape {value.shape}, "
+                        f"the shape in current model is {param.shape}"
+                    )
+                param.copy_(value)
+                loaded_keys.add(key)
+        del state_dict
+    missing_keys = [key for key in model_state_dict if key not in loaded_keys]
+    if strict and (missing_keys or unexpected_keys):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {model.__class__.__name__}: "
+            f"missing keys {missing_keys}, unexpected keys {sorted(unexpected_keys)}"
+        )
+    seconds = time.perf_counter() - start
+    return {
+        "missing_keys": missing_keys,
+        "unexpected_keys": sorted(unexpected_keys),
+        "num_tensors": len(loaded_keys),
+        "num_bytes": num_bytes,
+        "seconds": seconds,
+        "throughput": num_bytes / seconds / 1e9,
+    }
@@ -0,0 +1,307 @@
+# Continuous batching (iteration-level scheduling) as in Orca:
+# https://www.usenix.org/conference/osdi22/presentation/yu
+from collections import deque
+from dataclasses import dataclass, field, replace
+from typing import Any, Deque, List, Optional
+
+import torch
+from torch import Tensor
+
+from flash_attn.utils.generation import (
+    BatchSamplingParams,
+    InferenceParams,
+    SamplingParams,
+    sample,
+    sample_batched,
+)
+from flash_attn.utils.kv_cache import PagedKVCache
+
+
+@dataclass
+class GenerationRequest:
+    input_ids: Tensor  # (seqlen,)
+    max_new_tokens: int
+    eos_token_id: Optional[int] = None
+    request_id: Any = None
+    sampling_params: Optional[SamplingParams] = None
+    output_ids: List[int] = field(default_factory=list)
+    finished: bool = False
+
+    @property
+    def max_cache_seqlen(self) -> int:
+        # The last sampled token is never written to the KV cache
+        return self.input_ids.shape[0] + self.max_new_tokens - 1
+
+
+class ContinuousBatchingScheduler:
+    """Generation over a fixed number of batch slots backed by a PagedKVCache.
+
+    Requests are admitted into free slots at token boundaries and retired as soon as they hit EOS
+    or their token budget, so a long request does not hold up the rest of the batch. Each step
+    runs one decoding iteration over all the running slots (with per-slot lengths_per_sample and
+    position_ids), then prefills the newly admitted requests one at a time.
+
+    A request is only admitted if the free blocks cover the worst-case growth of all the running
+    requests plus its own, so running requests never have to be preempted. Blocks are still only
+    allocated as sequences grow, and are returned as soon as a request finishes.
+
+    With a @prefix_cache (RadixPrefixCache of the same PagedKVCache), prefill starts from the
+    longest cached prefix of the prompt. The prompt is added to the prefix cache right after
+    prefill, and the whole sequence when the request finishes.
+
+    With @prefill_chunk_size, prompts are prefilled in chunks of that many tokens, and each step
+    runs at most one chunk after the decoding iteration (chunked prefill as in Sarathi:
+    https://arxiv.org/abs/2308.16369). A long prompt then only delays the running requests by
+    one chunk per step instead of by its whole prefill, and the activation memory of prefill
+    doesn't grow with the prompt length. Prompts are prefilled in order of admission.
+    """
+
+    def __init__(
+        self,
+        model,
+        paged_kv_cache: PagedKVCache,
+        top_k=1,
+        top_p=0.0,
+        temperature=1.0,
+        vocab_size=None,
+        prefix_cache=None,
+        prefill_chunk_size=None,
+    ):
+        self.model = model
+        self.kv_cache = paged_kv_cache
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.vocab_size = vocab_size
+        assert prefix_cache is None or prefix_cache.kv_cache is paged_kv_cache
+        self.prefix_cache = prefix_cache
+        assert prefill_chunk_size is None or prefill_chunk_size > 0
+        self.prefill_chunk_size = prefill_chunk_size
+        self.device = paged_kv_cache.block_table.device
+        self.waiting: Deque[GenerationRequest] = deque()
+        self.slots: List[Optional[GenerationRequest]] = [None] * paged_kv_cache.max_batch_size
+        # Number of tokens of each slot that are in the KV cache
+        self.lengths = [0] * paged_kv_cache.max_batch_size
+        # Slots whose prompt is not fully in the KV cache yet, with chunked prefill
+        self.prefilling: Deque[int] = deque()
+
+    def add_request(
+        self, input_ids, max_new_tokens, eos_token_id=None, request_id=None, sampling_params=None
+    ):
+        """Queue a request. @input_ids is a 1D sequence of token ids.
+        If @sampling_params (SamplingParams) is None, the request is sampled with the top_k, top_p
+        and temperature of the scheduler.
+        Returns the GenerationRequest, whose output_ids are filled in as tokens are generated.
+        """
+        input_ids = torch.as_tensor(input_ids, dtype=torch.long, device=self.device).flatten()
+        assert input_ids.numel() > 0 and max_new_tokens > 0
+        if sampling_params is not None:
+            # Each request gets its own generator, even if the caller reuses the params
+            sampling_params = replace(sampling_params)
+        request = GenerationRequest(
+            input_ids, max_new_tokens, eos_token_id, request_id, sampling_params
+        )
+        if request.max_cache_seqlen > self.kv_cache.max_seqlen:
+            raise ValueError(
+                f"Request needs {request.max_cache_seqlen} tokens of KV cache, "
+                f"max_seqlen is {self.kv_cache.max_seqlen}"
+            )
+        if self.kv_cache.num_blocks_needed(request.max_cache_seqlen) > self.kv_cache.num_blocks:
+            raise ValueError("Request needs more KV cache blocks than there are in the cache")
+        self.waiting.append(request)
+        return request
+
+    @property
+    def running_slots(self) -> List[int]:
+        return [i for i, request in enumerate(self.slots) if request is not None]
+
+    @property
+    def decoding_slots(self) -> List[int]:
+        return [i for i in self.running_slots if i not in self.prefilling]
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self.waiting) or any(request is not None for request in self.slots)
+
+    def _num_free_blocks_after_growth(self) -> int:
+        """Free blocks left once every running request has grown to its maximum length."""
+        num_outstanding = sum(
+            self.kv_cache.num_blocks_needed(self.slots[i].max_cache_seqlen)
+            - len(self.kv_cache.block_tables[i])
+            for i in self.running_slots
+        )
+        num_free_blocks = self.kv_cache.num_free_blocks
+        if self.prefix_cache is not None:
+            num_free_blocks += self.prefix_cache.num_evictable_blocks
+        return num_free_blocks - num_outstanding
+
+    def _get_logits(self, input_ids, inference_params, position_ids=None):
+        logits = self.model(
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            num_last_tokens=1,
+        ).logits.squeeze(dim=1)
+        return logits[..., : self.vocab_size] if self.vocab_size is not None else logits
+
+    def _sample(self, slots, logits):
+        requests = [self.slots[slot] for slot in slots]
+        if all(request.sampling_params is None for request in requests):
+            return sample(logits, top_k=self.top_k, top_p=self.top_p, temperature=self.temperature)
+        default_params = SamplingParams(
+            temperature=self.temperature, top_k=self.top_k, top_p=self.top_p
+        )
+        params = BatchSamplingParams.from_list(
+            [request.sampling_params or default_params for request in requests], device=self.device
+        )
+        prev_ids = None
+        if params.repetition_penalty is not None:
+            # Pad with the first token of each sequence, which is penalized anyway
+            sequences = [request.input_ids.tolist() + request.output_ids for request in requests]
+            max_len = max(len(ids) for ids in sequences)
+            prev_ids = torch.tensor(
+                [ids + ids[:1] * (max_len - len(ids)) for ids in sequences], device=self.device
+            )
+        return sample_batched(logits, params, input_ids=prev_ids)
+
+    def _append_tokens(self, slots, logits) -> List[GenerationRequest]:
+        tokens = self._sample(slots, logits)
+        finished = []
+        # A single host copy per step instead of one sync per slot
+        for slot, token in zip(slots, tokens.tolist()):
+            request = self.slots[slot]
+            request.output_ids.append(token)
+            if token == request.eos_token_id or len(request.output_ids) >= request.max_new_tokens:
+                request.finished = True
+                if self.prefix_cache is not None:
+                    # The last token is not in the KV cache
+                    cached_ids = request.input_ids.tolist() + request.output_ids[:-1]
+                    self.prefix_cache.insert(cached_ids, self.kv_cache.block_tables[slot])
+                self.kv_cache.free(slot)
+                self.slots[slot] = None
+                self.lengths[slot] = 0
+                finished.append(request)
+        return finished
+
+    def _decode_step(self) -> List[GenerationRequest]:
+        slots = self.decoding_slots
+        if not slots:
+            return []
+        for slot in slots:
+            self.kv_cache.reserve(slot, self.lengths[slot] + 1)
+        input_ids = torch.tensor(
+            [[self.slots[slot].output_ids[-1]] for slot in slots],
+            dtype=torch.long,
+            device=self.device,
+        )
+        lengths_per_sample = torch.tensor(
+            [self.lengths[slot] for slot in slots], dtype=torch.int32, device=self.device
+        )
+        inference_params = InferenceParams(
+            max_seqlen=self.kv_cache.max_seqlen,
+            max_batch_size=len(slots),
+            seqlen_offset=max(self.lengths[slot] for slot in slots),
+            key_value_memory_dict=self.kv_cache.kv_pages,
+            lengths_per_sample=lengths_per_sample,
+            block_table=self.kv_cache.block_table[torch.tensor(slots, device=self.device)],
+        )
+        position_ids = lengths_per_sample.to(torch.long).unsqueeze(1)
+        logits = self._get_logits(input_ids, inference_params, position_ids=position_ids)
+        for slot in slots:
+            self.lengths[slot] += 1
+        return self._append_tokens(slots, logits)
+
+    def _match_prefix(self, slot):
+        """Reuse the cached blocks of the longest cached prefix of the prompt of @slot."""
+        if self.prefix_cache is not None:
+            prefix_len, blocks = self.prefix_cache.match(self.slots[slot].input_ids.tolist())
+            self.kv_cache.assign(slot, blocks)
+            self.lengths[slot] = prefix_len
+
+    def _prefill_tokens(self, slot, end):
+        """Run the prompt of @slot up to @end, on top of the tokens that are in the KV cache.
+        Returns the logits of the last token."""
+        request = self.slots[slot]
+        start = self.lengths[slot]
+        self.kv_cache.reserve(slot, end)
+        inference_params = InferenceParams(
+            max_seqlen=self.kv_cache.max_seqlen,
+            max_batch_size=1,
+            seqlen_offset=start,
+            key_value_memory_dict=self.kv_cache.kv_pages,
+            lengths_per_sample=torch.full((1,), start, dtype=torch.int32, device=self.device),
+            block_table=self.kv_cache.block_table[slot : slot + 1],
+        )
+        position_ids = torch.arange(start, end, dtype=torch.long, device=self.device)
+        logits = self._get_logits(
+            request.input_ids[start:end].unsqueeze(0),
+            inference_params,
+            position_ids=position_ids.unsqueeze(0),
+        )
+        self.lengths[slot] = end
+        return logits
+
+    def _finish_prefill(self, slot, logits) -> List[GenerationRequest]:
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(
+                self.slots[slot].input_ids.tolist(), self.kv_cache.block_tables[slot]
+            )
+        return self._append_tokens([slot], logits)
+
+    def _prefill(self, slot) -> List[GenerationRequest]:
+        self._match_prefix(slot)
+        logits = self._prefill_tokens(slot, self.slots[slot].input_ids.shape[0])
+        return self._finish_prefill(slot, logits)
+
+    def _prefill_chunk(self) -> List[GenerationRequest]:
+        """Run the next chunk of the prompt of the first slot that is prefilling."""
+        if not self.prefilling:
+            return []
+        slot = self.prefilling[0]
+        seqlen = self.slots[slot].input_ids.shape[0]
+        end = min(self.lengths[slot] + self.prefill_chunk_size, seqlen)
+        logits = self._prefill_tokens(slot, end)
+        if end < seqlen:
+            return []
+        self.prefilling.popleft()
+        return self._finish_prefill(slot, logits)
+
+    def _admit(self) -> List[GenerationRequest]:
+        finished = []
+        free_slots = [i for i, request in enumerate(self.slots) if request is None]
+        # First come first served: stop at the first request that does not fit, so that large
+        # requests are not starved by smaller ones behind them.
+        while self.waiting and free_slots:
+            request = self.waiting[0]
+            num_blocks = self.kv_cache.num_blocks_needed(request.max_cache_seqlen)
+            if num_blocks > self._num_free_blocks_after_growth():
+                break
+            self.waiting.popleft()
+            slot = free_slots.pop(0)
+            self.slots[slot] = request
+            if self.prefill_chunk_size is not None:
+                self._match_prefix(slot)
+                self.prefilling.append(slot)
+                continue
+            finished.extend(self._prefill(slot))
+            if self.slots[slot] is None:  # Finished right after prefill
+                free_slots.insert(0, slot)
+        return finished
+
+    @torch.inference_mode()
+    def step(self) -> List[GenerationRequest]:
+        """Run one token boundary: a decoding iteration over the running requests, then admission
+        of waiting requests into the slots that are free, then (with chunked prefill) one chunk of
+        prefill. Returns the requests that finished.
+        """
+        finished = self._decode_step()
+        finished.extend(self._admit())
+        if self.prefill_chunk_size is not None:
+            finished.extend(self._prefill_chunk())
+        return finished
+
+    def run(self) -> List[GenerationRequest]:
+        """Step until all the requests are done. Returns them in order of completion."""
+        finished = []
+        while self.has_unfinished_requests():
+            finished.extend(self.step())
+        return finished
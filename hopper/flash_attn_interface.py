@@ -11,11 +11,18 @@ import flash_attn_3_cuda
 
 # isort: on
 
+import kernel_manifest
+
 
 def maybe_contiguous(x):
     return x.contiguous() if x is not None and x.stride(-1) != 1 else x
 
 
+def _device_arch(device):
+    major, minor = torch.cuda.get_device_capability(device)
+    return major * 10 + minor
+
+
 def _flash_attn_forward(
         q,
         k,
@@ -91,6 +98,20 @@ def _flash_attn_forward(
         pack_gqa,
         sm_margin,
     )
+    if kernel_manifest.is_recording():
+        kernel_manifest.record(kernel_manifest.fwd_kernels(
+            _device_arch(q.device),
+            kernel_manifest.dtype_name(q.dtype),
+            q.shape[-1],
+            v.shape[-1],
+            q.shape[-2],
+            k.shape[-2],
+            paged_kv=page_table is not None,
+            # The accumulators are only allocated with more than 1 split
+            split=len(rest) > 0 and rest[0] is not None,
+            softcap=softcap > 0.0,
+            pack_gqa=pack_gqa,
+        ))
     return (out, softmax_lse, *rest)
 
 
@@ -146,6 +167,13 @@ def _flash_attn_backward(
         deterministic,
         sm_margin,
     )
+    if kernel_manifest.is_recording():
+        kernel_manifest.record(kernel_manifest.bwd_kernels(
+            _device_arch(q.device),
+            kernel_manifest.dtype_name(q.dtype),
+            q.shape[-1],
+            softcap=softcap > 0.0,
+        ))
     return dq, dk, dv, softmax_d
 
 
@@ -625,6 +653,7 @@ def flash_attn_with_kvcache(
     pack_gqa=None,   # Can be tuned for speed
     sm_margin=0,     # Can be tuned if some SMs are used for communication
     return_softmax_lse=False,
+    plan=None,
 ):
     """
     If k and v are not None, k_cache and v_cache will be updated *inplace* with the new values from
@@ -702,7 +731,12 @@ def flash_attn_with_kvcache(
            If num_splits == 1, we don't split the key/value. If num_splits == 0, we use a heuristic
            to automatically determine the number of splits.
            Don't change this unless you know what you are doing.
+        pack_gqa: bool or None. If None, we use a heuristic to decide whether to pack the query
+           heads that share a KV head into the same tile.
         return_softmax_lse: bool. Whether to return the logsumexp of the attention scores.
+        plan [optional]: LaunchPlan from flash_attn.planner (e.g. computed offline for a decode
+           batch shape and cached). If provided, its num_splits and pack_gqa are used instead of
+           the num_splits and pack_gqa arguments.
 
     Return:
         out: (batch_size, seqlen, nheads, headdim).
@@ -711,6 +745,8 @@ def flash_attn_with_kvcache(
             normalization factor).
     """
     assert sink_token_length == 0
+    if plan is not None:
+        num_splits, pack_gqa = plan.num_splits, plan.pack_gqa
     assert k_cache.stride(-1) == 1, "k_cache must have contiguous last dimension"
     assert v_cache.stride(-1) == 1, "v_cache must have contiguous last dimension"
     if softmax_scale is None:
@@ -10,6 +10,8 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Optional
 
+from kernel_manifest import load_manifest
+
 KERNEL_BATCH = namedtuple("Kernel", ["template", "filename"])
 
 DTYPE_MAP = {
@@ -78,6 +80,30 @@ void run_mha_bwd_<86, {DTYPE}, {HEAD_DIM}, {SOFTCAP}>(Flash_bwd_params &params,
 #endif
 """
 
+# Kernels that are not in the manifest (see kernel_manifest.py) are replaced by these stubs, so that
+# the dispatch code in flash_api.cpp still links without compiling them.
+KERNEL_STUBS_PRELUDE = """#include <stdexcept>
+
+#include "cutlass/numeric_types.h"
+
+#include "flash.h"
+"""
+
+KERNEL_STUB_TEMPLATE_FWD = """
+template<>
+void run_mha_fwd_<{ARCH}, {DTYPE}, {HEAD_DIM}, {HEAD_DIM_V}, {SPLIT}, {PAGEDKV}, {SOFTCAP}, {PACKGQA}>(Flash_fwd_params &params, cudaStream_t stream) {{
+    throw std::runtime_error("FlashAttention was built from a kernel manifest without {NAME}");
+}}
+"""
+
+KERNEL_STUB_TEMPLATE_BWD = """
+template<>
+void run_mha_bwd_<{ARCH}, {DTYPE}, {HEAD_DIM}, {SOFTCAP}>(Flash_bwd_params &params, cudaStream_t stream) {{
+    throw std::runtime_error("FlashAttention was built from a kernel manifest without {NAME}");
+}}
+"""
+
+KERNEL_STUBS_FILENAME = "flash_kernel_stubs.cu"
 
 
 @dataclass
@@ -123,6 +149,31 @@ class Kernel:
                     SOFTCAP=str(self.softcap).lower()
                 )
 
+    @property
+    def stub(self) -> str:
+        archs = [90] if self.sm == 90 else [80, 86]
+        name = self.filename[:-len(".cu")]
+        if self.direction == "fwd":
+            # Same template arguments as the instantiation
+            packgqa = self.packgqa or self.paged_kv or self.split or self.sm != 90
+            return "".join(
+                KERNEL_STUB_TEMPLATE_FWD.format(
+                    ARCH=str(arch), DTYPE=DTYPE_MAP[self.dtype],
+                    HEAD_DIM=self.head_dim, HEAD_DIM_V=self.head_dim_v,
+                    SPLIT=str(self.split).lower(), PAGEDKV=str(self.paged_kv).lower(),
+                    SOFTCAP=str(self.softcap).lower(), PACKGQA=str(packgqa).lower(), NAME=name
+                )
+                for arch in archs
+            )
+        else:
+            return "".join(
+                KERNEL_STUB_TEMPLATE_BWD.format(
+                    ARCH=str(arch), DTYPE=DTYPE_MAP[self.dtype], HEAD_DIM=self.head_dim,
+                    SOFTCAP=str(self.softcap).lower(), NAME=name
+                )
+                for arch in archs
+            )
+
     @property
     def filename(self) -> str:
         return f"flash_{self.direction}_hdim{self.head_dim}{f'_{self.head_dim_v}' if self.head_dim_v != self.head_dim else ''}_{self.dtype}{'_paged' if self.paged_kv else ''}{'_split' if self.split else ''}{'_softcap' if self.softcap else ''}{'_packgqa' if self.packgqa else ''}_sm{self.sm}.cu"
@@ -174,6 +225,49 @@ def batch_softcap(kernels_all) -> List[KERNEL_BATCH]:
             yield KERNEL_BATCH(template, filename)
 
 
+def get_manifest_kernels(kernels_all, manifest_path) -> List[Kernel]:
+    """Kernels of @kernels_all that are in the manifest. Raises if the manifest has a kernel that
+    doesn't exist."""
+    manifest = {Kernel(**kernel).filename for kernel in load_manifest(manifest_path)}
+    kernels = [k for k in kernels_all if k.filename in manifest]
+    missing = manifest - {k.filename for k in kernels}
+    if missing:
+        raise ValueError(f"Kernels of the manifest that don't exist: {sorted(missing)}")
+    return kernels
+
+
+def disabled_features(kernels) -> List[str]:
+    """FLASHATTENTION_DISABLE_* features (without the prefix) that none of @kernels use, so that
+    they can be disabled in the dispatch code."""
+    used = {
+        "BACKWARD": any(k.direction == "bwd" for k in kernels),
+        "SPLIT": any(k.split for k in kernels),
+        "PAGEDKV": any(k.paged_kv for k in kernels),
+        "SOFTCAP": any(k.softcap for k in kernels),
+        "FP16": any(k.dtype == "fp16" for k in kernels),
+        "FP8": any(k.dtype == "e4m3" for k in kernels),
+        "SM8x": any(k.sm < 90 for k in kernels),
+    }
+    for head_dim in HEAD_DIMENSIONS:
+        used[f"HDIM{head_dim}"] = any(head_dim in (k.head_dim, k.head_dim_v) for k in kernels)
+    return [feature for feature, is_used in used.items() if not is_used]
+
+
+def write_manifest_kernels(manifest_path, output_dir) -> List[str]:
+    """Write the kernels of the manifest, and the stubs of all the other kernels.
+    Returns the filenames of the files to compile."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    kernels_all = list(get_all_kernels())
+    kernels = get_manifest_kernels(kernels_all, manifest_path)
+    for kernel in kernels:
+        write_kernel(kernel, output_dir)
+    filenames = {k.filename for k in kernels}
+    stubs = [k.stub for k in kernels_all if k.filename not in filenames]
+    write_kernel(KERNEL_BATCH(KERNEL_STUBS_PRELUDE + "".join(stubs), KERNEL_STUBS_FILENAME), output_dir)
+    return [k.filename for k in kernels] + [KERNEL_STUBS_FILENAME]
+
+
 def write_kernel(kernel: Kernel, autogen_dir: Path) -> None:
     prelude = """// Copyright (c) 2024, Jay Shah, Ganesh Bikshandi, Ying Zhang, Vijay Thakkar, Pradeep Ramani, Tri Dao.
 // Splitting the different template instantiations to different files to speed up compilation.
@@ -182,8 +276,11 @@ def write_kernel(kernel: Kernel, autogen_dir: Path) -> None:
     (autogen_dir / kernel.filename).write_text(prelude + kernel.template)
 
 
-def main(output_dir: Optional[str]) -> None:
+def main(output_dir: Optional[str], manifest: Optional[str] = None) -> None:
     output_dir = Path(output_dir) if output_dir is not None else Path(__file__).parent
+    if manifest is not None:
+        write_manifest_kernels(manifest, output_dir)
+        return
     output_dir.mkdir(parents=True, exist_ok=True)
     kernels_all = list(get_all_kernels())
     for kernel in kernels_all:
@@ -208,5 +305,13 @@ if __name__ == "__main__":
         help="Where to generate the kernels "
         " will default to the current directory ",
     )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        default=None,
+        required=False,
+        help="Kernel manifest (see kernel_manifest.py): only generate its kernels, "
+        "and stubs for the others",
+    )
     args = parser.parse_args()
-    main(args.output_dir)
+    main(args.output_dir, args.manifest)
@@ -0,0 +1,150 @@
+# Recording of the kernel specializations that a workload launches, so that the extension can be
+# built with only those: run the workload with FLASH_ATTENTION_RECORD_KERNELS=manifest.json (or
+# inside record_kernels("manifest.json")), then build with
+# FLASH_ATTENTION_KERNEL_MANIFEST=manifest.json (see setup.py and generate_kernels.py).
+# This module doesn't import torch or the extension, so it can be used without a GPU.
+
+import atexit
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+HEAD_DIMENSIONS = [64, 96, 128, 192, 256]
+
+DTYPE_NAMES = {
+    "torch.float16": "fp16",
+    "torch.bfloat16": "bf16",
+    "torch.float8_e4m3fn": "e4m3",
+}
+
+# Fields of generate_kernels.Kernel, in order
+KERNEL_FIELDS = (
+    "sm", "dtype", "head_dim", "head_dim_v", "split", "paged_kv", "softcap", "packgqa", "direction"
+)
+
+
+def dtype_name(dtype):
+    return DTYPE_NAMES[str(dtype)]
+
+
+def round_up_headdim(head_dim):
+    for d in HEAD_DIMENSIONS:
+        if head_dim <= d:
+            return d
+    raise ValueError(f"head_dim {head_dim} is larger than {HEAD_DIMENSIONS[-1]}")
+
+
+def fwd_kernels(arch, dtype, head_dim, head_dim_v, num_heads, num_heads_k, paged_kv, split,
+                softcap, pack_gqa=None):
+    """Forward kernels that run_mha_fwd in flash_api.cpp dispatches to, as dicts with the fields of
+    generate_kernels.Kernel.
+    Arguments:
+        arch: compute capability, e.g. 90 or 86.
+        dtype: "fp16", "bf16" or "e4m3".
+        split: whether the call used more than 1 split (num_splits can be picked by a heuristic,
+            so this has to be observed after the call).
+        pack_gqa: as passed to the kernel. If None, it's picked by a heuristic that isn't
+            replicated here, so both variants are returned when the heuristic could pick either.
+    """
+    sm = 90 if arch >= 90 else 80
+    hdim = round_up_headdim(head_dim)
+    hdim_v = 128 if sm == 90 and hdim == 192 and head_dim_v <= 128 else hdim
+    if sm < 90 or paged_kv or split:
+        # PackGQA is always enabled for these, and the kernel is named without it
+        packgqas = [False]
+    elif pack_gqa is not None:
+        packgqas = [pack_gqa]
+    else:
+        packgqas = [False] if num_heads == num_heads_k else [False, True]
+    return [
+        dict(sm=sm, dtype=dtype, head_dim=hdim, head_dim_v=hdim_v, split=split, paged_kv=paged_kv,
+             softcap=softcap, packgqa=packgqa, direction="fwd")
+        for packgqa in packgqas
+    ]
+
+
+def bwd_kernels(arch, dtype, head_dim, softcap):
+    """Backward kernels that run_mha_bwd in flash_api.cpp dispatches to, see fwd_kernels."""
+    return [
+        dict(sm=90 if arch >= 90 else 80, dtype=dtype, head_dim=round_up_headdim(head_dim),
+             head_dim_v=round_up_headdim(head_dim), split=False, paged_kv=False, softcap=softcap,
+             packgqa=False, direction="bwd")
+    ]
+
+
+def load_manifest(path):
+    """List of the kernels (dicts with the fields of generate_kernels.Kernel) of a manifest."""
+    with open(path) as f:
+        kernels = json.load(f)["kernels"]
+    for kernel in kernels:
+        assert set(kernel) == set(KERNEL_FIELDS), f"Invalid kernel in manifest: {kernel}"
+    return kernels
+
+
+def save_manifest(path, kernels):
+    """Write @kernels to the manifest at @path, adding to the kernels it already has."""
+    path = Path(path)
+    if path.is_file():
+        kernels = list(kernels) + load_manifest(path)
+    unique = {tuple(kernel[name] for name in KERNEL_FIELDS) for kernel in kernels}
+    kernels = [dict(zip(KERNEL_FIELDS, values)) for values in sorted(unique)]
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"kernels": kernels}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class KernelRecorder:
+
+    def __init__(self):
+        self._kernels = set()
+        self._lock = threading.Lock()
+
+    def add(self, kernels):
+        with self._lock:
+            self._kernels.update(tuple(kernel[name] for name in KERNEL_FIELDS) for kernel in kernels)
+
+    @property
+    def kernels(self):
+        with self._lock:
+            return [dict(zip(KERNEL_FIELDS, values)) for values in sorted(self._kernels)]
+
+    def save(self, path):
+        save_manifest(path, self.kernels)
+
+
+_recorder = None
+
+
+def is_recording():
+    return _recorder is not None
+
+
+def record(kernels):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add(kernels)
+
+
+@contextmanager
+def record_kernels(path=None):
+    """Record the kernels launched by flash_attn_interface inside the context. Yields the
+    KernelRecorder, and adds its kernels to the manifest at @path (if not None) on exit."""
+    global _recorder
+    prev_recorder, _recorder = _recorder, KernelRecorder()
+    recorder = _recorder
+    try:
+        yield recorder
+    finally:
+        _recorder = prev_recorder
+        if path is not None:
+            recorder.save(path)
+        if prev_recorder is not None:
+            prev_recorder.add(recorder.kernels)
+
+
+if os.getenv("FLASH_ATTENTION_RECORD_KERNELS"):
+    _recorder = KernelRecorder()
+    atexit.register(_recorder.save, os.getenv("FLASH_ATTENTION_RECORD_KERNELS"))
@@ -63,6 +63,9 @@ DISABLE_HDIM256 = os.getenv("FLASH_ATTENTION_DISABLE_HDIM256", "FALSE") == "TRUE
 DISABLE_SM8x = os.getenv("FLASH_ATTENTION_DISABLE_SM80", "FALSE") == "TRUE"
 
 ENABLE_VCOLMAJOR = os.getenv("FLASH_ATTENTION_ENABLE_VCOLMAJOR", "FALSE") == "TRUE"
+# Only build the kernels of this manifest, recorded with FLASH_ATTENTION_RECORD_KERNELS (see
+# kernel_manifest.py). The features that none of them use are disabled.
+KERNEL_MANIFEST = os.getenv("FLASH_ATTENTION_KERNEL_MANIFEST")
 
 
 # HACK: we monkey patch pytorch's _write_ninja_file to pass
@@ -428,6 +431,30 @@ if not SKIP_CUDA_BUILD:
     repo_dir = Path(this_dir).parent
     cutlass_dir = repo_dir / "csrc" / "cutlass"
 
+    if KERNEL_MANIFEST is not None:
+        from generate_kernels import (
+            disabled_features, get_all_kernels, get_manifest_kernels, write_manifest_kernels
+        )
+
+        manifest_sources = [
+            f"instantiations/{filename}"
+            for filename in write_manifest_kernels(KERNEL_MANIFEST, Path(this_dir) / "instantiations")
+        ]
+        disabled = disabled_features(get_manifest_kernels(list(get_all_kernels()), KERNEL_MANIFEST))
+        print(f"Building the kernels of {KERNEL_MANIFEST}, disabled features: {disabled}")
+        DISABLE_BACKWARD = DISABLE_BACKWARD or "BACKWARD" in disabled
+        DISABLE_SPLIT = DISABLE_SPLIT or "SPLIT" in disabled
+        DISABLE_PAGEDKV = DISABLE_PAGEDKV or "PAGEDKV" in disabled
+        DISABLE_SOFTCAP = DISABLE_SOFTCAP or "SOFTCAP" in disabled
+        DISABLE_FP16 = DISABLE_FP16 or "FP16" in disabled
+        DISABLE_FP8 = DISABLE_FP8 or "FP8" in disabled
+        DISABLE_SM8x = DISABLE_SM8x or "SM8x" in disabled
+        DISABLE_HDIM64 = DISABLE_HDIM64 or "HDIM64" in disabled
+        DISABLE_HDIM96 = DISABLE_HDIM96 or "HDIM96" in disabled
+        DISABLE_HDIM128 = DISABLE_HDIM128 or "HDIM128" in disabled
+        DISABLE_HDIM192 = DISABLE_HDIM192 or "HDIM192" in disabled
+        DISABLE_HDIM256 = DISABLE_HDIM256 or "HDIM256" in disabled
+
     feature_args = (
         []
         + (["-DFLASHATTENTION_DISABLE_BACKWARD"] if DISABLE_BACKWARD else [])
@@ -487,6 +514,8 @@ if not SKIP_CUDA_BUILD:
         + (sources_fwd_sm80 if not DISABLE_SM8x else []) + sources_fwd_sm90
         + (sources_bwd_sm80 if not DISABLE_SM8x else []) + sources_bwd_sm90
     )
+    if KERNEL_MANIFEST is not None:
+        sources = ["flash_api.cpp"] + manifest_sources
     if not DISABLE_SPLIT:
         sources += ["flash_fwd_combine.cu"]
     nvcc_flags = [
@@ -611,7 +640,7 @@ setup(
             "benchmarks",
         )
     ),
-    py_modules=["flash_attn_interface"],
+    py_modules=["flash_attn_interface", "kernel_manifest"],
     description="FlashAttention-3",
     long_description=long_description,
     long_description_content_type="text/markdown",
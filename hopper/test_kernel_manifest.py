@@ -0,0 +1,73 @@
+import pytest
+
+import generate_kernels
+import kernel_manifest
+from kernel_manifest import bwd_kernels, fwd_kernels, record, record_kernels
+
+
+def test_fwd_kernels_dispatch():
+    # Head dimensions are rounded up, PackGQA is not part of the Sm8x / PagedKV / Split kernels
+    assert fwd_kernels(86, "fp16", 80, 80, 8, 2, True, False, False) == [
+        dict(sm=80, dtype="fp16", head_dim=96, head_dim_v=96, split=False, paged_kv=True,
+             softcap=False, packgqa=False, direction="fwd")
+    ]
+    # hdim 192 with hdim_v 128 has its own kernel on Sm90 only
+    assert fwd_kernels(90, "bf16", 192, 128, 8, 8, False, False, False)[0]["head_dim_v"] == 128
+    assert fwd_kernels(80, "bf16", 192, 128, 8, 8, False, False, False)[0]["head_dim_v"] == 192
+    # The PackGQA heuristic can only pick PackGQA for GQA
+    assert [k["packgqa"] for k in fwd_kernels(90, "bf16", 128, 128, 8, 8, False, False, False)] == [False]
+    assert [k["packgqa"] for k in fwd_kernels(90, "bf16", 128, 128, 8, 2, False, False, False)] == [False, True]
+    assert [k["packgqa"] for k in fwd_kernels(90, "bf16", 128, 128, 8, 2, False, False, False, pack_gqa=True)] == [True]
+    with pytest.raises(ValueError):
+        fwd_kernels(90, "bf16", 512, 512, 8, 8, False, False, False)
+
+
+def test_record_kernels(tmp_path):
+    path = tmp_path / "manifest.json"
+    assert not kernel_manifest.is_recording()
+    with record_kernels(path) as recorder:
+        assert kernel_manifest.is_recording()
+        record(fwd_kernels(90, "bf16", 128, 128, 8, 8, False, False, False))
+        record(fwd_kernels(90, "bf16", 128, 128, 8, 8, False, False, False))
+        record(bwd_kernels(90, "bf16", 128, False))
+    assert not kernel_manifest.is_recording()
+    assert len(recorder.kernels) == 2
+    # Recording again adds to the manifest
+    with record_kernels(path):
+        record(fwd_kernels(90, "e4m3", 64, 64, 8, 8, True, True, False))
+    assert len(kernel_manifest.load_manifest(path)) == 3
+
+
+def test_manifest_kernels(tmp_path):
+    path = tmp_path / "manifest.json"
+    kernels = (fwd_kernels(90, "bf16", 128, 128, 8, 2, False, False, False)
+               + fwd_kernels(86, "fp16", 64, 64, 8, 8, False, True, True)
+               + bwd_kernels(90, "bf16", 128, False))
+    kernel_manifest.save_manifest(path, kernels)
+    kernels_all = list(generate_kernels.get_all_kernels())
+    manifest_kernels = generate_kernels.get_manifest_kernels(kernels_all, path)
+    assert sorted(k.filename for k in manifest_kernels) == [
+        "flash_bwd_hdim128_bf16_sm90.cu",
+        "flash_fwd_hdim128_bf16_packgqa_sm90.cu",
+        "flash_fwd_hdim128_bf16_sm90.cu",
+        "flash_fwd_hdim64_fp16_split_softcap_sm80.cu",
+    ]
+    assert generate_kernels.disabled_features(manifest_kernels) == [
+        "PAGEDKV", "FP8", "HDIM96", "HDIM192", "HDIM256"
+    ]
+    output_dir = tmp_path / "instantiations"
+    filenames = generate_kernels.write_manifest_kernels(path, output_dir)
+    assert sorted(filenames[:-1]) == sorted(k.filename for k in manifest_kernels)
+    assert filenames[-1] == generate_kernels.KERNEL_STUBS_FILENAME
+    stubs = (output_dir / generate_kernels.KERNEL_STUBS_FILENAME).read_text()
+    # Every kernel that is not built has a stub, with the template arguments of its instantiation
+    assert stubs.count("template<>") == sum(
+        1 if k.sm == 90 else 2 for k in kernels_all if k not in manifest_kernels
+    )
+    assert "run_mha_fwd_<90, cutlass::bfloat16_t, 128, 128, false, false, false, false>" not in stubs
+    assert "run_mha_fwd_<90, cutlass::bfloat16_t, 128, 128, true, false, false, true>" in stubs
+    assert "run_mha_fwd_<86, cutlass::half_t, 64, 64, true, false, true, true>" not in stubs
+    # Kernels that don't exist are rejected
+    kernel_manifest.save_manifest(path, fwd_kernels(80, "e4m3", 128, 128, 8, 8, False, False, False))
+    with pytest.raises(ValueError):
+        generate_kernels.get_manifest_kernels(kernels_all, path)
@@ -6,7 +6,12 @@ import pytest
 import torch
 import torch.nn.functional as F
 from einops import rearrange
-from flash_attn.layers.rotary import RotaryEmbedding, apply_rotary_emb_func, apply_rotary_emb_qkv_
+from flash_attn.layers.rotary import (
+    RotaryEmbedding,
+    apply_rotary_emb_func,
+    apply_rotary_emb_qkv_,
+    clear_cos_sin_tables,
+)
 from transformers.models.gpt_neox.modeling_gpt_neox import RotaryEmbedding as RotaryEmbeddingNeoX
 from transformers.models.gpt_neox.modeling_gpt_neox import (
     apply_rotary_pos_emb as apply_rotary_pos_emb_neox,
@@ -54,10 +59,16 @@ def test_rotary(rotary_emb_fraction, seqlen_offset):
     q_neox, k_neox = apply_rotary_pos_emb_neox(q_pt, k_pt, cos_neox, sin_neox, offset=seqlen_offset)
     out = rotary(qkv, seqlen_offset=seqlen_offset)
     assert torch.allclose(
-        rotary._cos_cached, cos_neox[..., : rotary_dim // 2].to(dtype=dtype), rtol=rtol, atol=atol
+        rotary._cos_cached[:seqlen_total],
+        cos_neox[..., : rotary_dim // 2].to(dtype=dtype),
+        rtol=rtol,
+        atol=atol,
     )
     assert torch.allclose(
-        rotary._sin_cached, sin_neox[..., : rotary_dim // 2].to(dtype=dtype), rtol=rtol, atol=atol
+        rotary._sin_cached[:seqlen_total],
+        sin_neox[..., : rotary_dim // 2].to(dtype=dtype),
+        rtol=rtol,
+        atol=atol,
     )
     assert torch.allclose(
         rearrange(q_neox, "b h s d -> b s h d"), out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol
@@ -116,8 +127,8 @@ def test_rotary_interleaved(rotary_emb_fraction, seqlen_offset):
     q_gptj = apply_rotary_pos_emb_gptj(q_pt, sincos_gptj, offset=seqlen_offset)
     k_gptj = apply_rotary_pos_emb_gptj(k_pt, sincos_gptj, offset=seqlen_offset)
     out = rotary(qkv, seqlen_offset=seqlen_offset)
-    assert torch.allclose(rotary._cos_cached, sincos_gptj[1], rtol=rtol, atol=atol)
-    assert torch.allclose(rotary._sin_cached, sincos_gptj[0], rtol=rtol, atol=atol)
+    assert torch.allclose(rotary._cos_cached[:seqlen_total], sincos_gptj[1], rtol=rtol, atol=atol)
+    assert torch.allclose(rotary._sin_cached[:seqlen_total], sincos_gptj[0], rtol=rtol, atol=atol)
     assert torch.allclose(q_gptj, out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
     assert torch.allclose(k_gptj, out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
     assert torch.equal(out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:])
@@ -132,3 +143,33 @@ def test_rotary_interleaved(rotary_emb_fraction, seqlen_offset):
     assert torch.allclose(k_pt.grad, qkv.grad[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
     assert torch.equal(qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:])
     assert torch.equal(qkv.grad[:, :, 2], g_og[:, :, 2])
+
+
+@pytest.mark.parametrize("scale_base", [None, 512])
+def test_rotary_shared_cos_sin(scale_base):
+    clear_cos_sin_tables()
+    rotary_dim, dtype = 64, torch.float32
+    layers = [RotaryEmbedding(rotary_dim, scale_base=scale_base) for _ in range(4)]
+    rotary_ref = RotaryEmbedding(rotary_dim, scale_base=scale_base, share_cos_sin=False)
+    for seqlen, seqlen_table in [(100, 100), (101, 200), (150, 200), (1000, 1000)]:
+        for rotary in layers:
+            rotary._update_cos_sin_cache(seqlen, device=torch.device("cpu"), dtype=dtype)
+        # All the layers use the same tables
+        assert all(rotary._cos_cached is layers[0]._cos_cached for rotary in layers)
+        if scale_base is None:
+            # Grown geometrically, but same values as computing the table at once
+            assert layers[0]._seq_len_cached == seqlen_table
+            rotary_ref._cos_sin_table = None
+            rotary_ref._update_cos_sin_cache(
+                layers[0]._seq_len_cached, device=torch.device("cpu"), dtype=dtype
+            )
+        else:
+            assert layers[0]._seq_len_cached == seqlen
+            rotary_ref._update_cos_sin_cache(seqlen, device=torch.device("cpu"), dtype=dtype)
+            assert torch.equal(layers[0]._cos_k_cached, rotary_ref._cos_k_cached)
+        assert torch.equal(layers[0]._cos_cached, rotary_ref._cos_cached)
+        assert torch.equal(layers[0]._sin_cached, rotary_ref._sin_cached)
+    # Tables of other dtypes are separate
+    layers[0]._update_cos_sin_cache(10, device=torch.device("cpu"), dtype=torch.float16)
+    assert layers[0]._cos_cached.dtype == torch.float16
+    assert layers[1]._cos_cached.dtype == dtype
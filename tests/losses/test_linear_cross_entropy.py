@@ -0,0 +1,100 @@
+import pytest
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from flash_attn.losses.linear_cross_entropy import LinearCrossEntropyLoss
+
+
+def cross_entropy_ref(
+    hidden_states, weight, bias, labels, smoothing, logit_scale, lse_square_scale
+):
+    logits = F.linear(hidden_states, weight, bias).float() * logit_scale
+    losses = F.cross_entropy(logits, labels, label_smoothing=smoothing, reduction="none")
+    z_losses = lse_square_scale * torch.logsumexp(logits, dim=-1).square()
+    z_losses.masked_fill_(labels == -100, 0.0)
+    return losses + z_losses, z_losses
+
+
+@pytest.mark.parametrize("chunk_size", [1, 16, 1024])
+@pytest.mark.parametrize("lse_square_scale", [0.0, 1e-2])
+@pytest.mark.parametrize("logit_scale", [1.0, 0.7])
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+@pytest.mark.parametrize("has_bias", [False, True])
+def test_linear_cross_entropy_loss(has_bias, smoothing, logit_scale, lse_square_scale, chunk_size):
+    torch.manual_seed(0)
+    batch_size, hidden_dim, vocab_size = 37, 32, 1003
+    hidden_states = torch.randn(batch_size, hidden_dim, requires_grad=True)
+    weight = torch.randn(vocab_size, hidden_dim, requires_grad=True)
+    bias = torch.randn(vocab_size, requires_grad=True) if has_bias else None
+    labels = torch.randint(0, vocab_size, (batch_size,))
+    labels[torch.randperm(batch_size)[:5]] = -100
+    loss_fn = LinearCrossEntropyLoss(
+        label_smoothing=smoothing,
+        logit_scale=logit_scale,
+        lse_square_scale=lse_square_scale,
+        chunk_size=chunk_size,
+        return_z_loss=True,
+        reduction="none",
+    )
+    losses, z_losses = loss_fn(hidden_states, weight, labels, bias=bias)
+    losses_ref, z_losses_ref = cross_entropy_ref(
+        hidden_states, weight, bias, labels, smoothing, logit_scale, lse_square_scale
+    )
+    assert torch.allclose(losses, losses_ref, rtol=1e-5, atol=1e-5)
+    assert torch.allclose(z_losses, z_losses_ref, rtol=1e-5, atol=1e-5)
+    g = torch.randn_like(losses)
+    inputs = [hidden_states, weight] + ([bias] if has_bias else [])
+    grads = torch.autograd.grad(losses, inputs, g)
+    grads_ref = torch.autograd.grad(losses_ref, inputs, g)
+    for grad, grad_ref in zip(grads, grads_ref):
+        assert torch.allclose(grad, grad_ref, rtol=1e-4, atol=1e-5)
+
+
+def _run_linear_cross_entropy_parallel(rank, world_size, init_method, smoothing):
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    torch.manual_seed(0)
+    batch_size, hidden_dim, vocab_size = 37, 32, 1000
+    hidden_states = torch.randn(batch_size, hidden_dim, requires_grad=True)
+    weight = torch.randn(vocab_size, hidden_dim, requires_grad=True)
+    labels = torch.randint(0, vocab_size, (batch_size,))
+    labels[:3] = -100
+    loss_ref = LinearCrossEntropyLoss(label_smoothing=smoothing, lse_square_scale=1e-2)(
+        hidden_states, weight, labels
+    )
+    loss_ref.backward()
+
+    partition_size = vocab_size // world_size
+    hidden_states_local = hidden_states.detach().clone().requires_grad_()
+    weight_local = weight[rank * partition_size : (rank + 1) * partition_size]
+    weight_local = weight_local.detach().clone().requires_grad_()
+    loss_fn = LinearCrossEntropyLoss(
+        label_smoothing=smoothing,
+        lse_square_scale=1e-2,
+        chunk_size=16,
+        process_group=torch.distributed.group.WORLD,
+        sequence_parallel=False,
+    )
+    loss = loss_fn(hidden_states_local, weight_local, labels)
+    loss.backward()
+    assert torch.allclose(loss, loss_ref, rtol=1e-5, atol=1e-6)
+    assert torch.allclose(hidden_states_local.grad, hidden_states.grad, rtol=1e-4, atol=1e-6)
+    assert torch.allclose(
+        weight_local.grad,
+        weight.grad[rank * partition_size : (rank + 1) * partition_size],
+        rtol=1e-4,
+        atol=1e-6,
+    )
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+@pytest.mark.parametrize("world_size", [2, 4])
+def test_linear_cross_entropy_loss_parallel(world_size, smoothing, tmp_path):
+    init_method = f"file://{tmp_path / 'store'}"
+    mp.spawn(
+        _run_linear_cross_entropy_parallel,
+        args=(world_size, init_method, smoothing),
+        nprocs=world_size,
+    )
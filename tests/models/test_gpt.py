@@ -476,3 +476,59 @@ def test_gpt2_shard_unshard(n_heads_q_kv):
         ref = state_dict[k]
         new = state_dict[k]
         assert torch.allclose(ref, new, atol=0.0, rtol=0.0)
+
+
+def test_gpt2_packed_sequences():
+    """Forward on packed sequences with cu_seqlens matches running each sequence separately."""
+    config = GPT2Config(n_embd=256, n_head=4, n_layer=2, vocab_size=1024, n_positions=128)
+    config.use_flash_attn = True
+    device = "cuda"
+    dtype = torch.float16
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=dtype).eval()
+    seqlens = [17, 64, 1, 33]
+    sequences = [torch.randint(0, 1024, (1, seqlen), device=device) for seqlen in seqlens]
+    cu_seqlens = torch.tensor([0] + seqlens, device=device).cumsum(0, dtype=torch.int32)
+    position_ids = torch.cat([torch.arange(seqlen, device=device) for seqlen in seqlens])
+    with torch.no_grad():
+        logits = model(
+            torch.cat(sequences, dim=1),
+            position_ids=position_ids[None],
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max(seqlens),
+        ).logits
+        logits_ref = torch.cat([model(x).logits for x in sequences], dim=1)
+    assert logits.shape == (1, sum(seqlens), 1024)
+    assert (logits - logits_ref).abs().max().item() < 1e-2
+
+
+def test_gpt2_packed_sequences_rotary():
+    """Packed sequences with rotary embeddings are rejected before running any layer."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    config.rotary_emb_fraction = 0.5
+    model = GPTLMHeadModel(config)
+    cu_seqlens = torch.tensor([0, 3, 8], dtype=torch.int32)
+    with pytest.raises(AssertionError, match="rotary"):
+        model(torch.randint(0, 97, (1, 8)), cu_seqlens=cu_seqlens, max_seqlen=5)
+
+
+def test_gpt2_labels_loss():
+    """Forward with labels gives the loss of the logits, without materializing them."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=1000, n_positions=128)
+    config.lm_loss_chunk_size = 7
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config)
+    input_ids = torch.randint(0, 1000, (2, 33))
+    labels = torch.randint(0, 1000, (2, 33))
+    labels[0, :5] = -100
+    out = model(input_ids, labels=labels)
+    assert out.logits is None
+    out.loss.backward()
+    grads = [p.grad for p in model.parameters()]
+    model.zero_grad()
+    logits = model(input_ids).logits
+    loss_ref = torch.nn.functional.cross_entropy(logits.flatten(0, 1), labels.flatten())
+    loss_ref.backward()
+    assert torch.allclose(out.loss, loss_ref, rtol=1e-5, atol=1e-6)
+    for grad, p in zip(grads, model.parameters()):
+        assert torch.allclose(grad, p.grad, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,70 @@
+import pytest
+import torch
+import torch.multiprocessing as mp
+from flash_attn.modules.mha import MHA, ulysses_comm_volume
+
+SEQLENS = [5, 3, 8, 1]  # Uneven shards
+
+
+def _run_mha_ulysses(rank, world_size, init_method, num_heads_kv, causal):
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    process_group = torch.distributed.group.WORLD
+    batch_size, embed_dim, num_heads = 2, 64, 4
+    seqlens = SEQLENS[:world_size]
+    torch.manual_seed(0)
+    model_ref = MHA(embed_dim, num_heads, num_heads_kv=num_heads_kv, causal=causal)
+    model = MHA(
+        embed_dim,
+        num_heads,
+        num_heads_kv=num_heads_kv,
+        causal=causal,
+        ulysses_process_group=process_group,
+    )
+    model.load_state_dict(model_ref.state_dict())
+    x = torch.randn(batch_size, sum(seqlens), embed_dim, requires_grad=True)
+    g = torch.randn(batch_size, sum(seqlens), embed_dim)
+    out_ref = model_ref(x)
+    out_ref.backward(g)
+
+    start = sum(seqlens[:rank])
+    x_local = x[:, start : start + seqlens[rank]].detach().requires_grad_()
+    out = model(x_local)
+    out.backward(g[:, start : start + seqlens[rank]])
+    assert torch.allclose(out, out_ref[:, start : start + seqlens[rank]], rtol=1e-4, atol=1e-5)
+    assert torch.allclose(
+        x_local.grad, x.grad[:, start : start + seqlens[rank]], rtol=1e-4, atol=1e-5
+    )
+    # Each rank has the gradient of the weights for its tokens
+    for p, p_ref in zip(model.parameters(), model_ref.parameters()):
+        torch.distributed.all_reduce(p.grad, group=process_group)
+        assert torch.allclose(p.grad, p_ref.grad, rtol=1e-4, atol=1e-5)
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("num_heads_kv", [4, 2, 1])
+@pytest.mark.parametrize("world_size", [1, 2, 4])
+def test_mha_ulysses(world_size, num_heads_kv, causal, tmp_path):
+    init_method = f"file://{tmp_path / 'store'}"
+    mp.spawn(
+        _run_mha_ulysses, args=(world_size, init_method, num_heads_kv, causal), nprocs=world_size
+    )
+
+
+def test_ulysses_comm_volume():
+    kwargs = dict(batch_size=1, num_heads=32, num_heads_kv=8, head_dim=128)
+    # Scaling the sequence length with the number of ranks
+    volumes = [
+        ulysses_comm_volume(seqlen=8192 * world_size, world_size=world_size, **kwargs)
+        for world_size in [2, 4, 8]
+    ]
+    assert [v["all_to_all"] for v in volumes] == sorted(v["all_to_all"] for v in volumes)
+    assert volumes[-1]["all_to_all"] < 2 * volumes[0]["all_to_all"]
+    assert volumes[-1]["tensor_parallel"] > 3 * volumes[0]["tensor_parallel"]
+    # Each rank sends half of q, k, v and out of its 4 tokens
+    assert ulysses_comm_volume(1, 8, 4, 4, 16, 2, element_size=1)["all_to_all"] == 4 * 16 * 16 / 2
+    # With 1 KV head and 4 ranks, the KV head is replicated before being scattered
+    volume = ulysses_comm_volume(1, 8, 4, 1, 16, 4, element_size=1)
+    assert volume["all_to_all"] == 2 * 16 * 16 * 3 / 4
@@ -0,0 +1,47 @@
+import pytest
+import torch
+import torch.multiprocessing as mp
+from flash_attn.ops.ring_attention import ring_attn_func, zigzag_shard, zigzag_unshard
+from flash_attn.ops.split_kv import attention_partial
+
+
+def test_zigzag_shard():
+    world_size = 3
+    x = torch.arange(2 * 12).reshape(2, 12)
+    shards = [zigzag_shard(x, world_size, rank) for rank in range(world_size)]
+    assert shards[0][0].tolist() == [0, 1, 10, 11]
+    assert shards[2][0].tolist() == [4, 5, 6, 7]
+    assert torch.equal(zigzag_unshard(shards), x)
+
+
+def _run_ring_attention(rank, world_size, init_method, causal, nheads_k):
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    batch_size, seqlen, nheads, headdim = 2, 8 * world_size, 4, 16
+    torch.manual_seed(0)
+    q = torch.randn(batch_size, seqlen, nheads, headdim, requires_grad=True)
+    k = torch.randn(batch_size, seqlen, nheads_k, headdim, requires_grad=True)
+    v = torch.randn(batch_size, seqlen, nheads_k, headdim, requires_grad=True)
+    g = torch.randn(batch_size, seqlen, nheads, headdim)
+    out_ref, _ = attention_partial(q, k, v, causal=causal)
+    dq_ref, dk_ref, dv_ref = torch.autograd.grad(out_ref, (q, k, v), g)
+
+    q_local, k_local, v_local, g_local = [
+        zigzag_shard(x.detach(), world_size, rank).requires_grad_() for x in (q, k, v, g)
+    ]
+    out = ring_attn_func(q_local, k_local, v_local, torch.distributed.group.WORLD, causal=causal)
+    dq, dk, dv = torch.autograd.grad(out, (q_local, k_local, v_local), g_local)
+    for x, x_ref in [(out, out_ref), (dq, dq_ref), (dk, dk_ref), (dv, dv_ref)]:
+        assert torch.allclose(x, zigzag_shard(x_ref, world_size, rank), rtol=1e-4, atol=1e-5)
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("nheads_k", [4, 1])
+@pytest.mark.parametrize("world_size", [1, 2, 4])
+def test_ring_attention(world_size, nheads_k, causal, tmp_path):
+    init_method = f"file://{tmp_path / 'store'}"
+    mp.spawn(
+        _run_ring_attention, args=(world_size, init_method, causal, nheads_k), nprocs=world_size
+    )
@@ -0,0 +1,69 @@
+import math
+
+import pytest
+import torch
+from einops import repeat
+from flash_attn.ops.split_kv import attention_chunked, attention_partial, combine
+
+
+def attention_ref(q, k, v, causal=False):
+    seqlen_q, seqlen_k = q.shape[1], k.shape[1]
+    g = q.shape[2] // k.shape[2]
+    k = repeat(k, "b s h d -> b s (h g) d", g=g).float()
+    v = repeat(v, "b s h d -> b s (h g) d", g=g).float()
+    scores = torch.einsum("bthd,bshd->bhts", q.float() / math.sqrt(q.shape[-1]), k)
+    if causal:
+        row_idx = torch.arange(seqlen_q).unsqueeze(1)
+        col_idx = torch.arange(seqlen_k)
+        scores.masked_fill_(col_idx > row_idx + seqlen_k - seqlen_q, float("-inf"))
+    lse = torch.logsumexp(scores, dim=-1)
+    attn = torch.softmax(scores, dim=-1).nan_to_num(0.0)
+    return torch.einsum("bhts,bshd->bthd", attn, v), lse.transpose(1, 2)
+
+
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("nheads_k", [4, 1])
+@pytest.mark.parametrize("seqlen_q,seqlen_k", [(1, 97), (33, 97), (97, 97), (128, 33)])
+@pytest.mark.parametrize("chunk_size", [1, 16, 40, 1024])
+def test_attention_chunked(chunk_size, seqlen_q, seqlen_k, nheads_k, causal):
+    torch.manual_seed(0)
+    batch_size, nheads, headdim = 2, 4, 32
+    q = torch.randn(batch_size, seqlen_q, nheads, headdim)
+    k = torch.randn(batch_size, seqlen_k, nheads_k, headdim)
+    v = torch.randn(batch_size, seqlen_k, nheads_k, headdim)
+    out_ref, lse_ref = attention_ref(q, k, v, causal=causal)
+    out, lse = attention_chunked(q, k, v, chunk_size=chunk_size, causal=causal, return_lse=True)
+    torch.testing.assert_close(out, out_ref, atol=1e-5, rtol=1e-5)
+    # Rows without any visible key (causal with seqlen_q > seqlen_k) have lse = -inf
+    torch.testing.assert_close(lse, lse_ref, atol=1e-5, rtol=1e-5)
+    assert not out.isnan().any()
+
+
+def test_combine_layout():
+    """Partials stacked along the first dim, as for flash_attn_combine."""
+    torch.manual_seed(0)
+    q = torch.randn(3, 5, 2, 16)
+    k, v = torch.randn(3, 60, 2, 16), torch.randn(3, 60, 2, 16)
+    partials = [attention_partial(q, k[:, i : i + 20], v[:, i : i + 20]) for i in (0, 20, 40)]
+    out_partials = torch.stack([out for out, _ in partials])
+    lse_partials = torch.stack([lse for _, lse in partials])
+    assert out_partials.shape == (3, 3, 5, 2, 16) and lse_partials.shape == (3, 3, 5, 2)
+    out, lse = combine(out_partials, lse_partials, out_dtype=torch.bfloat16)
+    out_ref, lse_ref = attention_ref(q, k, v)
+    assert out.dtype == torch.bfloat16
+    torch.testing.assert_close(out.float(), out_ref, atol=1e-2, rtol=1e-2)
+    torch.testing.assert_close(lse, lse_ref)
+
+
+def test_combine_numerically_stable():
+    out_partials = torch.randn(2, 1, 3, 1, 8)
+    # Large lse would overflow exp without the max subtraction, -inf splits must not produce NaN
+    lse_partials = torch.tensor([[[1000.0], [float("-inf")], [float("-inf")]]]).expand(2, 1, 3, 1)
+    lse_partials = lse_partials.clone()
+    lse_partials[1, 0, 0, 0] = 1000.0 + math.log(3.0)
+    out_partials[1, 0, 1] = float("nan")
+    out, lse = combine(out_partials, lse_partials)
+    out_ref = 0.25 * out_partials[0, 0, 0] + 0.75 * out_partials[1, 0, 0]
+    torch.testing.assert_close(out[0, 0], out_ref)
+    torch.testing.assert_close(lse[0, 0, 0], torch.tensor(1000.0 + math.log(4.0)))
+    assert (out[0, 1:] == 0).all() and (lse[0, 1:] == float("-inf")).all()
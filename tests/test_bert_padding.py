@@ -0,0 +1,58 @@
+import pytest
+import torch
+from flash_attn.bert_padding import PackedBatch, pad_input, unpad_input
+from flash_attn.models.bert import BertModel
+
+
+def random_masks(batch_size, seqlen, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    seqlens = torch.randint(1, seqlen + 1, (batch_size,), generator=g)
+    attention_mask = torch.arange(seqlen)[None] < seqlens[:, None]
+    masked_tokens_mask = (torch.rand(batch_size, seqlen, generator=g) < 0.3) & attention_mask
+    return attention_mask, masked_tokens_mask
+
+
+@pytest.mark.parametrize("seqlen", [1, 17, 128])
+@pytest.mark.parametrize("batch_size", [1, 5])
+def test_packed_batch_matches_unpad_input(batch_size, seqlen):
+    attention_mask, _ = random_masks(batch_size, seqlen)
+    x = torch.randn(batch_size, seqlen, 8)
+    x_unpad, indices, cu_seqlens, max_seqlen, _ = unpad_input(x, attention_mask)
+    packed_batch = PackedBatch.from_mask(attention_mask)
+    assert torch.equal(packed_batch.indices, indices)
+    assert torch.equal(packed_batch.cu_seqlens, cu_seqlens)
+    assert packed_batch.max_seqlen == max_seqlen
+    assert torch.equal(packed_batch.unpad(x), x_unpad)
+    assert torch.equal(packed_batch.pad(x_unpad), pad_input(x_unpad, indices, batch_size, seqlen))
+
+
+def test_packed_batch_subset():
+    attention_mask, masked_tokens_mask = random_masks(4, 32)
+    first_col_mask = torch.zeros_like(attention_mask)
+    first_col_mask[:, 0] = True
+    subset_mask = masked_tokens_mask | first_col_mask
+    x = torch.randn(4, 32, 8)
+    packed_batch = PackedBatch.from_mask(attention_mask, subset_mask)
+    x_subset = packed_batch.unpad(x)[packed_batch.subset_idx]
+    assert torch.equal(x_subset, x[subset_mask & attention_mask])
+    subset_seqlens = (subset_mask & attention_mask).sum(dim=-1)
+    assert packed_batch.subset_cu_seqlens.tolist() == [0] + subset_seqlens.cumsum(0).tolist()
+    assert torch.equal(x_subset[packed_batch.subset_rows(first_col_mask)], x[:, 0])
+    assert torch.equal(
+        x_subset[packed_batch.subset_rows(masked_tokens_mask)], x[masked_tokens_mask]
+    )
+
+
+def test_bert_pack_batch():
+    attention_mask, masked_tokens_mask = random_masks(4, 32, seed=1)
+    x = torch.randn(4, 32, 8)
+    packed_batch = BertModel.pack_batch(attention_mask, masked_tokens_mask)
+    x_subset = packed_batch.unpad(x)[packed_batch.subset_idx]
+    assert torch.equal(x_subset[packed_batch.pool_idx], x[:, 0])
+    assert torch.equal(x_subset[packed_batch.masked_idx], x[masked_tokens_mask])
+    assert torch.equal(x.flatten(0, 1)[packed_batch.masked_token_idx], x[masked_tokens_mask])
+    # Moving to a device keeps the subclass and the extra fields
+    packed_batch_moved = packed_batch.to("cpu")
+    assert type(packed_batch_moved) is type(packed_batch)
+    assert torch.equal(packed_batch_moved.masked_idx, packed_batch.masked_idx)
+    assert packed_batch_moved.max_seqlen == packed_batch.max_seqlen
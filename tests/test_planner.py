@@ -0,0 +1,115 @@
+import pytest
+import torch
+from flash_attn.planner import (
+    num_splits_heuristic,
+    plan_fwd,
+    plan_with_kvcache,
+    should_pack_gqa,
+    tile_size_fwd_sm8x,
+    tile_size_fwd_sm90,
+)
+
+
+def test_num_splits_heuristic():
+    # Example from hopper/heuristics.h: 2 splits (efficiency 0.89) beats 3 splits (0.67)
+    assert num_splits_heuristic(48, 108, 64, 128) == 2
+    # Enough work to fill the SMs
+    assert num_splits_heuristic(100, 108, 64, 128) == 1
+    # Too few n blocks
+    assert num_splits_heuristic(8, 108, 4, 128) == 1
+
+
+def test_should_pack_gqa():
+    assert should_pack_gqa(True, 1024, 8, 128)
+    # Decoding: 1 / 128 vs 8 / 128
+    assert should_pack_gqa(False, 1, 8, 128)
+    assert not should_pack_gqa(False, 1024, 8, 128)
+
+
+def test_tile_sizes():
+    assert tile_size_fwd_sm90(128, 128, True, False) == (128, 128, True, True)
+    assert tile_size_fwd_sm90(128, 128, False, False) == (128, 176, True, True)
+    assert tile_size_fwd_sm90(256, 256, False, False, element_size=1, paged_kv=True) == (
+        128,
+        128,
+        True,
+        False,
+    )
+    assert tile_size_fwd_sm8x(True, 128, 128, False, False) == (128, 128, 8, 1, True)
+    assert tile_size_fwd_sm8x(False, 128, 128, False, False) == (128, 64, 4, 1, False)
+    assert tile_size_fwd_sm8x(False, 128, 128, False, False, varlen_and_split=True) == (
+        128,
+        112,
+        8,
+        1,
+        True,
+    )
+
+
+def test_plan_decode():
+    # GQA decoding with a long KV cache on an H100 SXM
+    plan = plan_fwd(
+        1, 1, 8192, 32, 8, 128, dtype=torch.bfloat16, varlen_k=True, num_sm=132, arch=90
+    )
+    assert (plan.block_m, plan.block_n) == (128, 176)
+    assert plan.num_n_blocks == 47
+    assert plan.num_splits == 4
+    assert plan.pack_gqa  # Always with splits
+    assert plan.num_ctas == 8 * 4
+    assert plan.wave_efficiency == pytest.approx(32 / 132)
+    # Large batch: no split needed
+    plan = plan_fwd(128, 1, 8192, 32, 8, 128, varlen_k=True, num_sm=132, arch=90)
+    assert plan.num_splits == 1
+    # Overrides are kept as is
+    plan = plan_fwd(1, 1, 8192, 32, 8, 128, num_sm=132, arch=90, num_splits=3, pack_gqa=False)
+    assert plan.num_splits == 3 and not plan.pack_gqa
+    assert plan.num_ctas == 32 * 3
+
+
+def test_plan_append_kv_sm86():
+    # The splits are computed before knew_ptr is set, i.e. with the tile of append_kv=False:
+    # 192 keys are 4 blocks of 48, too few to split. Only the launched tile uses 32 keys per block.
+    plan = plan_fwd(1, 1, 192, 32, 8, 256, varlen_k=True, append_kv=True, num_sm=82, arch=86)
+    assert tile_size_fwd_sm8x(True, 256, 256, False, False, varlen_and_split=True)[1] == 48
+    assert plan.num_splits == num_splits_heuristic(32 * 1, 82, (192 + 47) // 48, 128) == 1
+    assert (plan.block_m, plan.block_n) == (128, 32)
+    assert plan.num_n_blocks == 6 and plan.pack_gqa
+
+
+def test_plan_causal_local():
+    # causal with seqlen_q = seqlen_k
+    plan = plan_fwd(2, 4096, 4096, 16, 16, 128, causal=True, num_sm=132, arch=90)
+    assert plan.block_n == 128 and plan.num_splits == 1 and not plan.pack_gqa
+    # window_size=(-1, 0) is causal
+    assert plan_fwd(2, 4096, 4096, 16, 16, 128, window_size=(-1, 0), num_sm=132, arch=90) == plan
+    # Local only loads the window of keys
+    plan = plan_fwd(1, 1, 65536, 8, 8, 128, window_size=(255, 0), num_sm=132, arch=90)
+    assert plan.block_n == 128
+    assert plan.num_n_blocks == (255 + 0 + 1 + 128 + 127) // 128
+
+
+def test_plan_with_kvcache():
+    q = torch.empty(4, 1, 32, 128, dtype=torch.float16)
+    k_cache = torch.empty(64, 256, 8, 128, dtype=torch.float16)
+    page_table = torch.zeros(4, 16, dtype=torch.int32)
+    cache_seqlens = torch.zeros(4, dtype=torch.int32)
+    plan = plan_with_kvcache(
+        q, k_cache, k_cache, cache_seqlens=cache_seqlens, page_table=page_table, num_sm=132, arch=90
+    )
+    assert plan == plan_fwd(
+        4,
+        1,
+        16 * 256,
+        32,
+        8,
+        128,
+        dtype=torch.float16,
+        paged_kv=True,
+        varlen_k=True,
+        num_sm=132,
+        arch=90,
+    )
+    assert plan.block_n == 128 and plan.pack_gqa
+    # sm_margin reduces the number of SMs
+    plan = plan_with_kvcache(q, k_cache, k_cache, num_sm=132, arch=90, sm_margin=4)
+    assert plan.num_sm == 128
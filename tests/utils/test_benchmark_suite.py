@@ -0,0 +1,94 @@
+import json
+import random
+
+import pytest
+from flash_attn.utils.benchmark_suite import (
+    BenchmarkConfig,
+    attention_flops,
+    compare,
+    load_json,
+    main,
+    make_grid,
+    run_suite,
+    save_csv,
+    save_json,
+)
+
+
+def test_make_grid():
+    configs = make_grid(seqlen=[16, 32], causal=[False, True], headdim=32)
+    assert len(configs) == 4
+    assert configs[1] == BenchmarkConfig(seqlen=16, causal=True, headdim=32)
+    with pytest.raises(ValueError):
+        make_grid(seqlen_q=[16])
+
+
+def test_attention_flops():
+    assert attention_flops([4], [4], 1, 1, causal=False) == 4 * 16
+    # 1 + 2 + 3 + 4 entries
+    assert attention_flops([4], [4], 1, 1, causal=True) == 4 * 10
+    # Bottom right alignment: 3 + 4
+    assert attention_flops([2], [4], 1, 1, causal=True) == 4 * 7
+    assert attention_flops([4], [4], 1, 1, causal=False, mode="fwd_bwd") == 3.5 * 4 * 16
+
+
+@pytest.mark.parametrize("mode", ["fwd", "bwd", "fwd_bwd"])
+def test_run_suite_cpu(mode, tmp_path):
+    configs = make_grid(
+        backend="pytorch",
+        mode=mode,
+        dtype="float32",
+        seqlen=16,
+        nheads=4,
+        headdim=8,
+        gqa_ratio=[1, 2],
+        causal=[False, True],
+        varlen=[False, True],
+    )
+    run = run_suite(configs, device="cpu", repeats=2, num_samples=3, verbose=False)
+    assert len(run["results"]) == len(configs)
+    assert run["metadata"]["device"] == "cpu"
+    for result in run["results"]:
+        assert result["time_ms"] > 0 and result["tflops"] > 0
+        assert result["peak_memory_mb"] is None
+        assert len(result["samples_ms"]) == 3
+    save_json(run, tmp_path / "run.json")
+    assert load_json(tmp_path / "run.json") == json.loads(json.dumps(run))
+    save_csv(run, tmp_path / "run.csv")
+    lines = (tmp_path / "run.csv").read_text().splitlines()
+    assert len(lines) == 1 + len(configs) and "samples_ms" not in lines[0]
+
+
+def make_run(name_to_samples):
+    results = [
+        {"name": name, "time_ms": sorted(samples)[len(samples) // 2], "samples_ms": samples}
+        for name, samples in name_to_samples.items()
+    ]
+    return {"metadata": {}, "results": results}
+
+
+def test_compare():
+    rng = random.Random(0)
+    noise = lambda mean: [mean * (1 + 0.01 * rng.gauss(0, 1)) for _ in range(10)]
+    baseline = make_run({"a": noise(1.0), "b": noise(1.0), "c": noise(1.0), "d": noise(1.0)})
+    run = make_run({"a": noise(1.0), "b": noise(1.2), "c": noise(0.8), "e": noise(1.0)})
+    status = {c["name"]: c["status"] for c in compare(run, baseline)}
+    assert status == {"a": "unchanged", "b": "regression", "c": "improvement"}
+    # Too few samples for the difference to be significant
+    baseline = make_run({"a": [1.0, 1.1]})
+    run = make_run({"a": [1.2, 1.3]})
+    assert compare(run, baseline)[0]["status"] == "unchanged"
+
+
+def test_main_cpu(tmp_path):
+    grid = tmp_path / "grid.json"
+    grid.write_text(json.dumps({"backend": ["pytorch"], "dtype": ["float32"], "seqlen": [16]}))
+    args = ["--grid", str(grid), "--device", "cpu", "--repeats", "1", "--num-samples", "3"]
+    assert main(args + ["--output", str(tmp_path / "baseline.json")]) == 0
+    # Make the baseline look much faster than it was
+    baseline = load_json(tmp_path / "baseline.json")
+    for result in baseline["results"]:
+        result["samples_ms"] = [t * 1e-3 for t in result["samples_ms"]]
+        result["time_ms"] *= 1e-3
+    save_json(baseline, tmp_path / "baseline.json")
+    assert main(args + ["--baseline", str(tmp_path / "baseline.json")]) == 1
@@ -0,0 +1,156 @@
+import pytest
+import torch
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import (
+    InferenceParams,
+    decode,
+    decode_speculative,
+    generate_stream,
+    prefill_chunked,
+)
+from flash_attn.utils.kv_cache import PagedKVCache
+from transformers import GPT2Config
+
+
+@pytest.mark.parametrize("paged", [False, True])
+def test_decode_compact_finished(paged):
+    """Finished sequences are removed from the batch, the others generate the same tokens."""
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    model = GPTLMHeadModel(config).eval()
+    batch_size, seqlen, max_length = 6, 5, 30
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+    out_ref = decode(input_ids, model, max_length)
+    # A token that some sequences generate within the first 4 steps, but not all of them, so that
+    # the running sequences still allocate new pages (of 4 tokens) once the batch is compacted
+    generated = out_ref.sequences[:, seqlen:]
+    counts = torch.stack([(generated == t).any(dim=1) for t in range(config.vocab_size)]).sum(1)
+    early = torch.stack([(generated[:, :4] == t).any() for t in range(config.vocab_size)])
+    eos_token_id = int(torch.nonzero((counts > 0) & (counts < batch_size) & early)[0])
+    kwargs = {}
+    if paged:
+        kwargs["paged_kv_cache"] = PagedKVCache.from_model(
+            model, max_batch_size=batch_size, max_seqlen=max_length, page_block_size=4
+        )
+    out = decode(
+        input_ids, model, max_length, eos_token_id=eos_token_id, compact_finished=True, **kwargs
+    )
+    assert out.sequences.shape == (batch_size, max_length)
+    for i in range(batch_size):
+        tokens_ref = generated[i].tolist()
+        tokens = out.sequences[i, seqlen:].tolist()
+        if eos_token_id in tokens_ref:
+            num_tokens = tokens_ref.index(eos_token_id) + 1
+            assert tokens[:num_tokens] == tokens_ref[:num_tokens]
+            assert all(t == eos_token_id for t in tokens[num_tokens:])
+            assert all((score[i] == 0).all() for score in out.scores[num_tokens:])
+        else:
+            num_tokens = len(tokens_ref)
+            assert tokens == tokens_ref
+        torch.testing.assert_close(
+            torch.stack(out.scores[:num_tokens])[:, i],
+            torch.stack(out_ref.scores[:num_tokens])[:, i],
+        )
+
+
+def test_generate_stream():
+    """Streamed tokens are those of decode, with their logprobs and incremental text."""
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    model = GPTLMHeadModel(config).eval()
+    batch_size, seqlen, max_length = 3, 5, 20
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+    out_ref = decode(input_ids, model, max_length)
+
+    def detokenize(ids):
+        return "".join(f"<{i}>" for i in ids)
+
+    steps = list(
+        generate_stream(input_ids, model, max_length, output_logprobs=True, detokenize=detokenize)
+    )
+    assert len(steps) == max_length - seqlen
+    tokens = torch.stack([step.tokens for step in steps], dim=1)
+    assert torch.equal(tokens, out_ref.sequences[:, seqlen:])
+    for step, scores in zip(steps, out_ref.scores):
+        assert step.scores is None
+        torch.testing.assert_close(
+            step.logprobs, torch.log_softmax(scores, dim=-1).gather(-1, step.tokens[:, None])[:, 0]
+        )
+    for i in range(batch_size):
+        assert "".join(step.text[i] for step in steps) == detokenize(tokens[i].tolist())
+    # Stopping early doesn't run the remaining steps
+    stream = model.generate_stream(input_ids, max_length, output_scores=True)
+    step = next(stream)
+    torch.testing.assert_close(step.scores, out_ref.scores[0])
+    stream.close()
+
+
+@pytest.mark.parametrize("use_eos", [False, True])
+def test_decode_speculative_batched(use_eos):
+    """Greedy speculative decoding of a batch gives the tokens of greedy decoding, even though the
+    sequences accept different numbers of draft tokens."""
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    model = GPTLMHeadModel(config).eval()
+    model_draft = GPTLMHeadModel(GPT2Config(n_embd=32, n_head=2, n_layer=1, vocab_size=97)).eval()
+    batch_size, seqlen, max_length = 4, 5, 40
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+    out_ref = decode(input_ids, model, max_length)
+    generated = out_ref.sequences[:, seqlen:]
+    eos_token_id = None
+    if use_eos:
+        counts = torch.stack([(generated == t).any(dim=1) for t in range(config.vocab_size)])
+        counts = counts.sum(1)
+        eos_token_id = int(torch.nonzero((counts > 0) & (counts < batch_size))[0])
+    out, stats = decode_speculative(
+        input_ids,
+        model,
+        model_draft,
+        max_length,
+        speculative_lookahead=4,
+        eos_token_id=eos_token_id,
+        return_stats=True,
+    )
+    assert out.sequences.shape == (batch_size, max_length)
+    assert out.scores.shape == (batch_size, max_length - seqlen, config.vocab_size)
+    for i in range(batch_size):
+        tokens_ref = generated[i].tolist()
+        tokens = out.sequences[i, seqlen:].tolist()
+        num_tokens = len(tokens_ref)
+        if eos_token_id in tokens_ref:
+            num_tokens = tokens_ref.index(eos_token_id) + 1
+            assert all(t == eos_token_id for t in tokens[num_tokens:])
+            assert (out.scores[i, num_tokens:] == 0).all()
+        assert tokens[:num_tokens] == tokens_ref[:num_tokens]
+        torch.testing.assert_close(
+            out.scores[i, :num_tokens], torch.stack(out_ref.scores[:num_tokens])[:, i]
+        )
+    assert stats.num_main_model_calls <= max_length - seqlen
+    assert (stats.num_accepted_tokens <= stats.num_draft_tokens).all()
+    assert 0.0 <= stats.acceptance_rate <= 1.0
+
+
+@pytest.mark.parametrize("paged", [False, True])
+@pytest.mark.parametrize("prefill_chunk_size", [1, 7, 16])
+def test_decode_prefill_chunked(prefill_chunk_size, paged):
+    """Prefilling the prompt in chunks gives the logits and the tokens of prefilling it at once."""
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    model = GPTLMHeadModel(config).eval()
+    batch_size, seqlen, max_length = 2, 30, 40
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+    with torch.inference_mode():
+        logits_ref = model(input_ids).logits[:, -1]
+        inference_params = InferenceParams(max_seqlen=seqlen, max_batch_size=batch_size)
+        logits = prefill_chunked(model, input_ids, inference_params, prefill_chunk_size)
+    torch.testing.assert_close(logits, logits_ref)
+    assert inference_params.seqlen_offset == 0
+    kwargs = {}
+    if paged:
+        kwargs["paged_kv_cache"] = PagedKVCache.from_model(
+            model, max_batch_size=batch_size, max_seqlen=max_length, page_block_size=4
+        )
+    out_ref = decode(input_ids, model, max_length)
+    out = decode(input_ids, model, max_length, prefill_chunk_size=prefill_chunk_size, **kwargs)
+    assert torch.equal(out.sequences, out_ref.sequences)
+    torch.testing.assert_close(torch.stack(out.scores), torch.stack(out_ref.scores))
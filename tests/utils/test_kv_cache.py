@@ -0,0 +1,176 @@
+import pytest
+import torch
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.kv_cache import (
+    BlockAllocator,
+    PagedKVCache,
+    QuantizedKVCache,
+    dequantize_kv,
+    paged_kv_cache_gather,
+    paged_kv_cache_update,
+    quantize_kv,
+)
+from transformers import GPT2Config
+
+
+def test_block_allocator():
+    allocator = BlockAllocator(4)
+    blocks = [allocator.allocate() for _ in range(4)]
+    assert sorted(blocks) == [0, 1, 2, 3]
+    assert allocator.num_free_blocks == 0
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+    allocator.incref(blocks[0])
+    allocator.free(blocks[0])
+    assert allocator.num_free_blocks == 0  # still referenced once
+    allocator.free(blocks[0])
+    assert allocator.num_free_blocks == 1
+    assert allocator.allocate() == blocks[0]
+
+
+@pytest.mark.parametrize("page_block_size", [1, 4, 16])
+def test_paged_kv_cache_update_gather(page_block_size):
+    torch.manual_seed(0)
+    batch_size, max_seqlen, nheads, headdim = 3, 37, 2, 8
+    num_blocks = batch_size * ((max_seqlen + page_block_size - 1) // page_block_size)
+    kv_pages = {0: torch.zeros(num_blocks, page_block_size, 2, nheads, headdim)}
+    cache = PagedKVCache(kv_pages, batch_size, max_seqlen)
+    kv_dense = torch.zeros(batch_size, max_seqlen, 2, nheads, headdim)
+    cache_seqlens = torch.zeros(batch_size, dtype=torch.int32)
+    # Sequences grow by different amounts at each step
+    for seqlen_new in [5, 1, 7, 1, 1]:
+        for i in range(batch_size):
+            cache.reserve(i, cache_seqlens[i].item() + seqlen_new)
+        kv = torch.randn(batch_size, seqlen_new, 2, nheads, headdim)
+        paged_kv_cache_update(kv_pages[0], cache.block_table, kv, cache_seqlens)
+        for i in range(batch_size):
+            start = cache_seqlens[i].item()
+            kv_dense[i, start : start + seqlen_new] = kv[i]
+        cache_seqlens += seqlen_new
+    seqlen = cache_seqlens.max().item()
+    kv_gathered = paged_kv_cache_gather(kv_pages[0], cache.block_table, seqlen)
+    assert torch.equal(kv_gathered, kv_dense[:, :seqlen])
+    # Only the blocks that are needed have been allocated
+    assert cache.num_free_blocks == num_blocks - batch_size * cache.num_blocks_needed(seqlen)
+    for i in range(batch_size):
+        cache.free(i)
+    assert cache.num_free_blocks == num_blocks
+
+
+def test_paged_kv_cache_fork():
+    page_block_size, nheads, headdim = 4, 1, 2
+    kv_pages = {0: torch.randn(8, page_block_size, 2, nheads, headdim)}
+    cache = PagedKVCache(kv_pages, max_batch_size=2, max_seqlen=16)
+    cache.reserve(0, 10)
+    cache.fork(0, 1, 10)
+    # The 2 full blocks are shared, the partial block is copied
+    assert cache.block_tables[1][:2] == cache.block_tables[0][:2]
+    assert cache.block_tables[1][2] != cache.block_tables[0][2]
+    assert cache.num_free_blocks == 8 - 4
+    assert torch.equal(
+        paged_kv_cache_gather(kv_pages[0], cache.block_table[1:], 10),
+        paged_kv_cache_gather(kv_pages[0], cache.block_table[:1], 10),
+    )
+    cache.free(0)
+    assert cache.num_free_blocks == 8 - 3
+    cache.free(1)
+    assert cache.num_free_blocks == 8
+
+
+@pytest.mark.parametrize("page_block_size", [3, 16])
+def test_gpt_generation_paged_kv_cache(page_block_size):
+    """Greedy decoding on CPU with a paged KV cache must match decoding with a dense KV cache."""
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    model = GPTLMHeadModel(config).eval()
+    batch_size, seqlen, max_length = 3, 5, 20
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+
+    out_ref = model.generate(
+        input_ids, max_length=max_length, return_dict_in_generate=True, output_scores=True
+    )
+    paged_kv_cache = PagedKVCache.from_model(
+        model, max_batch_size=batch_size, max_seqlen=max_length, page_block_size=page_block_size
+    )
+    out = model.generate(
+        input_ids,
+        max_length=max_length,
+        return_dict_in_generate=True,
+        output_scores=True,
+        paged_kv_cache=paged_kv_cache,
+    )
+    assert torch.equal(out.sequences, out_ref.sequences)
+    torch.testing.assert_close(torch.stack(out.scores), torch.stack(out_ref.scores))
+    # All the blocks are released at the end of decoding
+    assert paged_kv_cache.num_free_blocks == paged_kv_cache.num_blocks
+
+
+@pytest.mark.parametrize("group_size", [None, 16])
+@pytest.mark.parametrize("num_bits", [8, 4])
+def test_quantize_kv(num_bits, group_size):
+    torch.manual_seed(0)
+    kv = torch.randn(2, 5, 2, 3, 64)
+    data, scale, shift = quantize_kv(kv, num_bits, group_size)
+    assert data.dtype == torch.uint8 and data.shape == (2, 5, 2, 3, 64 * num_bits // 8)
+    assert scale.shape == shift.shape == (2, 5, 2, 3, 64 // (group_size or 64))
+    kv_dq = dequantize_kv(data, scale, shift, num_bits)
+    # Rounding error is at most half a quantization step
+    step = scale.repeat_interleave(group_size or 64, dim=-1)
+    assert ((kv_dq - kv).abs() <= step / 2 + 1e-5).all()
+    # Constant groups are exact
+    data, scale, shift = quantize_kv(torch.full((4, 64), 0.5), num_bits, group_size)
+    assert torch.equal(dequantize_kv(data, scale, shift, num_bits), torch.full((4, 64), 0.5))
+
+
+@pytest.mark.parametrize("num_bits", [8, 4])
+def test_quantized_kv_cache_attention(num_bits):
+    torch.manual_seed(0)
+    batch_size, max_seqlen, nheads, headdim = 3, 50, 2, 32
+    cache = QuantizedKVCache(
+        batch_size + 1, max_seqlen, nheads, headdim, num_bits, dtype=torch.float32, chunk_size=16
+    )
+    kv = torch.randn(batch_size, 37, 2, nheads, headdim)
+    cache.update(kv[:, :30], batch_start=1)
+    cache.update(kv[:, 30:], batch_start=1, seqlen_start=30)
+    kv_dq = cache.dequantize(1, batch_size + 1, 0, 37)
+    q = torch.randn(batch_size, 7, nheads, headdim)
+    out = cache.attention(q, 37, batch_start=1, causal=True)
+    # Same as attention over the dequantized cache at once
+    scores = torch.einsum("bthd,bshd->bhts", q, kv_dq[:, :, 0]) / headdim**0.5
+    causal_mask = torch.arange(37) > torch.arange(7)[:, None] + 30
+    scores.masked_fill_(causal_mask, float("-inf"))
+    out_ref = torch.einsum("bhts,bshd->bthd", scores.softmax(dim=-1), kv_dq[:, :, 1])
+    torch.testing.assert_close(out, out_ref)
+    # Packed values, and a fp32 scale and shift per token and head
+    num_bytes_per_head = headdim * num_bits // 8 + 2 * 4
+    assert cache.num_bytes == (batch_size + 1) * max_seqlen * 2 * nheads * num_bytes_per_head
+
+
+def test_gpt_generation_quantized_kv_cache():
+    """Greedy decoding on CPU with an int8 KV cache should be close to decoding with a dense
+    KV cache."""
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    model = GPTLMHeadModel(config).eval()
+    batch_size, seqlen, max_length = 3, 5, 20
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+
+    out_ref = model.generate(
+        input_ids,
+        max_length=max_length,
+        return_dict_in_generate=True,
+        output_scores=True,
+    )
+    out = model.generate(
+        input_ids,
+        max_length=max_length,
+        return_dict_in_generate=True,
+        output_scores=True,
+        teacher_outputs=out_ref.sequences,
+        kv_cache_bits=8,
+    )
+    # Prompt processing doesn't read the cache
+    torch.testing.assert_close(out.scores[0], out_ref.scores[0])
+    torch.testing.assert_close(
+        torch.stack(out.scores), torch.stack(out_ref.scores), atol=5e-2, rtol=5e-2
+    )
@@ -0,0 +1,115 @@
+import torch
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.kv_cache import PagedKVCache
+from flash_attn.utils.prefix_cache import RadixPrefixCache
+from flash_attn.utils.scheduler import ContinuousBatchingScheduler
+from transformers import GPT2Config
+
+
+def get_model():
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    return GPTLMHeadModel(config).eval()
+
+
+def get_cache(num_blocks=8, page_block_size=4, max_batch_size=2, max_seqlen=32):
+    kv_pages = {0: torch.zeros(num_blocks, page_block_size, 2, 1, 2)}
+    return PagedKVCache(kv_pages, max_batch_size, max_seqlen)
+
+
+def test_radix_prefix_cache_match_insert():
+    kv_cache = get_cache()
+    prefix_cache = RadixPrefixCache(kv_cache)
+    tokens = list(range(10))
+    assert prefix_cache.match(tokens) == (0, [])
+    kv_cache.reserve(0, len(tokens))
+    prefix_cache.insert(tokens, kv_cache.block_tables[0])
+    # Only the 2 full blocks are cached
+    assert prefix_cache.num_cached_blocks == 2
+    blocks = kv_cache.block_tables[0][:2]
+    kv_cache.free(0)
+    assert kv_cache.num_free_blocks == 8 - 2
+    assert prefix_cache.match(tokens) == (8, blocks)
+    assert prefix_cache.match(tokens[:9] + [42]) == (8, blocks)
+    # The last token is never part of the match
+    assert prefix_cache.match(tokens[:8]) == (4, blocks[:1])
+    assert prefix_cache.match([1] + tokens[1:]) == (0, [])
+    assert prefix_cache.hits == 3 and prefix_cache.misses == 2
+    assert prefix_cache.num_hit_tokens == 8 + 8 + 4
+
+
+def test_radix_prefix_cache_lru_eviction():
+    kv_cache = get_cache(num_blocks=6)
+    prefix_cache = RadixPrefixCache(kv_cache, max_blocks=4)
+    for i, first_token in enumerate([0, 1]):
+        tokens = [first_token] * 8
+        kv_cache.reserve(i, 8)
+        prefix_cache.insert(tokens, kv_cache.block_tables[i])
+    assert prefix_cache.num_cached_blocks == 4
+    # Slot 0 still uses its blocks, so they can't be evicted
+    kv_cache.free(1)
+    assert prefix_cache.num_evictable_blocks == 2
+    prefix_cache.match([1] * 9)  # Touch the blocks of [1] * 8
+    kv_cache.free(0)
+    kv_cache.reserve(1, 4)
+    prefix_cache.insert([2] * 4, kv_cache.block_tables[1])
+    # Over budget: the least recently used leaf goes first, i.e. the 2nd block of [0] * 8
+    assert prefix_cache.num_evicted_blocks == 1
+    assert prefix_cache.match([0] * 9)[0] == 4
+    assert prefix_cache.match([1] * 9)[0] == 8
+    # Running out of blocks evicts from the prefix cache
+    kv_cache.free(1)
+    kv_cache.reserve(0, 24)
+    assert prefix_cache.num_cached_blocks == 0
+    assert prefix_cache.num_evicted_blocks == 5
+    kv_cache.free(0)
+    assert kv_cache.num_free_blocks == 6
+
+
+def test_radix_prefix_cache_memory_budget():
+    kv_cache = get_cache()
+    block_nbytes = 4 * 2 * 1 * 2 * 4
+    prefix_cache = RadixPrefixCache.from_memory_budget(kv_cache, max_bytes=3 * block_nbytes)
+    assert prefix_cache.max_blocks == 3
+
+
+def test_decode_prefix_cache():
+    """A second generate call with the same system prompt reuses its KV cache and gives the same
+    tokens as decoding without a prefix cache."""
+    model = get_model()
+    torch.manual_seed(1)
+    system_prompt = torch.randint(0, 97, (2, 9))
+    paged_kv_cache = PagedKVCache.from_model(
+        model, max_batch_size=2, max_seqlen=32, page_block_size=4
+    )
+    prefix_cache = RadixPrefixCache(paged_kv_cache)
+    for i in range(2):
+        input_ids = torch.cat([system_prompt, torch.randint(0, 97, (2, 3 + i))], dim=1)
+        out_ref = model.generate(input_ids, max_length=24)
+        out = model.generate(
+            input_ids, max_length=24, paged_kv_cache=paged_kv_cache, prefix_cache=prefix_cache
+        )
+        assert torch.equal(out, out_ref)
+    # The 2nd call reuses the first 2 blocks of the system prompt of each sequence
+    assert prefix_cache.hits == 2 and prefix_cache.misses == 2
+    assert prefix_cache.num_hit_tokens == 2 * 8
+
+
+def test_scheduler_prefix_cache():
+    model = get_model()
+    torch.manual_seed(1)
+    system_prompt = torch.randint(0, 97, (10,))
+    prompts = [torch.cat([system_prompt, torch.randint(0, 97, (l,))]) for l in [1, 4, 2, 6]]
+    paged_kv_cache = PagedKVCache.from_model(
+        model, max_batch_size=2, max_seqlen=32, page_block_size=4
+    )
+    prefix_cache = RadixPrefixCache(paged_kv_cache)
+    scheduler = ContinuousBatchingScheduler(model, paged_kv_cache, prefix_cache=prefix_cache)
+    requests = [scheduler.add_request(prompt, max_new_tokens=5) for prompt in prompts]
+    scheduler.run()
+    for prompt, request in zip(prompts, requests):
+        out_ref = model.generate(prompt[None], max_length=prompt.shape[0] + 5)
+        assert request.output_ids == out_ref[0, prompt.shape[0] :].tolist()
+    assert prefix_cache.misses == 1 and prefix_cache.hits == 3
+    num_blocks = paged_kv_cache.num_free_blocks + prefix_cache.num_cached_blocks
+    assert num_blocks == paged_kv_cache.num_blocks
@@ -0,0 +1,72 @@
+from functools import partial
+
+import pytest
+import torch
+from flash_attn.models.gpt import GPTLMHeadModel, remap_state_dict_hf_gpt2, shard_state_dict_tp
+from flash_attn.utils.pretrained import load_pretrained_streaming, state_dict_from_pretrained
+from transformers import GPT2Config
+from transformers.models.gpt2.modeling_gpt2 import GPT2Model
+
+
+class StateDictModel:
+    """Stand-in for a tensor parallel model, which can't be created without a process group."""
+
+    def __init__(self, state_dict):
+        self._state_dict = {k: torch.zeros_like(v) for k, v in state_dict.items()}
+
+    def state_dict(self):
+        return self._state_dict
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=96, n_positions=64)
+    # Several safetensors shards, in HF format
+    GPT2Model(config).save_pretrained(tmp_path, safe_serialization=True, max_shard_size="50KB")
+    assert len(list(tmp_path.glob("*.safetensors"))) > 1
+    return str(tmp_path), config
+
+
+@pytest.mark.parametrize("dtype", [None, torch.float16])
+def test_load_pretrained_streaming(checkpoint, dtype):
+    model_name, config = checkpoint
+    state_dict = state_dict_from_pretrained(model_name, dtype=dtype)
+    state_dict = remap_state_dict_hf_gpt2(state_dict, config)
+    model_ref = GPTLMHeadModel(config, dtype=dtype)
+    model_ref.load_state_dict(state_dict)
+    model = GPTLMHeadModel(config, dtype=dtype)
+    convert_fn = partial(remap_state_dict_hf_gpt2, config=config)
+    stats = load_pretrained_streaming(model, model_name, convert_fn, dtype=dtype)
+    assert stats["missing_keys"] == [] and stats["unexpected_keys"] == []
+    assert stats["num_bytes"] > 0 and stats["throughput"] > 0
+    for (name, p), p_ref in zip(model.state_dict().items(), model_ref.state_dict().values()):
+        assert torch.equal(p, p_ref), name
+
+
+@pytest.mark.parametrize("world_size", [2, 4])
+def test_load_pretrained_streaming_tp(checkpoint, world_size):
+    model_name, config = checkpoint
+    state_dict = remap_state_dict_hf_gpt2(state_dict_from_pretrained(model_name), config)
+    for rank in range(world_size):
+        state_dict_ref = shard_state_dict_tp(dict(state_dict), config, world_size, rank)
+        model = StateDictModel(state_dict_ref)
+
+        def convert_fn(state_dict):
+            state_dict = remap_state_dict_hf_gpt2(state_dict, config)
+            return shard_state_dict_tp(state_dict, config, world_size, rank)
+
+        load_pretrained_streaming(model, model_name, convert_fn)
+        for name, p in model.state_dict().items():
+            assert torch.equal(p, state_dict_ref[name]), name
+
+
+def test_load_pretrained_streaming_strict(checkpoint):
+    model_name, config = checkpoint
+    model = GPTLMHeadModel(config)
+    # Without remapping, no key matches
+    with pytest.raises(RuntimeError):
+        load_pretrained_streaming(model, model_name)
+    stats = load_pretrained_streaming(model, model_name, strict=False)
+    assert stats["num_tensors"] == 0
+    assert len(stats["missing_keys"]) == len(model.state_dict())
@@ -0,0 +1,71 @@
+import pytest
+import torch
+from flash_attn.utils.generation import (
+    BatchSamplingParams,
+    SamplingParams,
+    _top_p_threshold,
+    modify_logits_for_top_p_filtering,
+    sample_batched,
+)
+
+
+@pytest.mark.parametrize("top_p", [0.1, 0.5, 0.9, 0.99])
+def test_top_p_threshold(top_p):
+    torch.manual_seed(0)
+    logits = torch.randn(8, 1000) * 3
+    logits_ref = logits.clone()
+    modify_logits_for_top_p_filtering(logits_ref, top_p)
+    probs = torch.softmax(logits, dim=-1)
+    threshold = _top_p_threshold(probs, torch.full((8,), top_p))
+    assert torch.equal(probs >= threshold[:, None], logits_ref > float("-inf"))
+
+
+@pytest.mark.parametrize("top_k", [0, 3])
+def test_sample_batched_distribution(top_k):
+    torch.manual_seed(0)
+    logits = torch.tensor([[2.0, 1.0, 0.5, 0.0, -1.0]]).expand(20000, -1)
+    params = BatchSamplingParams.from_list(
+        [SamplingParams(temperature=2.0, top_k=top_k, top_p=0.9)] * logits.shape[0]
+    )
+    tokens = sample_batched(logits, params)
+    probs = torch.softmax(logits[0] / 2.0, dim=-1)
+    if top_k > 0:
+        probs[top_k:] = 0.0
+        probs /= probs.sum()
+    # Top-p: the smallest set of top tokens with probability >= 0.9
+    num_kept = int((probs.cumsum(dim=0) - probs < 0.9).sum())
+    probs[num_kept:] = 0.0
+    probs /= probs.sum()
+    freqs = torch.bincount(tokens, minlength=5).float() / tokens.shape[0]
+    assert (freqs[num_kept:] == 0).all()
+    torch.testing.assert_close(freqs, probs, atol=0.02, rtol=0.0)
+
+
+def test_sample_batched_per_row():
+    torch.manual_seed(0)
+    vocab_size = 50
+    logits = torch.randn(4, vocab_size)
+    params = [
+        SamplingParams(top_k=1),
+        SamplingParams(temperature=0.0),
+        SamplingParams(top_k=5, seed=0),
+        SamplingParams(top_p=0.5, seed=1),
+    ]
+    tokens = sample_batched(logits, BatchSamplingParams.from_list(params))
+    assert tokens[:2].tolist() == logits[:2].argmax(dim=-1).tolist()
+    assert tokens[2] in torch.topk(logits[2], 5).indices
+    # Seeded rows don't depend on the rest of the batch
+    params_ref = [SamplingParams(top_k=5, seed=0), SamplingParams(top_p=0.5, seed=1)]
+    for _ in range(10):
+        tokens = sample_batched(logits, BatchSamplingParams.from_list(params))
+        tokens_ref = sample_batched(logits[[2, 3]], BatchSamplingParams.from_list(params_ref))
+        assert tokens[2:].tolist() == tokens_ref.tolist()
+
+
+def test_sample_batched_repetition_penalty():
+    logits = torch.tensor([[1.0, 0.5, 0.2, -1.5], [1.0, 0.5, 0.2, -1.5]])
+    input_ids = torch.tensor([[0, 1], [0, 0]])
+    params = BatchSamplingParams.from_list([SamplingParams(top_k=1, repetition_penalty=10.0)] * 2)
+    assert params.repetition_penalty is not None
+    # 0.5 / 10 < 1.0 / 10 < 0.2 for the first row, 1.0 / 10 < 0.5 for the second one
+    assert sample_batched(logits, params, input_ids=input_ids).tolist() == [2, 1]
@@ -0,0 +1,154 @@
+import pytest
+import torch
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import SamplingParams
+from flash_attn.utils.kv_cache import PagedKVCache
+from flash_attn.utils.scheduler import ContinuousBatchingScheduler
+from transformers import GPT2Config
+
+
+def get_model():
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=97, n_positions=64)
+    return GPTLMHeadModel(config).eval()
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 2, 4])
+def test_continuous_batching_matches_decode(max_batch_size):
+    """Each request must generate the same tokens as decoding it on its own."""
+    model = get_model()
+    torch.manual_seed(1)
+    prompt_lens = [5, 2, 9, 3, 7]
+    max_new_tokens = [6, 12, 3, 8, 1]
+    prompts = [torch.randint(0, 97, (l,), dtype=torch.long) for l in prompt_lens]
+    paged_kv_cache = PagedKVCache.from_model(
+        model, max_batch_size=max_batch_size, max_seqlen=32, page_block_size=4
+    )
+    scheduler = ContinuousBatchingScheduler(model, paged_kv_cache)
+    requests = [
+        scheduler.add_request(prompt, n, request_id=i)
+        for i, (prompt, n) in enumerate(zip(prompts, max_new_tokens))
+    ]
+    num_running = []
+    while scheduler.has_unfinished_requests():
+        scheduler.step()
+        num_running.append(len(scheduler.running_slots))
+    assert max(num_running) <= max_batch_size
+    for prompt, n, request in zip(prompts, max_new_tokens, requests):
+        out_ref = model.generate(prompt[None], max_length=prompt.shape[0] + n)
+        assert request.finished
+        assert request.output_ids == out_ref[0, prompt.shape[0] :].tolist()
+    assert paged_kv_cache.num_free_blocks == paged_kv_cache.num_blocks
+
+
+def test_continuous_batching_eos_retires_early():
+    model = get_model()
+    torch.manual_seed(1)
+    short, long = torch.randint(0, 97, (4,)), torch.randint(0, 97, (6,))
+    out_ref = model.generate(short[None], max_length=4 + 10)[0, 4:].tolist()
+    eos_token_id = out_ref[2]
+    paged_kv_cache = PagedKVCache.from_model(
+        model, max_batch_size=2, max_seqlen=32, page_block_size=4
+    )
+    scheduler = ContinuousBatchingScheduler(model, paged_kv_cache)
+    request_short = scheduler.add_request(short, 10, eos_token_id=eos_token_id)
+    request_long = scheduler.add_request(long, 20)
+    request_waiting = scheduler.add_request(long, 2)
+    finished = scheduler.run()
+    assert request_short.output_ids == out_ref[: out_ref.index(eos_token_id) + 1]
+    # The waiting request took the slot of the short one and finished before the long one
+    assert finished == [request_short, request_waiting, request_long]
+    assert len(request_long.output_ids) == 20
+
+
+def test_continuous_batching_admission_respects_blocks():
+    model = get_model()
+    # Only enough blocks for one request at a time, although there are 2 slots
+    paged_kv_cache = PagedKVCache.from_model(
+        model, max_batch_size=2, max_seqlen=16, num_blocks=4, page_block_size=4
+    )
+    scheduler = ContinuousBatchingScheduler(model, paged_kv_cache)
+    for _ in range(3):
+        scheduler.add_request(torch.arange(6), max_new_tokens=8)
+    with pytest.raises(ValueError):
+        scheduler.add_request(torch.arange(6), max_new_tokens=12)
+    while scheduler.has_unfinished_requests():
+        scheduler.step()
+        assert len(scheduler.running_slots) <= 1
+    assert paged_kv_cache.num_free_blocks == paged_kv_cache.num_blocks
+
+
+def test_continuous_batching_sampling_params():
+    """Seeded requests sample the same tokens regardless of the other requests in the batch."""
+    model = get_model()
+    torch.manual_seed(1)
+    prompts = [torch.randint(0, 97, (l,), dtype=torch.long) for l in [5, 2, 9]]
+    outputs = []
+    for max_batch_size in [1, 3]:
+        paged_kv_cache = PagedKVCache.from_model(
+            model, max_batch_size=max_batch_size, max_seqlen=32, page_block_size=4
+        )
+        scheduler = ContinuousBatchingScheduler(model, paged_kv_cache)
+        requests = [
+            scheduler.add_request(prompt, 8, sampling_params=SamplingParams(top_p=0.9, seed=i))
+            for i, prompt in enumerate(prompts)
+        ]
+        # Greedy with the defaults of the scheduler
+        request_greedy = scheduler.add_request(prompts[0], 8)
+        scheduler.run()
+        outputs.append([request.output_ids for request in requests])
+        out_ref = model.generate(prompts[0][None], max_length=prompts[0].shape[0] + 8)
+        assert request_greedy.output_ids == out_ref[0, prompts[0].shape[0] :].tolist()
+    assert outputs[0] == outputs[1]
+
+
+def test_continuous_batching_shared_sampling_params():
+    """Requests that share one seeded SamplingParams each sample as if they ran alone."""
+    model = get_model()
+    torch.manual_seed(1)
+    prompts = [torch.randint(0, 97, (l,), dtype=torch.long) for l in [5, 9]]
+    params = SamplingParams(top_p=0.9, seed=0)
+
+    def run(prompts):
+        paged_kv_cache = PagedKVCache.from_model(
+            model, max_batch_size=2, max_seqlen=32, page_block_size=4
+        )
+        scheduler = ContinuousBatchingScheduler(model, paged_kv_cache)
+        requests = [scheduler.add_request(p, 8, sampling_params=params) for p in prompts]
+        scheduler.run()
+        return [request.output_ids for request in requests]
+
+    outputs_ref = [run([prompt])[0] for prompt in prompts]
+    assert run(prompts) == outputs_ref
+    # Reusing the params starts again at the seed
+    assert run(prompts[:1]) == outputs_ref[:1]
+
+
+@pytest.mark.parametrize("prefill_chunk_size", [1, 3, 8])
+def test_continuous_batching_chunked_prefill(prefill_chunk_size):
+    """Chunked prefill generates the same tokens as prefilling prompts at once, and a long prompt
+    doesn't stop the running requests from decoding."""
+    model = get_model()
+    torch.manual_seed(2)
+    prompt_lens = [3, 20, 4]
+    max_new_tokens = [10, 4, 6]
+    prompts = [torch.randint(0, 97, (l,), dtype=torch.long) for l in prompt_lens]
+    outputs = []
+    for chunk_size in [None, prefill_chunk_size]:
+        paged_kv_cache = PagedKVCache.from_model(
+            model, max_batch_size=3, max_seqlen=32, page_block_size=4
+        )
+        scheduler = ContinuousBatchingScheduler(
+            model, paged_kv_cache, prefill_chunk_size=chunk_size
+        )
+        requests = [scheduler.add_request(p, n) for p, n in zip(prompts, max_new_tokens)]
+        num_tokens_first = []
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            num_tokens_first.append(len(requests[0].output_ids))
+        outputs.append([request.output_ids for request in requests])
+        assert paged_kv_cache.num_free_blocks == paged_kv_cache.num_blocks
+    assert outputs[0] == outputs[1]
+    # The first request keeps decoding, one token per step, while the long prompt is prefilled
+    num_steps = -(-prompt_lens[0] // prefill_chunk_size)
+    assert num_tokens_first[num_steps - 1 : num_steps - 1 + 10] == list(range(1, 11))
@@ -10,28 +10,44 @@ from pytorch_lightning.utilities import rank_zero_only
 from pytorch_lightning.utilities.parsing import AttributeDict
 from pytorch_lightning.utilities.types import STEP_OUTPUT
 
-from src.utils.ema import ExponentialMovingAverage
+from src.utils.ema import ExponentialMovingAverage, FlatExponentialMovingAverage
 
 
 class EMACallback(Callback):
     """TD [2021-08-31]: saving and loading from checkpoint should work.
     """
-    def __init__(self, decay: float, use_num_updates: bool = True):
+    def __init__(self, decay: float, use_num_updates: bool = True, flat: bool = False,
+                 offload: bool = False, update_every: int = 1):
         """
         decay: The exponential decay.
         use_num_updates: Whether to use number of updates when computing
             averages.
+        flat: Whether to use FlatExponentialMovingAverage, which keeps the averages in flat
+            buffers and updates them with fused ops. Implied by offload and update_every.
+        offload: Whether to keep the averages in CPU memory, updated on a background thread.
+        update_every: Only update the averages every update_every optimizer steps.
         """
         super().__init__()
         self.decay = decay
         self.use_num_updates = use_num_updates
+        self.flat = flat or offload or update_every != 1
+        self.offload = offload
+        self.update_every = update_every
         self.ema = None
 
+    def _create_ema(self, pl_module):
+        parameters = [p for p in pl_module.parameters() if p.requires_grad]
+        if not self.flat:
+            return ExponentialMovingAverage(parameters, decay=self.decay,
+                                            use_num_updates=self.use_num_updates)
+        return FlatExponentialMovingAverage(parameters, decay=self.decay,
+                                            use_num_updates=self.use_num_updates,
+                                            offload=self.offload, update_every=self.update_every)
+
     def on_train_start(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"):
         # It's possible that we already loaded EMA from the checkpoint
         if self.ema is None:
-          self.ema = ExponentialMovingAverage([p for p in pl_module.parameters() if p.requires_grad],
-                                              decay=self.decay, use_num_updates=self.use_num_updates)
+          self.ema = self._create_ema(pl_module)
 
     # Ideally we want on_after_optimizer_step but pytorch-lightning doesn't have it
     # We only want to update when parameters are changing.
@@ -77,6 +93,5 @@ class EMACallback(Callback):
         checkpoint: Dict[str, Any]
     ) -> None:
         if self.ema is None:
-            self.ema = ExponentialMovingAverage([p for p in pl_module.parameters() if p.requires_grad],
-                                                decay=self.decay, use_num_updates=self.use_num_updates)
+            self.ema = self._create_ema(pl_module)
         self.ema.load_state_dict(checkpoint)
@@ -0,0 +1,146 @@
+# Packing of whole documents into token-budgeted batches, so that attention doesn't cross document
+# boundaries (unlike LMDataset) and no compute is wasted on padding. A batch is the concatenation
+# of its documents, described by cu_seqlens / max_seqlen as in the varlen FlashAttention kernels.
+import math
+
+import numpy as np
+import torch
+
+
+def document_offsets_from_eos(tokens, eos_token_id, chunk_size=1 << 24):
+    """Offsets of the documents in @tokens (e.g. a memmap), where each document ends with
+    @eos_token_id. Returns (num_docs + 1,) int64 array, the last document may not end with eos.
+    The tokens are read @chunk_size at a time.
+    """
+    ends = [np.zeros(1, dtype=np.int64)]
+    for start in range(0, len(tokens), chunk_size):
+        chunk = np.asarray(tokens[start:start + chunk_size])
+        ends.append(np.flatnonzero(chunk == eos_token_id).astype(np.int64) + start + 1)
+    offsets = np.concatenate(ends)
+    if offsets[-1] != len(tokens):
+        offsets = np.append(offsets, len(tokens))
+    return offsets
+
+
+class DocumentDataset(torch.utils.data.Dataset):
+
+    def __init__(self, tokens, doc_offsets, max_seqlen):
+        """Documents of @tokens, delimited by @doc_offsets. Documents longer than @max_seqlen
+        are split into segments of @max_seqlen, as LMDataset does with the whole stream.
+        Each item is (input_ids, labels) of the same length, labels being shifted by one.
+        """
+        self.tokens = tokens
+        self.max_seqlen = max_seqlen
+        doc_offsets = np.asarray(doc_offsets, dtype=np.int64)
+        starts, ends = doc_offsets[:-1], doc_offsets[1:] - 1  # ends: last input position + 1
+        num_segments = np.maximum(np.ceil((ends - starts) / max_seqlen).astype(np.int64), 0)
+        # Documents with a single token have no label and are dropped
+        doc_idx = np.repeat(np.arange(len(starts)), num_segments)
+        segment_idx = np.arange(len(doc_idx)) - np.repeat(np.cumsum(num_segments) - num_segments,
+                                                          num_segments)
+        self.starts = starts[doc_idx] + segment_idx * max_seqlen
+        self.lengths = np.minimum(ends[doc_idx] - self.starts, max_seqlen)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        start, seqlen = self.starts[idx], self.lengths[idx]
+        data = torch.as_tensor(self.tokens[start:start + seqlen + 1].astype(np.int64))
+        return data[:-1], data[1:].clone()
+
+
+def pack_first_fit_decreasing(lengths, max_tokens, lookahead=1024):
+    """Bin-pack items of @lengths into bins of at most @max_tokens, with first-fit-decreasing
+    over windows of @lookahead consecutive items (so that items stay roughly in order).
+    Returns a list of bins, each a list of item indices.
+    """
+    lengths = np.asarray(lengths)
+    assert (lengths <= max_tokens).all(), 'Items must fit in a bin'
+    bins = []
+    for window_start in range(0, len(lengths), lookahead):
+        window = np.arange(window_start, min(window_start + lookahead, len(lengths)))
+        # Stable sort so that ties keep their order
+        window = window[np.argsort(-lengths[window], kind='stable')]
+        window_bins = []
+        remaining = np.empty(len(window), dtype=np.int64)  # Space left in each bin
+        for idx in window:
+            fits = np.flatnonzero(remaining[:len(window_bins)] >= lengths[idx])
+            if len(fits) > 0:
+                window_bins[fits[0]].append(int(idx))
+                remaining[fits[0]] -= lengths[idx]
+            else:
+                remaining[len(window_bins)] = max_tokens - lengths[idx]
+                window_bins.append([int(idx)])
+        bins.extend(window_bins)
+    return bins
+
+
+class PackedBatchSampler(torch.utils.data.BatchSampler):
+
+    def __init__(self, lengths, max_tokens, lookahead=1024, shuffle=False, seed=0,
+                 num_replicas=1, rank=0, drop_last=False, sampler=None):
+        """Batch sampler yielding the indices of the documents of each packed batch, for a
+        DocumentDataset with @lengths (dataset.lengths) and at most @max_tokens tokens per batch.
+        With shuffle, documents are shuffled before packing, differently at every epoch (see
+        set_epoch). Batches are split across @num_replicas processes, keeping the same number of
+        batches on each (the last ones are dropped if drop_last, else repeated).
+        sampler: ignored. With replace_sampler_ddp, Lightning re-creates the batch sampler with
+            the same arguments and its DistributedSampler as @sampler, but the batches are
+            already split across processes here.
+        """
+        # BatchSampler.__init__ is not called, there is no underlying sampler or batch_size
+        self.sampler = None
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.lookahead = lookahead
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + epoch).permutation(len(self.lengths))
+        else:
+            order = np.arange(len(self.lengths))
+        self.bins = [[int(order[i]) for i in b]
+                     for b in pack_first_fit_decreasing(self.lengths[order], self.max_tokens,
+                                                        self.lookahead)]
+
+    @property
+    def packing_efficiency(self):
+        """Fraction of the token budget of the batches that is filled with tokens."""
+        return float(self.lengths.sum()) / max(len(self.bins) * self.max_tokens, 1)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.bins) // self.num_replicas
+        return math.ceil(len(self.bins) / self.num_replicas)
+
+    def __iter__(self):
+        bins = self.bins
+        num_bins = len(self) * self.num_replicas
+        if num_bins > len(bins):
+            bins = bins + bins[:num_bins - len(bins)]
+        return iter(bins[self.rank:num_bins:self.num_replicas])
+
+
+def packed_collate_fn(batch):
+    """Concatenate a list of (input_ids, labels) into a packed batch, to be passed to GPTModel.
+    Returns a dict with input_ids, labels and position_ids of shape (1, total), cu_seqlens of shape
+    (num_docs + 1,) int32 and max_seqlen.
+    """
+    seqlens = torch.tensor([x.shape[0] for x, _ in batch], dtype=torch.int32)
+    cu_seqlens = torch.nn.functional.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+    position_ids = torch.cat([torch.arange(seqlen) for seqlen in seqlens.tolist()])
+    return {
+        'input_ids': torch.cat([x for x, _ in batch])[None],
+        'labels': torch.cat([y for _, y in batch])[None],
+        'position_ids': position_ids[None],
+        'cu_seqlens': cu_seqlens,
+        'max_seqlen': int(seqlens.max()),
+    }
@@ -0,0 +1,197 @@
+# Sharded on-disk store of token ids, so that tokenizing a large corpus can be parallelized,
+# resumed after an interruption, and extended with new data without starting over.
+# Each shard is a flat binary file of token ids (memory-mapped when read), and index.json lists
+# the committed shards. A shard is written to a temporary file then renamed, and only added to
+# the index afterwards, so a shard is either fully there or not at all.
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+
+class ConcatTokens:
+    """Read-only concatenation of 1D arrays of tokens (e.g. memmaps of shards), which can be
+    indexed and sliced like a 1D numpy array. Slices inside one array are views (zero-copy), only
+    slices crossing a boundary between arrays are copied.
+    """
+
+    def __init__(self, arrays, dtype):
+        self.arrays = [a for a in arrays if len(a) > 0]
+        self.offsets = np.cumsum([0] + [len(a) for a in self.arrays])
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def _array_idx(self, idx):
+        return int(np.searchsorted(self.offsets, idx, side='right')) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1, 'Only contiguous slices are supported'
+            if start >= stop:
+                return np.empty(0, dtype=self.dtype)
+            first, last = self._array_idx(start), self._array_idx(stop - 1)
+            if first == last:
+                offset = self.offsets[first]
+                return self.arrays[first][start - offset:stop - offset]
+            return np.concatenate([
+                self.arrays[i][max(start - self.offsets[i], 0):stop - self.offsets[i]]
+                for i in range(first, last + 1)
+            ])
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'Index {idx} out of range for {len(self)} tokens')
+        i = self._array_idx(idx)
+        return self.arrays[i][idx - self.offsets[i]]
+
+
+_worker_tokenize_fn = None
+
+
+def _init_worker(tokenize_fn):
+    global _worker_tokenize_fn
+    _worker_tokenize_fn = tokenize_fn
+
+
+def _tokenize_shard(filename, payload, dtype, tokenize_fn=None):
+    tokenize_fn = tokenize_fn if tokenize_fn is not None else _worker_tokenize_fn
+    tokens = np.asarray(tokenize_fn(payload), dtype=dtype)
+    tmp_filename = filename.with_name(filename.name + '.tmp')
+    with open(tmp_filename, 'wb') as f:
+        tokens.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    return len(tokens)
+
+
+class ShardedTokenStore:
+    """Token ids of several splits, stored as shards of consecutive examples of a data source.
+
+    A shard is identified by (split, source, start, end), where [start, end) is the range of
+    examples of the source it contains. Shards are concatenated in the order their source was
+    first added, then by start.
+    """
+
+    def __init__(self, path, dtype=np.uint16):
+        self.path = Path(path)
+        (self.path / 'shards').mkdir(parents=True, exist_ok=True)
+        if (self.path / 'index.json').is_file():
+            with open(self.path / 'index.json') as f:
+                self.index = json.load(f)
+            assert np.dtype(self.index['dtype']) == np.dtype(dtype), 'dtype mismatch with the store'
+        else:
+            self.index = {'dtype': np.dtype(dtype).name, 'sources': [], 'shards': {}}
+        self.dtype = np.dtype(self.index['dtype'])
+
+    @staticmethod
+    def shard_key(split, source, start, end):
+        return f'{split}/{source}/{start}-{end}'
+
+    def _shard_filename(self, key):
+        return self.path / 'shards' / f'{hashlib.sha1(key.encode()).hexdigest()[:20]}.bin'
+
+    def _save_index(self):
+        tmp_filename = self.path / 'index.json.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.path / 'index.json')
+
+    def _commit(self, split, source, start, end, num_tokens):
+        key = self.shard_key(split, source, start, end)
+        self.index['shards'][key] = {'split': split, 'source': source, 'start': start,
+                                     'end': end, 'num_tokens': num_tokens}
+        self._save_index()
+
+    def _drop_stale_shards(self, tasks):
+        """Remove the shards that start where a task starts but end elsewhere, e.g. the last
+        (partial) shard of a source that got more examples since."""
+        task_keys = {self.shard_key(*task[:4]) for task in tasks}
+        task_starts = {tuple(task[:3]) for task in tasks}
+        stale = [key for key, shard in self.index['shards'].items()
+                 if (shard['split'], shard['source'], shard['start']) in task_starts
+                 and key not in task_keys]
+        for key in stale:
+            del self.index['shards'][key]
+            self._shard_filename(key).unlink(missing_ok=True)
+        if stale:
+            self._save_index()
+
+    def replace_source(self, source, new_source):
+        """Remove the shards of @source, and put @new_source in its place in the order of the
+        sources, e.g. for a source whose examples changed and must be tokenized again."""
+        stale = [key for key, shard in self.index['shards'].items() if shard['source'] == source]
+        for key in stale:
+            del self.index['shards'][key]
+            self._shard_filename(key).unlink(missing_ok=True)
+        sources = self.index['sources']
+        if source in sources:
+            if new_source in sources:
+                sources.remove(source)
+            else:
+                sources[sources.index(source)] = new_source
+        self._save_index()
+
+    def build(self, tasks, tokenize_fn, num_workers=1):
+        """Tokenize and commit the shards of @tasks that are not in the store yet.
+        Arguments:
+            tasks: list of (split, source, start, end, payload), where tokenize_fn(payload) returns
+                the 1D array of tokens of examples [start, end) of the source.
+            tokenize_fn: must be picklable if num_workers > 1, as shards are then tokenized by a
+                pool of @num_workers processes.
+        Return:
+            the number of shards that were tokenized.
+        """
+        self._drop_stale_shards(tasks)
+        for source in dict.fromkeys(task[1] for task in tasks):
+            if source not in self.index['sources']:
+                self.index['sources'].append(source)
+        todo = [task for task in tasks
+                if self.shard_key(*task[:4]) not in self.index['shards']
+                or not self._shard_filename(self.shard_key(*task[:4])).is_file()]
+        if num_workers <= 1:
+            for split, source, start, end, payload in todo:
+                filename = self._shard_filename(self.shard_key(split, source, start, end))
+                num_tokens = _tokenize_shard(filename, payload, self.dtype, tokenize_fn)
+                self._commit(split, source, start, end, num_tokens)
+        else:
+            with ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                     initargs=(tokenize_fn,)) as executor:
+                futures = {
+                    executor.submit(_tokenize_shard,
+                                    self._shard_filename(self.shard_key(*task[:4])), task[4],
+                                    self.dtype): task
+                    for task in todo
+                }
+                # Only this process writes the index
+                for future in as_completed(futures):
+                    self._commit(*futures[future][:4], future.result())
+        self._save_index()  # In case sources were added without any new shard
+        return len(todo)
+
+    def num_tokens(self, split):
+        return sum(shard['num_tokens'] for shard in self.index['shards'].values()
+                   if shard['split'] == split)
+
+    def tokens(self, split):
+        """All the tokens of @split, as a ConcatTokens of the memory-mapped shards."""
+        shards = sorted(
+            ((key, shard) for key, shard in self.index['shards'].items()
+             if shard['split'] == split),
+            key=lambda item: (self.index['sources'].index(item[1]['source']), item[1]['start'])
+        )
+        arrays = [np.memmap(self._shard_filename(key), dtype=self.dtype, mode='r')
+                  for key, shard in shards if shard['num_tokens'] > 0]
+        return ConcatTokens(arrays, self.dtype)
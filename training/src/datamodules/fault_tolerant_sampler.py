@@ -121,3 +121,98 @@ class FaultTolerantDistributedSampler(DistributedSampler):
 
         self.counter = 0
         # self.start_counter = self.counter
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(x):
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class FeistelPermutation:
+    """Keyed pseudo-random permutation of [0, n), computed one index at a time in O(1) memory.
+
+    A balanced Feistel network is a bijection over [0, 4^half_bits), which we restrict to [0, n)
+    by cycle-walking: re-encrypt until the value falls in [0, n). As 4^half_bits < 4n, this takes
+    fewer than 4 iterations on average.
+    """
+
+    def __init__(self, n, key, num_rounds=4):
+        self.n = n
+        self.half_bits = max(1, (max(n - 1, 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        self.round_keys = [_mix64((key * num_rounds + r) & _MASK64) for r in range(num_rounds)]
+
+    def __len__(self):
+        return self.n
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.half_mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ (_mix64(right ^ round_key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __call__(self, idx):
+        if not 0 <= idx < self.n:
+            raise IndexError(f'Index {idx} out of range for a permutation of {self.n}')
+        idx = self._encrypt(idx)
+        while idx >= self.n:
+            idx = self._encrypt(idx)
+        return idx
+
+
+class LazyPermutationFaultTolerantSampler(DistributedSampler):
+    """Fault-tolerant sampler that shuffles with a FeistelPermutation keyed by (seed, epoch)
+    instead of materializing torch.randperm(n).tolist(). Memory is O(1) in the size of the
+    dataset, and resuming from the middle of an epoch (load_state_dict) is O(1) as well.
+
+    Same state_dict / load_state_dict / set_epoch contract as FaultTolerantDistributedSampler, and
+    the same sharding across processes as DistributedSampler: process rank gets the indices at
+    positions rank, rank + num_replicas, ... of the permutation. If not drop_last, the last
+    positions wrap around to the beginning of the permutation so that all processes get
+    the same number of samples.
+    Like FaultTolerantDistributedSampler, this is a DistributedSampler so that Lightning doesn't
+    replace it (and shard its indices again) under DDP with replace_sampler_ddp.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=None,
+                 drop_last=False):
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if seed is None:
+            # As in RandomFaultTolerantSampler, reproducible if pl.seed_everything was called
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        # Only sets num_samples / total_size / epoch, the indices are never materialized
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle,
+                         seed=seed, drop_last=drop_last)
+        self.counter = 0
+        self.restarting = False
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "counter": self.counter}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict.get("seed", self.seed)
+        self.epoch = state_dict["epoch"]
+        self.counter = state_dict["counter"]
+        self.restarting = True
+
+    def __iter__(self) -> Iterator[int]:
+        n = len(self.dataset)
+        permutation = (FeistelPermutation(n, key=_mix64(self.seed & _MASK64) ^ self.epoch)
+                       if self.shuffle else None)
+        if not self.restarting:
+            self.counter = 0
+        self.restarting = False
+        for position in range(self.counter * self.num_replicas + self.rank, self.total_size,
+                              self.num_replicas):
+            self.counter += 1
+            yield permutation(position % n) if permutation is not None else position % n
+        self.counter = 0
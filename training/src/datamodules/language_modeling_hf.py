@@ -18,8 +18,12 @@ from datasets import load_dataset
 from pytorch_lightning import LightningDataModule
 
 from src.datamodules.datasets.lm_dataset import LMDataset
+from src.datamodules.datasets.packed_dataset import DocumentDataset, PackedBatchSampler
+from src.datamodules.datasets.packed_dataset import document_offsets_from_eos, packed_collate_fn
+from src.datamodules.datasets.token_store import ShardedTokenStore
 from src.datamodules.fault_tolerant_sampler import RandomFaultTolerantSampler
 from src.datamodules.fault_tolerant_sampler import FaultTolerantDistributedSampler
+from src.datamodules.fault_tolerant_sampler import LazyPermutationFaultTolerantSampler
 from src.datamodules.datasets.detokenizer import DATASET_TOKENIZATION_REGISTRY
 from src.utils.utils import get_logger
 logger = get_logger()
@@ -38,13 +42,54 @@ class SHMArray(np.ndarray): #copied from https://numpy.org/doc/stable/user/basic
         self.shm = getattr(obj, 'shm', None)
 
 
+class TokenizeRange:
+    """Tokenize examples [start, end) of a dataset into a flat array of token ids.
+    Picklable (unlike the lambdas in process_dataset), so that it can run in a process pool.
+    """
+
+    def __init__(self, tokenizer, text_column_name, add_eos, dtype):
+        self.tokenizer = tokenizer
+        self.text_column_name = text_column_name
+        self.add_eos = add_eos
+        self.dtype = dtype
+
+    def __call__(self, payload):
+        dataset, start, end = payload
+        texts = dataset[start:end][self.text_column_name]
+        if self.add_eos:
+            texts = [(seq + self.tokenizer.eos_token) if seq else seq for seq in texts]
+        return np.fromiter(chain(*self.tokenizer(texts)['input_ids']), dtype=self.dtype)
+
+
 class LMDataModule(LightningDataModule):
     def __init__(self, dataset_name, tokenizer_name, dataset_config_name=None, max_length=1024,
                  cache_dir=None, val_ratio=0.0005, val_split_seed=2357, add_eos=True,
                  detokenize=False, val_only=False, batch_size=32, batch_size_eval=None, num_workers=1,
                  shuffle=False, pin_memory=False, drop_last=False, fault_tolerant=False, ddp=False,
                  fast_forward_epochs=None, fast_forward_batches=None,
-                 use_shmem=True):
+                 use_shmem=True, use_token_store=False, examples_per_shard=10000,
+                 data_files=None, pack_documents=False, max_tokens=None,
+                 packing_lookahead=1024, lazy_permutation=False):
+        """
+        use_token_store: tokenize into a ShardedTokenStore in cache_dir, in parallel with
+            num_workers processes, one shard per examples_per_shard examples. Interrupted runs
+            resume from the shards already committed, and shards are only tokenized once.
+        data_files: list of data files to load with the dataset builder dataset_name (e.g. 'json'
+            or 'text'). With use_token_store, each file is a separate source with its own
+            train / validation split, so files appended to the list later are tokenized
+            incrementally. A file (or dataset) whose number of rows changed is tokenized again
+            from scratch, as its validation split is a shuffled split of all its rows.
+        pack_documents: instead of cutting the token stream into windows of max_length, pack
+            whole documents (split on the eos token, split further if longer than max_length)
+            into batches of at most max_tokens tokens (default batch_size * max_length).
+            Batches are dicts with cu_seqlens / max_seqlen / position_ids for GPTLMHeadModel.
+            The model must use learned position embeddings, as packed sequences don't support
+            rotary embeddings yet (SequenceLMModel checks this when the model is created).
+        packing_lookahead: number of documents that are packed together by
+            first-fit-decreasing.
+        lazy_permutation: with fault_tolerant, shuffle with LazyPermutationFaultTolerantSampler,
+            which doesn't materialize the permutation of the dataset (O(1) memory and resume).
+        """
         super().__init__()
         self.dataset_name = dataset_name
         self.dataset_config_name = dataset_config_name
@@ -76,6 +121,19 @@ class LMDataModule(LightningDataModule):
         self.use_shmem = use_shmem
         if self.use_shmem:
             assert cache_dir is not None
+        self.use_token_store = use_token_store
+        if self.use_token_store:
+            assert cache_dir is not None
+        self.examples_per_shard = examples_per_shard
+        self.data_files = data_files
+        self.pack_documents = pack_documents
+        if self.pack_documents:
+            assert add_eos, 'Documents are split on the eos token'
+            assert not fault_tolerant
+        self.max_tokens = max_tokens if max_tokens is not None else batch_size * max_length
+        assert self.max_tokens >= max_length
+        self.packing_lookahead = packing_lookahead
+        self.lazy_permutation = lazy_permutation
 
     def prepare_data(self):
         if self.cache_dir is None:  # Just download the dataset
@@ -89,44 +147,29 @@ class LMDataModule(LightningDataModule):
         concat_ids, self.tokenizer = self.process_dataset()
         self.vocab_size = len(self.tokenizer)
         # Create all splits
-        self.dataset_train, self.dataset_val, self.dataset_test = [
-            LMDataset(concat_ids[split], seq_len=self.max_length)
-            for split in ['train', 'validation', 'test']
-        ]
+        if self.pack_documents:
+            eos_token_id = self.tokenizer.eos_token_id
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                DocumentDataset(concat_ids[split],
+                                document_offsets_from_eos(concat_ids[split], eos_token_id),
+                                max_seqlen=self.max_length)
+                for split in ['train', 'validation', 'test']
+            ]
+        else:
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                LMDataset(concat_ids[split], seq_len=self.max_length)
+                for split in ['train', 'validation', 'test']
+            ]
 
     def process_dataset(self):
         cache_dir = None if self.cache_dir is None else self.cache_dir / self._cache_dir_name
+        if self.use_token_store:
+            return self._process_dataset_token_store(cache_dir)
         if cache_dir is not None:
             if cache_dir.is_dir():
                 return self._load_from_cache(cache_dir)
 
-        raw_datasets = load_dataset(self.dataset_name, self.dataset_config_name)
-        # https://github.com/stanford-crfm/mistral/blob/main/src/corpora/auto.py
-        if 'validation' not in raw_datasets:
-            assert "train" in raw_datasets, "You must have train in raw_datasets to make a validation raw_datasets"
-            raw_datasets = raw_datasets["train"].train_test_split(
-                test_size=self.val_ratio, seed=self.val_split_seed,
-                shuffle=True  # Otherwise test will be at the end of the dataset
-            )
-            raw_datasets['validation'] = raw_datasets['test']
-
-        if self.val_only:  # Should only be used for evaluation, not for training
-            raw_datasets['train'] = raw_datasets['validation']
-
-        # [2021-12-25] TD: Running the detokenizer on wikitext-103 makes ppl worse
-        # (GPT2-small val ppl after 10 epochs ~22 -> ~25)
-        # However, it's useful for zero-shot transfer from Openwebtext,
-        # as after detokenization it's closer to Openwebtext's format.
-        # https://github.com/stanford-crfm/mistral/issues/12
-        if self.detokenize:
-            if self.dataset_name in DATASET_TOKENIZATION_REGISTRY:
-                detokenizer = DATASET_TOKENIZATION_REGISTRY[self.dataset_name]
-                raw_datasets = raw_datasets.map(
-                    lambda example: {'text': detokenizer(example['text'])},
-                    num_proc=max(self.num_workers, 1),
-                    desc='Running detokenizer on dataset'
-                )
-
+        raw_datasets = self._load_raw_datasets(self.data_files)
         tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name, use_fast=True)
         # Preprocessing the datasets.
         # First we tokenize all the texts.
@@ -229,6 +272,75 @@ class LMDataModule(LightningDataModule):
                     Path(cache_dir / f'{name}.bin').unlink()
         return concat_ids, tokenizer
 
+    def _load_raw_datasets(self, data_files=None):
+        raw_datasets = load_dataset(self.dataset_name, self.dataset_config_name,
+                                    data_files=data_files)
+        # https://github.com/stanford-crfm/mistral/blob/main/src/corpora/auto.py
+        if 'validation' not in raw_datasets:
+            assert "train" in raw_datasets, "You must have train in raw_datasets to make a validation raw_datasets"
+            raw_datasets = raw_datasets["train"].train_test_split(
+                test_size=self.val_ratio, seed=self.val_split_seed,
+                shuffle=True  # Otherwise test will be at the end of the dataset
+            )
+            raw_datasets['validation'] = raw_datasets['test']
+
+        if self.val_only:  # Should only be used for evaluation, not for training
+            raw_datasets['train'] = raw_datasets['validation']
+
+        # [2021-12-25] TD: Running the detokenizer on wikitext-103 makes ppl worse
+        # (GPT2-small val ppl after 10 epochs ~22 -> ~25)
+        # However, it's useful for zero-shot transfer from Openwebtext,
+        # as after detokenization it's closer to Openwebtext's format.
+        # https://github.com/stanford-crfm/mistral/issues/12
+        if self.detokenize:
+            if self.dataset_name in DATASET_TOKENIZATION_REGISTRY:
+                detokenizer = DATASET_TOKENIZATION_REGISTRY[self.dataset_name]
+                raw_datasets = raw_datasets.map(
+                    lambda example: {'text': detokenizer(example['text'])},
+                    num_proc=max(self.num_workers, 1),
+                    desc='Running detokenizer on dataset'
+                )
+
+        return raw_datasets
+
+    def _process_dataset_token_store(self, cache_dir):
+        tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name, use_fast=True)
+        dtype = np.uint16 if tokenizer.vocab_size < 64 * 1024 else np.int32
+        store = ShardedTokenStore(cache_dir / 'token_store', dtype=dtype)
+        if self.data_files is not None:
+            sources = [(str(data_file), [str(data_file)]) for data_file in self.data_files]
+        else:
+            sources = [(self.dataset_name, None)]
+        for source, data_files in sources:
+            raw_datasets = self._load_raw_datasets(data_files)
+            # train_test_split shuffles all the rows, so the shards of a source are only valid
+            # for its number of rows: a source that grew is tokenized again, not extended.
+            num_rows = sum(len(ds) for ds in raw_datasets.values())
+            source_key = f'{source}@{num_rows}'
+            for stale in [s for s in store.index['sources']
+                          if s.rpartition('@')[0] == source and s != source_key]:
+                logger.info(f'Source {source} changed from {stale.rpartition("@")[2]} to '
+                            f'{num_rows} rows, tokenizing it again')
+                store.replace_source(stale, source_key)
+            column_names = raw_datasets['train'].column_names
+            text_column_name = 'text' if 'text' in column_names else column_names[0]
+            tasks = [
+                (split, source_key, start, min(start + self.examples_per_shard, len(ds)),
+                 (ds, start, min(start + self.examples_per_shard, len(ds))))
+                for split, ds in raw_datasets.items() if split in ['train', 'validation', 'test']
+                for start in range(0, len(ds), self.examples_per_shard)
+            ]
+            num_tokenized = store.build(
+                tasks, TokenizeRange(tokenizer, text_column_name, self.add_eos, dtype),
+                num_workers=max(self.num_workers, 1)
+            )
+            logger.info(f'Token store at {str(store.path)}: tokenized {num_tokenized} new shards '
+                        f'of {len(tasks)} for source {source}')
+        with open(cache_dir / 'tokenizer.pkl', 'wb') as f:
+            pickle.dump(tokenizer, f)
+        concat_ids = {split: store.tokens(split) for split in ['train', 'validation', 'test']}
+        return concat_ids, tokenizer
+
     def _save_to_cache(self, concat_ids, tokenizer, cache_dir):
         cache_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f'Saving to cache at {str(cache_dir)}')
@@ -252,10 +364,18 @@ class LMDataModule(LightningDataModule):
 
     def train_dataloader(self, *args: Any, **kwargs: Any) -> DataLoader:
         """ The train dataloader """
+        if self.pack_documents:
+            return self._packed_data_loader(self.dataset_train, shuffle=self.shuffle)
         if self.shuffle and self.fault_tolerant:
             shuffle = False
-            sampler = (FaultTolerantDistributedSampler(self.dataset_train) if self.ddp
-                       else RandomFaultTolerantSampler(self.dataset_train))
+            if self.lazy_permutation:
+                sampler = (LazyPermutationFaultTolerantSampler(self.dataset_train, seed=0)
+                           if self.ddp
+                           else LazyPermutationFaultTolerantSampler(self.dataset_train,
+                                                                    num_replicas=1, rank=0))
+            else:
+                sampler = (FaultTolerantDistributedSampler(self.dataset_train) if self.ddp
+                           else RandomFaultTolerantSampler(self.dataset_train))
             # TD [2022-08-06]: Only the DDP sampler supports fast-forwarding for now
             # We assume that it's being resumed with the same number of GPUs
             if self.ddp and self.fast_forward_epochs is not None and self.fast_forward_batches is not None:
@@ -271,10 +391,14 @@ class LMDataModule(LightningDataModule):
 
     def val_dataloader(self, *args: Any, **kwargs: Any) -> Union[DataLoader, List[DataLoader]]:
         """ The val dataloader """
+        if self.pack_documents:
+            return self._packed_data_loader(self.dataset_val)
         return self._data_loader(self.dataset_val, batch_size=self.batch_size_eval)
 
     def test_dataloader(self, *args: Any, **kwargs: Any) -> Union[DataLoader, List[DataLoader]]:
         """ The test dataloader """
+        if self.pack_documents:
+            return self._packed_data_loader(self.dataset_test)
         return self._data_loader(self.dataset_test, batch_size=self.batch_size_eval)
 
     def _data_loader(self, dataset: Dataset, batch_size: int, shuffle: bool = False,
@@ -290,6 +414,26 @@ class LMDataModule(LightningDataModule):
             # persistent_workers=True
         )
 
+    def _packed_data_loader(self, dataset: DocumentDataset, shuffle: bool = False) -> DataLoader:
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+        else:
+            num_replicas, rank = 1, 0
+        batch_sampler = PackedBatchSampler(dataset.lengths, self.max_tokens,
+                                           lookahead=self.packing_lookahead, shuffle=shuffle,
+                                           num_replicas=num_replicas, rank=rank,
+                                           drop_last=self.drop_last)
+        logger.info(f'Packed {len(dataset)} documents into {len(batch_sampler.bins)} batches of '
+                    f'{self.max_tokens} tokens, packing efficiency '
+                    f'{batch_sampler.packing_efficiency:.3f}')
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=packed_collate_fn,
+            num_workers=1,
+            pin_memory=self.pin_memory,
+        )
+
     def load_state_dict(self, checkpoint):
         if self.fault_tolerant:
             self.fast_forward_epochs = checkpoint['loops']['fit_loop']['epoch_progress']['current']['completed']
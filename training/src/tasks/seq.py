@@ -168,9 +168,24 @@ class SequenceModel(LightningModule):
 
 class SequenceLMModel(SequenceModel):
 
+    def instantiate_model(self):
+        super().instantiate_model()
+        if getattr(self._datamodule, 'pack_documents', False):
+            rotary_emb_fraction = getattr(getattr(self.model, 'config', None),
+                                          'rotary_emb_fraction', 0.0)
+            assert rotary_emb_fraction == 0.0, (
+                'pack_documents needs learned position embeddings (rotary_emb_fraction=0.0): '
+                "packed sequences (cu_seqlens) don't support rotary embeddings yet"
+            )
+
     def step(self, batch: Any, is_train=True):
-        x, y = batch
-        output = self.forward(x).logits
+        if isinstance(batch, dict):  # Packed documents, from packed_collate_fn
+            batch = dict(batch)
+            y = batch.pop('labels')
+            output = self.forward(**batch).logits
+        else:
+            x, y = batch
+            output = self.forward(x).logits
         output = rearrange(output, '... C -> (...) C')
         y = rearrange(y, '... -> (...)')
         loss = self.loss_fn(output, y) if is_train else self.loss_fn_val(output, y)
@@ -6,6 +6,7 @@ from typing import Iterable, Optional
 import weakref
 import copy
 import contextlib
+import threading
 
 import torch
 
@@ -278,3 +279,291 @@ class ExponentialMovingAverage:
                 "Tried to `load_state_dict()` with the wrong number of "
                 "parameters in the saved state."
             )
+
+
+# Number of elements of the parameters cast to float at once by _foreach_lerp_cast_
+_LERP_CHUNK_NUMEL = 1 << 24
+
+
+def _foreach_lerp_cast_(tensors, others, weight):
+    """torch._foreach_lerp_(tensors, others, weight), with others cast to the dtype of tensors
+    _LERP_CHUNK_NUMEL elements at a time (or one tensor at a time if larger), so that the casts
+    don't take as much memory as all the parameters."""
+    start, numel = 0, 0
+    for end, other in enumerate(others):
+        if end > start and numel + other.numel() > _LERP_CHUNK_NUMEL:
+            torch._foreach_lerp_(tensors[start:end],
+                                 [o.to(dtype=tensors[start].dtype) for o in others[start:end]],
+                                 weight)
+            start, numel = end, 0
+        numel += other.numel()
+    if start < len(others):
+        torch._foreach_lerp_(tensors[start:],
+                             [o.to(dtype=tensors[start].dtype) for o in others[start:]], weight)
+
+
+class _ShadowGroup:
+    """Shadow parameters of the parameters of one dtype and device, as views of a flat buffer."""
+
+    def __init__(self, idx, params, offload, pin_memory):
+        self.idx = idx
+        param_dtype = params[0].dtype
+        dtype = torch.float32 if param_dtype in [torch.float16, torch.bfloat16] else param_dtype
+        numel = sum(p.numel() for p in params)
+        device = torch.device('cpu') if offload else params[0].device
+        self.flat = torch.empty(numel, dtype=dtype, device=device, pin_memory=pin_memory)
+        self.set_views([p.shape for p in params])
+        with torch.no_grad():
+            for view, p in zip(self.views, params):
+                view.copy_(p)
+        # With offload, the parameters are copied there to be averaged on CPU
+        self.staging, self.staging_views = None, None
+        if offload:
+            self.staging = torch.empty(numel, dtype=param_dtype, pin_memory=pin_memory)
+            self.staging_views = [v.view(p.shape) for v, p in
+                                  zip(self.staging.split([p.numel() for p in params]), params)]
+
+    def set_views(self, shapes):
+        numels = [shape.numel() for shape in shapes]
+        self.views = [v.view(shape) for v, shape in zip(self.flat.split(numels), shapes)]
+
+
+class FlatExponentialMovingAverage(ExponentialMovingAverage):
+    """
+    ExponentialMovingAverage with the shadow parameters in one flat buffer per dtype, so that an
+    update is a few fused ops (torch._foreach_lerp_, over chunks of the parameters when they are
+    cast to float) instead of one op per parameter. store() / restore() swap the parameters' data with the averages instead
+    of cloning the parameters. state_dict() has the same format as ExponentialMovingAverage.
+    Args:
+        parameters: Iterable of `torch.nn.Parameter` (typically from
+            `model.parameters()`).
+        decay: The exponential decay.
+        use_num_updates: Whether to use number of updates when computing
+            averages.
+        offload: Whether to keep the shadow parameters in (pinned) CPU memory. The parameters are
+            then copied to CPU and averaged on a background thread, which overlaps with training.
+        update_every: Only average the parameters every `update_every` calls to update, with the
+            decay of all these steps (decay ** update_every), to reduce the overhead (e.g. the
+            copies to CPU with offload).
+    """
+    def __init__(
+        self,
+        parameters: Iterable[torch.nn.Parameter],
+        decay: float,
+        use_num_updates: bool = True,
+        offload: bool = False,
+        update_every: int = 1
+    ):
+        if decay < 0.0 or decay > 1.0:
+            raise ValueError('Decay must be between 0 and 1')
+        self.decay = decay
+        self.num_updates = 0 if use_num_updates else None
+        self.offload = offload
+        self.update_every = update_every
+        parameters = list(parameters)
+        # Filtered once, and not at every update
+        self._trainable_idx = [i for i, p in enumerate(parameters) if p.requires_grad]
+        trainable = [parameters[i] for i in self._trainable_idx]
+        pin_memory = offload and torch.cuda.is_available()
+        groups = {}
+        for i, p in enumerate(trainable):
+            groups.setdefault((p.dtype, p.device), []).append(i)
+        self._groups = [_ShadowGroup(idx, [trainable[i] for i in idx], offload, pin_memory)
+                        for idx in groups.values()]
+        self._pending_decay = 1.0
+        self._pending_steps = 0
+        self._thread = None
+        self._stored = False
+        self.collected_params = None
+        self._params_refs = [weakref.ref(p) for p in parameters]
+
+    @property
+    def shadow_params(self):
+        self._wait()
+        shadow_params = [None] * sum(len(group.idx) for group in self._groups)
+        for group in self._groups:
+            for i, view in zip(group.idx, group.views):
+                shadow_params[i] = view
+        return shadow_params
+
+    def _get_parameters(
+        self,
+        parameters: Optional[Iterable[torch.nn.Parameter]]
+    ) -> Iterable[torch.nn.Parameter]:
+        if parameters is None:
+            parameters = super()._get_parameters(parameters)
+            return [parameters[i] for i in self._trainable_idx]
+        return super()._get_parameters([p for p in parameters if p.requires_grad])
+
+    def _wait(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def update(
+        self,
+        parameters: Optional[Iterable[torch.nn.Parameter]] = None
+    ) -> None:
+        """
+        Update currently maintained parameters, see ExponentialMovingAverage.update. With
+        offload, this returns once the parameters are copied to CPU, and the average is computed
+        in the background.
+        """
+        parameters = self._get_parameters(parameters)
+        decay = self.decay
+        if self.num_updates is not None:
+            self.num_updates += 1
+            decay = min(
+                decay,
+                (1 + self.num_updates) / (10 + self.num_updates)
+            )
+        self._pending_decay *= decay
+        self._pending_steps += 1
+        if self._pending_steps < self.update_every:
+            return
+        one_minus_decay = 1.0 - self._pending_decay
+        self._pending_decay, self._pending_steps = 1.0, 0
+        if not self.offload and parameters[0].device != self._groups[0].flat.device:
+            self.to(device=parameters[0].device)
+        self._wait()  # The previous update is still reading the staging buffers
+        with torch.no_grad():
+            for group in self._groups:
+                params = [parameters[i].detach() for i in group.idx]
+                if group.staging is not None:
+                    # Straight into the staging buffer, without a flattened copy on the GPU
+                    for view, param in zip(group.staging_views, params):
+                        view.copy_(param, non_blocking=True)
+                elif params[0].dtype == group.flat.dtype:
+                    torch._foreach_lerp_(group.views, params, one_minus_decay)
+                else:
+                    _foreach_lerp_cast_(group.views, params, one_minus_decay)
+        if self.offload:
+            copy_done = None
+            if parameters[0].is_cuda:
+                copy_done = torch.cuda.Event()
+                copy_done.record()
+
+            def lerp_staging():
+                if copy_done is not None:
+                    copy_done.synchronize()
+                with torch.no_grad():
+                    for group in self._groups:
+                        if group.staging is not None:
+                            _foreach_lerp_cast_(group.views, group.staging_views,
+                                                one_minus_decay)
+
+            self._thread = threading.Thread(target=lerp_staging, daemon=True)
+            self._thread.start()
+
+    def copy_to(
+        self,
+        parameters: Optional[Iterable[torch.nn.Parameter]] = None
+    ) -> None:
+        """
+        Copy current averaged parameters into given collection of parameters. After store(),
+        the parameters' data is replaced by the averages instead (without copy if they have the
+        same dtype and device), the original data being kept by store().
+        """
+        self._wait()
+        parameters = self._get_parameters(parameters)
+        with torch.no_grad():
+            for group in self._groups:
+                for i, view in zip(group.idx, group.views):
+                    param = parameters[i]
+                    if self._stored:
+                        param.data = view.to(device=param.device, dtype=param.dtype)
+                    else:
+                        param.data.copy_(view)
+
+    def store(
+        self,
+        parameters: Optional[Iterable[torch.nn.Parameter]] = None
+    ) -> None:
+        """
+        Save the current parameters for restoring later. This only keeps a reference to the
+        parameters' data, which the following copy_to swaps with the averages.
+        """
+        parameters = self._get_parameters(parameters)
+        self.collected_params = [param.data for param in parameters]
+        self._stored = True
+
+    def restore(
+        self,
+        parameters: Optional[Iterable[torch.nn.Parameter]] = None
+    ) -> None:
+        """
+        Restore the parameters stored with the `store` method.
+        """
+        if self.collected_params is None:
+            raise RuntimeError(
+                "This ExponentialMovingAverage has no `store()`ed weights "
+                "to `restore()`"
+            )
+        parameters = self._get_parameters(parameters)
+        for c_param, param in zip(self.collected_params, parameters):
+            if self._stored:
+                param.data = c_param
+            else:  # Loaded from a state_dict
+                param.data.copy_(c_param)
+        self._stored = False
+
+    def to(self, device=None, dtype=None) -> None:
+        r"""Move the shadow parameters to `device`. With offload, they stay on CPU."""
+        self._wait()
+        for group in self._groups:
+            shapes = [view.shape for view in group.views]
+            if not self.offload:
+                group.flat = group.flat.to(device=device, dtype=dtype)
+            elif dtype is not None:
+                group.flat = group.flat.to(dtype=dtype)
+            group.set_views(shapes)
+        if self.collected_params is not None and not self._stored:
+            self.collected_params = [p.to(device=device, dtype=dtype)
+                                     if p.is_floating_point() else p.to(device=device)
+                                     for p in self.collected_params]
+
+    def state_dict(self) -> dict:
+        r"""Returns the state of the ExponentialMovingAverage as a dict, in the same format as
+        ExponentialMovingAverage (the shadow parameters are views of the flat buffers)."""
+        return {
+            "decay": self.decay,
+            "num_updates": self.num_updates,
+            "shadow_params": self.shadow_params,
+            "collected_params": self.collected_params
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        r"""Loads the state of an ExponentialMovingAverage or FlatExponentialMovingAverage.
+        Args:
+            state_dict (dict): EMA state. Should be an object returned
+                from a call to :meth:`state_dict`.
+        """
+        self._wait()
+        self.decay = state_dict["decay"]
+        if self.decay < 0.0 or self.decay > 1.0:
+            raise ValueError('Decay must be between 0 and 1')
+        self.num_updates = state_dict["num_updates"]
+        assert self.num_updates is None or isinstance(self.num_updates, int), \
+            "Invalid num_updates"
+        shadow_params = state_dict["shadow_params"]
+        assert isinstance(shadow_params, list), "shadow_params must be a list"
+        assert all(
+            isinstance(p, torch.Tensor) for p in shadow_params
+        ), "shadow_params must all be Tensors"
+        if len(shadow_params) != len(self._trainable_idx):
+            raise ValueError(
+                "Tried to `load_state_dict()` with the wrong number of "
+                "parameters in the saved state."
+            )
+        with torch.no_grad():
+            for view, p in zip(self.shadow_params, shadow_params):
+                view.copy_(p)
+        self.collected_params = state_dict["collected_params"]
+        self._stored = False
+        if self.collected_params is not None:
+            assert isinstance(self.collected_params, list), \
+                "collected_params must be a list"
+            assert len(self.collected_params) == len(shadow_params), \
+                "collected_params and shadow_params had different lengths"
+            # Copies, to be consistent with module API
+            self.collected_params = [p.clone() for p in self.collected_params]
@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from src.datamodules.fault_tolerant_sampler import FaultTolerantDistributedSampler
+from src.datamodules.fault_tolerant_sampler import FeistelPermutation
+from src.datamodules.fault_tolerant_sampler import LazyPermutationFaultTolerantSampler
+
+
+class TestLazyPermutationSampler:
+
+    @pytest.mark.parametrize('n', [1, 2, 3, 16, 17, 1000, 4097])
+    def test_feistel_permutation(self, n):
+        permutation = FeistelPermutation(n, key=1234)
+        indices = [permutation(i) for i in range(n)]
+        assert sorted(indices) == list(range(n))
+        assert indices == [FeistelPermutation(n, key=1234)(i) for i in range(n)]
+        if n >= 16:
+            assert indices != [FeistelPermutation(n, key=4321)(i) for i in range(n)]
+            assert indices != list(range(n))
+        with pytest.raises(IndexError):
+            permutation(n)
+
+    def test_resume(self):
+        dataset = list(range(100))
+        sampler = LazyPermutationFaultTolerantSampler(dataset, num_replicas=1, rank=0, seed=0)
+        indices = list(sampler)
+        assert sorted(indices) == dataset
+        it = iter(sampler)
+        for _ in range(37):
+            next(it)
+        state_dict = sampler.state_dict()
+        assert state_dict['counter'] == 37
+        sampler = LazyPermutationFaultTolerantSampler(dataset, num_replicas=1, rank=0, seed=1)
+        sampler.load_state_dict(state_dict)
+        assert list(sampler) == indices[37:]
+        # The next epoch is a full, different permutation
+        sampler.set_epoch(1)
+        indices_1 = list(sampler)
+        assert sorted(indices_1) == dataset and indices_1 != indices
+
+    @pytest.mark.parametrize('drop_last', [False, True])
+    @pytest.mark.parametrize('num_replicas', [1, 3, 8])
+    def test_distributed(self, num_replicas, drop_last):
+        dataset = list(range(101))
+        samplers = [LazyPermutationFaultTolerantSampler(dataset, num_replicas=num_replicas,
+                                                        rank=rank, seed=0, drop_last=drop_last)
+                    for rank in range(num_replicas)]
+        indices = [list(s) for s in samplers]
+        assert all(len(idx) == len(s) for idx, s in zip(indices, samplers))
+        assert len({len(idx) for idx in indices}) == 1
+        ref = [FaultTolerantDistributedSampler(dataset, num_replicas=num_replicas, rank=rank,
+                                               shuffle=False, drop_last=drop_last)
+               for rank in range(num_replicas)]
+        # Same sharding as DistributedSampler, up to the permutation
+        for sampler, ref_sampler in zip(samplers, ref):
+            sampler.shuffle = False
+            assert list(sampler) == list(ref_sampler)
+        all_indices = [i for idx in indices for i in idx]
+        if drop_last:
+            assert len(set(all_indices)) == len(all_indices)
+        else:
+            assert set(all_indices) == set(dataset)
+
+    def test_not_replaced_under_ddp(self):
+        pl = pytest.importorskip('pytorch_lightning')
+        dataset = list(range(101))
+        sampler = LazyPermutationFaultTolerantSampler(dataset, num_replicas=2, rank=1, seed=0)
+        assert isinstance(sampler, torch.utils.data.DistributedSampler)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=4, sampler=sampler)
+        trainer = pl.Trainer(accelerator='cpu', devices=2, strategy='ddp', logger=False,
+                             enable_checkpointing=False, replace_sampler_ddp=True)
+        # Otherwise Lightning wraps it in a DistributedSamplerWrapper, which lists all the
+        # indices and shards them across processes a second time
+        assert not trainer._data_connector._requires_distributed_sampler(loader)
+        assert trainer._data_connector._prepare_dataloader(loader, shuffle=True) is loader
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import torch
+
+from src.datamodules.datasets.packed_dataset import DocumentDataset, PackedBatchSampler
+from src.datamodules.datasets.packed_dataset import document_offsets_from_eos
+from src.datamodules.datasets.packed_dataset import pack_first_fit_decreasing, packed_collate_fn
+
+
+class TestPackedDataset:
+
+    def test_document_offsets_from_eos(self):
+        eos = 0
+        tokens = np.array([5, 6, 0, 7, 0, 0, 8, 9])
+        for chunk_size in [1, 3, 100]:
+            offsets = document_offsets_from_eos(tokens, eos, chunk_size=chunk_size)
+            assert offsets.tolist() == [0, 3, 5, 6, 8]
+        assert document_offsets_from_eos(tokens[:5], eos).tolist() == [0, 3, 5]
+
+    def test_document_dataset(self):
+        tokens = np.arange(100)
+        # Documents of 12, 1, 3 and 84 tokens
+        dataset = DocumentDataset(tokens, [0, 12, 13, 16, 100], max_seqlen=32)
+        # 11 + 2 + 83 inputs, the 83 are split into 32 + 32 + 19
+        assert dataset.lengths.tolist() == [11, 2, 32, 32, 19]
+        x, y = dataset[0]
+        assert x.tolist() == list(range(11)) and y.tolist() == list(range(1, 12))
+        x, y = dataset[4]
+        assert x.tolist() == list(range(80, 99)) and y.tolist() == list(range(81, 100))
+        # Labels never cross a document boundary
+        for i in range(len(dataset)):
+            x, y = dataset[i]
+            assert torch.equal(x + 1, y)
+
+    @pytest.mark.parametrize('lookahead', [1, 4, 1000])
+    def test_pack_first_fit_decreasing(self, lookahead):
+        rng = np.random.default_rng(0)
+        lengths = rng.integers(1, 65, size=200)
+        bins = pack_first_fit_decreasing(lengths, 64, lookahead=lookahead)
+        assert sorted(i for b in bins for i in b) == list(range(200))
+        assert all(lengths[b].sum() <= 64 for b in bins)
+        if lookahead == 1:
+            assert len(bins) == 200
+        else:
+            # First-fit-decreasing uses at most 11/9 OPT + 1 bins per window
+            lower_bound = int(np.ceil(lengths.sum() / 64))
+            assert len(bins) <= 11 / 9 * lower_bound + 200 // lookahead + 2
+
+    def test_packed_batch_sampler(self):
+        lengths = np.array([60, 10, 50, 30, 40, 20, 64, 5])
+        sampler = PackedBatchSampler(lengths, 64, lookahead=8)
+        assert sorted(len(b) for b in sampler) == [1, 1, 2, 2, 2]
+        assert sampler.packing_efficiency == pytest.approx(lengths.sum() / (5 * 64))
+        # Each replica gets the same number of batches
+        samplers = [PackedBatchSampler(lengths, 64, num_replicas=2, rank=rank) for rank in [0, 1]]
+        assert [len(list(s)) for s in samplers] == [3, 3]
+        samplers = [PackedBatchSampler(lengths, 64, num_replicas=2, rank=rank, drop_last=True)
+                    for rank in [0, 1]]
+        batches = [b for s in samplers for b in s]
+        indices = [i for b in batches for i in b]
+        assert len(batches) == 4 and len(indices) == len(set(indices))
+        # Shuffling changes with the epoch, and all documents are still there
+        sampler = PackedBatchSampler(lengths, 64, shuffle=True)
+        epoch0 = list(sampler)
+        sampler.set_epoch(1)
+        assert sorted(i for b in sampler for i in b) == list(range(8))
+        assert sorted(i for b in epoch0 for i in b) == list(range(8))
+
+    def test_packed_batch_sampler_ddp(self):
+        # Under DDP with replace_sampler_ddp, Lightning re-creates the batch sampler of the
+        # dataloaders it gets from the hooks, passing its DistributedSampler as sampler
+        lightning_lite_data = pytest.importorskip('lightning_lite.utilities.data')
+        pl_data = pytest.importorskip('pytorch_lightning.utilities.data')
+        dataset = DocumentDataset(np.arange(100), [0, 12, 13, 16, 40, 41, 100], max_seqlen=32)
+        with lightning_lite_data._replace_dunder_methods(torch.utils.data.DataLoader, 'dataset'), \
+                lightning_lite_data._replace_dunder_methods(torch.utils.data.BatchSampler):
+            batch_sampler = PackedBatchSampler(dataset.lengths, 40, shuffle=True, num_replicas=2,
+                                               rank=1)
+            loader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler,
+                                                 collate_fn=packed_collate_fn)
+        sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=2, rank=1,
+                                                      shuffle=False)
+        loader_ddp = pl_data._update_dataloader(loader, sampler)
+        assert type(loader_ddp.batch_sampler) is PackedBatchSampler
+        assert list(loader_ddp.batch_sampler) == list(batch_sampler)
+        for batch, batch_ref in zip(loader_ddp, loader):
+            assert torch.equal(batch['input_ids'], batch_ref['input_ids'])
+
+    def test_packed_collate_fn(self):
+        dataset = DocumentDataset(np.arange(100), [0, 12, 13, 16, 100], max_seqlen=32)
+        batch = packed_collate_fn([dataset[i] for i in [0, 1, 4]])
+        assert batch['input_ids'].shape == batch['labels'].shape == (1, 11 + 2 + 19)
+        assert batch['cu_seqlens'].tolist() == [0, 11, 13, 32]
+        assert batch['cu_seqlens'].dtype == torch.int32
+        assert batch['max_seqlen'] == 19
+        assert batch['position_ids'][0].tolist() == list(range(11)) + [0, 1] + list(range(19))
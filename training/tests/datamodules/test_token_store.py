@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+import pytest
+
+from src.datamodules.datasets.lm_dataset import LMDataset
+from src.datamodules.datasets.token_store import ConcatTokens, ShardedTokenStore
+
+
+def tokenize(payload):
+    # Each example i is tokenized to i % 7 + 1 tokens, all equal to i
+    examples, start, end = payload
+    return np.concatenate([np.full(examples[i] % 7 + 1, examples[i]) for i in range(start, end)])
+
+
+def make_tasks(source, num_examples, examples_per_shard, split='train'):
+    examples = list(range(num_examples))
+    return [(split, source, start, min(start + examples_per_shard, num_examples),
+             (examples, start, min(start + examples_per_shard, num_examples)))
+            for start in range(0, num_examples, examples_per_shard)]
+
+
+class TestShardedTokenStore:
+
+    def test_concat_tokens(self):
+        arrays = [np.arange(0, 5), np.arange(5, 5), np.arange(5, 12), np.arange(12, 13)]
+        tokens = ConcatTokens(arrays, np.int64)
+        ref = np.arange(13)
+        assert len(tokens) == 13
+        for start in range(14):
+            for stop in range(start, 14):
+                assert np.array_equal(tokens[start:stop], ref[start:stop])
+        assert tokens[-1] == 12 and tokens[6] == 6
+        # Slices inside an array are views
+        assert np.shares_memory(tokens[6:9], arrays[2])
+        with pytest.raises(IndexError):
+            tokens[13]
+
+    @pytest.mark.parametrize('num_workers', [1, 2])
+    def test_build_resume_append(self, tmp_path, num_workers):
+        store = ShardedTokenStore(tmp_path, dtype=np.uint16)
+        tasks = make_tasks('a', 25, 10)
+        assert store.build(tasks, tokenize, num_workers=num_workers) == 3
+        ref = tokenize((list(range(25)), 0, 25))
+        assert np.array_equal(store.tokens('train')[:], ref)
+        # Resuming doesn't tokenize anything, even from a new store object
+        store = ShardedTokenStore(tmp_path, dtype=np.uint16)
+        assert store.build(tasks, tokenize, num_workers=num_workers) == 0
+        # The source grew: only the last (partial) shard and the new shards are tokenized
+        assert store.build(make_tasks('a', 42, 10), tokenize, num_workers=num_workers) == 3
+        # A new source is appended after the first one
+        assert store.build(make_tasks('b', 5, 10), tokenize, num_workers=num_workers) == 1
+        ref = np.concatenate([tokenize((list(range(42)), 0, 42)), tokenize((list(range(5)), 0, 5))])
+        assert np.array_equal(store.tokens('train')[:], ref)
+        assert store.num_tokens('train') == len(ref)
+        assert len(list((tmp_path / 'shards').glob('*.bin'))) == 5 + 1
+
+    def test_replace_source(self, tmp_path):
+        store = ShardedTokenStore(tmp_path)
+        store.build(make_tasks('a@25', 25, 10), tokenize)
+        store.build(make_tasks('b@5', 5, 10), tokenize)
+        # The examples of a changed, e.g. its split was reshuffled: all its shards are dropped
+        store.replace_source('a@25', 'a@42')
+        assert store.num_tokens('train') == len(tokenize((list(range(5)), 0, 5)))
+        assert len(list((tmp_path / 'shards').glob('*.bin'))) == 1
+        examples = list(range(100, 142))
+        tasks = [(split, 'a@42', start, end, (examples, start, end))
+                 for split, _, start, end, _ in make_tasks('a@42', 42, 10)]
+        assert store.build(tasks, tokenize) == 5
+        # a is still the first source
+        ref = np.concatenate([tokenize((examples, 0, 42)), tokenize((list(range(5)), 0, 5))])
+        assert np.array_equal(store.tokens('train')[:], ref)
+        assert ShardedTokenStore(tmp_path).index['sources'] == ['a@42', 'b@5']
+
+    def test_interrupted_build(self, tmp_path):
+        store = ShardedTokenStore(tmp_path)
+        tasks = make_tasks('a', 30, 10)
+
+        def tokenize_and_fail(payload):
+            if payload[1] == 20:
+                raise KeyboardInterrupt
+            return tokenize(payload)
+
+        with pytest.raises(KeyboardInterrupt):
+            store.build(tasks, tokenize_and_fail)
+        with open(tmp_path / 'index.json') as f:
+            assert len(json.load(f)['shards']) == 2
+        store = ShardedTokenStore(tmp_path)
+        assert store.build(tasks, tokenize) == 1
+        assert np.array_equal(store.tokens('train')[:], tokenize((list(range(30)), 0, 30)))
+
+    def test_lm_dataset(self, tmp_path):
+        store = ShardedTokenStore(tmp_path)
+        store.build(make_tasks('a', 100, 7), tokenize)
+        tokens = store.tokens('train')
+        ref = tokenize((list(range(100)), 0, 100))
+        dataset, dataset_ref = LMDataset(tokens, seq_len=16), LMDataset(ref, seq_len=16)
+        assert len(dataset) == len(dataset_ref)
+        for i in range(len(dataset)):
+            x, y = dataset[i]
+            x_ref, y_ref = dataset_ref[i]
+            assert (x == x_ref).all() and (y == y_ref).all()
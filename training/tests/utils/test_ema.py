@@ -0,0 +1,102 @@
+import pytest
+import torch
+
+from src.utils.ema import ExponentialMovingAverage, FlatExponentialMovingAverage
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4, bias=False))
+    model[1].to(dtype=torch.bfloat16)
+    model[0].bias.requires_grad_(False)
+    return model
+
+
+def perturb(model):
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p))
+
+
+class TestFlatExponentialMovingAverage:
+
+    @pytest.mark.parametrize('offload', [False, True])
+    @pytest.mark.parametrize('use_num_updates', [False, True])
+    def test_update(self, use_num_updates, offload):
+        model, model_ref = make_model(), make_model()
+        ema = FlatExponentialMovingAverage(model.parameters(), decay=0.9,
+                                           use_num_updates=use_num_updates, offload=offload)
+        ema_ref = ExponentialMovingAverage(model_ref.parameters(), decay=0.9,
+                                           use_num_updates=use_num_updates)
+        for _ in range(5):
+            perturb(model)
+            model_ref.load_state_dict(model.state_dict())
+            ema.update()
+            ema_ref.update([p for p in model_ref.parameters() if p.requires_grad])
+        assert len(ema.shadow_params) == len(ema_ref.shadow_params) == 2
+        for s, s_ref in zip(ema.shadow_params, ema_ref.shadow_params):
+            assert s.dtype == torch.float32
+            assert torch.allclose(s, s_ref.cpu(), rtol=1e-5, atol=1e-6)
+
+    @pytest.mark.parametrize('offload', [False, True])
+    def test_update_chunked(self, monkeypatch, offload):
+        # bf16 parameters are cast to float a few at a time
+        monkeypatch.setattr('src.utils.ema._LERP_CHUNK_NUMEL', 100)
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(*[torch.nn.Linear(8, 8) for _ in range(4)]).to(torch.bfloat16)
+        ema = FlatExponentialMovingAverage(model.parameters(), decay=0.9, offload=offload)
+        ema_ref = ExponentialMovingAverage(model.parameters(), decay=0.9)
+        for _ in range(3):
+            perturb(model)
+            ema.update()
+            ema_ref.update()
+        for s, s_ref in zip(ema.shadow_params, ema_ref.shadow_params):
+            assert torch.allclose(s, s_ref.cpu(), rtol=1e-5, atol=1e-6)
+
+    def test_update_every(self):
+        model = make_model()
+        ema = FlatExponentialMovingAverage(model.parameters(), decay=0.9, use_num_updates=False,
+                                           update_every=3)
+        shadow_init = [s.clone() for s in ema.shadow_params]
+        perturb(model)
+        ema.update()
+        ema.update()
+        for s, s_init in zip(ema.shadow_params, shadow_init):
+            assert torch.equal(s, s_init)
+        ema.update()
+        params = [model[0].weight, model[1].weight]
+        for s, s_init, p in zip(ema.shadow_params, shadow_init, params):
+            assert torch.allclose(s, torch.lerp(s_init, p.float(), 1 - 0.9 ** 3), atol=1e-6)
+
+    @pytest.mark.parametrize('offload', [False, True])
+    def test_store_restore(self, offload):
+        model = make_model()
+        ema = FlatExponentialMovingAverage(model.parameters(), decay=0.5, offload=offload)
+        perturb(model)
+        ema.update()
+        params = [p.detach().clone() for p in model.parameters()]
+        with ema.average_parameters():
+            assert torch.equal(model[0].weight, ema.shadow_params[0])
+            assert torch.equal(model[1].weight, ema.shadow_params[1].to(torch.bfloat16))
+            assert model[1].weight.dtype == torch.bfloat16
+            assert torch.equal(model[0].bias, params[1])  # Not averaged
+        for p, p_og in zip(model.parameters(), params):
+            assert torch.equal(p, p_og)
+
+    def test_state_dict(self):
+        model = make_model()
+        ema = FlatExponentialMovingAverage(model.parameters(), decay=0.9)
+        perturb(model)
+        ema.update()
+        # Compatible with ExponentialMovingAverage both ways
+        trainable = [p for p in model.parameters() if p.requires_grad]
+        ema_ref = ExponentialMovingAverage(trainable, decay=0.5)
+        ema_ref.load_state_dict(ema.state_dict())
+        assert ema_ref.decay == 0.9 and ema_ref.num_updates == 1
+        ema_loaded = FlatExponentialMovingAverage(model.parameters(), decay=0.5, offload=True)
+        ema_loaded.load_state_dict(ema_ref.state_dict())
+        for s, s_ref, s_loaded in zip(ema.shadow_params, ema_ref.shadow_params,
+                                      ema_loaded.shadow_params):
+            # ExponentialMovingAverage casts the shadow params to the dtype of the params on load
+            assert torch.allclose(s, s_ref, rtol=1e-2)
+            assert torch.equal(s_ref, s_loaded)